@@ -0,0 +1,361 @@
+"""Benchmark the stages of adept_core.execute on synthetic data.
+
+The synthetic workload is built with the same helpers as the smoke tests
+(natcap.opal.tests.vector/raster and test_smoke.square/subdivide), scaled by
+the number of ecosystem parcels, impact sites and servicesheds and by the size
+of the static map rasters.  Each stage of adept_core.execute is timed by
+wrapping the function that implements it, so the timings are for the stages
+as execute() calls them.  Stages called from within another stage (such as
+locate_intersecting_polygons within prepare_offset_parcels) are counted as
+part of the outer stage.
+
+Results are written as JSON (every repeat, plus the parameters, commit and
+platform) and appended to a CSV (one row per stage per run) so that runs can
+be compared across commits.
+
+Example:
+    python scripts/benchmark_pipeline.py --parcels 2000 --impacts 20 \\
+        --servicesheds 16 --raster-size 2000 --repeat 3 \\
+        --output benchmark_results
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+import contextlib
+import logging
+
+import numpy
+from shapely.geometry import box
+
+from natcap.opal.tests import vector, raster, COLOMBIA_SRS
+from natcap.opal.tests.test_smoke import square, subdivide
+from natcap.opal import adept_core
+from natcap.opal import preprocessing
+from natcap.opal import analysis
+from natcap.opal import offsets
+
+LOGGER = logging.getLogger('natcap.opal.benchmark')
+
+# The width and height of the synthetic hydrozone, in meters.
+AREA_WIDTH = 20000
+AREA_HEIGHT = 40000
+
+# (stage name, module, function name) for each timed stage, in the order the
+# stages first run in adept_core.execute().
+STAGES = [
+    ('prepare_parcels', preprocessing, 'prepare_offset_parcels'),
+    ('locate', preprocessing, 'locate_intersecting_polygons'),
+    ('subtract', preprocessing, 'subtract_vectors'),
+    ('aggregate', analysis, 'aggregate_stats_multi'),
+    ('biodiversity_impact', analysis, 'calculate_biodiversity_impact'),
+    ('selection', offsets, '_select_offsets'),
+    ('percent_overlap', analysis, 'percent_overlap'),
+    ('report', adept_core, 'build_report'),
+]
+
+CSV_COLUMNS = ['commit', 'timestamp', 'parcels', 'impacts', 'servicesheds',
+    'raster_size', 'offset_scheme', 'repeat', 'stage', 'calls', 'seconds']
+
+
+def git_commit():
+    """Get the hash of the commit the repository is at, or 'unknown'."""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=repo_dir).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain',
+            '--untracked-files=no'], cwd=repo_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def build_workload(data_dir, n_parcels, n_impacts, n_servicesheds,
+        raster_size, seed=0):
+    """Build a synthetic dataset for adept_core.execute.
+
+        data_dir - a folder to write the dataset to.  The tool data is
+            written to data_dir/data, where execute() expects it.
+        n_parcels - the approximate number of natural ecosystem parcels.
+        n_impacts - the number of impact sites.
+        n_servicesheds - the approximate number of servicesheds.
+        raster_size - the number of rows and columns in each raster.
+        seed=0 - the seed for the impact site locations and raster values.
+
+    Returns a dictionary of args for adept_core.execute(), without a
+    workspace_dir."""
+
+    rng = random.Random(seed)
+    numpy_rng = numpy.random.RandomState(seed)
+    static_dir = os.path.join(data_dir, 'data', 'colombia_static_data')
+    tool_dir = os.path.join(data_dir, 'data', 'colombia_tool_data')
+    for dirname in [static_dir, tool_dir]:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    search_area = box(0, 0, AREA_WIDTH, AREA_HEIGHT)
+
+    def _side_length(count):
+        return max(1, int((AREA_WIDTH * AREA_HEIGHT / float(count)) ** 0.5))
+
+    # servicesheds and municipalities
+    servicesheds = subdivide(search_area, _side_length(n_servicesheds))
+    vector(servicesheds, COLOMBIA_SRS, {'pop_center': str, 'pop_size': int},
+        [{'pop_center': str(i), 'pop_size': i * 1000}
+         for i in range(len(servicesheds))],
+        format='ESRI Shapefile',
+        filename=os.path.join(tool_dir, 'ssheds_Col_new.shp'))
+    municipalities = subdivide(search_area, 5000)
+    vector(municipalities, COLOMBIA_SRS, format='ESRI Shapefile',
+        filename=os.path.join(tool_dir, 'Municipalities.shp'))
+
+    # hydro subzones, all in a single hydrozone.
+    subzones = subdivide(search_area, 5000)
+    hydro_subzones = vector(subzones, COLOMBIA_SRS, {'zone': str},
+        [{'zone': 'Hydrozone_A'}] * len(subzones), format='ESRI Shapefile',
+        filename=os.path.join(data_dir, 'hydro_subzones.shp'))
+
+    # natural ecosystem parcels, with a gap between neighbors so that the LCI
+    # varies.
+    parcel_side = _side_length(n_parcels)
+    parcels = [square(cell.centroid.coords[0], parcel_side * 0.8)
+        for cell in subdivide(search_area, parcel_side)]
+    ecosystems = vector(parcels, COLOMBIA_SRS,
+        {'ecosystem': str, 'mit_ratio': float},
+        [{'ecosystem': 'Eco_%s' % 'AB'[i % 2], 'mit_ratio': 4.5}
+         for i in range(len(parcels))],
+        format='ESRI Shapefile',
+        filename=os.path.join(data_dir, 'ecosystems.shp'))
+
+    # impact sites, kept away from the edge of the hydrozone.
+    impacts = []
+    for _ in range(n_impacts):
+        side_length = rng.uniform(500, 2000)
+        impacts.append(square(
+            (rng.uniform(2000, AREA_WIDTH - 2000),
+             rng.uniform(2000, AREA_HEIGHT - 2000)), side_length))
+    impact_sites = vector(impacts, COLOMBIA_SRS, {'FID': int},
+        [{'FID': i} for i in range(len(impacts))], format='ESRI Shapefile',
+        filename=os.path.join(data_dir, 'impacts.shp'))
+
+    # north-up rasters covering the whole hydrozone.
+    pixel_size = max(AREA_WIDTH, AREA_HEIGHT) / float(raster_size)
+    geotransform = [0, pixel_size, 0, AREA_HEIGHT, 0, -pixel_size]
+
+    def _raster(filename):
+        values = numpy_rng.uniform(0.5, 1.5,
+            (raster_size, raster_size)).astype(numpy.float32)
+        return raster(values, COLOMBIA_SRS, geotransform, -1,
+            filename=filename)
+
+    for model_name in ['carbon', 'sediment', 'nutrient']:
+        for scenario in ['paved', 'bare', 'protection']:
+            _raster(os.path.join(static_dir, '%s_%s_static_map_lzw.tif' % (
+                model_name, scenario)))
+            if model_name == 'nutrient':
+                _raster(os.path.join(static_dir, '%s_%s_pts.tif' % (
+                    model_name, scenario)))
+
+    return {
+        'project_footprint_uri': impact_sites,
+        'impact_type': 'Road/Paved',
+        'ecosystems_map_uri': ecosystems,
+        'search_areas_uri': hydro_subzones,
+        'threat_map': _raster(os.path.join(data_dir, 'threat.tif')),
+        'richness_map': _raster(os.path.join(data_dir, 'richness.tif')),
+        'data_dir': data_dir,
+        'cache_dir': None,
+        'n_workers': 1,
+    }
+
+
+@contextlib.contextmanager
+def timed_stages(timings):
+    """Time calls to the functions in STAGES while in this context.
+
+        timings - a dictionary.  Each stage name is mapped to a list of
+            [number of calls, total seconds].  Calls made while another stage
+            is running are counted as part of the outer stage.
+    """
+    active = []
+
+    def _wrap(stage_name, function):
+        def _timed(*args, **kwargs):
+            if len(active) > 0:
+                return function(*args, **kwargs)
+            active.append(stage_name)
+            start_time = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage_timing = timings.setdefault(stage_name, [0, 0.0])
+                stage_timing[0] += 1
+                stage_timing[1] += time.time() - start_time
+                active.pop()
+        return _timed
+
+    originals = []
+    for stage_name, module, function_name in STAGES:
+        function = getattr(module, function_name)
+        originals.append((module, function_name, function))
+        setattr(module, function_name, _wrap(stage_name, function))
+    try:
+        yield
+    finally:
+        for module, function_name, function in originals:
+            setattr(module, function_name, function)
+
+
+def run_benchmark(args, workspace, repeat):
+    """Run adept_core.execute repeatedly, timing each stage.
+
+        args - the args dictionary from build_workload().
+        workspace - a folder for the model workspaces.
+        repeat - the number of times to run the model.
+
+    Returns a list with a dictionary mapping stage names to (calls, seconds)
+    for each run.  The whole run is recorded as the 'execute' stage."""
+    runs = []
+    for run_index in range(repeat):
+        run_args = args.copy()
+        run_args['workspace_dir'] = os.path.join(workspace,
+            'run_%s' % run_index)
+        if os.path.exists(run_args['workspace_dir']):
+            shutil.rmtree(run_args['workspace_dir'])
+
+        timings = {}
+        start_time = time.time()
+        with timed_stages(timings):
+            adept_core.execute(run_args)
+        timings['execute'] = [1, time.time() - start_time]
+        runs.append(timings)
+        LOGGER.info('Run %s took %.2fs', run_index, timings['execute'][1])
+    return runs
+
+
+def write_results(output_base, parameters, runs):
+    """Write the benchmark results to output_base.json and append them to
+    output_base.csv.
+
+        output_base - the path of the output files, without an extension.
+        parameters - a dictionary of the workload parameters.
+        runs - the list returned by run_benchmark().
+
+    Returns nothing."""
+    commit = git_commit()
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    stage_names = [name for (name, _, _) in STAGES] + ['execute']
+
+    summary = {}
+    for stage_name in stage_names:
+        seconds = [run[stage_name][1] for run in runs if stage_name in run]
+        if len(seconds) == 0:
+            continue
+        summary[stage_name] = {
+            'calls': runs[0].get(stage_name, [0])[0],
+            'min': min(seconds),
+            'median': float(numpy.median(seconds)),
+            'max': max(seconds),
+        }
+
+    results = {
+        'commit': commit,
+        'timestamp': timestamp,
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'parameters': parameters,
+        'stages': summary,
+        'runs': runs,
+    }
+    with open(output_base + '.json', 'w') as json_file:
+        json.dump(results, json_file, indent=4, sort_keys=True)
+
+    csv_uri = output_base + '.csv'
+    write_header = not os.path.exists(csv_uri)
+    with open(csv_uri, 'a') as csv_file:
+        if write_header:
+            csv_file.write(','.join(CSV_COLUMNS) + '\n')
+        for repeat_index, run in enumerate(runs):
+            for stage_name in stage_names:
+                if stage_name not in run:
+                    continue
+                row = dict(parameters)
+                row.update({
+                    'commit': commit,
+                    'timestamp': timestamp,
+                    'repeat': repeat_index,
+                    'stage': stage_name,
+                    'calls': run[stage_name][0],
+                    'seconds': '%.4f' % run[stage_name][1],
+                })
+                csv_file.write(','.join(str(row[column])
+                    for column in CSV_COLUMNS) + '\n')
+
+    for stage_name in stage_names:
+        if stage_name in summary:
+            print '%-20s %4s calls %10.3fs (median)' % (stage_name,
+                summary[stage_name]['calls'],
+                summary[stage_name]['median'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--parcels', type=int, default=500,
+        help='The approximate number of natural ecosystem parcels.')
+    parser.add_argument('--impacts', type=int, default=10,
+        help='The number of impact sites.')
+    parser.add_argument('--servicesheds', type=int, default=8,
+        help='The approximate number of servicesheds.')
+    parser.add_argument('--raster-size', type=int, default=400,
+        help='The number of rows and columns in each raster.')
+    parser.add_argument('--offset-scheme', type=int, default=2,
+        help='The offset scheme to run.  See adept_core.execute().')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='The number of times to run the model.')
+    parser.add_argument('--seed', type=int, default=0,
+        help='The seed for the synthetic data.')
+    parser.add_argument('--workspace', default=None,
+        help='A folder for the data and model workspaces.  Defaults to a '
+             'temporary folder that is removed afterwards.')
+    parser.add_argument('--output', default='benchmark_results',
+        help='The path of the results files, without an extension.')
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    LOGGER.setLevel(logging.INFO)
+
+    if options.workspace is None:
+        workspace = tempfile.mkdtemp()
+    else:
+        workspace = options.workspace
+
+    parameters = {
+        'parcels': options.parcels,
+        'impacts': options.impacts,
+        'servicesheds': options.servicesheds,
+        'raster_size': options.raster_size,
+        'offset_scheme': options.offset_scheme,
+    }
+    try:
+        LOGGER.info('Building the synthetic workload: %s', parameters)
+        args = build_workload(os.path.join(workspace, 'data'),
+            options.parcels, options.impacts, options.servicesheds,
+            options.raster_size, options.seed)
+        args['offset_scheme'] = options.offset_scheme
+        runs = run_benchmark(args, workspace, options.repeat)
+        write_results(options.output, parameters, runs)
+    finally:
+        if options.workspace is None:
+            shutil.rmtree(workspace)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@
 import json
 import glob
 import logging
+import multiprocessing
 import os
 import shutil
 import tempfile
@@ -125,9 +126,89 @@ def execute(args):
             'distribution' - (optional) The distribution of the tool we're
                 running.  Either 'mafe-t' or 'opal'.  Defaults to 'mafe-t' if
                 not provided.
+            'distance_metric' - (optional) How the distance from an offset
+                parcel to the nearest impact site is measured.  Either
+                'centroid' (between polygon centroids) or 'edge' (between
+                polygon edges).  Defaults to 'centroid' if not provided.
+            'selection_method' - (optional) How recommended parcels are
+                selected.  Either 'greedy' or 'optimal'.  'optimal' finds the
+                smallest portfolio that meets all of the requirements at once.
+                Defaults to 'greedy' if not provided.
+            'selection_objective' - (optional) What the 'optimal' selection
+                minimizes.  Either 'area' or 'count'.  Defaults to 'area'.
+            'selection_time_budget' - (optional) The number of seconds the
+                'optimal' selection may search for the best portfolio of each
+                hydrozone.  Defaults to 30.
+            'n_workers' - (optional) The number of worker processes to use
+                for the parts of the analysis that can run in parallel.
+                Defaults to 1 (no parallelism) if not provided.
+            'memory_limit' - (optional) The approximate number of megabytes
+                of polygons to read into memory at once when processing
+                large vectors, such as the national ecosystems vector.
+                Defaults to 512.
+            'vector_format' - (optional) The OGR driver name of the format
+                of the vectors written to the workspace.  Either
+                'ESRI Shapefile' or 'GPKG'.  GeoPackages store each vector in
+                a single file with a built-in spatial index and no limit on
+                the length of field names.  Defaults to 'ESRI Shapefile'.
+            'cache_dir' - (optional) A URI to a folder where intermediate
+                results are cached.  Results are keyed by the contents of the
+                input files and the relevant arguments, so re-running a
+                scenario with only different selection parameters (such as
+                prop_offset or the mitigation ratios) reuses the prepared
+                parcels and per-hydrozone aggregates.  Building the keys
+                reads all of the input files on every run.  Defaults to
+                None, in which case nothing is cached.
+            'profile' - (optional) A boolean.  If True, the wall time, CPU
+                time, peak memory use and feature counts of each step of the
+                analysis are written to <workspace_dir>/_dev/profile.json, and
+                the steps of each hydrozone are also written to the
+                hydrozone's own _dev/profile.json.  Defaults to False.
+            'profile_trace' - (optional) A boolean.  If True (and 'profile'
+                is True), each profile.json is accompanied by a
+                profile_trace.json in the Chrome trace event format, which can
+                be viewed with chrome://tracing.  Defaults to False.
 
         Returns nothing."""
 
+    try:
+        profile = args['profile']
+    except KeyError:
+        profile = False
+
+    if not profile:
+        _execute(args)
+        return
+
+    utils.enable_profiling()
+    try:
+        with utils.span('execute'):
+            _execute(args)
+    finally:
+        # Write whatever was recorded, even if the run failed.
+        profiler = utils.disable_profiling()
+        _write_profile(profiler, args, os.path.join(args['workspace_dir'],
+            '_dev'))
+
+def _write_profile(profiler, args, dev_dir, **tags):
+    """Write the spans recorded by a profiler to dev_dir/profile.json and,
+    if requested in args, to dev_dir/profile_trace.json.
+
+        profiler - a utils.Profiler.
+        args - the args dictionary passed to execute().
+        dev_dir - the folder to write the profile to.
+        **tags - if provided, only spans with these tags are written.
+
+    Returns nothing."""
+    if args.get('profile_trace', False):
+        trace_uri = os.path.join(dev_dir, 'profile_trace.json')
+    else:
+        trace_uri = None
+    profiler.write(os.path.join(dev_dir, 'profile.json'), trace_uri, **tags)
+
+def _execute(args):
+    """Run the analysis described in execute()."""
+
     LOGGER.debug('Current language: "%s"', natcap.opal.i18n.language.current_lang)
     # build a list of possible places to look for the ascii art text file in
     # order of priority.
@@ -181,26 +262,37 @@ def execute(args):
     except KeyError:
         _offset_parcels = _ecosystems
 
+    try:
+        vector_format = args['vector_format']
+    except KeyError:
+        vector_format = 'ESRI Shapefile'
+
+    if vector_format not in utils.VECTOR_FORMATS:
+        raise InvalidInput('Vector format %s is invalid.  Must be one of %s'
+            % (vector_format, sorted(utils.VECTOR_FORMATS.keys())))
+    vector_ext = utils.VECTOR_FORMATS[vector_format]
+    LOGGER.debug('Writing %s vectors to the workspace', vector_format)
+
     files = {
         'active_hydrozones': os.path.join(dirs['intermediate'],
-            'active_hydrozones.shp'),
+            'active_hydrozones' + vector_ext),
         'max_search_area': os.path.join(dirs['intermediate'],
-            'search_area.shp'),
+            'search_area' + vector_ext),
         'ecosystems': _ecosystems,
         'offset_parcels': _offset_parcels,
         'prep_offset_sites': os.path.join(dirs['temp'],
-            'tmp_offset_sites.shp'),
+            'tmp_offset_sites' + vector_ext),
         'prep_natural_parcels': os.path.join(dirs['intermediate'],
-            'prepared_ecosystems.shp'),
+            'prepared_ecosystems' + vector_ext),
         'global_impacted_subzones': os.path.join(dirs['intermediate'],
-            'impacted_subzones.shp'),
+            'impacted_subzones' + vector_ext),
         'union_of_subzones': os.path.join(dirs['intermediate'],
-            'union_impacted_subzones.shp'),
+            'union_impacted_subzones' + vector_ext),
         'buffered_subzones': os.path.join(dirs['intermediate'],
-            'buffered_subzones.shp'),
+            'buffered_subzones' + vector_ext),
         'base_report': os.path.join(dirs['results'], 'index.html'),
         'impacted_sb3': os.path.join(dirs['intermediate'],
-                                     'impacted_softboundary3.shp')
+                                     'impacted_softboundary3' + vector_ext)
     }
 
     pygeoprocessing.create_directories(dirs.values())
@@ -366,8 +458,10 @@ def execute(args):
         for map_uri in map_list:
             if map_uri is not None:
                 all_static_maps.append(map_uri)
-    if not preprocessing.impacts_in_static_maps(all_static_maps,
-            args['project_footprint_uri']):
+    with utils.span('check_static_maps'):
+        impacts_in_static_maps = preprocessing.impacts_in_static_maps(
+            all_static_maps, args['project_footprint_uri'])
+    if not impacts_in_static_maps:
         raise InvalidImpactsVector(('Some polygon(s) do not intersect static '
             'maps.  Correct this and re-run the tool.'))
 
@@ -384,13 +478,15 @@ def execute(args):
         hydro_subzones = args['search_areas_uri']
         LOGGER.debug('Using user-provided hydro subzones: %s', hydro_subzones)
 
-        hydrozones = os.path.join(dirs['intermediate'], 'hydrozones.shp')
+        hydrozones = os.path.join(dirs['intermediate'],
+            'hydrozones' + vector_ext)
         # build the hydrozones out of the hydrosubzones by zone attribute
         contained_subzones = preprocessing.union_by_attribute(hydro_subzones,
             'zone', hydrozones)
     except KeyError:
         hydro_subzones = common_data['hydrosubzones']
         hydrozones = common_data['hydrozones']
+        contained_subzones = []
         LOGGER.debug('Using default hydro subzones: %s', hydro_subzones)
         LOGGER.debug('Using default hydrozones: %s', hydrozones)
 
@@ -421,21 +517,25 @@ def execute(args):
         LOGGER.debug('Using user-provided AOI')
     except KeyError:
         LOGGER.debug('Building AOI from hydro subzones')
-        area_of_influence = os.path.join(dirs['intermediate'], 'aoi_computed.shp')
-        preprocessing.prepare_aoi(args['project_footprint_uri'],
-            hydro_subzones, area_of_influence)
-
-    LOGGER.info('Determining active hydrozone')
-    preprocessing.locate_intersecting_polygons(hydrozones,
-        args['project_footprint_uri'], files['active_hydrozones'])
-
-    LOGGER.info('Preparing impact sites')
-    impact_sites_list = preprocessing.prepare_impact_sites(args['project_footprint_uri'],
-        hydrozones, dirs['impact_sites'])
-
-    LOGGER.info('Finding the union of active hydrozones and the AOI')
-    preprocessing.union_of_vectors([files['active_hydrozones'],
-        area_of_influence], files['max_search_area'])
+        area_of_influence = os.path.join(dirs['intermediate'],
+            'aoi_computed' + vector_ext)
+        with utils.span('prepare_aoi'):
+            preprocessing.prepare_aoi(args['project_footprint_uri'],
+                hydro_subzones, area_of_influence)
+
+    with utils.span('prepare_impact_sites') as stage:
+        LOGGER.info('Determining active hydrozone')
+        preprocessing.locate_intersecting_polygons(hydrozones,
+            args['project_footprint_uri'], files['active_hydrozones'])
+
+        LOGGER.info('Preparing impact sites')
+        impact_sites_list = preprocessing.prepare_impact_sites(args['project_footprint_uri'],
+            hydrozones, dirs['impact_sites'], vector_format=vector_format)
+
+        LOGGER.info('Finding the union of active hydrozones and the AOI')
+        preprocessing.union_of_vectors([files['active_hydrozones'],
+            area_of_influence], files['max_search_area'])
+        stage.count(hydrozones=len(impact_sites_list))
 
     if 'include_lci' not in args:
         args['include_lci'] = True
@@ -443,38 +543,69 @@ def execute(args):
         assert type(args['include_lci']) is BooleanType, ('Key "include_lci"'
             ' must be a boolean.  %s found' % type(args['include_lci']))
 
-    LOGGER.info('Preparing offset sites')
-    preprocessing.prepare_offset_parcels(files['offset_parcels'],
-        files['active_hydrozones'], files['prep_offset_sites'],
-        include_lci=args['include_lci'])
+    try:
+        n_workers = int(args['n_workers'])
+    except KeyError:
+        n_workers = 1
+    LOGGER.debug('Using %s worker processes', n_workers)
+
+    try:
+        cache_dir = args['cache_dir']
+    except KeyError:
+        cache_dir = None
+    LOGGER.debug('Using cache folder %s', cache_dir)
 
     # if the natural and offset parcels are found in different vectors, then
     # we'll need to prepare a subset of the natural parcels as well.
     # If natural and offset parcels are found in the same vector, then we can
     # use the prepared offset parcels vector for the prepared natural parcels.
     _abspath = lambda p: os.path.abspath(p)
-    if _abspath(files['offset_parcels']) != _abspath(files['ecosystems']):
-        LOGGER.info('Preparing impacted natural parcels')
-
-        # Build a vector of the hydro subzones that intersect the impact sites.
-        preprocessing.locate_intersecting_polygons(args['search_areas_uri'],
-            args['project_footprint_uri'], files['global_impacted_subzones'])
-        preprocessing.union_of_vectors([files['global_impacted_subzones']],
-            files['union_of_subzones'])
-
-        # when buffering, include at least 1000 extra distance units of
-        # parcels, just in case there are any parcels near the boundary of the
-        # hydrozones that need to be included in the LCI calculations.
-        preprocessing.buffer_vector(files['union_of_subzones'], 1000,
-            files['buffered_subzones'])
-
-        preprocessing.prepare_offset_parcels(files['ecosystems'],
-            files['buffered_subzones'], files['prep_natural_parcels'],
-            include_lci=args['include_lci'])
+    separate_natural_parcels = (_abspath(files['offset_parcels']) !=
+        _abspath(files['ecosystems']))
+
+    # Only the original inputs are used in cache keys.  Intermediate vectors
+    # are rewritten on every run, so their bytes may change even when their
+    # contents don't.
+    if 'search_areas_uri' in args:
+        hydrozones_source = hydro_subzones
+    else:
+        hydrozones_source = hydrozones
+    prep_cache_key = None
+    if cache_dir is not None:
+        prep_cache_key = utils.get_digest({
+            'stage': 'prepare_parcels',
+            'version': natcap.opal.__version__,
+            'project_footprint': args['project_footprint_uri'],
+            'hydrozones': hydrozones_source,
+            'hydro_subzones': hydro_subzones,
+            'offset_parcels': files['offset_parcels'],
+            'ecosystems': files['ecosystems'],
+            'separate_natural_parcels': separate_natural_parcels,
+            'include_lci': args['include_lci'],
+            'vector_format': vector_format,
+        })
+    prep_cache_files = {'prep_offset_sites': files['prep_offset_sites']}
+    if separate_natural_parcels:
+        prep_cache_files['prep_natural_parcels'] = (
+            files['prep_natural_parcels'])
     else:
         LOGGER.debug('Offset parcels are natural')
         files['prep_natural_parcels'] = files['prep_offset_sites']
 
+    if (cache_dir is not None and utils.restore_cache(cache_dir,
+            prep_cache_key, prep_cache_files) is not None):
+        LOGGER.info('Using cached offset sites and natural parcels')
+    else:
+        with utils.span('prepare_parcels') as stage:
+            _prepare_parcels(args, files, separate_natural_parcels,
+                n_workers, _memory_limit(args))
+            if stage.enabled:
+                stage.count(features=utils.feature_count(
+                    files['prep_offset_sites']))
+        if cache_dir is not None:
+            utils.store_cache(cache_dir, prep_cache_key, prep_cache_files,
+                {})
+
 
     try:
         servicesheds = args['servicesheds_uri']
@@ -483,38 +614,413 @@ def execute(args):
         servicesheds = common_data['servicesheds']
         LOGGER.debug('Using default servicesheds: %s', servicesheds)
 
+    if 'prop_offset' not in args:
+        LOGGER.debug('Defaulting to prop_offset=1.0')
+        args['prop_offset'] = 1.0
+
+    # Everything a hydrozone needs from this function.  Hydrozones only share
+    # read-only inputs, so they can be processed in parallel.
+    run_data = {
+        'args': args,
+        'dirs': dirs,
+        'files': files,
+        'cache_dir': cache_dir,
+        'prep_cache_key': prep_cache_key,
+        'servicesheds': servicesheds,
+        'municipalities': municipalities,
+        'hydro_subzones': hydro_subzones,
+        'area_of_influence': area_of_influence,
+        'contained_subzones': contained_subzones,
+        'protection_services': protection_services,
+        'desired_services': desired_services,
+        'custom_servicesheds': custom_servicesheds,
+        'vector_ext': vector_ext,
+        'profile': utils.get_profiler() is not None,
+    }
+
     # Start looping through all of the impacted hydrozones
-    for impact_sites_data in impact_sites_list:
-        if type(impact_sites_data['name']) is StringType:
-            recode = lambda s: s.decode('utf-8')
-        else:
-            recode = lambda s: s.encode('utf-8')
-        impact_sites_data['name'] = recode(impact_sites_data['name'])
+    num_zone_workers = min(n_workers, len(impact_sites_list))
+    if num_zone_workers > 1:
+        LOGGER.info('Processing %s hydrozones with %s worker processes',
+            len(impact_sites_list), num_zone_workers)
+        pool = multiprocessing.Pool(num_zone_workers)
+        try:
+            # map() re-raises the first exception raised in a worker.
+            with utils.span('process_hydrozones'):
+                worker_spans = pool.map(_hydrozone_worker,
+                    [(run_data, impact_sites_data)
+                     for impact_sites_data in impact_sites_list],
+                    chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        # Spans recorded in the workers are returned to this process.
+        for spans in worker_spans:
+            utils.add_spans(spans)
+    else:
+        with utils.span('process_hydrozones'):
+            for impact_sites_data in impact_sites_list:
+                _process_hydrozone(run_data, impact_sites_data)
+
+    # return tempfile.tempdir to its original state.
+    tempfile.tempdir = old_temp_dir
+    shutil.rmtree(dirs['temp'])
 
-        LOGGER.debug('Processing impacts for hydrozone %s',
+    with utils.span('write_results_index'):
+        write_results_index(dirs['results'], files['base_report'],
+                             distribution=args['distribution'])
+
+def _recode_hydrozone_name(name):
+    """Toggle the hydrozone name between a utf-8 bytestring and unicode, as
+    the per-hydrozone outputs have always expected."""
+    if type(name) is StringType:
+        return name.decode('utf-8')
+    return name.encode('utf-8')
+
+def _process_hydrozone(run_data, impact_sites_data):
+    """Analyze the impacts and offsets of a single hydrozone and build its
+    report.  Each hydrozone writes to its own results and temp folders, so
+    several hydrozones may be processed at the same time.
+
+        run_data - a dictionary of the workspace-wide inputs and settings
+            built in execute().
+        impact_sites_data - a dictionary with the 'name' of the hydrozone and
+            the 'uri' of its impact sites vector, as returned by
+            preprocessing.prepare_impact_sites().
+
+    Returns nothing."""
+
+    args = run_data['args']
+    dirs = run_data['dirs']
+    files = run_data['files']
+    cache_dir = run_data['cache_dir']
+    prep_cache_key = run_data['prep_cache_key']
+    servicesheds = run_data['servicesheds']
+    municipalities = run_data['municipalities']
+    hydro_subzones = run_data['hydro_subzones']
+    area_of_influence = run_data['area_of_influence']
+    contained_subzones = run_data['contained_subzones']
+    protection_services = run_data['protection_services']
+    desired_services = run_data['desired_services']
+    custom_servicesheds = run_data['custom_servicesheds']
+    vector_ext = run_data['vector_ext']
+
+    impact_sites_data['name'] = _recode_hydrozone_name(
+        impact_sites_data['name'])
+
+    LOGGER.debug('Processing impacts for hydrozone %s',
+        impact_sites_data['name'])
+    _clean_hydrozone_name = impact_sites_data['name'].lower().replace(' ', '_')
+
+    hzone_dir = os.path.join(dirs['results'], _clean_hydrozone_name)
+    hzone_dev = os.path.join(hzone_dir, '_dev')
+    hzone_static_maps = os.path.join(hzone_dir, 'static_data')
+    hzone_temp = os.path.join(dirs['temp'], _clean_hydrozone_name)
+    pygeoprocessing.create_directories([hzone_dir, hzone_dev,
+        hzone_static_maps, hzone_temp])
+
+    _hzone_vector = lambda name: os.path.join(hzone_dir, name + vector_ext)
+    hzone_paths = {
+        'offset_sites': _hzone_vector('offset_sites_available'),
+        'all_offsets': _hzone_vector('potential_offsets_in_zone'),
+        'all_natural_parcels': _hzone_vector('natural_parcels_in_zone'),
+        'impact_sites': impact_sites_data['uri'],
+        'bio_impacts': os.path.join(hzone_dev, 'bio_impacts.json'),
+        'selected_offsets': _hzone_vector('offset_sites_filtered'),
+        'impacted_muni': _hzone_vector('impacted_softboundary2'),
+        'servicesheds': _hzone_vector('servicesheds_in_zone'),
+        'hydrozone': _hzone_vector('impacted_zone'),
+        'hydrosubzones': _hzone_vector('impacted_subzones'),
+        'parcel_info': os.path.join(hzone_dev, 'selected_parcels.json'),
+    }
+
+    hzone_paths['offset_servicesheds'] = _hzone_vector(
+        'servicesheds_with_offset_parcels')
+
+    # The geometry, aggregation and overlap steps for this hydrozone only
+    # depend on these inputs, so their outputs can be reused when a
+    # scenario is re-run with different selection parameters.
+    hzone_cache_key = None
+    if cache_dir is not None:
+        hzone_cache_key = utils.get_digest({
+            'stage': 'hydrozone',
+            'prepared_parcels': prep_cache_key,
+            'hydrozone': impact_sites_data['name'],
+            'servicesheds': servicesheds,
+            'municipalities': municipalities,
+            'hydro_subzones': hydro_subzones,
+            'area_of_influence': args.get('area_of_influence_uri'),
+            'conservation_portfolio': args.get('conservation_portfolio'),
+            'threat_map': args.get('threat_map'),
+            'richness_map': args.get('richness_map'),
+            'services': protection_services,
+            'offset_scheme': args['offset_scheme'],
+            'distance_metric': args.get('distance_metric',
+                offsets.DISTANCE_CENTROID),
+        })
+    hzone_cache_files = dict((key, hzone_paths[key]) for key in [
+        'hydrozone', 'servicesheds', 'all_offsets', 'all_natural_parcels',
+        'offset_sites', 'impact_sites', 'hydrosubzones',
+        'selected_offsets', 'offset_servicesheds', 'bio_impacts',
+        'parcel_info'])
+    if municipalities is not None:
+        hzone_cache_files['impacted_muni'] = hzone_paths['impacted_muni']
+
+    if cache_dir is not None:
+        hzone_results = utils.restore_cache(cache_dir, hzone_cache_key,
+            hzone_cache_files)
+    else:
+        hzone_results = None
+
+    if hzone_results is not None:
+        LOGGER.info('Using cached analysis of hydrozone %s',
             impact_sites_data['name'])
-        _clean_hydrozone_name = impact_sites_data['name'].lower().replace(' ', '_')
-
-        hzone_dir = os.path.join(dirs['results'], _clean_hydrozone_name)
-        hzone_dev = os.path.join(hzone_dir, '_dev')
-        hzone_static_maps = os.path.join(hzone_dir, 'static_data')
-        pygeoprocessing.create_directories([hzone_dir, hzone_dev,
-            hzone_static_maps])
-
-        hzone_paths = {
-            'offset_sites': os.path.join(hzone_dir, 'offset_sites_available.shp'),
-            'all_offsets': os.path.join(hzone_dir, 'potential_offsets_in_zone.shp'),
-            'all_natural_parcels': os.path.join(hzone_dir, 'natural_parcels_in_zone.shp'),
-            'impact_sites': impact_sites_data['uri'],
-            'bio_impacts': os.path.join(hzone_dev, 'bio_impacts.json'),
-            'selected_offsets': os.path.join(hzone_dir, 'offset_sites_filtered.shp'),
-            'impacted_muni': os.path.join(hzone_dir, 'impacted_softboundary2.shp'),
-            'servicesheds': os.path.join(hzone_dir, 'servicesheds_in_zone.shp'),
-            'hydrozone': os.path.join(hzone_dir, 'impacted_zone.shp'),
-            'hydrosubzones': os.path.join(hzone_dir, 'impacted_subzones.shp'),
-            'parcel_info': os.path.join(hzone_dev, 'selected_parcels.json'),
-        }
+    else:
+        with utils.span('analyze_hydrozone',
+                hydrozone=impact_sites_data['name']):
+            hzone_results = _analyze_hydrozone(args, files, hzone_paths,
+                servicesheds, municipalities, hydro_subzones,
+                area_of_influence, protection_services, desired_services,
+                hzone_temp)
+        if cache_dir is not None:
+            utils.store_cache(cache_dir, hzone_cache_key,
+                hzone_cache_files, hzone_results)
+
+    total_impacts = hzone_results['total_impacts']
+    biodiversity_impact = hzone_results['biodiversity_impact']
+    per_offset_data = hzone_results['per_offset_data']
+    per_impact_data = hzone_results['per_impact_data']
+
+    LOGGER.debug('Total impacts: %s', total_impacts)
+    LOGGER.info(biodiversity_impact)
+
+    json.dump(per_offset_data, open(os.path.join(hzone_dev,
+        'per_offset_data.json'), 'w'), indent=4, sort_keys=True)
+    opal_reporting.write_per_offset_csv(per_offset_data,
+        os.path.join(hzone_dir, 'offset_benefits_per_serviceshed.csv'))
+
+
+    #########################
+    # PARCEL RECOMMENDATION #
+    #########################
+    # parcel data contains information for us to drive the offset value per
+    # serviceshed as well.
+    parcel_data = offsets.ParcelTable.from_per_offset_data(per_offset_data)
+    json.dump(parcel_data.to_dict(), open(os.path.join(hzone_dev,
+        'translated_parcel_data.json'), 'w'), indent=4, sort_keys=True)
+
+    # 2 of the offset schemes use ES.  If we're using ES, include ES parcel
+    # analysis and offset recommendation.
+    if args['offset_scheme'] != offsets.OFFSET_SCHEME_BIODIV:
+        json.dump(per_impact_data, open(os.path.join(hzone_dev,
+            'per_impact_data.json'), 'w'), indent=4, sort_keys=True)
+
+        # collect ES impacts from per_impact_data
+        es_hydro_requirements = offsets.translate_es_impacts(per_impact_data)
+        json.dump(es_hydro_requirements, open(os.path.join(hzone_dev,
+            'es_hydro_requirements.json'), 'w'), indent=4, sort_keys=True)
+
+        # group offset parcels by serviceshed and merge them into the
+        # es_hydro_requirements
+        offset_parcels_by_sshed = offsets.group_offset_parcels_by_sshed(
+            per_offset_data)
+        empty_services = dict((k, 0) for k in es_hydro_requirements.values()[0])
+        for sshed_name, sshed_offsets in offset_parcels_by_sshed.iteritems():
+            try:
+                es_hydro_requirements[sshed_name]['parcels'] = sshed_offsets
+            except KeyError:
+                # when there are no impacts for this serviceshed (but there are
+                # offsets), then we can skip the serviceshed.
+                continue
+        json.dump({'offset_parcels_by_sshed': offset_parcels_by_sshed,
+            'es_hydro_requirements': es_hydro_requirements},
+            open(os.path.join(hzone_dev,
+            'es_hydro_requirements_complete.json'), 'w'), indent=4,
+            sort_keys=True)
+    else:
+        es_hydro_requirements = None
+
+    # biodiversity requirements stored in the `biodiversity_impact`
+    # variable.
+    # hydro_es_req - this would need to be determined from the
+    # per_impact_data
+    try:
+        selection_method = args['selection_method']
+    except KeyError:
+        selection_method = 'greedy'
+
+    with utils.span('recommend_parcels', hydrozone=impact_sites_data['name'],
+            method=selection_method):
+        if selection_method == 'optimal':
+            try:
+                selection_objective = args['selection_objective']
+            except KeyError:
+                selection_objective = 'area'
+
+            try:
+                time_budget = float(args['selection_time_budget'])
+            except KeyError:
+                time_budget = 30.0
+
+            recommended_parcels = offsets.select_set_optimal(parcel_data,
+                biodiversity_impact, es_hydro_requirements,
+                proportion_offset=args['prop_offset'],
+                objective=selection_objective, time_budget=time_budget)
+        else:
+            recommended_parcels = offsets.select_set_multifactor(parcel_data,
+                biodiversity_impact, es_hydro_requirements,
+                proportion_offset=args['prop_offset'])
+    json.dump(recommended_parcels, open(os.path.join(hzone_dev,
+        'recommended_parcels.json'), 'w'), indent=4, sort_keys=True)
+
+    # check to see if the user provided avoidance areas.  If so, check to
+    # see if any of the impact sites intersect the provided avoidance
+    # areas.
+    try:
+        impacts_disallowed = analysis.vectors_intersect(
+            hzone_paths['impact_sites'], args['avoidance_areas'])
+    except KeyError:
+        impacts_disallowed = False
+
+    service_mitigation_ratios = {}
+    for service in total_impacts.keys():
+        mit_ratio_key = '%s_mitigation_ratio' % service
+        try:
+            mit_ratio = float(args[mit_ratio_key])
+        except KeyError:
+            mit_ratio = 1.0
+        service_mitigation_ratios[service] = mit_ratio
+
+    # We only want to include the AOI in the report if the user actually
+    # provided an AOI (so we did not compute it for them), and we're
+    # running OPAL.
+    include_aoi = True
+    if 'area_of_influence_uri' not in args:
+        if args['distribution'] == DIST_OPAL:
+            include_aoi = False
+    LOGGER.debug('Include AOI column: %s', include_aoi)
+
+    # We only want to include the subzones column in the parcels CSV iff
+    # there is only 1 subzone for this zone.
+    include_subzone = impact_sites_data['name'] in contained_subzones
+    LOGGER.debug('Name: %s', impact_sites_data['name'])
+    LOGGER.debug('Contained subzones: %s', contained_subzones)
+    LOGGER.debug('Include subzone column: %s', include_subzone)
+
+    LOGGER.info("Building output report")
+    with utils.span('build_report', hydrozone=impact_sites_data['name']):
+        build_report(hzone_paths['servicesheds'], biodiversity_impact,
+            hzone_paths['selected_offsets'],
+            args['project_footprint_uri'], total_impacts,
+            args['impact_type'], hzone_dir, hzone_paths['impact_sites'],
+            'pop_center', '%s_report.html' % _clean_hydrozone_name,
+            hzone_paths['all_natural_parcels'], impacts_disallowed,
+            suggested_parcels=recommended_parcels,
+            custom_es_servicesheds=custom_servicesheds,
+            dev_dir = hzone_dev, service_mitrat=service_mitigation_ratios,
+            per_offset_data=per_offset_data, prop_offset=args['prop_offset'],
+            distribution=args['distribution'], include_aoi_column=include_aoi,
+            include_subzone_column=include_subzone,
+            hzone_name=impact_sites_data['name'])
 
+    # copy static maps to the workspace.
+    LOGGER.info('Clipping static data to the hydrozone for reference')
+    with utils.span('clip_static_maps', hydrozone=impact_sites_data['name']):
+        for service_name, static_data in protection_services:
+            for impact_raster_key in ['static_impact', 'static_protection']:
+                src_file = static_data[impact_raster_key]
+                dest_filename = os.path.join(hzone_static_maps,
+                    '%s_%s.tif' % (service_name, impact_raster_key))
+                LOGGER.info('Clipping %s:%s', impact_raster_key, src_file)
+                try:
+                    static_maps.clip_static_map(src_file,
+                        hzone_paths['hydrozone'], dest_filename)
+                except Exception as error:
+                    LOGGER.error('Could not clip static map: %s', error)
+
+    profiler = utils.get_profiler()
+    if profiler is not None:
+        _write_profile(profiler, args, hzone_dev,
+            hydrozone=impact_sites_data['name'])
+
+def _hydrozone_worker(job):
+    """Process a single hydrozone in a worker process.  Log messages from the
+    worker are also written to a logfile in the hydrozone's _dev folder, and
+    temporary files are kept in the hydrozone's own temp folder.
+
+        job - a tuple of (run_data, impact_sites_data).  See
+            _process_hydrozone().
+
+    Returns a list of the profiling spans recorded for the hydrozone, which
+    is empty unless profiling was enabled in the parent process."""
+
+    run_data, impact_sites_data = job
+    clean_name = _recode_hydrozone_name(
+        impact_sites_data['name']).lower().replace(' ', '_')
+    hzone_dev = os.path.join(run_data['dirs']['results'], clean_name, '_dev')
+    hzone_temp = os.path.join(run_data['dirs']['temp'], clean_name)
+    pygeoprocessing.create_directories([hzone_dev, hzone_temp])
+
+    log_handler = logging.FileHandler(os.path.join(hzone_dev, 'logfile.txt'))
+    log_handler.setFormatter(logging.Formatter(
+        fmt=(
+            '%(asctime)s %(name)-18s '
+            '%(processName)-12s %(levelname)-8s %(message)s'),
+        datefmt='%m/%d/%Y %H:%M:%S '))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(log_handler)
+
+    # Workers record their own spans, which are merged into the parent's
+    # profile when they're returned.
+    if run_data['profile']:
+        utils.enable_profiling()
+
+    old_temp_dir = tempfile.tempdir
+    tempfile.tempdir = hzone_temp
+    try:
+        _process_hydrozone(run_data, impact_sites_data)
+    finally:
+        tempfile.tempdir = old_temp_dir
+        root_logger.removeHandler(log_handler)
+        log_handler.close()
+        profiler = utils.disable_profiling()
+
+    if profiler is None:
+        return []
+    return profiler.spans
+
+def _analyze_hydrozone(args, files, hzone_paths, servicesheds,
+        municipalities, hydro_subzones, area_of_influence,
+        protection_services, desired_services, temp_dir):
+    """Run the geometry, aggregation and overlap steps for a single
+    hydrozone.  The results of this function depend only on the input data
+    and not on the offset selection parameters, so they may be cached.
+
+        args - the args dictionary passed to execute().
+        files - the dictionary of workspace files built in execute().
+        hzone_paths - a dictionary of the files for this hydrozone.
+        servicesheds - a URI to the servicesheds vector.
+        municipalities - a URI to the municipalities vector, or None.
+        hydro_subzones - a URI to the hydro subzones vector.
+        area_of_influence - a URI to the area of influence vector.
+        protection_services - a list of (service name, static data) tuples.
+        desired_services - a list of the services to consider.
+        temp_dir - a folder for temporary files.
+
+    Returns a dictionary with these keys:
+        'total_impacts' - the total impact to each service.
+        'biodiversity_impact' - from analysis.calculate_biodiversity_impact.
+        'per_offset_data' - percent overlap of selected offsets with
+            servicesheds.
+        'per_impact_data' - percent overlap of impact sites with servicesheds,
+            or None if ecosystem services are not part of the offset scheme.
+    """
+
+    with utils.span('locate_parcels') as stage:
         LOGGER.info('Locating the current hydrozone polygon')
         preprocessing.locate_intersecting_polygons(files['active_hydrozones'],
             hzone_paths['impact_sites'], hzone_paths['hydrozone'])
@@ -529,245 +1035,195 @@ def execute(args):
             hzone_paths['hydrozone'], hzone_paths['all_offsets'], clip=True)
 
         LOGGER.info('Locating natural parcels available for this hydrozone')
-        preprocessing.locate_intersecting_polygons(files['prep_natural_parcels'],
-            hzone_paths['hydrozone'], hzone_paths['all_natural_parcels'],
-            clip=True)
-
-        LOGGER.info('Cutting out the impact sites from available offset parcels.')
+        preprocessing.locate_intersecting_polygons(
+            files['prep_natural_parcels'], hzone_paths['hydrozone'],
+            hzone_paths['all_natural_parcels'], clip=True)
+        if stage.enabled:
+            stage.count(
+                offset_parcels=utils.feature_count(hzone_paths['all_offsets']),
+                natural_parcels=utils.feature_count(
+                    hzone_paths['all_natural_parcels']))
+
+    with utils.span('subtract_impacts'):
+        LOGGER.info('Cutting out the impact sites from available offset '
+            'parcels.')
         preprocessing.subtract_vectors(hzone_paths['all_offsets'],
             hzone_paths['impact_sites'], hzone_paths['offset_sites'])
 
-        LOGGER.info('Aggregating services provided by parcels')
-        service_impacts = {}
-        for service_name, static_data in protection_services:
-            LOGGER.debug('Aggregating stats for service %s', service_name)
-            LOGGER.debug('Aggregating %s stats for offset sites', service_name)
-            _ = analysis.aggregate_stats(static_data['static_protection'],
-                hzone_paths['offset_sites'], 'FID', service_name,
-                static_data['pts_protection'])
-            LOGGER.debug('Aggregating %s stats for impact sites', service_name)
-            service_impacts[service_name] = analysis.aggregate_stats(
-                static_data['static_impact'], hzone_paths['impact_sites'], 'FID',
-                service_name, static_data['pts_impact'])
-
-        for args_key, col_name in [('threat_map', 'Threat'), ('richness_map',
-            'Richness')]:
-            if args_key not in args:
-                continue
-            LOGGER.debug('Found %s map in args.  Calculating stats.',
-                col_name.lower())
-            _ = analysis.aggregate_stats(args[args_key],
-                hzone_paths['impact_sites'], 'FID', col_name)
-            _ = analysis.aggregate_stats(args[args_key],
-                hzone_paths['offset_sites'], 'FID', col_name)
-            _ = analysis.aggregate_stats(args[args_key],
-                hzone_paths['all_offsets'], 'FID', col_name)
-
-    #    LOGGER.info('Selecting offset parcels')
-    #    offset_dir = os.path.join(output_dir, 'offsets')
-    #    offset_info = offsets.select_offsets(offset_sites, impact_sites, offset_dir)
-    #
-    #    # find the impact sum
-    #    total_impacts = {
-    #        'sediment': sum(map(lambda r: r['services']['sediment']['impact'],
-    #            offset_info.values()))
-    #    }
-    #
-    #    LOGGER.debug(json.dumps(offset_info, sort_keys=True, indent=4))
-
-        # get the proper impacts from the returned service impacts from the
-        # above analysis step.
-        _get_impacts = lambda k: sum(service_impacts[k].values())
-        total_impacts = dict((service, _get_impacts(service)) for service in
-            desired_services)
-#        total_impacts = {
-#            'sediment': _get_impacts('sediment'),
-#            'nutrient': _get_impacts('nutrient'),
-#            'carbon': _get_impacts('carbon'),
-#        }
-        if 'custom' in service_impacts:
-            total_impacts['custom'] = _get_impacts('custom')
-
-        LOGGER.debug('Total impacts: %s', total_impacts)
-
-        # TODO: Write these values to JSON in the calculat_bio_impact function
+    LOGGER.info('Aggregating services provided by parcels')
+    # Collect the rasters to aggregate under each vector so that each
+    # vector is only rasterized and updated once.
+    offset_stats = []
+    impact_stats = []
+    all_offsets_stats = []
+    for service_name, static_data in protection_services:
+        LOGGER.debug('Aggregating stats for service %s', service_name)
+        offset_stats.append((service_name,
+            static_data['static_protection'],
+            static_data['pts_protection']))
+        impact_stats.append((service_name, static_data['static_impact'],
+            static_data['pts_impact']))
+
+    for args_key, col_name in [('threat_map', 'Threat'), ('richness_map',
+        'Richness')]:
+        if args_key not in args:
+            continue
+        LOGGER.debug('Found %s map in args.  Calculating stats.',
+            col_name.lower())
+        for stats_list in [impact_stats, offset_stats, all_offsets_stats]:
+            stats_list.append((col_name, args[args_key], None))
+
+    with utils.span('aggregate_stats') as stage:
+        LOGGER.debug('Aggregating stats for offset sites')
+        _ = analysis.aggregate_stats_multi(hzone_paths['offset_sites'], 'FID',
+            offset_stats)
+        LOGGER.debug('Aggregating stats for impact sites')
+        impact_site_stats = analysis.aggregate_stats_multi(
+            hzone_paths['impact_sites'], 'FID', impact_stats)
+        LOGGER.debug('Aggregating stats for all offset parcels')
+        _ = analysis.aggregate_stats_multi(hzone_paths['all_offsets'], 'FID',
+            all_offsets_stats)
+        if stage.enabled:
+            stage.count(
+                features=sum(utils.feature_count(hzone_paths[key]) for key in
+                    ['offset_sites', 'impact_sites', 'all_offsets']),
+                pixels=sum(utils.pixel_count(raster_uri) for (_, raster_uri, _)
+                    in offset_stats + impact_stats + all_offsets_stats))
+    service_impacts = dict((service_name, impact_site_stats[service_name])
+        for (service_name, _) in protection_services)
+
+    # get the proper impacts from the returned service impacts from the
+    # above analysis step.
+    _get_impacts = lambda k: sum(service_impacts[k].values())
+    total_impacts = dict((service, _get_impacts(service)) for service in
+        desired_services)
+    if 'custom' in service_impacts:
+        total_impacts['custom'] = _get_impacts('custom')
+
+    # TODO: Write these values to JSON in the calculat_bio_impact function
+    with utils.span('biodiversity_impact'):
         biodiversity_impact = analysis.calculate_biodiversity_impact(
             hzone_paths['impact_sites'], hzone_paths['all_natural_parcels'])
-        json.dump(biodiversity_impact, open(hzone_paths['bio_impacts'], 'w'), sort_keys=True,
-            indent=4)
+    json.dump(biodiversity_impact, open(hzone_paths['bio_impacts'], 'w'),
+        sort_keys=True, indent=4)
 
-        LOGGER.info(biodiversity_impact)
+    # Build a vector of the current hydro subzones.
+    preprocessing.locate_intersecting_polygons(hydro_subzones,
+        hzone_paths['impact_sites'], hzone_paths['hydrosubzones'])
 
-        # Build a vector of the current hydro subzones.
-        preprocessing.locate_intersecting_polygons(hydro_subzones,
-            hzone_paths['impact_sites'], hzone_paths['hydrosubzones'])
+    comparison_vectors = {
+        'AOI': area_of_influence,
+        'Subzone': hzone_paths['hydrosubzones'],
+    }
 
-        comparison_vectors = {
-            'AOI': area_of_influence,
-            'Subzone': hzone_paths['hydrosubzones'],
-        }
+    try:
+        comparison_vectors['Conservation Portfolio'] = \
+            args['conservation_portfolio']
+    except KeyError:
+        LOGGER.debug('Conservation portfolio not in args, skipping.')
 
-        try:
-            comparison_vectors['Conservation Portfolio'] = \
-                args['conservation_portfolio']
-        except KeyError:
-            LOGGER.debug('Conservation portfolio not in args, skipping.')
+    if municipalities is not None:
+        # Get all the municipalities that intersect with the impact vector.
+        preprocessing.locate_intersecting_polygons(municipalities,
+            hzone_paths['impact_sites'], hzone_paths['impacted_muni'])
+        comparison_vectors['City'] = hzone_paths['impacted_muni']
 
-        if municipalities is not None:
-            # Get all the municipalities that intersect with the impact vector.
-            preprocessing.locate_intersecting_polygons(municipalities,
-                hzone_paths['impact_sites'], hzone_paths['impacted_muni'])
-            comparison_vectors['City'] = hzone_paths['impacted_muni']
+    try:
+        distance_metric = args['distance_metric']
+    except KeyError:
+        distance_metric = offsets.DISTANCE_CENTROID
 
-        #biodiversity_impact contains ONLY the biodiversity impacts.
+    #biodiversity_impact contains ONLY the biodiversity impacts.
+    with utils.span('select_offsets') as stage:
         _, recommended_parcels = offsets._select_offsets(
             hzone_paths['offset_sites'],
             hzone_paths['impact_sites'], biodiversity_impact,
             hzone_paths['selected_offsets'], hzone_paths['parcel_info'],
             comparison_vectors, total_impacts.keys(),
-            offset_scheme=args['offset_scheme'])
-
-        # take the parcels selected in _select_offsets and calculate the
-        # percent_overlap
-        temp_municipalities = os.path.join(hzone_dir,
-            'servicesheds_with_offset_parcels.shp')
+            offset_scheme=args['offset_scheme'],
+            distance_metric=distance_metric)
+        if stage.enabled:
+            stage.count(features=utils.feature_count(
+                hzone_paths['selected_offsets']))
+
+    # take the parcels selected in _select_offsets and calculate the
+    # percent_overlap
+    with utils.span('percent_overlap'):
         per_offset_data = analysis.percent_overlap(
             hzone_paths['selected_offsets'], hzone_paths['servicesheds'],
-            temp_municipalities, 'pop_center')
-        json.dump(per_offset_data, open(os.path.join(hzone_dev,
-            'per_offset_data.json'), 'w'), indent=4, sort_keys=True)
-        opal_reporting.write_per_offset_csv(per_offset_data,
-            os.path.join(hzone_dir, 'offset_benefits_per_serviceshed.csv'))
-
-
-        #########################
-        # PARCEL RECOMMENDATION #
-        #########################
-        # parcel data contains information for us to drive the offset value per
-        # serviceshed as well.
-        parcel_data = offsets.translate_parcel_data(per_offset_data)
-        json.dump(parcel_data, open(os.path.join(hzone_dev,
-            'translated_parcel_data.json'), 'w'), indent=4, sort_keys=True)
-
-        # 2 of the offset schemes use ES.  If we're using ES, include ES parcel
-        # analysis and offset recommendation.
-        if args['offset_scheme'] != offsets.OFFSET_SCHEME_BIODIV:
-            temp_municipalities_2 = os.path.join(dirs['temp'],
-                'municipalities_intersecting_impacts.shp')
+            hzone_paths['offset_servicesheds'], 'pop_center',
+            memory_limit=_memory_limit(args))
+
+    # 2 of the offset schemes use ES.  If we're using ES, we'll also need to
+    # know how the impacts overlap the servicesheds.
+    if args['offset_scheme'] != offsets.OFFSET_SCHEME_BIODIV:
+        temp_municipalities_2 = os.path.join(temp_dir,
+            'municipalities_intersecting_impacts' +
+            utils.VECTOR_FORMATS[utils.vector_driver_name(
+                hzone_paths['servicesheds'])])
+        with utils.span('percent_overlap'):
             per_impact_data = analysis.percent_overlap(
                 hzone_paths['impact_sites'], hzone_paths['servicesheds'],
-                temp_municipalities_2, 'pop_center')
-            json.dump(per_impact_data, open(os.path.join(hzone_dev,
-                'per_impact_data.json'), 'w'), indent=4, sort_keys=True)
-
-            # collect ES impacts from per_impact_data
-            es_hydro_requirements = offsets.translate_es_impacts(per_impact_data)
-            json.dump(es_hydro_requirements, open(os.path.join(hzone_dev,
-                'es_hydro_requirements.json'), 'w'), indent=4, sort_keys=True)
-
-            # group offset parcels by serviceshed and merge them into the
-            # es_hydro_requirements
-            offset_parcels_by_sshed = offsets.group_offset_parcels_by_sshed(
-                per_offset_data)
-            empty_services = dict((k, 0) for k in es_hydro_requirements.values()[0])
-            for sshed_name, sshed_offsets in offset_parcels_by_sshed.iteritems():
-                try:
-                    es_hydro_requirements[sshed_name]['parcels'] = sshed_offsets
-                except KeyError:
-                    # when there are no impacts for this serviceshed (but there are
-                    # offsets), then we can skip the serviceshed.
-                    continue
-            json.dump({'offset_parcels_by_sshed': offset_parcels_by_sshed,
-                'es_hydro_requirements': es_hydro_requirements},
-                open(os.path.join(hzone_dev,
-                'es_hydro_requirements_complete.json'), 'w'), indent=4,
-                sort_keys=True)
-        else:
-            es_hydro_requirements = None
-
-        # biodiversity requirements stored in the `biodiversity_impact`
-        # variable.
-        # hydro_es_req - this would need to be determined from the
-        # per_impact_data
-        if 'prop_offset' not in args:
-            LOGGER.debug('Defaulting to prop_offset=1.0')
-            args['prop_offset'] = 1.0
-        recommended_parcels = offsets.select_set_multifactor(parcel_data,
-            biodiversity_impact, es_hydro_requirements,
-            proportion_offset=args['prop_offset'])
-        json.dump(recommended_parcels, open(os.path.join(hzone_dev,
-            'recommended_parcels.json'), 'w'), indent=4, sort_keys=True)
-
-        # check to see if the user provided avoidance areas.  If so, check to
-        # see if any of the impact sites intersect the provided avoidance
-        # areas.
-        try:
-            impacts_disallowed = analysis.vectors_intersect(
-                hzone_paths['impact_sites'], args['avoidance_areas'])
-        except KeyError:
-            impacts_disallowed = False
+                temp_municipalities_2, 'pop_center',
+                memory_limit=_memory_limit(args))
+    else:
+        per_impact_data = None
 
-        service_mitigation_ratios = {}
-        for service in total_impacts.keys():
-            mit_ratio_key = '%s_mitigation_ratio' % service
-            try:
-                mit_ratio = float(args[mit_ratio_key])
-            except KeyError:
-                mit_ratio = 1.0
-            service_mitigation_ratios[service] = mit_ratio
-
-        # We only want to include the AOI in the report if the user actually
-        # provided an AOI (so we did not compute it for them), and we're
-        # running OPAL.
-        include_aoi = True
-        if 'area_of_influence_uri' not in args:
-            if args['distribution'] == DIST_OPAL:
-                include_aoi = False
-        LOGGER.debug('Include AOI column: %s', include_aoi)
-
-        # We only want to include the subzones column in the parcels CSV iff
-        # there is only 1 subzone for this zone.
-        include_subzone = impact_sites_data['name'] in contained_subzones
-        LOGGER.debug('Name: %s', impact_sites_data['name'])
-        LOGGER.debug('Contained subzones: %s', contained_subzones)
-        LOGGER.debug('Include subzone column: %s', include_subzone)
-
-        LOGGER.info("Building output report")
-        build_report(hzone_paths['servicesheds'], biodiversity_impact,
-            hzone_paths['selected_offsets'],
-            args['project_footprint_uri'], total_impacts,
-            args['impact_type'], hzone_dir, hzone_paths['impact_sites'],
-            'pop_center', '%s_report.html' % _clean_hydrozone_name,
-            hzone_paths['all_natural_parcels'], impacts_disallowed,
-            suggested_parcels=recommended_parcels,
-            custom_es_servicesheds=custom_servicesheds,
-            dev_dir = hzone_dev, service_mitrat=service_mitigation_ratios,
-            per_offset_data=per_offset_data, prop_offset=args['prop_offset'],
-            distribution=args['distribution'], include_aoi_column=include_aoi,
-            include_subzone_column=include_subzone,
-            hzone_name=impact_sites_data['name'])
+    return {
+        'total_impacts': total_impacts,
+        'biodiversity_impact': biodiversity_impact,
+        'per_offset_data': per_offset_data,
+        'per_impact_data': per_impact_data,
+    }
 
-        # copy static maps to the workspace.
-        LOGGER.info('Clipping static data to the hydrozone for reference')
-        for service_name, static_data in protection_services:
-            for impact_raster_key in ['static_impact', 'static_protection']:
-                src_file = static_data[impact_raster_key]
-                dest_filename = os.path.join(hzone_static_maps,
-                    '%s_%s.tif' % (service_name, impact_raster_key))
-                LOGGER.info('Clipping %s:%s', impact_raster_key, src_file)
-                try:
-                    static_maps.clip_static_map(src_file, hzone_paths['hydrozone'],
-                        dest_filename)
-                except Exception as error:
-                    LOGGER.error('Could not clip static map: %s', error)
+def _memory_limit(args):
+    """Get the approximate number of bytes of polygons that may be read into
+    memory at once, or None to use the default."""
+    try:
+        return int(args['memory_limit']) * 2**20
+    except KeyError:
+        return None
 
+def _prepare_parcels(args, files, separate_natural_parcels, n_workers,
+        memory_limit=None):
+    """Prepare the offset parcels and, if they come from a different vector,
+    the natural parcels used for biodiversity impacts.
 
-    # return tempfile.tempdir to its original state.
-    tempfile.tempdir = old_temp_dir
-    shutil.rmtree(dirs['temp'])
+        args - the args dictionary passed to execute().
+        files - the dictionary of workspace files built in execute().
+        separate_natural_parcels - a boolean.  Whether the natural parcels
+            need to be prepared separately from the offset parcels.
+        n_workers - the number of worker processes to use for LCI.
+        memory_limit=None - the approximate number of bytes of parcel
+            polygons to hold in memory at once.
+
+    Returns nothing."""
+
+    LOGGER.info('Preparing offset sites')
+    preprocessing.prepare_offset_parcels(files['offset_parcels'],
+        files['active_hydrozones'], files['prep_offset_sites'],
+        include_lci=args['include_lci'], n_workers=n_workers,
+        memory_limit=memory_limit)
+
+    if separate_natural_parcels:
+        LOGGER.info('Preparing impacted natural parcels')
+
+        # Build a vector of the hydro subzones that intersect the impact sites.
+        preprocessing.locate_intersecting_polygons(args['search_areas_uri'],
+            args['project_footprint_uri'], files['global_impacted_subzones'])
+        preprocessing.union_of_vectors([files['global_impacted_subzones']],
+            files['union_of_subzones'])
 
-    write_results_index(dirs['results'], files['base_report'],
-                         distribution=args['distribution'])
+        # when buffering, include at least 1000 extra distance units of
+        # parcels, just in case there are any parcels near the boundary of the
+        # hydrozones that need to be included in the LCI calculations.
+        preprocessing.buffer_vector(files['union_of_subzones'], 1000,
+            files['buffered_subzones'])
+
+        preprocessing.prepare_offset_parcels(files['ecosystems'],
+            files['buffered_subzones'], files['prep_natural_parcels'],
+            include_lci=args['include_lci'], n_workers=n_workers,
+            memory_limit=memory_limit)
 
 def write_results_index(results_dir, out_file, distribution):
     """
@@ -841,7 +1297,22 @@ def build_report(municipalities, biodiversity_impact, selected_parcels,
     custom_es_servicesheds=None, dev_dir='_dev', service_mitrat={'carbon': 1.0,
         'nutrient': 1.0, 'sediment': 1.0}, per_offset_data=None,
     prop_offset=1.0, distribution='opal', include_aoi_column=True,
-    include_subzone_column=True, hzone_name=''):
+    include_subzone_column=True, hzone_name='', impacted_areas=None,
+    impact_overlaps=None):
+    """Build the HTML report and CSV tables of a hydrozone.  The overlap
+    tables used by the report may be passed in if they have already been
+    calculated:
+
+        impacted_areas=None - the areas of the intersections of the natural
+            parcels with the impact sites, from
+            analysis.overlap_areas(natural_parcels, impact_sites).  If None,
+            they are calculated when building the impacted parcels table.
+        impact_overlaps=None - the areas of the intersections of the impact
+            sites with the servicesheds that overlap the selected parcels,
+            from analysis.overlap_areas().  If None, they are calculated when
+            building the per-serviceshed impact data.
+
+    Returns nothing."""
 
     # sort the suggested offset parcels
     suggested_parcels = sorted(suggested_parcels)
@@ -859,8 +1330,10 @@ def build_report(municipalities, biodiversity_impact, selected_parcels,
         os.makedirs(dev_dir)
 
     # Determine which municipalities the selected polygons overlap with.
+    # This vector was written in the same format as the servicesheds.
     temp_municipalities = os.path.join(output_workspace,
-        'servicesheds_with_offset_parcels.shp')
+        'servicesheds_with_offset_parcels' +
+        utils.VECTOR_FORMATS[utils.vector_driver_name(municipalities)])
 #    per_offset_data = analysis.percent_overlap(selected_parcels,
 #        municipalities, temp_municipalities, pop_col)
 
@@ -906,7 +1379,7 @@ def build_report(municipalities, biodiversity_impact, selected_parcels,
     if not skip_biodiv:
         impacted_parcels_table = opal_reporting.impacted_parcels_table(
             impact_sites, natural_parcels, os.path.join(output_workspace,
-            'impacted_natural_ecosystems.csv'))
+            'impacted_natural_ecosystems.csv'), impacted_areas)
     else:
         impacted_parcels_table = EMPTY_REPORT_OBJ()
 
@@ -975,7 +1448,8 @@ def build_report(municipalities, biodiversity_impact, selected_parcels,
                 'data_src': json.dumps(opal_reporting.get_impact_data(
                     temp_municipalities, impact_sites, pop_col,
                     'pop_size', service_mitrat,
-                    os.path.join(dev_dir, 'serviceshed_data.json'))),
+                    os.path.join(dev_dir, 'serviceshed_data.json'),
+                    impact_overlaps)),
                 'attributes': {'id': 'impact-data'},
             },
             {
@@ -1209,77 +1683,43 @@ def write_vector(in_vector_uri, feature_indices, out_vector_uri,
 
     if os.path.exists(out_vector_uri):
         LOGGER.warning('%s already exists on disk', out_vector_uri)
-        preprocessing.rm_shapefile(out_vector_uri)
 
     LOGGER.debug('Creating a new vector at %s', out_vector_uri)
-    LOGGER.debug('Out vector type: %s', type(out_vector_uri))
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
-    out_vector = out_driver.CreateDataSource(out_vector_uri)
+    out_writer = utils.VectorWriter(out_vector_uri, in_layer_srs)
 
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(out_vector_uri)[0]))
-    out_layer = out_vector.CreateLayer(layer_name, srs=in_layer_srs)
-
-    # map the old index to the new index.
-    field_indices = {}
     if include_fields is None:
         LOGGER.debug('No fields will be copied')
         include_fields = []
 
     if include_fields is 'all':
         LOGGER.debug('All fields will be copied')
-        field_names = []
-        for index in range(in_layer_defn.GetFieldCount()):
-            field_defn = in_layer_defn.GetFieldDefn(index)
-            field_names.append(field_defn.GetName())
-        include_fields = field_names
+        include_fields = None
 
     LOGGER.debug('Copying fields %s', include_fields)
-    for old_field in include_fields:
-        old_field_index =  in_layer_defn.GetFieldIndex(old_field)
-        old_field_defn = in_layer_defn.GetFieldDefn(old_field_index)
-
-        # create a new field in the output layer based on the old field
-        # definition
-        out_layer.CreateField(old_field_defn)
-        out_layer_defn = out_layer.GetLayerDefn()
-        new_field_index = out_layer_defn.GetFieldIndex(old_field)
-        field_indices[old_field_index] = new_field_index
+    out_writer.copy_fields(in_layer_defn, include_fields)
 
     # assume new_fields is a list of fieldnames, and all new fields are floats.
     if new_fields is not None:
         LOGGER.debug('Creating new fields %s', new_fields)
-        for fieldname in new_fields:
-            try:
-                field_type = field_types[fieldname]
-            except KeyError:
-                field_type = ogr.OFTReal
-            field_defn = ogr.FieldDefn(fieldname, field_type)
-            out_layer.CreateField(field_defn)
-
-    layer_schema = map(lambda d: d.GetName(), out_layer.schema)
+        out_writer.create_fields(new_fields, field_types)
 
     index_map = {}
     for feature_index in feature_indices:
         old_feature = in_layer.GetFeature(feature_index)
-        new_feature = ogr.Feature(out_layer_defn)
-        new_feature.SetGeometry(old_feature.GetGeometryRef())
-
-        for old_index, new_index in field_indices.iteritems():
-            old_value = old_feature.GetField(old_index)
-            new_feature.SetField(new_index, old_value)
-
-            if new_values is not None:
-                for fieldname, value in new_values[feature_index].iteritems():
-                    if fieldname not in layer_schema:
-                        continue
-
-                    new_feature.SetField(fieldname, value)
 
-        out_layer.CreateFeature(new_feature)
+        feature_values = None
+        if new_values is not None:
+            feature_values = dict((fieldname, value) for (fieldname, value)
+                in new_values[feature_index].iteritems()
+                if out_writer.has_field(fieldname))
 
-        index_map[feature_index] = new_feature.GetFID()
+        index_map[feature_index] = out_writer.add_feature(
+            old_feature.GetGeometryRef(), feature_values,
+            source_feature=old_feature)
 
+    out_writer.close()
+    in_layer = None
+    in_vector = None
     return index_map
 
 
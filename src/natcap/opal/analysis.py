@@ -1,15 +1,20 @@
 import logging
 import json
 import os
+import tempfile
+import shutil
 
 from osgeo import ogr
+from osgeo import gdal
+import numpy
+import scipy.sparse
 import shapely
 import shapely.ops
-import shapely.speedups
 import shapely.wkb
 import shapely.prepared
 import pygeoprocessing
 
+import geometry as opal_geometry
 import preprocessing
 import offsets
 import utils
@@ -29,7 +34,7 @@ def aggregate_stats(raster_uri, aggregate_vector, id_field, target_field,
     # of the correct field.
 
     utils.assert_files_exist([raster_uri, aggregate_vector])
-    target_field = target_field[:8]
+    target_field = utils.vector_field_name(aggregate_vector, target_field)
 
     # collect stats under the aggregate polygon
     raster_stats = pygeoprocessing.aggregate_raster_values_uri(raster_uri,
@@ -72,11 +77,8 @@ def aggregate_stats(raster_uri, aggregate_vector, id_field, target_field,
 
     # map FID field value to polygon index
     fid_fields = {}
-    num_features = out_layer.GetFeatureCount()
-    for feature_id in xrange(num_features):
-        feature = out_layer.GetFeature(feature_id)
-        fid_field_value = feature.GetField('FID')
-        fid_fields[fid_field_value] = feature_id
+    for feature in out_layer:
+        fid_fields[feature.GetField('FID')] = feature.GetFID()
 
     # I only care about the sum under the polygons ('total' attribute)
     LOGGER.debug('Number of fields analyzed: %s', len(raster_stats))
@@ -93,13 +95,285 @@ def aggregate_stats(raster_uri, aggregate_vector, id_field, target_field,
 
     return adjusted_stats
 
+def aggregate_stats_multi(aggregate_vector, id_field, raster_stats):
+    """Aggregate the values of several rasters under the polygons of a
+    vector, writing a new field to the vector for each raster.
+
+    This calculates the same values as calling aggregate_stats() once per
+    raster, but the polygons are rasterized only once per raster grid, every
+    raster is read in the same block-by-block sweep, and all of the new
+    fields are written to the vector in a single update.  Polygons that
+    overlap other polygons are split into groups that don't overlap, and
+    each group is rasterized and swept separately within its own extent, so
+    the pixels they share are counted for each of them.
+
+        aggregate_vector - a URI to an OGR vector of polygons.  This vector
+            is modified in place.
+        id_field - the name of an integer field in aggregate_vector that
+            uniquely identifies each polygon.
+        raster_stats - a list of (target_field, raster_uri, percent_to_stream)
+            tuples.  target_field is the name of the field to create (it is
+            truncated to 8 characters), raster_uri is the raster to sum under
+            each polygon and percent_to_stream is either None or a URI to a
+            raster whose maximum value under each polygon will be multiplied
+            by the sum.
+
+    Returns a dictionary mapping each target_field (as provided) to a
+    dictionary mapping id_field values to the aggregated value."""
+
+    if len(raster_stats) == 0:
+        return {}
+
+    raster_uris = []
+    for _, raster_uri, percent_to_stream in raster_stats:
+        for uri in [raster_uri, percent_to_stream]:
+            if uri is not None and uri not in raster_uris:
+                raster_uris.append(uri)
+    utils.assert_files_exist([aggregate_vector] + raster_uris)
+
+    fids, geometries, field_values = opal_geometry.read_vector(
+        aggregate_vector, [id_field])
+    feature_ids = numpy.array(field_values[id_field], dtype=numpy.int64)
+    id_values = numpy.unique(feature_ids)
+    if len(id_values) > 0:
+        feature_bounds = opal_geometry.bounds(geometries)
+        extent = (numpy.nanmin(feature_bounds[:, 0]),
+            numpy.nanmax(feature_bounds[:, 2]),
+            numpy.nanmin(feature_bounds[:, 1]),
+            numpy.nanmax(feature_bounds[:, 3]))
+    else:
+        extent = None
+    overlap_groups = _overlapping_id_groups(feature_ids, geometries)
+
+    # Group the rasters by their grid so that the polygons only need to be
+    # rasterized once per grid.
+    grids = {}
+    for raster_uri in raster_uris:
+        raster = gdal.Open(raster_uri)
+        grid_key = (tuple(raster.GetGeoTransform()), raster.RasterXSize,
+            raster.RasterYSize)
+        raster = None
+        try:
+            grids[grid_key].append(raster_uri)
+        except KeyError:
+            grids[grid_key] = [raster_uri]
+
+    # pixel totals and maximum values under each polygon, indexed by the
+    # position of the polygon's ID in id_values.
+    num_ids = len(id_values)
+    pixel_counts = numpy.zeros(num_ids, dtype=numpy.int64)
+    raster_totals = dict((uri, numpy.zeros(num_ids)) for uri in raster_uris)
+    raster_maxima = dict((uri, numpy.empty(num_ids)) for uri in raster_uris)
+    raster_valid = dict((uri, numpy.zeros(num_ids, dtype=bool))
+        for uri in raster_uris)
+    for maxima in raster_maxima.values():
+        maxima.fill(-numpy.inf)
+
+    # Pixels of overlapping polygons are skipped in the raster of all of the
+    # polygons, since they may have been burned with another polygon's ID.
+    overlapping_positions = numpy.zeros(num_ids, dtype=bool)
+    for group_ids in overlap_groups:
+        overlapping_positions[numpy.searchsorted(id_values, group_ids)] = True
+
+    id_nodata = -1
+    def _sweep(id_raster_uri, window, grid_rasters, skip_positions):
+        id_raster = gdal.Open(id_raster_uri)
+        id_band = id_raster.GetRasterBand(1)
+        open_bands = []
+        for raster_uri in grid_rasters:
+            raster = gdal.Open(raster_uri)
+            band = raster.GetRasterBand(1)
+            open_bands.append((raster_uri, raster, band,
+                band.GetNoDataValue()))
+
+        x_offset, y_offset, n_cols, n_rows = window
+        for (block_x, block_y, block_cols, block_rows) in (
+                utils.block_windows(n_cols, n_rows,
+                    id_band.GetBlockSize())):
+            id_block = id_band.ReadAsArray(block_x, block_y, block_cols,
+                block_rows)
+            under_polygons = id_block != id_nodata
+            if not under_polygons.any():
+                continue
+
+            id_positions = numpy.searchsorted(id_values,
+                id_block[under_polygons])
+            if skip_positions is not None:
+                counted = ~skip_positions[id_positions]
+                under_polygons[under_polygons] = counted
+                id_positions = id_positions[counted]
+            pixel_counts[:] += numpy.bincount(id_positions,
+                minlength=num_ids)
+
+            for raster_uri, _, band, nodata in open_bands:
+                values = band.ReadAsArray(x_offset + block_x,
+                    y_offset + block_y, block_cols,
+                    block_rows)[under_polygons]
+                if nodata is not None:
+                    valid_mask = values != nodata
+                    values = values[valid_mask]
+                    valid_positions = id_positions[valid_mask]
+                else:
+                    valid_positions = id_positions
+
+                raster_totals[raster_uri] += numpy.bincount(
+                    valid_positions, weights=values, minlength=num_ids)
+                numpy.maximum.at(raster_maxima[raster_uri],
+                    valid_positions, values)
+                raster_valid[raster_uri][valid_positions] = True
+
+        open_bands = None
+        id_band = None
+        id_raster = None
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for grid_index, grid_rasters in enumerate(grids.values()):
+            if extent is None:
+                break
+            window = utils.raster_window_for_extent(grid_rasters[0], extent)
+            if window is None:
+                LOGGER.debug('%s does not overlap %s', aggregate_vector,
+                    grid_rasters)
+                continue
+
+            id_raster_uri = os.path.join(temp_dir, 'ids_%s.tif' % grid_index)
+            LOGGER.debug('Rasterizing %s for %s rasters', aggregate_vector,
+                len(grid_rasters))
+            utils.rasterize_feature_ids(aggregate_vector, id_field,
+                grid_rasters[0], window, id_raster_uri, id_nodata)
+            _sweep(id_raster_uri, window, grid_rasters,
+                overlapping_positions if len(overlap_groups) > 0 else None)
+
+            for group_index, group_ids in enumerate(overlap_groups):
+                in_group = numpy.in1d(feature_ids, group_ids)
+                group_bounds = feature_bounds[in_group]
+                group_window = utils.raster_window_for_extent(
+                    grid_rasters[0], (numpy.nanmin(group_bounds[:, 0]),
+                        numpy.nanmax(group_bounds[:, 2]),
+                        numpy.nanmin(group_bounds[:, 1]),
+                        numpy.nanmax(group_bounds[:, 3])))
+                if group_window is None:
+                    continue
+                group_raster_uri = os.path.join(temp_dir, 'ids_%s_%s.tif' % (
+                    grid_index, group_index))
+                utils.rasterize_feature_ids(aggregate_vector, id_field,
+                    grid_rasters[0], group_window, group_raster_uri,
+                    id_nodata, fids=fids[in_group].tolist())
+                _sweep(group_raster_uri, group_window, grid_rasters, None)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    # Only polygons that cover at least one pixel have aggregated values.
+    covered_ids = [(position, int(id_value)) for (position, id_value) in
+        enumerate(id_values) if pixel_counts[position] > 0]
+
+    aggregated_stats = {}
+    for target_field, raster_uri, percent_to_stream in raster_stats:
+        field_stats = {}
+        for position, id_value in covered_ids:
+            pixel_sum = float(raster_totals[raster_uri][position])
+            if percent_to_stream is not None:
+                if raster_valid[percent_to_stream][position]:
+                    pixel_sum *= float(
+                        raster_maxima[percent_to_stream][position])
+                else:
+                    pixel_sum *= 0.0
+            field_stats[id_value] = pixel_sum
+        aggregated_stats[target_field] = field_stats
+
+    LOGGER.debug('Opening aggregate vector for editing')
+    out_vector = ogr.Open(aggregate_vector, 1)
+    out_layer = out_vector.GetLayer()
+
+    field_names = dict((target_field, utils.vector_field_name(
+        aggregate_vector, target_field)) for (target_field, _, _) in
+        raster_stats)
+    for target_field, _, _ in raster_stats:
+        LOGGER.debug('Adding new field "%s"', field_names[target_field])
+        new_field_defn = ogr.FieldDefn(field_names[target_field],
+            ogr.OFTReal)
+        out_layer.CreateField(new_field_defn)
+
+    # map the id field value to the feature ID
+    fid_fields = {}
+    for feature in out_layer:
+        fid_fields[feature.GetField(id_field)] = feature.GetFID()
+
+    out_layer.StartTransaction()
+    for id_value, feature_id in fid_fields.iteritems():
+        feature = out_layer.GetFeature(feature_id)
+        for target_field, field_stats in aggregated_stats.iteritems():
+            try:
+                feature.SetField(field_names[target_field],
+                    field_stats[id_value])
+            except KeyError:
+                # This polygon didn't cover any pixels.
+                pass
+        out_layer.SetFeature(feature)
+    out_layer.CommitTransaction()
+
+    out_layer.SyncToDisk()
+    out_layer = None
+    ogr.DataSource.__swig_destroy__(out_vector)
+    out_vector = None
+
+    return aggregated_stats
+
+def _overlapping_id_groups(feature_ids, geometries):
+    """Find the polygons whose interiors overlap a polygon with a different
+    ID, and split their IDs into groups in which no two IDs overlap.
+
+        feature_ids - a 1D numpy array of the ID of each polygon.
+        geometries - an array of the shapely polygons, in the same order.
+
+    Returns a list of sorted lists of IDs.  The list is empty if no polygons
+    overlap."""
+
+    indices_a, indices_b = opal_geometry.intersecting_pairs(geometries,
+        geometries)
+    candidates = feature_ids[indices_a] < feature_ids[indices_b]
+    indices_a = indices_a[candidates]
+    indices_b = indices_b[candidates]
+    # polygons that only share an edge or a corner don't overlap.
+    overlapping = opal_geometry.area(opal_geometry.intersection(
+        geometries[indices_a], geometries[indices_b])) > 0
+
+    neighbors = {}
+    for id_a, id_b in zip(feature_ids[indices_a[overlapping]].tolist(),
+            feature_ids[indices_b[overlapping]].tolist()):
+        neighbors.setdefault(id_a, set()).add(id_b)
+        neighbors.setdefault(id_b, set()).add(id_a)
+
+    # greedy coloring of the overlap graph.
+    group_ids = []
+    id_groups = {}
+    for id_value in sorted(neighbors):
+        neighbor_groups = set(id_groups.get(neighbor) for neighbor in
+            neighbors[id_value])
+        group_index = 0
+        while group_index in neighbor_groups:
+            group_index += 1
+        if group_index == len(group_ids):
+            group_ids.append([])
+        group_ids[group_index].append(id_value)
+        id_groups[id_value] = group_index
+    return group_ids
+
 def calculate_biodiversity_impact(permitting_area_ds_uri, ecosystems_ds_uri):
     """Generates a dictionary indexed by ecosystem name that has both the
         impacted area and required offset area for mitigation.
 
-        permitting_area_ds_uri -
+        The impact polygons are indexed with an rtree, so each natural parcel
+        is only intersected with the impact polygons around it rather than
+        with the union of all impacts.  Only the parcels within the bounding
+        box of the impacts are read.
 
-        ecosystems_ds_uri -
+        permitting_area_ds_uri - a URI to an OGR vector of impact sites.
+
+        ecosystems_ds_uri - a URI to an OGR vector of natural parcels with
+            'ecosystem' and 'mit_ratio' fields, and optionally 'LCI',
+            'Threat' and 'Richness' fields.
 
         returns a dictionary of the format
             {
@@ -114,214 +388,318 @@ def calculate_biodiversity_impact(permitting_area_ds_uri, ecosystems_ds_uri):
 
     utils.assert_files_exist([permitting_area_ds_uri, ecosystems_ds_uri])
 
-    #1) Load the permitting_area dataset into a shapely permitting_area_polygon
+    opal_geometry.enable_speedups()
+
+    #1) Load the impact polygons and index them.
     permitting_area_ds = ogr.Open(permitting_area_ds_uri)
     permitting_area_layer = permitting_area_ds.GetLayer()
-    polygon_list = []
-    for feature_index in xrange(permitting_area_layer.GetFeatureCount()):
-        feature = permitting_area_layer.GetFeature(feature_index)
+    impact_polygons = []
+    for feature in permitting_area_layer:
         geometry = feature.GetGeometryRef()
-        polygon_list.append(shapely.wkb.loads(geometry.ExportToWkb()))
-    permitting_area_polygon = shapely.ops.cascaded_union(polygon_list)
-
-    if not permitting_area_polygon.is_valid:
-        raise IOError('Permitting area is not a valid polygon')
-
-
-    #2) Make a spatial index?
-    if shapely.speedups.available:
-        LOGGER.debug('Enabling shapely speedups')
-        shapely.speedups.enable()
-
-    impacts_schema = [f.GetName() for f in permitting_area_layer.schema]
-
-    #3) Loop through each feature in permitting_area ds and build a polygon out of it
-    biodiversity_impacts = {}
+        polygon = shapely.wkb.loads(geometry.ExportToWkb())
+        if polygon.is_empty:
+            continue
+        if not polygon.is_valid:
+            raise IOError('Permitting area is not a valid polygon')
+        impact_polygons.append(polygon)
+    permitting_area_layer = None
+    permitting_area_ds = None
+    impact_index = preprocessing.build_geometry_index(impact_polygons)
+
+    #2) Find the area of each natural parcel covered by the impacts.  Impact
+    # polygons may overlap each other, so the pieces of the impacts within a
+    # parcel are unioned before their area is measured.
     ecosystems_ds = ogr.Open(ecosystems_ds_uri)
     ecosystems_ds_layer = ecosystems_ds.GetLayer()
-
-    # determine if we want to also record ES impacts.
-    ecosystems_schema = set(map(lambda f: f.GetName(),
-        ecosystems_ds_layer.schema))
-    _services_map = {
-        'mitrat_c': 'carbon',
-        'mitrat_s': 'sediment',
-        'mitrat_n': 'nitrogen',
-        'mitrat_cus': 'custom'
-    }
-    services = []
-    for column_name, service_name in _services_map.iteritems():
-        if column_name in ecosystems_schema:
-            services.append(service_name)
-    services = sorted(services)
-
-    for feature_index in xrange(ecosystems_ds_layer.GetFeatureCount()):
-        feature = ecosystems_ds_layer.GetFeature(feature_index)
-        _get = lambda x: feature.GetField(x)
-        ecosystem_type = _get('ecosystem')
-        impact_factor = _get('mit_ratio')
-        try:
-            parcel_lci = _get('LCI')
-        except ValueError:
-            parcel_lci = None
-
-        try:
-            threat_score = _get('Threat')
-        except ValueError:
-            threat_score = None
-
-        try:
-            richness_score = _get('Richness')
-        except ValueError:
-            richness_score = None
-
+    utils.set_spatial_filter(ecosystems_ds_layer, impact_polygons)
+
+    ecosystem_types = []  # in the order they were first impacted
+    ecosystem_ids = {}
+    parcel_ecosystems = []
+    parcel_stats = []  # impacted area, mit ratio and parcel area, in ha
+    parcel_scores = {'LCI': [], 'Threat': [], 'Richness': []}
+    for feature in ecosystems_ds_layer:
         geometry = feature.GetGeometryRef()
         polygon = shapely.wkb.loads(geometry.ExportToWkb())
         prepared_polygon = shapely.prepared.prep(polygon)
-        if prepared_polygon.intersects(permitting_area_polygon):
-            LOGGER.debug('Permitting area intersects.  Calculating area overlap')
-            intersection = permitting_area_polygon.intersection(polygon)
-
-            # dividing by 10,000 gives us ha.
-            impacted_area = intersection.area / 10000.0
-            mitigation_area = impacted_area * impact_factor
-            impacted_parcel_area = (polygon.area / 10000.0)
+        impacts = [impact_polygons[impact_id] for impact_id in
+            sorted(impact_index.intersection(polygon.bounds))
+            if prepared_polygon.intersects(impact_polygons[impact_id])]
+        if len(impacts) == 0:
+            continue
+
+        if len(impacts) == 1:
+            intersection = polygon.intersection(impacts[0])
+        else:
+            intersection = shapely.ops.cascaded_union(
+                [polygon.intersection(impact) for impact in impacts])
+
+        ecosystem_type = feature.GetField('ecosystem')
+        try:
+            ecosystem_id = ecosystem_ids[ecosystem_type]
+        except KeyError:
+            ecosystem_id = ecosystem_ids[ecosystem_type] = len(
+                ecosystem_types)
+            ecosystem_types.append(ecosystem_type)
+        parcel_ecosystems.append(ecosystem_id)
+
+        # dividing by 10,000 gives us ha.
+        parcel_stats.append((intersection.area / 10000.0,
+            feature.GetField('mit_ratio'), polygon.area / 10000.0))
+
+        for field_name, scores in parcel_scores.iteritems():
             try:
-                # If we have already found a parcel with this ecosystem type,
-                # then we want to update the tracked amounts of biodiversity
-                # that has been impacted and is required for offsets.
-                ecosystem_impacts = biodiversity_impacts[ecosystem_type]
-                ecosystem_impacts['impacted_area'] += impacted_area
-                ecosystem_impacts['mitigation_area'] += mitigation_area
-
-                previous_min = ecosystem_impacts['min_impacted_parcel_area']
-                if previous_min > impacted_parcel_area:
-                    ecosystem_impacts['min_impacted_parcel_area'] = impacted_parcel_area
-
-                ecosystem_impacts['min_lci'] = max(
-                    ecosystem_impacts['min_lci'], parcel_lci)
-
-                ecosystem_impacts['max_threat'] = max(
-                    ecosystem_impacts['max_threat'], threat_score)
+                scores.append(feature.GetField(field_name))
+            except ValueError:
+                scores.append(None)
 
-                ecosystem_impacts['min_richness'] = min(
-                    ecosystem_impacts['min_richness'], richness_score)
+    ecosystems_ds_layer = None
+    ecosystems_ds = None
 
-                ecosystem_impacts['patches_impacted'] += 1
+    #3) Aggregate the stats of the impacted parcels by ecosystem.
+    biodiversity_impacts = {}
+    if len(parcel_ecosystems) == 0:
+        LOGGER.debug('No natural parcels are impacted.')
+        return biodiversity_impacts
+
+    parcel_ecosystems = numpy.array(parcel_ecosystems)
+    parcel_stats = numpy.array(parcel_stats, dtype=numpy.float64)
+    n_ecosystems = len(ecosystem_types)
+    _sum = lambda weights: numpy.bincount(parcel_ecosystems, weights=weights,
+        minlength=n_ecosystems)
+    impacted_areas = _sum(parcel_stats[:, 0])
+    mitigation_areas = _sum(parcel_stats[:, 0] * parcel_stats[:, 1])
+    patches_impacted = numpy.bincount(parcel_ecosystems,
+        minlength=n_ecosystems)
+    min_parcel_areas = numpy.empty(n_ecosystems)
+    min_parcel_areas.fill(numpy.inf)
+    numpy.minimum.at(min_parcel_areas, parcel_ecosystems, parcel_stats[:, 2])
+
+    # Missing scores are None, which compares less than any number.  So the
+    # maximum scores ignore missing scores, but a missing richness is the
+    # minimum richness.
+    def _reduce_scores(field_name, ufunc, ignore_missing):
+        scores = parcel_scores[field_name]
+        present = numpy.array([score is not None for score in scores])
+        values = numpy.array([score for score in scores if score is not None],
+            dtype=numpy.float64)
+        reduced = numpy.empty(n_ecosystems)
+        reduced.fill(numpy.inf if ufunc is numpy.minimum else -numpy.inf)
+        ufunc.at(reduced, parcel_ecosystems[present], values)
+        n_present = numpy.bincount(parcel_ecosystems[present],
+            minlength=n_ecosystems)
+        return [None if (n_present[i] == 0 or (not ignore_missing and
+            n_present[i] < patches_impacted[i])) else float(reduced[i])
+            for i in xrange(n_ecosystems)]
+
+    min_lci = _reduce_scores('LCI', numpy.maximum, ignore_missing=True)
+    max_threat = _reduce_scores('Threat', numpy.maximum, ignore_missing=True)
+    min_richness = _reduce_scores('Richness', numpy.minimum,
+        ignore_missing=False)
+
+    for ecosystem_id, ecosystem_type in enumerate(ecosystem_types):
+        # Use the mean mitigation ratio.
+        impacted_area = float(impacted_areas[ecosystem_id])
+        mitigation_area = float(mitigation_areas[ecosystem_id])
+        biodiversity_impacts[ecosystem_type] = {
+            'impacted_area': impacted_area,
+            'mitigation_ratio': mitigation_area / (impacted_area or 1.0),
+            'mitigation_area': mitigation_area,
+            'min_impacted_parcel_area': float(min_parcel_areas[ecosystem_id]),
+            'min_lci': min_lci[ecosystem_id],
+            'max_threat': max_threat[ecosystem_id],
+            'min_richness': min_richness[ecosystem_id],
+            'patches_impacted': int(patches_impacted[ecosystem_id]),
+        }
+        LOGGER.debug('%s overlaps: %s, required offset: %s Ha',
+            ecosystem_type, impacted_area, mitigation_area)
 
-            except KeyError:
-                # If we have not yet impacted a parcel with this ecosystem
-                # type, then create a new dictionary for tracking its relevant
-                # information.
-                ecosystem_impacts = {
-                    'impacted_area': impacted_area,
-                    'mitigation_ratio': impact_factor,
-                    'mitigation_area': mitigation_area,
-                    'min_impacted_parcel_area': impacted_parcel_area,
-                    'min_lci': parcel_lci,
-                    'max_threat': threat_score,
-                    'min_richness': richness_score,
-                    'patches_impacted': 1,
-                }
-
-            # Use the mean mitigation ratio.
-            impacted_area = ecosystem_impacts['impacted_area']
-            if impacted_area == 0:
-                impacted_area = 1.0
-
-            ecosystem_impacts['mitigation_ratio'] = (
-                float(ecosystem_impacts['mitigation_area']) / float(impacted_area))
-
-            biodiversity_impacts[ecosystem_type] = ecosystem_impacts
-
-            LOGGER.debug('Overlaps: %s',
-                biodiversity_impacts[ecosystem_type]['impacted_area'])
-            LOGGER.debug('Required offset: %s Ha',
-                biodiversity_impacts[ecosystem_type]['mitigation_area'])
     LOGGER.debug('Done.')
     return biodiversity_impacts
 
 # TODO: make temp_file optional
-def percent_overlap(offset_sites, municipalities, temp_file, pop_col):
+def percent_overlap(offset_sites, municipalities, temp_file, pop_col,
+        sparse=False, memory_limit=None):
+    """Calculate the fraction of each offset site that overlaps each
+    municipality (serviceshed).  Offset sites are read in spatial tiles (see
+    utils.TiledVectorReader) along with the municipalities around each tile.
+
+        offset_sites - a URI to an OGR vector of offset sites.
+        municipalities - a URI to an OGR vector of municipalities.
+        temp_file - a URI to where the municipalities intersecting the offset
+            sites will be saved.
+        pop_col - the string name of the municipality field to use as the
+            municipality name.
+        sparse=False - whether to also return the overlap as a sparse
+            matrix.
+        memory_limit=None - the approximate number of bytes the polygons of
+            a tile of offset sites may use.  Defaults to
+            utils.DEFAULT_TILE_MEMORY.
+
+    Returns a dict mapping offset site FIDs to a dict of the offset site's
+    fields (capitalized) and a 'municipalities' dict mapping municipality
+    names to the fraction of the site overlapping the municipality.
+
+    If sparse is True, returns a tuple of (that dict, a sorted list of
+    municipality names, a scipy.sparse CSR matrix of overlap fractions),
+    where the matrix has one row per offset site in order of FID and one
+    column per municipality name."""
     utils.assert_files_exist([offset_sites, municipalities])
 
     # first, get a set of municipalities polygons that intersect
     preprocessing.locate_intersecting_polygons(municipalities, offset_sites,
         temp_file)
 
+    offsets_reader = utils.TiledVectorReader(offset_sites, memory_limit)
+    munis_reader = utils.TiledVectorReader(temp_file, memory_limit)
+
     offset_vector = ogr.Open(offset_sites)
     offset_layer = offset_vector.GetLayer()
-    offset_schema = [f.GetName() for f in offset_layer.schema]
 
     # These are columns in the vector that we want to skip, probably because we
     # want the offset_data dictionary key to be something custom.
     known_columns = ['ecosystem']
 
-    all_offsets = {}
-    for offset_feature in offset_layer:
-        offset_fid = offset_feature.GetFID()
-        offset_geometry = offset_feature.GetGeometryRef()
-        offset_area = offset_geometry.Area()
-        shapely_polygon = offsets.build_shapely_polygon(offset_feature)
-        offset_data = {
-#            'sediment': offset_feature.GetField('sediment'),
-#            'nutrient': offset_feature.GetField('nutrient'),
-#            'carbon': offset_feature.GetField('carbon'),
-#            'distance': offset_feature.GetField('distance'),
-            'area': offset_area,
-            'polygon': shapely_polygon,
-            'prep_polygon': shapely.prepared.prep(shapely_polygon),
-        }
-        if 'ecosystem' in offset_schema:
-            offset_data['ecosystem'] = offset_feature.GetField('ecosystem')
-
-        for field_name, field_value in offset_feature.items().iteritems():
-            if field_name not in known_columns:
-                offset_data[field_name] = field_value
-
-        all_offsets[offset_fid] = offset_data
-
-    temp_vector = ogr.Open(temp_file)
-    temp_layer = temp_vector.GetLayer()
-
-
     final_data = {}
-    for offset_fid, offset_data in all_offsets.iteritems():
-        offset_area = offset_data['polygon'].area
-        final_offset_data = {
-#            'Sediment': offset_data['sediment'],
-#            'Nitrogen': offset_data['nutrient'],
-#            'Carbon': offset_data['carbon'],
-#            'distance': offset_data['distance'],
-#            'ecosystem': offset_data['ecosystem'],
-#            'area': offset_data['area'],
-            'municipalities': {}
-        }
-
-        for offset_key, offset_value in offset_data.iteritems():
-            if offset_key in ['polygon', 'prep_polygon']:
-                continue
-
-            if offset_key.lower() == 'nutrient':
-                offset_key = 'nitrogen'
-
-            final_offset_data[offset_key.capitalize()] = offset_value
-
-        for municipality in temp_layer:
-            m_polygon = offsets.build_shapely_polygon(municipality)
-            m_name = municipality.GetField(pop_col)
-
-            # check to see if there's overlap.
-            if offset_data['prep_polygon'].intersects(m_polygon):
-                inter_area = offset_data['polygon'].intersection(m_polygon).area
-
-                overlap_ratio = inter_area / offset_area
-
-                if overlap_ratio > 0:
-                    final_offset_data['municipalities'][m_name] = overlap_ratio
-        temp_layer.ResetReading()
-        final_data[offset_fid] = final_offset_data
-    return final_data
+    all_m_names = set()
+    for tile_offsets, _ in offsets_reader.iter_tiles():
+        # Parse and index the municipalities around this tile's offset
+        # sites.  They're read in layer order, so later municipalities with
+        # the same name replace earlier ones.
+        tile_bounds = [polygon.bounds for (_, polygon, _) in tile_offsets]
+        tile_munis = munis_reader.read(munis_reader.intersecting((
+            min(b[0] for b in tile_bounds), min(b[1] for b in tile_bounds),
+            max(b[2] for b in tile_bounds), max(b[3] for b in tile_bounds))),
+            [pop_col])
+        m_names = [values[pop_col] for (_, _, values) in tile_munis]
+        m_polygons = [polygon for (_, polygon, _) in tile_munis]
+        m_index = preprocessing.build_geometry_index(m_polygons)
+        all_m_names.update(m_names)
+
+        for offset_fid, offset_polygon, _ in tile_offsets:
+            final_data[offset_fid] = _offset_overlap(
+                offset_layer.GetFeature(offset_fid), offset_polygon,
+                m_names, m_polygons, m_index, known_columns)
+
+    offsets_reader.close()
+    munis_reader.close()
+    offset_layer = None
+    offset_vector = None
+
+    if not sparse:
+        return final_data
+
+    sshed_names = sorted(all_m_names)
+    sshed_columns = dict((name, col) for (col, name) in
+        enumerate(sshed_names))
+    rows = []
+    cols = []
+    ratios = []
+    for row, offset_fid in enumerate(sorted(final_data)):
+        for m_name, overlap_ratio in (
+                final_data[offset_fid]['municipalities'].iteritems()):
+            rows.append(row)
+            cols.append(sshed_columns[m_name])
+            ratios.append(overlap_ratio)
+    overlap_matrix = scipy.sparse.csr_matrix((ratios, (rows, cols)),
+        shape=(len(final_data), len(sshed_names)))
+    return final_data, sshed_names, overlap_matrix
+
+def overlap_areas(vector_a_uri, vector_b_uri, memory_limit=None):
+    """Calculate the area of the intersection of each pair of overlapping
+    polygons from two vectors.  The polygons of vector A are read in spatial
+    tiles (see utils.TiledVectorReader), and the polygons of vector B around
+    each tile are indexed, so each polygon is only intersected with the
+    polygons near it.  The intersections of each tile are computed as arrays
+    (see natcap.opal.geometry).
+
+        vector_a_uri - a URI to an OGR vector of polygons.
+        vector_b_uri - a URI to an OGR vector of polygons.
+        memory_limit=None - the approximate number of bytes the polygons of
+            a tile may use.  Defaults to utils.DEFAULT_TILE_MEMORY.
+
+    Returns a dict mapping the FID of each polygon in vector A that overlaps
+    any polygons in vector B to a dict mapping the FIDs of those polygons to
+    the area of the intersection.  Polygons that only touch are not
+    included."""
+    utils.assert_files_exist([vector_a_uri, vector_b_uri])
+
+    a_reader = utils.TiledVectorReader(vector_a_uri, memory_limit)
+    b_reader = utils.TiledVectorReader(vector_b_uri, memory_limit)
+
+    areas = {}
+    for tile_a, _ in a_reader.iter_tiles():
+        tile_bounds = [polygon.bounds for (_, polygon, _) in tile_a]
+        tile_b = b_reader.read(b_reader.intersecting((
+            min(b[0] for b in tile_bounds), min(b[1] for b in tile_bounds),
+            max(b[2] for b in tile_bounds), max(b[3] for b in tile_bounds))))
+        if len(tile_b) == 0:
+            continue
+
+        a_fids = [fid for (fid, _, _) in tile_a]
+        a_polygons = opal_geometry.as_array(
+            polygon for (_, polygon, _) in tile_a)
+        b_fids = [fid for (fid, _, _) in tile_b]
+        b_polygons = opal_geometry.as_array(
+            polygon for (_, polygon, _) in tile_b)
+
+        a_indices, b_indices = opal_geometry.intersecting_pairs(a_polygons,
+            b_polygons)
+        intersection_areas = opal_geometry.area(opal_geometry.intersection(
+            a_polygons[a_indices], b_polygons[b_indices]))
+        for a_index, b_index, intersection_area in zip(a_indices, b_indices,
+                intersection_areas):
+            if intersection_area > 0:
+                areas.setdefault(a_fids[a_index], {})[b_fids[b_index]] = (
+                    float(intersection_area))
+
+    a_reader.close()
+    b_reader.close()
+    return areas
+
+def _offset_overlap(offset_feature, offset_polygon, m_names, m_polygons,
+        m_index, known_columns):
+    """Calculate the fraction of a single offset site that overlaps each
+    municipality.  See percent_overlap().
+
+        offset_feature - the ogr.Feature of the offset site.
+        offset_polygon - the shapely polygon of the offset site.
+        m_names - a list of municipality names.
+        m_polygons - a list of the shapely polygons of the municipalities.
+        m_index - an rtree index of m_polygons.
+        known_columns - a list of fields handled specially.
+
+    Returns a dict of the offset site's data."""
+    offset_area = offset_polygon.area
+    final_offset_data = {
+        'Area': offset_feature.GetGeometryRef().Area(),
+        'municipalities': {},
+    }
+    for field_name, field_value in offset_feature.items().iteritems():
+        if field_name in known_columns:
+            final_offset_data['Ecosystem'] = field_value
+            continue
+
+        if field_name.lower() == 'nutrient':
+            field_name = 'nitrogen'
+        final_offset_data[field_name.capitalize()] = field_value
+
+    # Later municipalities with the same name replace earlier ones, so
+    # visit the candidates in layer order.
+    prep_polygon = shapely.prepared.prep(offset_polygon)
+    for m_index_id in sorted(m_index.intersection(offset_polygon.bounds)):
+        m_polygon = m_polygons[m_index_id]
+
+        # check to see if there's overlap.
+        if prep_polygon.intersects(m_polygon):
+            inter_area = offset_polygon.intersection(m_polygon).area
+
+            overlap_ratio = inter_area / offset_area
+
+            if overlap_ratio > 0:
+                final_offset_data['municipalities'][
+                    m_names[m_index_id]] = overlap_ratio
+    return final_offset_data
 
 def vectors_intersect(vector_1_uri, vector_2_uri):
     """Take in two OGR vectors (we're assuming that they're in the same
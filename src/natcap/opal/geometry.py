@@ -0,0 +1,196 @@
+"""Operations on arrays of shapely geometries.
+
+Geometries are held in numpy object arrays, and the elementwise functions
+broadcast their arguments like numpy ufuncs.  This lets callers replace their
+per-feature loops with a few calls on whole arrays, and keeps those loops in
+one place."""
+import logging
+
+import numpy
+import rtree
+import shapely.geometry.base
+import shapely.ops
+import shapely.prepared
+import shapely.wkb
+from osgeo import ogr
+
+LOGGER = logging.getLogger('natcap.opal.geometry')
+
+
+def enable_speedups():
+    """Enable shapely's C speedups if they're available and not already
+    enabled.
+
+    Returns nothing."""
+    import shapely.speedups
+    if shapely.speedups.available and not getattr(shapely.speedups,
+            'enabled', False):
+        LOGGER.debug('Enabling shapely speedups')
+        shapely.speedups.enable()
+
+
+def as_array(geometries):
+    """Convert geometries to a numpy object array.
+
+        geometries - a numpy array, a single shapely geometry or an iterable
+            of shapely geometries.
+
+    Returns a numpy object array.  A single geometry becomes a 0-d array."""
+    if isinstance(geometries, numpy.ndarray):
+        return geometries
+
+    if isinstance(geometries, shapely.geometry.base.BaseGeometry):
+        array = numpy.empty((), dtype=object)
+        array[()] = geometries
+        return array
+
+    # Geometries are assigned one at a time, since numpy would otherwise try
+    # to unpack multi-part geometries (and coordinates, with shapely 1).
+    geometries = list(geometries)
+    array = numpy.empty(len(geometries), dtype=object)
+    for index, geometry in enumerate(geometries):
+        array[index] = geometry
+    return array
+
+
+def from_wkb(wkb_strings):
+    """Parse a sequence of WKB strings.
+
+    Returns a numpy object array of shapely geometries."""
+    return as_array(shapely.wkb.loads(wkb) for wkb in wkb_strings)
+
+
+def to_wkb(geometries):
+    """Convert an array of geometries to a list of WKB strings."""
+    return [geometry.wkb for geometry in as_array(geometries)]
+
+
+def read_vector(vector_uri, field_names=None):
+    """Read all of the geometries in the first layer of an OGR vector into an
+    array.  As in utils.build_shapely_polygon(), the rings of each geometry
+    are closed before it's parsed.
+
+        vector_uri - a URI to an OGR vector.
+        field_names=None - a list of the names of fields whose values should
+            also be read.
+
+    Returns a tuple of (fids, geometries, values), where fids is a numpy
+    array of the feature IDs, geometries is a numpy object array of the
+    shapely geometries in the same order, and values is a dict mapping each
+    field name to a list of the field's values in the same order."""
+    if field_names is None:
+        field_names = []
+
+    vector = ogr.Open(vector_uri)
+    layer = vector.GetLayer()
+    fids = []
+    wkb_strings = []
+    values = dict((field_name, []) for field_name in field_names)
+    for feature in layer:
+        fids.append(feature.GetFID())
+        ogr_geometry = feature.GetGeometryRef()
+        ogr_geometry.CloseRings()
+        wkb_strings.append(ogr_geometry.ExportToWkb())
+        for field_name in field_names:
+            values[field_name].append(feature.GetField(field_name))
+    layer = None
+    vector = None
+
+    return (numpy.array(fids, dtype=numpy.int64), from_wkb(wkb_strings),
+        values)
+
+
+_intersects = numpy.frompyfunc(lambda a, b: a.intersects(b), 2, 1)
+_intersection = numpy.frompyfunc(lambda a, b: a.intersection(b), 2, 1)
+_difference = numpy.frompyfunc(lambda a, b: a.difference(b), 2, 1)
+_distance = numpy.frompyfunc(lambda a, b: a.distance(b), 2, 1)
+_buffer = numpy.frompyfunc(lambda a, d: a.buffer(d), 2, 1)
+_area = numpy.frompyfunc(lambda a: a.area, 1, 1)
+
+
+def intersects(geometries_a, geometries_b):
+    """Return a boolean array of whether each pair of geometries
+    intersects."""
+    return numpy.asarray(_intersects(as_array(geometries_a),
+        as_array(geometries_b)), dtype=bool)
+
+
+def intersection(geometries_a, geometries_b):
+    """Return an object array of the intersection of each pair of
+    geometries."""
+    return _intersection(as_array(geometries_a), as_array(geometries_b))
+
+
+def difference(geometries_a, geometries_b):
+    """Return an object array of the parts of each geometry in geometries_a
+    that are not in the paired geometry in geometries_b."""
+    return _difference(as_array(geometries_a), as_array(geometries_b))
+
+
+def distance(geometries_a, geometries_b):
+    """Return a float array of the distance between each pair of
+    geometries."""
+    return numpy.asarray(_distance(as_array(geometries_a),
+        as_array(geometries_b)), dtype=numpy.float64)
+
+
+def buffer(geometries, distances):
+    """Return an object array of each geometry buffered by a distance.
+    distances may be a single number or an array."""
+    return _buffer(as_array(geometries),
+        numpy.asarray(distances, dtype=numpy.float64))
+
+
+def area(geometries):
+    """Return a float array of the area of each geometry."""
+    return numpy.asarray(_area(as_array(geometries)), dtype=numpy.float64)
+
+
+def bounds(geometries):
+    """Return an (n, 4) float array of the (minx, miny, maxx, maxy) bounds
+    of each geometry.  The bounds of empty geometries are NaN."""
+    geometries = as_array(geometries)
+    result = numpy.empty((geometries.size, 4), dtype=numpy.float64)
+    result.fill(numpy.nan)
+    for index, geometry in enumerate(geometries.ravel()):
+        if not geometry.is_empty:
+            result[index] = geometry.bounds
+    return result
+
+
+def union_all(geometries):
+    """Return the union of an array of geometries as a single geometry."""
+    geometries = as_array(geometries).ravel()
+    return shapely.ops.cascaded_union(list(geometries))
+
+
+def intersecting_pairs(geometries_a, geometries_b):
+    """Find all of the pairs of geometries from two arrays that intersect,
+    using a spatial index of geometries_b.
+
+    Returns a tuple of two integer arrays (indices_a, indices_b), where
+    geometries_a[indices_a[i]] intersects geometries_b[indices_b[i]].  The
+    pairs are sorted by indices_a, then by indices_b."""
+    geometries_a = as_array(geometries_a).ravel()
+    geometries_b = as_array(geometries_b).ravel()
+
+    indices_a = []
+    indices_b = []
+    b_bounds = bounds(geometries_b)
+    valid_b = numpy.nonzero(~numpy.isnan(b_bounds[:, 0]))[0]
+    if len(valid_b) > 0:
+        b_index = rtree.index.Index((index, tuple(b_bounds[index]), None)
+            for index in valid_b)
+        for index_a, geometry_a in enumerate(geometries_a):
+            if geometry_a.is_empty:
+                continue
+            prepared_a = shapely.prepared.prep(geometry_a)
+            for index_b in sorted(b_index.intersection(geometry_a.bounds)):
+                if prepared_a.intersects(geometries_b[index_b]):
+                    indices_a.append(index_a)
+                    indices_b.append(index_b)
+
+    indices_a = numpy.asarray(indices_a, dtype=numpy.int64)
+    indices_b = numpy.asarray(indices_b, dtype=numpy.int64)
+    order = numpy.lexsort((indices_b, indices_a))
+    return indices_a[order], indices_b[order]
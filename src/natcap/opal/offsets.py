@@ -3,16 +3,23 @@ import logging
 import math
 import os
 import json
+import time
+import heapq
 
 from osgeo import ogr
+import numpy
+import scipy.linalg
+import scipy.sparse
+import scipy.spatial
 import shapely
-import shapely.speedups
 import shapely.wkb
 import shapely.prepared
 import shapely.geometry
 import shapely.geos
+import rtree
 
 import adept_core
+import geometry as opal_geometry
 
 LOGGER = logging.getLogger('natcap.opal.offsets')
 
@@ -21,6 +28,10 @@ OFFSET_SCHEME_ES = 0
 OFFSET_SCHEME_BIODIV = 1
 OFFSET_SCHEME_BIO_ES = 2
 
+# distance metrics for ranking offset parcels by distance to impacts
+DISTANCE_CENTROID = 'centroid'
+DISTANCE_EDGE = 'edge'
+
 def build_shapely_polygon(ogr_feature, prep=False, fix=False):
     geometry = ogr_feature.GetGeometryRef()
     try:
@@ -62,14 +73,189 @@ def poly_intersects_vector(polygon, vector_uri):
             return True
     return False
 
+class IntersectionOracle(object):
+    """Answers whether polygons intersect any feature of a set of vectors.
+    Each vector is read once and its features are indexed with an rtree, so
+    the oracle can be queried for many polygons.
+
+    Gives the same answers as poly_intersects_vector()."""
+
+    def __init__(self, vectors):
+        """Read and index the features of each vector.
+
+            vectors - a dict mapping string names to URIs of OGR vectors.
+        """
+        self.names = sorted(vectors.keys())
+        self._polygons = {}
+        self._prepared = {}
+        self._indexes = {}
+        for name in self.names:
+            vector = ogr.Open(vectors[name])
+            layer = vector.GetLayer()
+            polygons = [build_shapely_polygon(feature) for feature in layer]
+            layer = None
+            vector = None
+
+            self._polygons[name] = polygons
+            self._prepared[name] = {}
+            if len(polygons) > 0:
+                self._indexes[name] = rtree.index.Index(
+                    (index, polygon.bounds, None) for (index, polygon) in
+                    enumerate(polygons))
+            else:
+                self._indexes[name] = None
+
+    def intersects(self, polygon, name):
+        """Check whether a shapely polygon intersects any feature of the
+        vector called name.
+
+        Returns True or False."""
+        spatial_index = self._indexes[name]
+        if spatial_index is None:
+            return False
+
+        prepared = self._prepared[name]
+        for feature_index in spatial_index.intersection(polygon.bounds):
+            # Features are only prepared once they are needed.
+            try:
+                prep_feature = prepared[feature_index]
+            except KeyError:
+                prep_feature = shapely.prepared.prep(
+                    self._polygons[name][feature_index])
+                prepared[feature_index] = prep_feature
+
+            if prep_feature.intersects(polygon):
+                return True
+        return False
+
+    def query(self, polygons):
+        """Check whether each of a list of shapely polygons intersects each of
+        the vectors.
+
+        Returns a 2D numpy boolean array with one row per polygon and one
+        column per vector, in the order of self.names."""
+        intersections = numpy.zeros((len(polygons), len(self.names)),
+            dtype=bool)
+        for column, name in enumerate(self.names):
+            for row, polygon in enumerate(polygons):
+                intersections[row, column] = self.intersects(polygon, name)
+        return intersections
+
+def _bounds_distance(bounds_a, bounds_b):
+    """Get the distance between two (minx, miny, maxx, maxy) bounding boxes.
+    This is a lower bound on the distance between the geometries within."""
+    dx = max(bounds_a[0] - bounds_b[2], bounds_b[0] - bounds_a[2], 0)
+    dy = max(bounds_a[1] - bounds_b[3], bounds_b[1] - bounds_a[3], 0)
+    return math.hypot(dx, dy)
+
+class DistanceEngine(object):
+    """Measures the distance from polygons to the nearest of a set of impact
+    sites.
+
+    With DISTANCE_CENTROID, distances are between polygon centroids, and the
+    impact centroids are indexed with a KD-tree.  With DISTANCE_EDGE,
+    distances are between the polygons themselves, and the impact polygons
+    are indexed with an rtree that is searched outwards from each polygon
+    until no closer impact can exist."""
+
+    def __init__(self, impact_polygons, metric=DISTANCE_CENTROID):
+        """Index the impact sites.
+
+            impact_polygons - a list of shapely polygons of the impact sites.
+            metric=DISTANCE_CENTROID - either DISTANCE_CENTROID or
+                DISTANCE_EDGE.
+        """
+        if metric not in (DISTANCE_CENTROID, DISTANCE_EDGE):
+            raise ValueError('Distance metric must be one of %s, not %s' %
+                ([DISTANCE_CENTROID, DISTANCE_EDGE], metric))
+
+        self.metric = metric
+        self.impact_polygons = impact_polygons
+        self.impact_centroids = numpy.array([polygon.centroid.coords[0]
+            for polygon in impact_polygons]).reshape((-1, 2))
+        if len(impact_polygons) == 0:
+            # Nothing to index.
+            return
+        elif metric == DISTANCE_CENTROID:
+            self._kdtree = scipy.spatial.cKDTree(self.impact_centroids)
+        else:
+            self._impact_bounds = [polygon.bounds for polygon in
+                impact_polygons]
+            self._rtree = rtree.index.Index(
+                (index, bounds, None) for (index, bounds) in
+                enumerate(self._impact_bounds))
+
+    def _nearest_edge_distance(self, polygon):
+        # rtree returns impacts in order of bounding box distance.  Fetch
+        # more of them until the farthest box fetched is no closer than the
+        # nearest polygon found.
+        bounds = polygon.bounds
+        min_distance = numpy.inf
+        measured = set()
+        num_results = 1
+        while True:
+            candidates = list(self._rtree.nearest(bounds, num_results))
+            max_bounds_distance = 0
+            for impact_index in candidates:
+                max_bounds_distance = max(max_bounds_distance,
+                    _bounds_distance(bounds,
+                        self._impact_bounds[impact_index]))
+                if impact_index in measured:
+                    continue
+                measured.add(impact_index)
+                min_distance = min(min_distance,
+                    polygon.distance(self.impact_polygons[impact_index]))
+
+            if (len(measured) == len(self.impact_polygons) or
+                    max_bounds_distance >= min_distance):
+                return min_distance
+            num_results *= 2
+
+    def nearest_distances(self, polygons):
+        """Get the distance from each polygon to its nearest impact site.
+
+            polygons - a list of shapely polygons.
+
+        Returns a 1D numpy array of distances, one per polygon."""
+        if len(polygons) == 0:
+            return numpy.zeros(0)
+        if len(self.impact_polygons) == 0:
+            raise ValueError('No impact sites to measure distances to')
+
+        if self.metric == DISTANCE_CENTROID:
+            centroids = numpy.array([polygon.centroid.coords[0] for polygon
+                in polygons])
+            distances, _ = self._kdtree.query(centroids, k=1)
+            return distances
 
-def locate_parcels(possible_parcels, selection_area, impact_sites):
+        return numpy.array([self._nearest_edge_distance(polygon)
+            for polygon in polygons])
+
+    def all_distances(self, polygon):
+        """Get the distance from a polygon to every impact site.
+
+            polygon - a shapely polygon.
+
+        Returns a 1D numpy array with one distance per impact site."""
+        if self.metric == DISTANCE_CENTROID:
+            x, y = polygon.centroid.coords[0]
+            return numpy.hypot(self.impact_centroids[:, 0] - x,
+                self.impact_centroids[:, 1] - y)
+        return numpy.array([polygon.distance(impact) for impact in
+            self.impact_polygons])
+
+
+def locate_parcels(possible_parcels, selection_area, impact_sites,
+        distance_metric=DISTANCE_EDGE):
     """This function will iterate through all polygons in the possible_parcels
     vector that are within the selection area.
 
         possible_parcels - a URI to an OGR vector of polygons.
         selection_area - a URI to an OGR vector of the area to consider.
         impact_sites - a URI to an OGR vector of impact sites.
+        distance_metric=DISTANCE_EDGE - how distances between parcels and
+            impact sites are measured.  One of DISTANCE_EDGE or
+            DISTANCE_CENTROID.
 
     #TODO: What should this function return?
     Returns something ... not yet sure what."""
@@ -84,14 +270,12 @@ def locate_parcels(possible_parcels, selection_area, impact_sites):
     # TODO: start out with just selecting all the parcels completely contained
     # within the selection area.
 
-    if shapely.speedups.available:
-        LOGGER.debug('Enabling shapely speedups')
-        shapely.speedups.enable()
+    opal_geometry.enable_speedups()
 
     LOGGER.debug('Extracting selection area polygon')
     sa_vector = ogr.Open(selection_area)
     sa_layer = sa_vector.GetLayer()
-    sa_feature = sa_layer.GetFeature(0)
+    sa_feature = sa_layer.GetNextFeature()
     sa_geometry = sa_feature.GetGeometryRef()
     sa_polygon = shapely.wkb.loads(sa_geometry.ExportToWkb())
     #selection_area = shapely.geometry.polygon.Polygon(sa_polygon)
@@ -100,6 +284,8 @@ def locate_parcels(possible_parcels, selection_area, impact_sites):
     LOGGER.debug('Opening the impact sites vector')
     impact_vector = ogr.Open(impact_sites)
     impact_layer = impact_vector.GetLayer()
+    distance_engine = DistanceEngine([build_shapely_polygon(impact_site)
+        for impact_site in impact_layer], distance_metric)
 
     # create a data structure that allows me to prioritize possible polygons.
     parcels = []
@@ -114,19 +300,10 @@ def locate_parcels(possible_parcels, selection_area, impact_sites):
         if prepared_polygon.intersects(sa_polygon):
             LOGGER.debug('Possible offset area intersects.')
 
-            distances = {}
-            for impact_id, ogr_impact_site in enumerate(impact_layer):
-                impact_site = build_shapely_polygon(ogr_impact_site)
-                key = 'impact_%s' % impact_id
-
-                # currently accessing the minimum distance between polygons.  If we
-                # want the distance between centroids, get the point's coordinates
-                # like so:
-                # impact_site.centroid.coords[0] and pass it to the
-                # distance_between_points function, above.
-                distance = impact_site.distance(polygon)
-                distances[key] = distance
-            impact_layer.ResetReading()
+            # By default, this is the minimum distance between polygons.
+            distances = dict(('impact_%s' % impact_id, distance)
+                for (impact_id, distance) in enumerate(
+                    distance_engine.all_distances(polygon)))
 
             offset_parcel_data = {
                 'polygon': polygon,
@@ -139,7 +316,7 @@ def locate_parcels(possible_parcels, selection_area, impact_sites):
 def _select_offsets(offset_parcels_uri, impact_sites_uri, biodiversity_impacts, output_vector,
         output_json, comparison_vectors={}, services=['carbon', 'nutrient', 'sediment'],
         offset_factors={'carbon': 1.0, 'nutrient': 1.0,'sediment': 1.0, 'biodiversity': 1.0},
-        offset_scheme=OFFSET_SCHEME_BIODIV):
+        offset_scheme=OFFSET_SCHEME_BIODIV, distance_metric=DISTANCE_CENTROID):
     """Determine which parcels to return, where parcels returned meet
     appropriate criteria defined in the inputs.
 
@@ -192,6 +369,9 @@ def _select_offsets(offset_parcels_uri, impact_sites_uri, biodiversity_impacts,
         should offset.  Default: 1.0.
     offset_scheme - a number, one of OFFSET_SCHEME_ES, OFFSET_SCHEME_BIODIV, or
         OFFSET_SCHEME_BIO_ES.  Indicates which offset scheme should be used.
+    distance_metric - either DISTANCE_CENTROID or DISTANCE_EDGE.  Indicates
+        whether the distance from an offset parcel to the nearest impact site
+        is measured between centroids or between polygon edges.
 
     Returns a tuple.  The first tuple element is a list of all integer parcel
     indices selected.  The second tuple element is a set of recommended parcels
@@ -226,8 +406,9 @@ def _select_offsets(offset_parcels_uri, impact_sites_uri, biodiversity_impacts,
     bio_offsets = locate_biodiversity_offsets(offset_parcels_uri,
         biodiversity_impacts, include_all_ecosystems)
 
-    # loop through the impact sites and get a list of centroid coordinates
-    impact_polygons = [build_shapely_polygon(site).centroid for site in impact_layer]
+    # index the impact sites for measuring distances to offset parcels.
+    distance_engine = DistanceEngine([build_shapely_polygon(site) for site in
+        impact_layer], distance_metric)
 
 #    for offset_index in xrange(num_offset_parcels):
 #        offset_feature = offsets_layer.GetFeature(offset_index)
@@ -241,26 +422,66 @@ def _select_offsets(offset_parcels_uri, impact_sites_uri, biodiversity_impacts,
     offsets_vector = ogr.Open(offset_parcels_uri)
     offsets_layer = offsets_vector.GetLayer()
 
-    for offset_index, offset_data in bio_offsets.iteritems():
+    # Read the polygons and the attributes needed for selection of all the
+    # possible offset parcels in one pass over the layer.
+    offsets_schema = [d.GetName() for d in offsets_layer.schema]
+    attribute_fields = ['ecosystem'] + [field for field in
+        services + ['Threat', 'Richness'] if field in offsets_schema]
+    offset_indices = sorted(bio_offsets.keys())
+    offset_polygons = []
+    offset_attributes = {}
+    for offset_index in offset_indices:
         offset_parcel = offsets_layer.GetFeature(offset_index)
-        offset_polygon = build_shapely_polygon(offset_parcel)
-
-        # figure out if our offset polygon intersects any of the comparison
-        # vectors.
-        for comp_name, comp_vector in comparison_vectors.iteritems():
-            intersects = poly_intersects_vector(offset_polygon, comp_vector)
-            bio_offsets[offset_index][comp_name] = intersects
-
-        offset_polygon = offset_polygon.centroid
-
-        min_distance = min(map(lambda x: offset_polygon.distance(x),
-            impact_polygons))
-        bio_offsets[offset_index]['distance'] = min_distance
+        offset_polygons.append(build_shapely_polygon(offset_parcel))
+
+        parcel_attributes = dict((field, offset_parcel.GetField(field))
+            for field in attribute_fields)
+        parcel_attributes['area'] = offset_parcel.GetGeometryRef().Area()
+        offset_attributes[offset_index] = parcel_attributes
+    parcel_table = ParcelTable.from_parcels(offset_attributes)
+
+    min_distances = distance_engine.nearest_distances(offset_polygons)
+    for offset_index, min_distance in zip(offset_indices, min_distances):
+        bio_offsets[offset_index]['distance'] = float(min_distance)
+    parcel_table.add_column('distance', min_distances)
+
+    # figure out if our offset polygons intersect any of the comparison
+    # vectors.
+    LOGGER.debug('Intersecting offsets with comparison vectors')
+    oracle = IntersectionOracle(comparison_vectors)
+    intersections = oracle.query(offset_polygons)
+    for row, offset_index in enumerate(offset_indices):
+        for column, comp_name in enumerate(oracle.names):
+            bio_offsets[offset_index][comp_name] = bool(
+                intersections[row, column])
+    offset_polygons = None
 
     # for now, just sort based on distance from impact parcel.
-    sorted_offset_parcels = sorted(bio_offsets.keys(),
-        key=lambda k: bio_offsets[k]['distance'])
-    LOGGER.debug('Sorted offset parcels: %s', sorted_offset_parcels)
+    distance_order = numpy.argsort(parcel_table.data['distance'],
+        kind='mergesort')
+    LOGGER.debug('Sorted offset parcels: %s', parcel_table.ids[distance_order])
+    distance_rank = numpy.empty(len(parcel_table), dtype=numpy.int64)
+    distance_rank[distance_order] = numpy.arange(len(parcel_table))
+
+    # Threat and richness are NaN where they are None.  Parcels without the
+    # fields are treated as if their values were None.
+    missing_values = numpy.empty(len(parcel_table))
+    missing_values.fill(numpy.nan)
+    if parcel_table.has_column('Threat'):
+        parcel_threat = parcel_table.data['Threat']
+    else:
+        parcel_threat = missing_values
+    if parcel_table.has_column('Richness'):
+        parcel_richness = parcel_table.data['Richness']
+    else:
+        parcel_richness = missing_values
+
+    def _field_value(column_name, row):
+        # Convert a table value back to the value of the OGR field.
+        value = parcel_table.data[column_name][row]
+        if numpy.isnan(value):
+            return None
+        return float(value)
 
     # select enough parcels to offset the impact requirements and still meet
     # the minimum number of parcels required.
@@ -299,52 +520,52 @@ def _select_offsets(offset_parcels_uri, impact_sites_uri, biodiversity_impacts,
             min_mitigation = 0.0
 
         LOGGER.debug('Locating offsets for ecosystem "%s"', ecosystem_name)
-        parcels_in_ecosystem = []
-        for possible_offset in sorted_offset_parcels:
-            parcel_feature = offsets_layer.GetFeature(possible_offset)
-
-            if parcel_feature.GetField('ecosystem') == ecosystem_name:
-                # if we have Threat data, we need to enforce that all offset
-                # parcels meet the minimum threat score requirement.
-                if max_threat is not None:
-                    parcel_threat = parcel_feature.GetField('Threat')
-                    if parcel_threat > max_threat:
-                        # if threat requirement is not met, skip this parcel
-                        continue
-
-                if min_richness is not None:
-                    parcel_richness = parcel_feature.GetField('Richness')
-                    if parcel_richness < min_richness:
-                        # if the richness requirement is not met, skip this
-                        # parcel
-                        continue
-
-                parcels_in_ecosystem.append(possible_offset)
-
-                parcel_area = parcel_feature.GetGeometryRef().Area()
-                parcels_selected[possible_offset] = parcel_area
-                impact_offsets[ecosystem_name] += parcel_area
-
-                parcel_data = {}
-                for fieldname in new_fields:
-                    new_field_value = bio_offsets[possible_offset][fieldname]
-                    parcel_data[fieldname] = new_field_value
-
-                new_field_data[possible_offset] = parcel_data
-                new_field_data[possible_offset]['area'] = parcel_area
-                new_field_data[possible_offset]['ecosystem_type'] = ecosystem_name
-                new_field_data[possible_offset]['parcel_id'] = possible_offset
+        ecosystem_rows = parcel_table.ecosystem_rows(ecosystem_name)
+        with numpy.errstate(invalid='ignore'):
+            # if we have Threat data, we need to enforce that all offset
+            # parcels meet the minimum threat score requirement.  Parcels
+            # without a threat value always meet it.
+            if max_threat is not None:
+                ecosystem_rows = ecosystem_rows[~(
+                    parcel_threat[ecosystem_rows] > max_threat)]
+
+            # Parcels without a richness value never meet the richness
+            # requirement.
+            if min_richness is not None:
+                ecosystem_rows = ecosystem_rows[
+                    parcel_richness[ecosystem_rows] >= min_richness]
+        ecosystem_rows = ecosystem_rows[numpy.argsort(
+            distance_rank[ecosystem_rows], kind='mergesort')]
 
-                for es_field in services:
-                    es_value = parcel_feature.GetField(es_field)
-                    new_field_data[possible_offset][es_field] = es_value
-
-                # Uncomment these lines if you want to only show the minimum
-                # number of parcels needed to meet the rules above.
-#                if impact_offsets[ecosystem_name] >= min_mitigation and \
-#                    len(parcels_selected) >= min_parcels_to_select:
-#                    LOGGER.debug('Parcel requirements have been satisfied.')
-#                    break
+        parcels_in_ecosystem = []
+        for row in ecosystem_rows:
+            possible_offset = parcel_table.ids[row]
+            parcels_in_ecosystem.append(possible_offset)
+
+            parcel_area = float(parcel_table.data['area'][row])
+            parcels_selected[possible_offset] = parcel_area
+            impact_offsets[ecosystem_name] += parcel_area
+
+            parcel_data = {}
+            for fieldname in new_fields:
+                new_field_value = bio_offsets[possible_offset][fieldname]
+                parcel_data[fieldname] = new_field_value
+
+            new_field_data[possible_offset] = parcel_data
+            new_field_data[possible_offset]['area'] = parcel_area
+            new_field_data[possible_offset]['ecosystem_type'] = ecosystem_name
+            new_field_data[possible_offset]['parcel_id'] = possible_offset
+
+            for es_field in services:
+                es_value = _field_value(es_field, row)
+                new_field_data[possible_offset][es_field] = es_value
+
+            # Uncomment these lines if you want to only show the minimum
+            # number of parcels needed to meet the rules above.
+#            if impact_offsets[ecosystem_name] >= min_mitigation and \
+#                len(parcels_selected) >= min_parcels_to_select:
+#                LOGGER.debug('Parcel requirements have been satisfied.')
+#                break
 
         # I only want those offsets that match this ecosystem name
         available_offset_parcels = {}
@@ -457,8 +678,8 @@ def locate_biodiversity_offsets(offset_parcels_uri, biodiversity_impacts,
 
     num_offset_parcels = offsets_layer.GetFeatureCount()
     LOGGER.debug('Examining %s possible offset parcels', num_offset_parcels)
-    for offset_index in xrange(num_offset_parcels):
-        offset_feature = offsets_layer.GetFeature(offset_index)
+    for offset_feature in offsets_layer:
+        offset_index = offset_feature.GetFID()
         ecosystem_impacted = offset_feature.GetField('ecosystem')
 
         # Convert parcel area to Ha.
@@ -513,9 +734,7 @@ def select_offsets(offset_parcels_uri, impact_sites_uri, output_dir):
             ...
         }"""
 
-    if shapely.speedups.available:
-        LOGGER.debug('Enabling shapely speedups')
-        shapely.speedups.enable()
+    opal_geometry.enable_speedups()
 
     LOGGER.debug('Opening parcels vector %s', offset_parcels_uri)
     parcels_vector = ogr.Open(offset_parcels_uri)
@@ -700,58 +919,326 @@ def select_set(parcels_dict, requirements):
             for parcel selection.
 
         In the examples given, Parcel 3 meets all three requirements, so it is
-        the only parcel returned from this function.
+        the only parcel returned from this function.  Parcels with equal
+        values are taken in order of parcel identifier.
 
         Returns a sorted list of parcel identifiers meeting the above
         requirements."""
 
-    # use sets because a parcel ID can only appear once and order doesn't
-    # matter, and constant-time accesses are useful.
-    available_parcels = set(parcels_dict.keys())
-    recommended_parcels = set()
+    table = ParcelTable.from_parcels(parcels_dict)
+    recommended_parcels = numpy.zeros(len(table), dtype=bool)
 
     for rule_key, rule_min in requirements:
-        # sort parcels from max to min.  We want a minimum number of parcels
-        # that meets this requirement.
-        # available_parcels contains only those parcels that have not been
-        # selected.
-        sorted_parcels = sorted(available_parcels,
-            key=lambda pid: parcels_dict[pid][rule_key], reverse=True)
-
+        values = table.values(rule_key)
         rule_sum = 0
-        if len(recommended_parcels) > 0:
+        if recommended_parcels.any():
             # If we already have selected parcels, we need to first check if
             # they already satisfy this requirement.
-            rule_sum = sum([parcels_dict[x][rule_key] for x in recommended_parcels])
+            rule_sum = values[recommended_parcels].sum()
             if rule_sum >= rule_min:
                 LOGGER.debug(('Rule %s already met with existing parcel set'
                     ' (min=%s, sum=%s)'), rule_key, rule_min, rule_sum)
                 continue
 
-        for parcel_id in sorted_parcels:
-            if rule_sum >= rule_min:
-                LOGGER.debug('Met rule %s >= %s with %s', rule_key, rule_min,
-                    rule_sum)
-                break
-            rule_sum += parcels_dict[parcel_id][rule_key]
-            recommended_parcels.add(parcel_id)
-            available_parcels.remove(parcel_id)
-        LOGGER.debug('Parcel set so far: %s', recommended_parcels)
-
-    LOGGER.debug('Found %s parcels to recommend', len(recommended_parcels))
-    return sorted(recommended_parcels)
+        # Take the largest of the parcels that have not been selected until
+        # the rule is met.
+        available_parcels = numpy.nonzero(~recommended_parcels)[0]
+        recommended_parcels[available_parcels[_take_largest(
+            values[available_parcels], rule_sum, rule_min)]] = True
+        LOGGER.debug('Parcel set so far: %s', table.ids[recommended_parcels])
 
+    LOGGER.debug('Found %s parcels to recommend',
+        recommended_parcels.sum())
+    return sorted(table.ids[recommended_parcels].tolist())
 
 # quick function to convert from m to ha
 Ha = lambda m: m / 10000.0
 
+def _take_largest(values, start_total, required_amt, strict=False):
+    """Take values from largest to smallest, adding each to a running total,
+    until the total meets the required amount.
+
+        values - a 1D numpy array of values.
+        start_total - the running total before any values are taken.
+        required_amt - the amount the running total must meet.
+        strict=False - whether the total must exceed required_amt (True) or
+            only equal it (False).
+
+    Returns a 1D numpy array of the indices of the taken values, in the order
+    they were taken.  Equal values are taken in order of their index."""
+
+    order = numpy.argsort(-values, kind='mergesort')
+    totals_before = start_total + numpy.concatenate(([0.0],
+        numpy.cumsum(values[order])[:-1]))
+    if strict:
+        met = totals_before > required_amt
+    else:
+        met = totals_before >= required_amt
+
+    if met.any():
+        return order[:met.argmax()]
+    return order
+
+class ParcelTable(object):
+    """A columnar table of offset parcels for parcel selection.
+
+    Parcels are stored in order of their parcel ID.  Numeric attributes are
+    stored in a numpy structured array (``data``), with None stored as NaN.
+    Ecosystem names are stored as integer codes into ``ecosystems`` (-1 for
+    no ecosystem).  The fraction of each parcel that offsets to each
+    serviceshed is stored in a scipy.sparse CSR matrix (``sshed_overlap``)
+    with one row per parcel and one column per name in ``sshed_names``."""
+
+    def __init__(self, parcel_ids, columns, ecosystems=None,
+            present=None, sshed_names=None, sshed_overlap=None):
+        """Create a table.  Most tables should be built with one of the
+        from_* class methods.
+
+            parcel_ids - a sorted list of parcel IDs.
+            columns - a dict mapping column names to 1D numpy arrays with one
+                value per parcel.  The 'ecosystem' column holds integer
+                ecosystem codes.
+            ecosystems=None - a list of ecosystem names, indexed by code.
+            present=None - a dict mapping column names to 1D boolean arrays
+                of whether each parcel had a value for the column.  Parcels
+                have all columns if not provided.
+            sshed_names=None - a list of serviceshed names.
+            sshed_overlap=None - a CSR matrix of parcel/serviceshed overlap.
+        """
+        self.ids = numpy.empty(len(parcel_ids), dtype=object)
+        self.ids[:] = parcel_ids
+        self.index = dict((pid, row) for (row, pid) in enumerate(parcel_ids))
+
+        dtype = []
+        for column_name in sorted(columns):
+            if column_name == 'ecosystem':
+                dtype.append((column_name, numpy.int32))
+            else:
+                dtype.append((column_name, numpy.float64))
+        self.data = numpy.empty(len(parcel_ids), dtype=dtype)
+        for column_name, values in columns.iteritems():
+            self.data[column_name] = values
+
+        if ecosystems is None:
+            ecosystems = []
+        self.ecosystems = ecosystems
+
+        if present is None:
+            present = {}
+        self.present = present
+        self.sshed_names = sshed_names
+        self.sshed_overlap = sshed_overlap
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_parcels(cls, parcels):
+        """Build a table from a dict mapping parcel IDs to dicts of parcel
+        attributes, as used by select_set_multifactor().  A ParcelTable is
+        returned unchanged.
+
+        The 'overlap' attribute, if present, maps serviceshed names to the
+        fraction of the parcel offsetting to that serviceshed.  Every other
+        attribute except 'ecosystem' must be numeric or None.
+
+        Returns a ParcelTable."""
+
+        if isinstance(parcels, cls):
+            return parcels
+
+        parcel_ids = sorted(parcels.keys())
+        num_parcels = len(parcel_ids)
+        columns = {}
+        present = {}
+        ecosystem_codes = {}
+        sshed_codes = {}
+        overlap_rows = []
+        overlap_cols = []
+        overlap_values = []
+
+        for row, parcel_id in enumerate(parcel_ids):
+            for key, value in parcels[parcel_id].iteritems():
+                if key not in present:
+                    present[key] = numpy.zeros(num_parcels, dtype=bool)
+                present[key][row] = True
+
+                if key == 'overlap':
+                    for sshed_name, fraction in value.iteritems():
+                        if sshed_name not in sshed_codes:
+                            sshed_codes[sshed_name] = len(sshed_codes)
+                        overlap_rows.append(row)
+                        overlap_cols.append(sshed_codes[sshed_name])
+                        overlap_values.append(fraction)
+                    continue
+
+                if key not in columns:
+                    if key == 'ecosystem':
+                        columns[key] = numpy.empty(num_parcels,
+                            dtype=numpy.int32)
+                        columns[key].fill(-1)
+                    else:
+                        columns[key] = numpy.empty(num_parcels)
+                        columns[key].fill(numpy.nan)
+
+                if value is None:
+                    continue
+                if key == 'ecosystem':
+                    if value not in ecosystem_codes:
+                        ecosystem_codes[value] = len(ecosystem_codes)
+                    columns[key][row] = ecosystem_codes[value]
+                else:
+                    columns[key][row] = value
+
+        has_overlap = 'overlap' in present
+
+        # Only keep the masks of columns that some parcels do not have.
+        present = dict((key, mask) for (key, mask) in present.iteritems()
+            if not mask.all())
+        ecosystems = sorted(ecosystem_codes, key=ecosystem_codes.get)
+
+        if has_overlap:
+            sshed_names = sorted(sshed_codes, key=sshed_codes.get)
+            sshed_overlap = scipy.sparse.csr_matrix((overlap_values,
+                (overlap_rows, overlap_cols)),
+                shape=(num_parcels, len(sshed_names)))
+        else:
+            sshed_names = None
+            sshed_overlap = None
+
+        return cls(parcel_ids, columns, ecosystems, present, sshed_names,
+            sshed_overlap)
+
+    @classmethod
+    def from_per_offset_data(cls, per_offset_data):
+        """Build a table from the per-offset parcel data dictionary returned
+        from natcap.opal.analysis.percent_overlap().  Parcel areas are
+        converted from m^2 to Ha.
+
+        Returns a ParcelTable."""
+        known_keys = {
+            'Carbon': 'carbon',
+            'Nitrogen': 'nutrient',
+            'Sediment': 'sediment',
+            'Custom': 'custom',
+            'Area': 'area',
+            'Ecosystem': 'ecosystem',
+            'municipalities': 'overlap',
+        }
+        parcels = {}
+        for parcel_id, parcel_data in per_offset_data.iteritems():
+            parcels[parcel_id] = dict((new_key, parcel_data[old_key])
+                for (old_key, new_key) in known_keys.iteritems()
+                if old_key in parcel_data)
+
+        table = cls.from_parcels(parcels)
+        if 'area' in table.data.dtype.names:
+            table.data['area'] = Ha(table.data['area'])  # convert from m^2 to Ha
+        return table
+
+    def has_column(self, column_name):
+        """Return whether the table has a column called column_name."""
+        if column_name == 'overlap':
+            return self.sshed_overlap is not None
+        return column_name in self.data.dtype.names
+
+    def add_column(self, column_name, values):
+        """Add (or replace) a numeric column.
+
+            column_name - the string name of the column.
+            values - a sequence of one value per parcel, in table order.
+
+        Returns nothing."""
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if column_name in self.data.dtype.names:
+            self.data[column_name] = values
+            return
+
+        new_data = numpy.empty(len(self), dtype=self.data.dtype.descr +
+            [(column_name, numpy.float64)])
+        for existing_name in self.data.dtype.names:
+            new_data[existing_name] = self.data[existing_name]
+        new_data[column_name] = values
+        self.data = new_data
+
+    def values(self, column_name):
+        """Get the numeric values of a column, with missing values as 0.
+
+            column_name - the string name of the column.
+
+        Returns a 1D numpy float array with one value per parcel.  If the
+        table doesn't have the column, all values are 0."""
+        if column_name not in self.data.dtype.names:
+            return numpy.zeros(len(self))
+        return numpy.nan_to_num(self.data[column_name].astype(numpy.float64))
+
+    def rows(self, parcel_ids):
+        """Get the table rows of a list of parcel IDs.
+
+        Returns a 1D numpy int array of unique rows, in increasing order.
+        Raises KeyError if a parcel is not in the table."""
+        return numpy.unique(numpy.array([self.index[pid] for pid in
+            parcel_ids], dtype=numpy.int64))
+
+    def ecosystem_rows(self, ecosystem):
+        """Get the table rows of the parcels of an ecosystem.
+
+        Returns a 1D numpy int array of rows, in increasing order."""
+        try:
+            code = self.ecosystems.index(ecosystem)
+        except ValueError:
+            return numpy.array([], dtype=numpy.int64)
+        return numpy.nonzero(self.data['ecosystem'] == code)[0]
+
+    def to_dict(self):
+        """Convert the table to a dict mapping parcel IDs to dicts of parcel
+        attributes, the inverse of from_parcels().
+
+        Returns a dict."""
+        output_parcels = {}
+        column_names = self.data.dtype.names
+        for row, parcel_id in enumerate(self.ids):
+            parcel_data = {}
+            for column_name in column_names:
+                try:
+                    if not self.present[column_name][row]:
+                        continue
+                except KeyError:
+                    pass
+
+                value = self.data[column_name][row]
+                if column_name == 'ecosystem':
+                    if value < 0:
+                        parcel_data[column_name] = None
+                    else:
+                        parcel_data[column_name] = self.ecosystems[value]
+                elif numpy.isnan(value):
+                    parcel_data[column_name] = None
+                else:
+                    parcel_data[column_name] = float(value)
+
+            if self.sshed_overlap is not None and (
+                    'overlap' not in self.present or
+                    self.present['overlap'][row]):
+                start = self.sshed_overlap.indptr[row]
+                end = self.sshed_overlap.indptr[row + 1]
+                overlap = dict((self.sshed_names[sshed], float(fraction))
+                    for (sshed, fraction) in zip(
+                        self.sshed_overlap.indices[start:end],
+                        self.sshed_overlap.data[start:end]))
+                parcel_data['overlap'] = overlap
+
+            output_parcels[parcel_id] = parcel_data
+        return output_parcels
+
+
 def select_set_multifactor(parcels, biodiversity_req=None, es_hydro_req=None,
         es_global_req=None, proportion_offset=1.0):
     """Multifactor parcel selection.  Selects offset parcels based on
     biodiversity, hydrological ES and global ES requirements.
 
-    parcels - a dict mapping integer offset parcel IDs to dictionaries with
-        offset parcel information:
+    parcels - a ParcelTable, or a dict mapping integer offset parcel IDs to
+        dictionaries with offset parcel information:
             'area' - a numberic value, the parcel's area.  Required if
                 biodiversity_req is provided.
             'ecosystem' - a string ecosystem name for this offset parcel.
@@ -762,65 +1249,55 @@ def select_set_multifactor(parcels, biodiversity_req=None, es_hydro_req=None,
                 this ecosystem type.
     proportion_offset=1.0 - a number indicating the proportion of
         impacts/requirements to offset.
+
+    Parcels are taken from largest to smallest value, and parcels with equal
+    values are taken in order of parcel ID.
 """
     if biodiversity_req is None and es_hydro_req is None and es_global_req is None:
         raise Exception('No requirements specified')
     proportion_offset = float(proportion_offset)
     LOGGER.debug('Offsetting with proportion = %s', proportion_offset)
 
-    selected_parcels = set([])
-    if biodiversity_req is not None:
-        # determine which parcels are in which ecosystem.
-        ecosystems = {}
-        for parcel_key, parcel_data in parcels.iteritems():
-            ecosystem_id = parcel_data['ecosystem']
-            try:
-                ecosystems[ecosystem_id].append(parcel_key)
-            except:
-                ecosystems[ecosystem_id] = [parcel_key]
+    table = ParcelTable.from_parcels(parcels)
+    selected_parcels = numpy.zeros(len(table), dtype=bool)
 
+    # look up each column once.
+    column_names = ['area', 'sediment', 'nutrient', 'custom']
+    if es_global_req is not None:
+        column_names += es_global_req.keys()
+    column_values = dict((name, table.values(name))
+        for name in column_names)
+    if biodiversity_req is not None:
         for impacted_ecosystem, ecosys_data in biodiversity_req.iteritems():
             required_area = ecosys_data['mitigation_area']
-            ecosys_selected_area = 0
-            ecosystem_selected_parcels = []
-            try:
-                possible_parcels = ecosystems[impacted_ecosystem]
-            except KeyError:
+            possible_parcels = table.ecosystem_rows(impacted_ecosystem)
+            if len(possible_parcels) == 0:
                 LOGGER.warn(('Impacted ecosystem "%s" does not have any '
                     'available offset parcels') % impacted_ecosystem)
                 continue
 
-            # sort so that largest parcel areas are first.
-            sorted_parcels = sorted(possible_parcels,
-                key=lambda p: parcels[p]['area'], reverse=True)
-
-            for parcel_key in sorted_parcels:
-                if ecosys_selected_area >= (required_area * proportion_offset):
-                    LOGGER.debug('Ecosystem %s area req. (%s*%s) met with (%s)',
-                        impacted_ecosystem, proportion_offset, required_area,
-                        ecosys_selected_area)
-                    break
-
-                parcel_data = parcels[parcel_key]
-
-                # select the parcel.
-                ecosystem_selected_parcels.append(parcel_key)
-                ecosys_selected_area += parcel_data['area']
+            # select the largest parcels first.
+            ecosystem_selected_parcels = possible_parcels[_take_largest(
+                column_values['area'][possible_parcels], 0,
+                required_area * proportion_offset)]
+            LOGGER.debug('Ecosystem %s area req. (%s*%s) offset with (%s)',
+                impacted_ecosystem, proportion_offset, required_area,
+                column_values['area'][ecosystem_selected_parcels].sum())
 
             # add the newly selected parcels to the running set
-            selected_parcels.update(ecosystem_selected_parcels)
+            selected_parcels[ecosystem_selected_parcels] = True
         LOGGER.debug('Parcels selected after biodiversity: %s',
-            selected_parcels)
+            table.ids[selected_parcels])
 
     if es_hydro_req is not None:
-        hydro_selected_parcels = set([])
         for serviceshed_id, serviceshed_data in es_hydro_req.iteritems():
             try:
-                sshed_parcels = serviceshed_data['parcels']
+                sshed_parcel_ids = serviceshed_data['parcels']
             except KeyError:
                 # If there are no parcels in this serviceshed, skip
                 # the serviceshed.  Related to adept_core.py, line 667.
                 continue
+            sshed_parcels = table.rows(sshed_parcel_ids)
 
             # Figure out which hydrological services have impacts and if we
             # have selected parcels, we want to know the service offset values
@@ -828,19 +1305,16 @@ def select_set_multifactor(parcels, biodiversity_req=None, es_hydro_req=None,
             services = {}
             for service_key in ['sediment', 'nutrient', 'custom']:
                 try:
-                     sshed_service_data = {
+                    sshed_service_data = {
                         'required_amt': serviceshed_data[service_key],
-                        'offset': 0
+                        'offset': column_values[service_key][
+                            sshed_parcels[selected_parcels[sshed_parcels]]
+                        ].sum(),
                     }
                 except KeyError:
                     # when the service is not in serviceshed_data, we're not
                     # trying to meet that service's requrements.
                     continue
-
-                for sshed_parcel in sshed_parcels:
-                    if sshed_parcel in selected_parcels:
-                        service_offset = parcels[sshed_parcel][service_key]
-                        sshed_service_data['offset'] += service_offset
                 LOGGER.debug('sshed %s %s: %s', serviceshed_id, service_key,
                     sshed_service_data['offset'])
 
@@ -848,102 +1322,507 @@ def select_set_multifactor(parcels, biodiversity_req=None, es_hydro_req=None,
                 services[service_key] = sshed_service_data
 
             # select available parcels until requirements have been met.
-            remaining_parcels = set(serviceshed_data['parcels']).difference(
-                selected_parcels)
-            LOGGER.debug('Remaining parcels: %s', remaining_parcels)
+            remaining_parcels = sshed_parcels[~selected_parcels[sshed_parcels]]
+            LOGGER.debug('Remaining parcels: %s', table.ids[remaining_parcels])
             if len(remaining_parcels) == 0:
                 continue
 
-            # iterate through the provided services in alphabetical order.
+            # iterate through the provided services in alphabetical order,
+            # selecting the parcels with the largest service offset first.
             for service, service_data in sorted(services.iteritems(),
                     key=lambda x: x[0]):
-                # get a list of available parcels, sorted in increasing order
-                offset_parcels = sorted(remaining_parcels, key=lambda x:
-                    parcels[x][service], reverse=True)
-                LOGGER.debug('Offset parcels: %s', offset_parcels)
-                service_offset = service_data['offset']
                 required_amt = service_data['required_amt'] * proportion_offset
+                taken = _take_largest(
+                    column_values[service][remaining_parcels],
+                    service_data['offset'], required_amt, strict=True)
+                new_parcels = remaining_parcels[taken]
+
+                # account for all of the services the new parcels provide
+                for _service in services.keys():
+                    services[_service]['offset'] += column_values[_service][
+                        new_parcels].sum()
+                remaining_parcels = numpy.delete(remaining_parcels, taken)
+                selected_parcels[new_parcels] = True
+                LOGGER.debug('selected parcels: %s',
+                    table.ids[selected_parcels])
 
-                for offset_parcel in offset_parcels:
-                    if service_offset > required_amt:
-                        break
+    if es_global_req is not None:
+        # The offsets of parcels selected for biodiversity or hydrological ES
+        # are not counted towards the global requirements.
+        service_totals = dict((service, 0) for service in es_global_req)
 
-                    # if we've already picked the parcel, skip it.
-                    if offset_parcel in hydro_selected_parcels:
-                        continue
+        available_parcels = numpy.nonzero(~selected_parcels)[0]
+        global_es_selected_parcels = numpy.zeros(len(table), dtype=bool)
+        for service in sorted(es_global_req.keys()):
+            # select available parcels in decreasing order of service offset
+            amt_required = es_global_req[service] * proportion_offset
+            taken = _take_largest(column_values[service][available_parcels],
+                service_totals[service], amt_required)
+            new_parcels = available_parcels[taken]
+
+            available_parcels = numpy.delete(available_parcels, taken)
+            global_es_selected_parcels[new_parcels] = True
+            for _service in es_global_req.keys():
+                service_totals[_service] += column_values[_service][
+                    new_parcels].sum()
+
+        LOGGER.debug('Global selected parcels: %s',
+            table.ids[global_es_selected_parcels])
+        selected_parcels |= global_es_selected_parcels
+
+    return sorted(table.ids[selected_parcels].tolist())
+
+
+def _covering_constraints(table, biodiversity_req, es_hydro_req,
+        es_global_req, proportion_offset):
+    """Express the biodiversity, hydrological ES and global ES requirements as
+    the rows of a covering problem over the offset parcels.
+
+    table - a ParcelTable of the offset parcels.  See select_set_multifactor()
+        for a description of the other inputs.
+
+    Returns a scipy.sparse CSC matrix with one row per requirement and one
+    column per parcel in the table.  Each row is scaled so that a selection of
+    parcels meets the requirement when its row sum is >= 1.  Requirements that
+    cannot be met by all of the available parcels are reduced to the total
+    that the available parcels can provide, which is what the greedy selection
+    ends up selecting in that case."""
+
+    row_indices = []
+    col_indices = []
+    values = []
+    def _add_requirement(parcel_rows, key, required_amt):
+        parcel_rows = numpy.unique(parcel_rows)
+        amounts = numpy.maximum(table.values(key)[parcel_rows], 0)
+        required_amt = min(required_amt, amounts.sum())
+        if required_amt <= 0:
+            return
+        contributing = amounts > 0
+        # Any single parcel can at most meet the whole requirement.
+        row_indices.append(numpy.repeat(len(row_indices),
+            contributing.sum()))
+        col_indices.append(parcel_rows[contributing])
+        values.append(numpy.minimum(amounts[contributing] / required_amt,
+            1.0))
 
-                    parcel_data = parcels[offset_parcel]
-                    service_offset += parcel_data[service]
+    if biodiversity_req is not None:
+        for impacted_ecosystem, ecosys_data in sorted(
+                biodiversity_req.iteritems()):
+            possible_parcels = table.ecosystem_rows(impacted_ecosystem)
+            if len(possible_parcels) == 0:
+                LOGGER.warn(('Impacted ecosystem "%s" does not have any '
+                    'available offset parcels') % impacted_ecosystem)
+                continue
+            _add_requirement(possible_parcels, 'area',
+                ecosys_data['mitigation_area'] * proportion_offset)
 
-                    # account for all of the services that parcel provides
-                    for _service in services.keys():
-                        services[_service]['offset'] += parcel_data[_service]
-                    remaining_parcels.remove(offset_parcel)
-                    hydro_selected_parcels.add(offset_parcel)
-                    selected_parcels.add(offset_parcel)
-                    LOGGER.debug('selected parcels: %s', selected_parcels)
+    if es_hydro_req is not None:
+        for serviceshed_id, serviceshed_data in sorted(
+                es_hydro_req.iteritems()):
+            try:
+                sshed_parcels = table.rows(serviceshed_data['parcels'])
+            except KeyError:
+                # No offset parcels in this serviceshed.
+                continue
+
+            for service_key in ['custom', 'nutrient', 'sediment']:
+                try:
+                    required_amt = serviceshed_data[service_key]
+                except KeyError:
+                    continue
+                _add_requirement(sshed_parcels, service_key,
+                    required_amt * proportion_offset)
 
     if es_global_req is not None:
-        # Determine the service offsets for any parcels we've already selected.
-        service_totals = {}
-        for service in es_global_req.keys():
-            if len(selected_parcels) > 0:
-                service_init = 0
-            else:
-                service_init = sum(map(lambda pid:
-                    parcels[pid][service], selected_parcels))
-            service_totals[service] = service_init
+        for service, required_amt in sorted(es_global_req.iteritems()):
+            _add_requirement(numpy.arange(len(table)), service,
+                required_amt * proportion_offset)
+
+    shape = (len(row_indices), len(table))
+    if len(row_indices) == 0:
+        return scipy.sparse.csc_matrix(shape)
+    return scipy.sparse.csc_matrix((numpy.concatenate(values),
+        (numpy.concatenate(row_indices), numpy.concatenate(col_indices))),
+        shape=shape)
+
+def _remove_redundant_parcels(coverage, costs, selected, tolerance=1e-9):
+    """Drop parcels from a feasible selection while the selection still meets
+    all of the requirements, starting with the most expensive parcel.
+
+        coverage - a scipy.sparse CSC matrix, as returned by
+            _covering_constraints().
+        costs - a 1D numpy array of the cost of each parcel.
+        selected - a 1D boolean numpy array of selected parcels.
+
+    Returns a new 1D boolean numpy array of selected parcels."""
+
+    selected = selected.copy()
+    covered = coverage.dot(selected.astype(numpy.float64))
+    selected_indices = numpy.nonzero(selected)[0]
+    for index in selected_indices[numpy.argsort(-costs[selected_indices],
+            kind='mergesort')]:
+        column = slice(coverage.indptr[index], coverage.indptr[index + 1])
+        rows = coverage.indices[column]
+        remaining = covered[rows] - coverage.data[column]
+        if numpy.all(remaining >= 1.0 - tolerance):
+            selected[index] = False
+            covered[rows] = remaining
+    return selected
+
+def _greedy_cover(coverage, costs, tolerance=1e-9):
+    """Find a feasible selection of parcels with the greedy heuristic for
+    set multicover: repeatedly select the parcel that meets the most of the
+    outstanding requirements per unit of cost.
+
+        coverage - a scipy.sparse CSC matrix, as returned by
+            _covering_constraints().
+        costs - a 1D numpy array of the cost of each parcel.
+
+    Returns a 1D boolean numpy array of selected parcels."""
+
+    num_parcels = coverage.shape[1]
+    selected = numpy.zeros(num_parcels, dtype=bool)
+    outstanding = numpy.ones(coverage.shape[0])
+    # the column of each stored value, for summing the gains per parcel.
+    columns = numpy.repeat(numpy.arange(num_parcels),
+        numpy.diff(coverage.indptr))
+    while numpy.any(outstanding > tolerance):
+        gains = numpy.bincount(columns, weights=numpy.minimum(coverage.data,
+            outstanding[coverage.indices]), minlength=num_parcels)
+        gains[selected] = 0
+        if gains.max() <= tolerance:
+            break
+        with numpy.errstate(divide='ignore'):
+            ratios = numpy.where(costs > 0, gains / numpy.maximum(costs,
+                tolerance), numpy.inf)
+        ratios[gains <= tolerance] = -1
+        best_parcel = numpy.argmax(ratios)
+        selected[best_parcel] = True
+        column = slice(coverage.indptr[best_parcel],
+            coverage.indptr[best_parcel + 1])
+        rows = coverage.indices[column]
+        outstanding[rows] = numpy.maximum(outstanding[rows] -
+            coverage.data[column], 0)
+
+    return _remove_redundant_parcels(coverage, costs, selected)
+
+def _solve_covering_lp(coverage, costs, required, deadline,
+        tolerance=1e-9, max_iterations=200):
+    """Solve the linear programming relaxation of a covering problem,
+
+        minimize costs.x subject to coverage.x >= required, 0 <= x <= 1,
+
+    with a primal-dual interior point method (Mehrotra's predictor-corrector).
+    The upper bounds are handled by the method rather than as constraints,
+    so each iteration only factors a dense matrix with one row per
+    requirement and otherwise costs a few passes over the sparse coverage
+    matrix.  The deadline is checked before every iteration.
+
+    The returned cost is the objective of the dual,
+
+        maximize required.y - sum(max(coverage'.y - costs, 0)), y >= 0,
+
+    at the final iterate.  Any y >= 0 gives a lower bound on the optimal
+    cost this way, so the cost can safely be used to prune a branch and bound
+    search even though the iterates only approach the optimum.
+
+        coverage - a scipy.sparse matrix with one row per requirement and one
+            column per parcel.
+        costs - a 1D numpy array of the non-negative cost of each parcel.
+        required - a 1D numpy array of the amount required for each row.
+        deadline - the time.time() at or after which to give up.
+
+    Returns a tuple of (cost, x), where cost is a lower bound on the optimal
+    cost (within tolerance of it) and x is the approximately optimal primal
+    solution, or (None, None) if the deadline passed or the method did not
+    converge.  The problem must be feasible, i.e. the row sums of coverage
+    must meet required."""
+
+    coverage = scipy.sparse.csr_matrix(coverage)
+    num_rows, num_parcels = coverage.shape
+    cost_scale = max(costs.max(), tolerance) if num_parcels > 0 else 1.0
+    c = costs / cost_scale
+    b = numpy.asarray(required, dtype=numpy.float64)
+
+    # x are the parcel variables, w = 1 - x their upper bound slacks and s the
+    # surplus of each requirement.  y, z and v are the duals of s, x and w.
+    x = numpy.ones(num_parcels) * 0.5
+    w = 1.0 - x
+    s = numpy.ones(num_rows)
+    y = numpy.ones(num_rows)
+    z = numpy.ones(num_parcels)
+    v = numpy.ones(num_parcels)
+    num_pairs = 2 * num_parcels + num_rows
+
+    def _step_length(values, deltas):
+        shrinking = deltas < 0
+        if not numpy.any(shrinking):
+            return 1.0
+        return min(1.0, (-values[shrinking] / deltas[shrinking]).min())
+
+    for _ in xrange(max_iterations):
+        if time.time() >= deadline:
+            return None, None
+
+        primal_residual = b - coverage.dot(x) + s
+        dual_residual = c - coverage.T.dot(y) - z + v
+        mu = (x.dot(z) + w.dot(v) + s.dot(y)) / num_pairs
+        if (numpy.abs(primal_residual).max() < tolerance * (1 + b.max()) and
+                numpy.abs(dual_residual).max() < tolerance * (1 + c.max())
+                and mu < tolerance):
+            y = numpy.maximum(y, 0)
+            dual_cost = b.dot(y) - numpy.maximum(coverage.T.dot(y) - c,
+                0).sum()
+            return dual_cost * cost_scale, numpy.clip(x, 0, 1)
+
+        scaling = 1.0 / (z / x + v / w)
+        normal_matrix = (coverage.multiply(scaling).dot(coverage.T)
+            ).toarray() + numpy.diag(s / y)
+        try:
+            factor = scipy.linalg.cho_factor(normal_matrix)
+        except numpy.linalg.LinAlgError:
+            return None, None
+
+        def _direction(xz_target, wv_target, sy_target):
+            q = xz_target / x - wv_target / w - dual_residual
+            dy = scipy.linalg.cho_solve(factor, primal_residual -
+                coverage.dot(scaling * q) + sy_target / y)
+            dx = scaling * (coverage.T.dot(dy) + q)
+            dz = (xz_target - z * dx) / x
+            dv = (wv_target + v * dx) / w
+            ds = (sy_target - s * dy) / y
+            return dx, dy, dz, dv, ds
+
+        def _step_lengths(dx, dy, dz, dv, ds):
+            return (min(_step_length(x, dx), _step_length(w, -dx),
+                _step_length(s, ds)), min(_step_length(z, dz),
+                _step_length(v, dv), _step_length(y, dy)))
+
+        # predictor: the affine scaling direction.
+        dx, dy, dz, dv, ds = _direction(-x * z, -w * v, -s * y)
+        primal_step, dual_step = _step_lengths(dx, dy, dz, dv, ds)
+        affine_mu = ((x + primal_step * dx).dot(z + dual_step * dz) +
+            (w - primal_step * dx).dot(v + dual_step * dv) +
+            (s + primal_step * ds).dot(y + dual_step * dy)) / num_pairs
+        centering = (affine_mu / mu) ** 3
+
+        # corrector: recenter and account for the second-order terms.
+        dx, dy, dz, dv, ds = _direction(
+            centering * mu - x * z - dx * dz,
+            centering * mu - w * v + dx * dv,
+            centering * mu - s * y - ds * dy)
+        primal_step, dual_step = _step_lengths(dx, dy, dz, dv, ds)
+        primal_step = min(1.0, 0.99 * primal_step)
+        dual_step = min(1.0, 0.99 * dual_step)
+
+        x = x + primal_step * dx
+        w = w - primal_step * dx
+        s = s + primal_step * ds
+        y = y + dual_step * dy
+        z = z + dual_step * dz
+        v = v + dual_step * dv
+
+    return None, None
+
+def select_set_optimal(parcels, biodiversity_req=None, es_hydro_req=None,
+        es_global_req=None, proportion_offset=1.0, objective='area',
+        time_budget=30.0):
+    """Select offset parcels that meet the biodiversity, hydrological ES and
+    global ES requirements with the smallest total area (or the smallest
+    number of parcels).
+
+    The requirements are the same as for select_set_multifactor(), but are
+    solved together as a covering integer program.  A greedy solution is
+    improved by a branch and bound search over linear programming
+    relaxations until the best portfolio is proven or the time budget runs
+    out.  The result of select_set_multifactor() is returned if nothing
+    better is found.
+
+    parcels - a ParcelTable, or a dict mapping offset parcel IDs to
+        dictionaries with offset parcel information.  See
+        select_set_multifactor().
+    biodiversity_req=None - See select_set_multifactor().
+    es_hydro_req=None - See select_set_multifactor().
+    es_global_req=None - See select_set_multifactor().
+    proportion_offset=1.0 - a number indicating the proportion of
+        impacts/requirements to offset.
+    objective='area' - either 'area' to minimize the total area of the
+        selected parcels or 'count' to minimize the number of selected
+        parcels.
+    time_budget=30.0 - the number of seconds to spend searching for the best
+        portfolio.  The deadline is checked before every relaxation is
+        solved and during each solve, so the search stops shortly after the
+        budget is spent and the best portfolio found so far is returned.  If
+        the budget is 0, the result of select_set_multifactor() is returned.
+
+    Returns a sorted list of selected parcel IDs."""
+
+    if objective not in ('area', 'count'):
+        raise ValueError('Objective must be "area" or "count", not %s' %
+            objective)
+    proportion_offset = float(proportion_offset)
+    deadline = time.time() + time_budget
 
-        available_parcels = set(parcels.keys()).difference(selected_parcels)
-        global_es_selected_parcels = set([])
-        for service in sorted(es_global_req.keys()):
-            # sort available parcels in decreasing order of service offset
-            service_sort = lambda pid: parcels[pid][service]
-            for parcel_id in sorted(available_parcels, key=service_sort,
-                reverse=True):
-                amt_required = es_global_req[service] * proportion_offset
-                if service_totals[service] >= amt_required:
-                    break
+    table = ParcelTable.from_parcels(parcels)
+    greedy_parcels = select_set_multifactor(table, biodiversity_req,
+        es_hydro_req, es_global_req, proportion_offset)
 
-                available_parcels.remove(parcel_id)
-                global_es_selected_parcels.add(parcel_id)
-                for _service in es_global_req.keys():
-                    service_totals[_service] += parcels[parcel_id][_service]
+    coverage = _covering_constraints(table, biodiversity_req, es_hydro_req,
+        es_global_req, proportion_offset)
+    if coverage.shape[0] == 0:
+        LOGGER.debug('No requirements to meet, using greedy selection')
+        return greedy_parcels
 
-        LOGGER.debug('Global selected parcels: %s', global_es_selected_parcels)
-        selected_parcels.update(global_es_selected_parcels)
+    parcel_ids = table.ids
+    if objective == 'area':
+        costs = numpy.maximum(table.values('area'), 0)
+    else:
+        costs = numpy.ones(len(table))
+
+    # Parcels that do not count towards any requirement are never part of a
+    # minimal portfolio, so leave them out of the program.
+    useful = numpy.nonzero(numpy.diff(coverage.indptr) > 0)[0]
+    coverage = coverage[:, useful]
+    costs = costs[useful]
+    num_parcels = len(useful)
+    tolerance = 1e-7
+
+    def _cost(selection):
+        return costs[selection].sum()
+
+    def _to_parcel_ids(selection):
+        return sorted(parcel_ids[useful[selection]].tolist())
+
+    greedy_selection = numpy.zeros(len(table), dtype=bool)
+    greedy_selection[table.rows(greedy_parcels)] = True
+    greedy_selection = greedy_selection[useful]
+    if time.time() >= deadline:
+        LOGGER.info('Parcel selection time budget of %ss exceeded, using '
+            'greedy selection', time_budget)
+        return greedy_parcels
+
+    best = _greedy_cover(coverage, costs)
+    best_cost = _cost(best)
+
+    # The greedy selection from select_set_multifactor may already be
+    # better.
+    if (numpy.all(coverage.dot(greedy_selection.astype(numpy.float64)) >=
+            1 - 1e-9) and _cost(greedy_selection) < best_cost):
+        best = _remove_redundant_parcels(coverage, costs, greedy_selection)
+        best_cost = _cost(best)
+
+    def _solve_relaxation(lower, upper):
+        # Fixed parcels are taken out of the program: the requirements are
+        # reduced by what the parcels fixed at 1 provide.
+        fixed = lower >= upper
+        free = numpy.nonzero(~fixed)[0]
+        fixed_cost = costs[lower > 0].sum()
+        required = 1.0 - coverage.dot(lower)
+        solution = lower.copy()
+        if numpy.all(required <= tolerance):
+            return fixed_cost, solution
+
+        free_coverage = coverage[:, free]
+        if numpy.any(free_coverage.dot(numpy.ones(len(free))) <
+                required - tolerance):
+            # the requirements cannot be met with the remaining parcels.
+            return None, None
+        outstanding = numpy.nonzero(required > tolerance)[0]
+        lp_cost, lp_solution = _solve_covering_lp(
+            free_coverage[outstanding], costs[free], required[outstanding],
+            deadline)
+        if lp_cost is None:
+            return None, None
+        solution[free] = lp_solution
+        return fixed_cost + lp_cost, solution
+
+    def _lower_bound(lp_cost):
+        # Costs are integers when counting parcels.
+        if objective == 'count':
+            return math.ceil(lp_cost - tolerance)
+        return lp_cost
+
+    lower = numpy.zeros(num_parcels)
+    upper = numpy.ones(num_parcels)
+    lp_cost = None
+    if time.time() < deadline:
+        lp_cost, lp_solution = _solve_relaxation(lower, upper)
+
+    if lp_cost is None:
+        LOGGER.warn('Could not solve the parcel selection problem within %ss, '
+            'using the best heuristic parcel selection', time_budget)
+        if _cost(best) >= _cost(greedy_selection):
+            return greedy_parcels
+        return _to_parcel_ids(best)
+
+    # Best-first branch and bound.  Nodes are ordered by their LP bound, which
+    # is the dual objective of the relaxation and so never overestimates.
+    node_counter = 0
+    open_nodes = [(_lower_bound(lp_cost), node_counter, lower, upper,
+        lp_solution)]
+    proven_optimal = False
+    while True:
+        # a node may have been left unexplored when the time ran out.
+        if time.time() >= deadline:
+            LOGGER.info('Parcel selection time budget of %ss exceeded',
+                time_budget)
+            break
+        if len(open_nodes) == 0:
+            proven_optimal = True
+            break
+
+        bound, _, lower, upper, solution = heapq.heappop(open_nodes)
+        if bound >= best_cost - tolerance * max(1.0, best_cost):
+            # no remaining node can improve on the best selection.
+            open_nodes = []
+            continue
+
+        # Rounding up the relaxation always meets the requirements.
+        rounded = _remove_redundant_parcels(coverage, costs,
+            solution > tolerance)
+        if _cost(rounded) < best_cost:
+            best = rounded
+            best_cost = _cost(rounded)
+
+        fractional = numpy.nonzero((solution > tolerance) &
+            (solution < 1 - tolerance))[0]
+        if len(fractional) == 0:
+            continue
+
+        branch_index = fractional[numpy.argmin(
+            numpy.abs(solution[fractional] - 0.5))]
+        for branch_value in (1, 0):
+            if time.time() >= deadline:
+                break
+            branch_lower = lower.copy()
+            branch_upper = upper.copy()
+            branch_lower[branch_index] = branch_value
+            branch_upper[branch_index] = branch_value
+            branch_cost, branch_solution = _solve_relaxation(branch_lower,
+                branch_upper)
+            if branch_cost is None:
+                # infeasible, or out of time.
+                continue
+            branch_bound = _lower_bound(branch_cost)
+            if branch_bound < best_cost - tolerance * max(1.0, best_cost):
+                node_counter += 1
+                heapq.heappush(open_nodes, (branch_bound, node_counter,
+                    branch_lower, branch_upper, branch_solution))
 
-    return sorted(selected_parcels)
+    LOGGER.debug('Optimal parcel selection: cost=%s, proven optimal=%s, '
+        '%s nodes, greedy cost=%s', best_cost, proven_optimal, node_counter,
+        _cost(greedy_selection))
+    return _to_parcel_ids(best)
 
 def translate_parcel_data(per_offset_data):
     """Translate the per-offset parcel data dictionary returned from
     natcap.opal.analysis.percent_overlap() into the data structures required for
-    multifactor parcel selection to take place."""
-    output_parcels = {}
-    output_ssheds = {}
-    known_keys = {
-        'Carbon': 'carbon',
-        'Nitrogen': 'nutrient',
-        'Sediment': 'sediment',
-        'Custom': 'custom',
-        'Area': 'area',
-        'Ecosystem': 'ecosystem',
-        'municipalities': 'overlap',
-    }
-    for parcel_id, parcel_data in per_offset_data.iteritems():
-        output_parcel_data = {}
-        for old_key, new_key in known_keys.iteritems():
-            try:
-                value = parcel_data[old_key]
-                if new_key == 'area':
-                    value = Ha(value)  # convert from m^2 to Ha
-                output_parcel_data[new_key] = value
-            except KeyError:
-                # When old_key isn't in parcel_data
-                pass
-        output_parcels[parcel_id] = output_parcel_data
+    multifactor parcel selection to take place.
+
+    Returns a dict mapping parcel IDs to dicts of parcel attributes.  See
+    ParcelTable.from_per_offset_data() for a columnar version."""
+    return ParcelTable.from_per_offset_data(per_offset_data).to_dict()
 
-    return output_parcels
 
 def translate_es_impacts(per_impact_data, custom_type='global'):
     """Translate the per-impact data dictionary returned from
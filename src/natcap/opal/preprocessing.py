@@ -7,21 +7,24 @@ import shutil
 import json
 import glob
 import time
+import multiprocessing
+import itertools
 
 from osgeo import ogr
 from osgeo import gdal
 from osgeo import osr
 import shapely
 import shapely.ops
-import shapely.speedups
 import shapely.geos
 import shapely.prepared
 import shapely.validation
 import shapely.geometry
+import shapely.wkb
 import rtree
 import pygeoprocessing
 import faulthandler
 
+import geometry as opal_geometry
 import offsets
 import utils
 
@@ -30,6 +33,9 @@ faulthandler.enable()
 
 LOGGER = logging.getLogger('natcap.opal.preprocessing')
 
+# The distance (in meters) around a parcel considered in LCI calculations.
+LCI_DISTANCE = 500
+
 def rm_shapefile(uri):
     """Delete all files associated with the user-defined ESRI Shapefile.
 
@@ -42,28 +48,63 @@ def rm_shapefile(uri):
         LOGGER.debug('Removing %s', filename)
         os.remove(filename)
 
-def build_spatial_index(vector):
+def _temp_vector_uri(temp_dir, name, like_uri):
+    """Build a URI for a temporary vector called name in temp_dir, in the
+    same vector format as like_uri."""
+    extension = utils.VECTOR_FORMATS[utils.vector_driver_name(like_uri)]
+    return os.path.join(temp_dir, name + extension)
+
+def build_spatial_index(vector, load_polygons=True, memory_limit=None):
     """Build an rtree spatial index mapping the parcel index to the bounds of
     each polygon in the input vector.  Returns a tuple of (Index, dict), where
     Index is an instance of rtree.index.Index and dict is a python dictionary
-    mapping parcel index to shapely polygon of the parcel."""
+    mapping parcel index to shapely polygon of the parcel.
+
+    If load_polygons is False, the index is built from the feature envelopes
+    alone and the dict is None, so the polygons are never all in memory.
+    Otherwise, polygons are read one tile at a time (see
+    utils.TiledVectorReader, which also takes memory_limit) and the index is
+    bulk-loaded."""
 
     utils.assert_files_exist([vector])
     LOGGER.debug('Building spatial index for vector %s', vector)
 
-    parcels_vector = ogr.Open(vector)
-    parcels_layer = parcels_vector.GetLayer()
-
-    spatial_index = rtree.index.Index()
-    parcel_dict = {}
-    for parcel in parcels_layer:
-        parcel_index = parcel.GetFID()
-        parcel_polygon = offsets.build_shapely_polygon(parcel)
-        spatial_index.insert(parcel_index, parcel_polygon.bounds)
-        parcel_dict[parcel_index] = parcel_polygon
+    parcels_reader = utils.TiledVectorReader(vector, memory_limit)
+    entries = [(int(fid), tuple(bounds), None) for (fid, bounds) in
+        zip(parcels_reader.fids, parcels_reader.bounds)]
+    if len(entries) > 0:
+        spatial_index = rtree.index.Index(entries)
+    else:
+        # rtree's bulk loading requires at least one item.
+        spatial_index = rtree.index.Index()
+
+    if load_polygons:
+        parcel_dict = {}
+        for tile_parcels, _ in parcels_reader.iter_tiles():
+            for parcel_index, parcel_polygon, _ in tile_parcels:
+                parcel_dict[parcel_index] = parcel_polygon
+    else:
+        parcel_dict = None
+    parcels_reader.close()
 
     return (spatial_index, parcel_dict)
 
+def build_geometry_index(geometries):
+    """Bulk-load an rtree spatial index over the bounding boxes of a list of
+    shapely geometries.
+
+        geometries - a list of shapely geometries.
+
+    Returns an rtree.index.Index where the id of each entry is the index of
+    the geometry in the input list."""
+
+    if len(geometries) == 0:
+        # rtree's bulk loading requires at least one item.
+        return rtree.index.Index()
+
+    return rtree.index.Index((geom_index, geometry.bounds, None)
+        for (geom_index, geometry) in enumerate(geometries))
+
 def split_multipolygons(in_vector_uri, out_vector_uri, include_fields=None):
     """Create a new ESRI shapefile with a single layer in it, where this layer
     contains only polygons.  Any multipolygons encountered are split into
@@ -95,19 +136,9 @@ def split_multipolygons(in_vector_uri, out_vector_uri, include_fields=None):
 
     if os.path.exists(out_vector_uri):
         LOGGER.warning('%s already exists on disk', out_vector_uri)
-        rm_shapefile(out_vector_uri)
 
     LOGGER.debug('Creating a new vector at %s', out_vector_uri)
-    LOGGER.debug('Out vector type: %s', type(out_vector_uri))
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
-    out_vector = out_driver.CreateDataSource(out_vector_uri)
-
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(out_vector_uri)[0]))
-    out_layer = out_vector.CreateLayer(layer_name, srs=in_layer_srs)
-
-    # map the old index to the new index.
-    field_indices = {}
+    out_writer = utils.VectorWriter(out_vector_uri, in_layer_srs)
 
     if include_fields is None:
         LOGGER.debug('No fields will be copied')
@@ -115,37 +146,19 @@ def split_multipolygons(in_vector_uri, out_vector_uri, include_fields=None):
 
     if include_fields is 'all':
         LOGGER.debug('All fields will be copied')
-        field_names = []
-        for index in range(in_layer_defn.GetFieldCount()):
-            field_defn = in_layer_defn.GetFieldDefn(index)
-            field_names.append(field_defn.GetName())
-        include_fields = field_names
+        include_fields = None
 
     LOGGER.debug('Copying fields %s', include_fields)
-    for old_field in include_fields:
-        old_field_index =  in_layer_defn.GetFieldIndex(old_field)
-        old_field_defn = in_layer_defn.GetFieldDefn(old_field_index)
-
-        # create a new field in the output layer based on the old field
-        # definition
-        out_layer.CreateField(old_field_defn)
-        out_layer_defn = out_layer.GetLayerDefn()
-        new_field_index = out_layer_defn.GetFieldIndex(old_field)
-        field_indices[old_field_index] = new_field_index
+    out_writer.copy_fields(in_layer_defn, include_fields)
 
     # create an FID column because I want it for later for aggregating raster
     # stats.
     LOGGER.debug('Creating new field FID')
-    fid_field_defn = ogr.FieldDefn('FID', ogr.OFTInteger)
-    out_layer.CreateField(fid_field_defn)
-    out_layer_defn = out_layer.GetLayerDefn()
-    fid_index = out_layer_defn.GetFieldIndex('FID')
+    fid_index = out_writer.create_field(
+        ogr.FieldDefn('FID', ogr.OFTInteger))
     LOGGER.debug('FID index: %s', fid_index)
 
-    if shapely.speedups.available:
-        LOGGER.debug('Speedups are available')
-        shapely.speedups.enable()
-        LOGGER.debug('Speedups enabled')
+    opal_geometry.enable_speedups()
 
     polygon_count = 0
     num_invalid = 0
@@ -195,25 +208,13 @@ def split_multipolygons(in_vector_uri, out_vector_uri, include_fields=None):
                 '%s instead') % feature_type_label)
 
         for polygon_wkb in polygons_in_feature:
-            # new_geometry = ogr.CreateGeometryFromWkb()
-            new_geometry = ogr.CreateGeometryFromWkb(polygon_wkb)
-            # create feature with geometry
-            new_feature = ogr.Feature(out_layer_defn)
-            new_feature.SetGeometryDirectly(new_geometry)
-            for old_index, new_index in field_indices.iteritems():
-                old_value = feature.GetField(old_index)
-                new_feature.SetField(new_index, old_value)
-
-            # <add field data to feature, as necessary>
-            # create the feature in the layer.
-            new_feature.SetField('FID', polygon_count)
-            out_layer.CreateFeature(new_feature)
+            out_writer.add_feature(polygon_wkb, {fid_index: polygon_count},
+                source_feature=feature)
             polygon_count += 1
     LOGGER.debug('Fixed %s geometry errors while processing', num_fixed)
     LOGGER.debug('Found %s invalid polygons.', num_invalid)
 
-    out_layer.SyncToDisk()
-    out_vector.SyncToDisk()
+    out_writer.close()
 
 
 def prepare_aoi(impact_sites_uri, hydro_subzones_uri, out_uri):
@@ -232,10 +233,11 @@ def prepare_aoi(impact_sites_uri, hydro_subzones_uri, out_uri):
 
     if os.path.exists(out_uri):
         LOGGER.debug('Cleaning up existing AOI')
-        rm_shapefile(out_uri)
+        utils.remove_vector(out_uri)
 
     temp_dir = tempfile.mkdtemp()
-    intersecting_uri = os.path.join(temp_dir, 'intersecting_subzones.shp')
+    intersecting_uri = _temp_vector_uri(temp_dir, 'intersecting_subzones',
+        out_uri)
     LOGGER.debug('Saving intersecting subzones to %s', intersecting_uri)
     locate_intersecting_polygons(hydro_subzones_uri, impact_sites_uri,
         intersecting_uri)
@@ -244,7 +246,8 @@ def prepare_aoi(impact_sites_uri, hydro_subzones_uri, out_uri):
     union_of_vectors([intersecting_uri], out_uri)
     shutil.rmtree(temp_dir)
 
-def prepare_impact_sites(impact_sites_uri, hydrozones, out_dir):
+def prepare_impact_sites(impact_sites_uri, hydrozones, out_dir,
+        vector_format='ESRI Shapefile'):
     """Clip impact sites by hydrozones, storing the resulting zones in out_dir.
     This function will also ensure that any multipolygon impacts are split into
     separate individual polygons.
@@ -253,18 +256,22 @@ def prepare_impact_sites(impact_sites_uri, hydrozones, out_dir):
         hydrozones - a URI to an OGR vector with hydrozone polygons.
         out_dir - a URI to an output folder where the split impact sites should
             be stored.
+        vector_format='ESRI Shapefile' - the OGR driver name of the format
+            of the new vectors.  One of the keys of utils.VECTOR_FORMATS.
 
     Returns a list of URIs to new impact site vectors stored within out_dir."""
 
     utils.assert_files_exist([impact_sites_uri, hydrozones])
     temp_dir = tempfile.mkdtemp()
 
-    split_impacts_uri = os.path.join(temp_dir, 'split_multipolygons.shp')
+    split_impacts_uri = os.path.join(temp_dir, 'split_multipolygons' +
+        utils.VECTOR_FORMATS[vector_format])
     LOGGER.debug('Splitting multipolygons')
     split_multipolygons(impact_sites_uri, split_impacts_uri, 'all')
 
     LOGGER.debug('Splitting impacts into separate vectors by hydrozone')
-    split_impact_data = split_impacts(split_impacts_uri, hydrozones, out_dir)
+    split_impact_data = split_impacts(split_impacts_uri, hydrozones, out_dir,
+        vector_format=vector_format)
 
     LOGGER.debug('Removing temp files %s', temp_dir)
     shutil.rmtree(temp_dir)
@@ -274,7 +281,7 @@ def prepare_impact_sites(impact_sites_uri, hydrozones, out_dir):
 # assume that the AOI is completely contained within a single hydrozone
 def prepare_offset_parcels(parcels_vector, max_search_vector,
         out_vector_uri, previous_offsets=None, previous_impacts=None,
-        include_lci=True):
+        include_lci=True, n_workers=None, memory_limit=None):
     """Prepare offset parcels.  This function takes in a vector of parcels and
     a max search area and writes out an OGR vector to out_vector_uri.
 
@@ -287,6 +294,9 @@ def prepare_offset_parcels(parcels_vector, max_search_vector,
         - Restrict the set of output polygons to only those found in the max
           seach vector.
 
+    Each of these steps is recorded as a span when profiling is enabled.  See
+    utils.span().
+
     Parameters:
         parcels_vector - an OGR vector of polygons and/or multipolygons.
         max_search_vector - an OGR vector with a single polygon.  Any polygons
@@ -297,6 +307,11 @@ def prepare_offset_parcels(parcels_vector, max_search_vector,
         previous_impacts - an OGR vector of polygons/multipolygons
         include_lci=True - a boolean.  If False, LCI calculations will be
             skipped.
+        n_workers=None - the number of worker processes to use when
+            calculating the LCI.  See calculate_lci().
+        memory_limit=None - the approximate number of bytes the parcel
+            polygons in memory may use when calculating the LCI.  See
+            calculate_lci().
 
     Returns nothing.
     """
@@ -307,51 +322,72 @@ def prepare_offset_parcels(parcels_vector, max_search_vector,
 
     # copy the impact site datasource so I can edit.
     LOGGER.debug('Splitting multipolygons')
-    mp_split_uri = os.path.join(temp_dir, 'mp_split.shp')
+    mp_split_uri = _temp_vector_uri(temp_dir, 'mp_split', out_vector_uri)
     LOGGER.debug('Writing temp vector to %s', mp_split_uri)
-    split_multipolygons(parcels_vector, mp_split_uri, 'all')
+    with utils.span('split_multipolygons') as stage:
+        split_multipolygons(parcels_vector, mp_split_uri, 'all')
+        if stage.enabled:
+            stage.count(features=utils.feature_count(mp_split_uri))
 
     if include_lci:
         # locate the parcels we'll use for calculating the LCI
         # This also restricts the number of parcels to be slightly more than just
         # those that intersect with the search vector.
-        lci_parcels = os.path.join(temp_dir, 'lci_parcels.shp')
-        _locate_lci_parcels(mp_split_uri, max_search_vector, 500, lci_parcels)
+        lci_parcels = _temp_vector_uri(temp_dir, 'lci_parcels',
+            out_vector_uri)
+        with utils.span('locate_lci_parcels') as stage:
+            _locate_lci_parcels(mp_split_uri, max_search_vector, 500,
+                lci_parcels)
+            if stage.enabled:
+                stage.count(features=utils.feature_count(lci_parcels))
         prepared_parcels_uri = lci_parcels
     else:
         prepared_parcels_uri = mp_split_uri
 
     if previous_offsets is not None:
         LOGGER.info('Subtracting previous offsets from offset parcels')
-        temp_prev_offsets = os.path.join(temp_dir, 'diff_prev_offsets.shp')
-        subtract_vectors(prepared_parcels_uri, previous_offsets,
-            temp_prev_offsets)
+        temp_prev_offsets = _temp_vector_uri(temp_dir, 'diff_prev_offsets',
+            out_vector_uri)
+        with utils.span('subtract_previous_offsets'):
+            subtract_vectors(prepared_parcels_uri, previous_offsets,
+                temp_prev_offsets)
         prepared_parcels_uri = temp_prev_offsets
 
     if previous_impacts is not None:
         LOGGER.info('Subtracting previous impacts from offset parcels')
-        temp_prev_impacts = os.path.join(temp_dir, 'diff_prev_impacts.shp')
-        subtract_vectors(prepared_parcels_uri, previous_impacts,
-            temp_prev_impacts)
+        temp_prev_impacts = _temp_vector_uri(temp_dir, 'diff_prev_impacts',
+            out_vector_uri)
+        with utils.span('subtract_previous_impacts'):
+            subtract_vectors(prepared_parcels_uri, previous_impacts,
+                temp_prev_impacts)
         prepared_parcels_uri = temp_prev_impacts
 
     if include_lci:
         # Calculate the LCI based on the located parcels with the previous offsets
         # and previous impacts removed.
-        calculated_lci = os.path.join(temp_dir, 'calculated_lci.shp')
+        calculated_lci = _temp_vector_uri(temp_dir, 'calculated_lci',
+            out_vector_uri)
         LOGGER.info('Calculating LCI: %s', calculated_lci)
-        calculate_lci(prepared_parcels_uri, calculated_lci)
+        with utils.span('calculate_lci') as stage:
+            calculate_lci(prepared_parcels_uri, calculated_lci,
+                n_workers=n_workers, memory_limit=memory_limit)
+            if stage.enabled:
+                stage.count(features=utils.feature_count(calculated_lci))
 
         # Now that we've calculated the LCI, restore the set of polygons to only
         # those that intersect the search area.  This discards any other polygons
         # that are completely outside the search area that we needed for
         # calculating the LCI.
         LOGGER.info('Limiting parcels to only intersecting the search area')
-        locate_intersecting_polygons(calculated_lci, max_search_vector,
-            out_vector_uri)
+        search_parcels_uri = calculated_lci
     else:
-        locate_intersecting_polygons(prepared_parcels_uri, max_search_vector,
+        search_parcels_uri = prepared_parcels_uri
+
+    with utils.span('locate_search_area_parcels') as stage:
+        locate_intersecting_polygons(search_parcels_uri, max_search_vector,
             out_vector_uri)
+        if stage.enabled:
+            stage.count(features=utils.feature_count(out_vector_uri))
 
     LOGGER.debug('Cleaning up temp folder %s', temp_dir)
     shutil.rmtree(temp_dir)
@@ -380,19 +416,22 @@ def _locate_lci_parcels(parcels_vector_uri, max_search_vector, buffer, out_vecto
 
     # get the set of all parcels that intersect with the max_search_vector.
     LOGGER.debug('Locating parcels intersecting search area')
-    parcels_in_ssa = os.path.join(temp_dir, 'intersect_ssa.shp')
+    parcels_in_ssa = _temp_vector_uri(temp_dir, 'intersect_ssa',
+        out_vector)
     locate_intersecting_polygons(parcels_vector_uri, max_search_vector,
         parcels_in_ssa)
 
     # Take the cascaded union of all the parcels that intersect with the
     #   max_search_vector and all parcels in the max_search_vector.
     LOGGER.debug('Taking union of parcels outside search area and search area')
-    parcels_union_ssa = os.path.join(temp_dir, 'ssa_union_parcels.shp')
+    parcels_union_ssa = _temp_vector_uri(temp_dir, 'ssa_union_parcels',
+        out_vector)
     union_of_vectors([parcels_in_ssa, max_search_vector], parcels_union_ssa)
 
     # Buffer the new max_search_vector by 500m.
     LOGGER.debug('Buffering max search vector')
-    buffered_search_area = os.path.join(temp_dir, 'buffered_ssa.shp')
+    buffered_search_area = _temp_vector_uri(temp_dir, 'buffered_ssa',
+        out_vector)
     buffer_vector(parcels_union_ssa, 500, buffered_search_area)
 
     # get all the parcels that intersect with the buffered max search area.
@@ -425,27 +464,13 @@ def buffer_vector(in_vector_uri, buffer_dist, out_vector_uri):
 
     if os.path.exists(out_vector_uri):
         LOGGER.debug('Removing preexisting output vector: %s', out_vector_uri)
-        rm_shapefile(out_vector_uri)
 
     LOGGER.debug('Creating buffered vector at %s',
             os.path.abspath(out_vector_uri))
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
-    out_vector = out_driver.CreateDataSource(out_vector_uri)
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(out_vector_uri)[0]))
-    out_layer = out_vector.CreateLayer(layer_name, srs=in_layer_srs)
-    LOGGER.debug('New layer name: %s', layer_name)
+    out_writer = utils.VectorWriter(out_vector_uri, in_layer_srs)
 
     # create all the same fields in the output vector
-    field_indices = {}
-    for field_index in xrange(in_layer_defn.GetFieldCount()):
-        # get the old field definition, create a new field in the new layer
-        old_field_defn = in_layer_defn.GetFieldDefn(field_index)
-        out_layer.CreateField(old_field_defn)
-        field_name = old_field_defn.GetName()
-        out_layer_defn = out_layer.GetLayerDefn()
-        out_field_index = out_layer_defn.GetFieldIndex(field_name)
-        field_indices[field_index] = out_field_index
+    out_writer.copy_fields(in_layer_defn)
 
     num_features = in_layer.GetFeatureCount()
     LOGGER.debug('Buffering %s features by %s', num_features, buffer_dist)
@@ -458,22 +483,14 @@ def buffer_vector(in_vector_uri, buffer_dist, out_vector_uri):
         #buffered_feature = feature.buffer(buffer_dist)
         #geometry = ogr.CreateGeometryFromWkb(buffered_feature.wkb)
 
-        new_feature = ogr.Feature(in_layer_defn)
-        new_feature.SetGeometry(geometry)
-
-        for old_index, new_index in field_indices.iteritems():
-            old_value = old_feature.GetField(old_index)
-            new_feature.SetField(new_index, old_value)
-
-        out_layer.CreateFeature(new_feature)
+        out_writer.add_feature(geometry, source_feature=old_feature)
 
+    out_writer.close()
     ogr.DataSource.__swig_destroy__(in_vector)
-    ogr.DataSource.__swig_destroy__(out_vector)
     in_vector = None
-    out_vector = None
 
 def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
-        out_vector_uri, clip=False):
+        out_vector_uri, clip=False, spatial_index=True):
     """ Locate all polygons in source_vector_uri that intersect with any polygons
     in comparison_vector_uri.  If any intersecting polygons are found, the
     geometry, fields and field values are all copied to the output vector.
@@ -485,13 +502,17 @@ def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
             This file must not already exist on disk.
         clip - a boolean to indicate whether the output geometry should be
             clipped to the comparison vector.
+        spatial_index=True - a boolean.  If True, the comparison polygons are
+            loaded into an rtree index once and each source polygon is only
+            tested against those comparison polygons whose bounding boxes it
+            overlaps.  If False, every source polygon is tested against every
+            comparison polygon.  The output vector is the same either way.
 
     Returns nothing."""
 
     utils.assert_files_exist([source_vector_uri, comparison_vector_uri])
     utils.assert_ogr_projections_equal([source_vector_uri,
         comparison_vector_uri])
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
 
     LOGGER.debug('Opening input vector %s', os.path.abspath(source_vector_uri))
     in_vector = ogr.Open(source_vector_uri)
@@ -517,26 +538,21 @@ def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
             LOGGER.debug('Feature %s has invalid geometry: "%s"', fid,
                 shapely.validation.explain_validity())
 
-    if os.path.exists(out_vector_uri):
-        rm_shapefile(out_vector_uri)
+    impact_features = opal_geometry.as_array(impact_features)
+    if spatial_index:
+        LOGGER.debug('Indexing %s comparison polygons', len(impact_features))
+        comparison_index = build_geometry_index(impact_features)
+
+        # Only source polygons within the extent of the comparison polygons
+        # can intersect them, so let the source vector's spatial index (if
+        # it has one) skip the rest.
+        utils.set_spatial_filter(in_layer, impact_features)
 
     LOGGER.debug('Creating a new vector at %s', out_vector_uri)
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
-    out_vector = out_driver.CreateDataSource(out_vector_uri)
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(out_vector_uri)[0]))
-    out_layer = out_vector.CreateLayer(layer_name, srs=in_layer_srs)
+    out_writer = utils.VectorWriter(out_vector_uri, in_layer_srs)
 
     # create all the same fields in the output vector
-    field_indices = {}
-    for field_index in xrange(in_layer_defn.GetFieldCount()):
-        # get the old field definition, create a new field in the new layer
-        old_field_defn = in_layer_defn.GetFieldDefn(field_index)
-        out_layer.CreateField(old_field_defn)
-        field_name = old_field_defn.GetName()
-        out_layer_defn = out_layer.GetLayerDefn()
-        out_field_index = out_layer_defn.GetFieldIndex(field_name)
-        field_indices[field_index] = out_field_index
+    out_writer.copy_fields(in_layer_defn)
 
     LOGGER.debug('Locating intersecting polygons')
     found_features = {}
@@ -544,8 +560,6 @@ def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
     num_features = 0
     for feature in in_layer:
         index = feature.GetFID()
-        feature_defn = feature.GetDefnRef()
-        geometry = feature.GetGeometryRef()
         num_features += 1
 
         try:
@@ -560,21 +574,40 @@ def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
         prep_polygon = shapely.prepared.prep(polygon)
 
         if not skip:
-            if not clip:
-                for impact_site in impact_features:
-                    if index not in found_features:
-                        if prep_polygon.intersects(impact_site):
-                            if polygon.intersection(impact_site).area > 0:
-                                found_features[index] = [polygon.wkb]
+            if spatial_index:
+                # Sort the hits so that clipped geometries are written in the
+                # same order as in the unindexed case.
+                candidates = impact_features[sorted(
+                    comparison_index.intersection(polygon.bounds))]
             else:
-                for impact_site in impact_features:
+                candidates = impact_features
+
+            if not clip:
+                for impact_site in candidates:
                     if prep_polygon.intersects(impact_site):
-                        intersection = polygon.intersection(impact_site)
-                        if intersection.area > 0:
-                            try:
-                                found_features[index].append(intersection.wkb)
-                            except KeyError:
-                                found_features[index] = [intersection.wkb]
+                        # When the comparison polygon falls entirely within
+                        # this polygon, the intersection is the comparison
+                        # polygon itself, so there's no need to compute it.
+                        if spatial_index and prep_polygon.contains(impact_site):
+                            intersection_area = impact_site.area
+                        else:
+                            intersection_area = polygon.intersection(
+                                impact_site).area
+
+                        if intersection_area > 0:
+                            found_features[index] = [polygon.wkb]
+                            break
+            else:
+                hits = opal_geometry.as_array([impact_site for impact_site
+                    in candidates if prep_polygon.intersects(impact_site)])
+                intersections = opal_geometry.intersection(polygon, hits)
+                for intersection, intersection_area in zip(intersections,
+                        opal_geometry.area(intersections)):
+                    if intersection_area > 0:
+                        try:
+                            found_features[index].append(intersection.wkb)
+                        except KeyError:
+                            found_features[index] = [intersection.wkb]
         else:
             LOGGER.warn('Feature %s is invalid and could not be fixed.', index)
 
@@ -589,18 +622,11 @@ def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
 
     last_time = time.time()
     LOGGER.debug('Creating %s new geometries', len(found_features))
-    for index, binary_geometries in found_features.iteritems():
+    for index in sorted(found_features):
         old_feature = in_layer.GetFeature(index)
-        for binary_geometry in binary_geometries:
-            new_geometry = ogr.CreateGeometryFromWkb(binary_geometry)
-            new_feature = ogr.Feature(feature_defn)
-            new_feature.SetGeometry(new_geometry)
-
-            for old_index, new_index in field_indices.iteritems():
-                old_value = old_feature.GetField(old_index)
-                new_feature.SetField(new_index, old_value)
-
-            out_layer.CreateFeature(new_feature)
+        for binary_geometry in found_features[index]:
+            out_writer.add_feature(binary_geometry,
+                source_feature=old_feature)
 
             # Sometimes, this progress logging show up and I have no idea why
             # it doesn't.  Need to debug later.
@@ -613,10 +639,9 @@ def locate_intersecting_polygons(source_vector_uri, comparison_vector_uri,
                 LOGGER.info('Creating geometries %s%% complete', percent_complete)
 
     LOGGER.debug('Creating geometries 100%% complete')
-    out_vector.SyncToDisk()
+    out_writer.close()
 
     ogr.DataSource.__swig_destroy__(in_vector)
-    ogr.DataSource.__swig_destroy__(out_vector)
 
 def union_of_vectors(input_vector_uris, out_vector_uri):
     """Find the union of all features in the provided input vectors and write
@@ -636,16 +661,9 @@ def union_of_vectors(input_vector_uris, out_vector_uri):
     in_layer = in_vector.GetLayer()
     in_layer_srs = in_layer.GetSpatialRef()
 
-    if os.path.exists(out_vector_uri):
-        rm_shapefile(out_vector_uri)
-
     LOGGER.debug('Creating a new vector at %s', out_vector_uri)
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
-    out_vector = out_driver.CreateDataSource(out_vector_uri)
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(out_vector_uri)[0]))
     new_srs = osr.SpatialReference(wkt=in_layer_srs.ExportToWkt())
-    out_layer = out_vector.CreateLayer(layer_name, new_srs, ogr.wkbPolygon)
+    out_writer = utils.VectorWriter(out_vector_uri, new_srs)
     ogr.DataSource.__swig_destroy__(in_vector)
 
     LOGGER.debug('Building shapely geometries')
@@ -676,31 +694,22 @@ def union_of_vectors(input_vector_uris, out_vector_uri):
             union_features.append(feature)
 
     LOGGER.debug('Taking union of %s features', len(union_features))
-    biggest_feature = shapely.ops.cascaded_union(union_features)
+    biggest_feature = opal_geometry.union_all(union_features)
 
     union_polygon = biggest_feature
 
 #    LOGGER.debug('Taking the union of %s features', len(all_features))
 #    union_polygon = shapely.ops.cascaded_union(all_features)
 #    union_polygon = shapely.geometry.MultiPolygon(union_polygon)
-    LOGGER.debug('Creating new feature from empty definition')
-    new_feature = ogr.Feature(ogr.FeatureDefn())
-    new_geometry = ogr.CreateGeometryFromWkb(union_polygon.wkb)
-    LOGGER.debug('Setting geometry from union_polygon with len(wkt)=%s',
-        len(union_polygon.wkt))
-    new_feature.SetGeometry(new_geometry)
-
     LOGGER.debug('Creating new feature')
-    out_layer.CreateFeature(new_feature)
+    out_writer.add_feature(union_polygon)
 
     LOGGER.debug('Cleaning up')
-    new_feature = None
-    out_layer = None
-    out_vector = None
-    out_driver = None
+    out_writer.close()
     LOGGER.debug('Finished cleanup of new vector')
 
-def subtract_vectors(minuend_uri, subtrahend_uri, difference_uri):
+def subtract_vectors(minuend_uri, subtrahend_uri, difference_uri,
+        spatial_index=True):
     """Subtract the subtrahend vector from the minuend vector, writing the
     output geometries tothe difference vector.
 
@@ -708,6 +717,11 @@ def subtract_vectors(minuend_uri, subtrahend_uri, difference_uri):
         subtrahend_uri - a URI to an OGR vector on disk.
         difference_uri - a URI to where the difference vector should be saved
             This file must not already exist on disk.
+        spatial_index=True - a boolean.  If True, the subtrahend polygons are
+            read once into an rtree index and each minuend polygon has the
+            union of only the subtrahend polygons it intersects removed from
+            it in a single difference operation.  If False, every subtrahend
+            polygon is re-read and tested for every minuend polygon.
 
     Returns nothing."""
 
@@ -722,174 +736,272 @@ def subtract_vectors(minuend_uri, subtrahend_uri, difference_uri):
     subtrahend_vector = ogr.Open(subtrahend_uri)
     subtrahend_layer = subtrahend_vector.GetLayer()
 
-    if os.path.exists(difference_uri):
-        rm_shapefile(difference_uri)
+    if spatial_index:
+        _, subtrahend_polygons, _ = opal_geometry.read_vector(subtrahend_uri)
+        LOGGER.debug('Indexing %s subtrahend polygons',
+            len(subtrahend_polygons))
+        subtrahend_index = build_geometry_index(subtrahend_polygons)
 
     LOGGER.debug('Creating difference vector at %s', difference_uri)
-    difference_driver = ogr.GetDriverByName('ESRI Shapefile')
-    difference_vector = difference_driver.CreateDataSource(difference_uri)
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(difference_uri)[0]))
-    difference_layer = difference_vector.CreateLayer(layer_name,
-        srs=minuend_layer_srs)
+    difference_writer = utils.VectorWriter(difference_uri, minuend_layer_srs)
 
     # create all the same fields in the output vector
-    field_indices = {}
-    for field_index in xrange(minuend_layer_defn.GetFieldCount()):
-        # get the old field definition, create a new field in the new layer
-        old_field_defn = minuend_layer_defn.GetFieldDefn(field_index)
-        difference_layer.CreateField(old_field_defn)
-        field_name = old_field_defn.GetName()
-        difference_layer_defn = difference_layer.GetLayerDefn()
-        difference_field_index = difference_layer_defn.GetFieldIndex(field_name)
-        field_indices[field_index] = difference_field_index
-
-    LOGGER.debug('Field map: %s', field_indices)
+    difference_writer.copy_fields(minuend_layer_defn)
 
     for minuend_feature in minuend_layer:
         minuend_polygon = offsets.build_shapely_polygon(minuend_feature)
-        minuend_defn = minuend_feature.GetDefnRef()
-
-        for subtrahend_feature in subtrahend_layer:
-            subtrahend_polygon = offsets.build_shapely_polygon(subtrahend_feature)
-            if minuend_polygon.intersects(subtrahend_polygon):
-                minuend_polygon = minuend_polygon.difference(subtrahend_polygon)
 
-        subtrahend_layer.ResetReading()
+        if spatial_index:
+            prep_minuend = shapely.prepared.prep(minuend_polygon)
+            overlapping_polygons = [subtrahend_polygons[i] for i in
+                subtrahend_index.intersection(minuend_polygon.bounds)
+                if prep_minuend.intersects(subtrahend_polygons[i])]
 
-        if minuend_polygon.area > 0:
-            new_feature = ogr.Feature(minuend_defn)
-            new_geometry = ogr.CreateGeometryFromWkb(minuend_polygon.wkb)
-            new_feature.SetGeometry(new_geometry)
+            if len(overlapping_polygons) > 0:
+                minuend_polygon = minuend_polygon.difference(
+                    opal_geometry.union_all(overlapping_polygons))
+        else:
+            for subtrahend_feature in subtrahend_layer:
+                subtrahend_polygon = offsets.build_shapely_polygon(
+                    subtrahend_feature)
+                if minuend_polygon.intersects(subtrahend_polygon):
+                    minuend_polygon = minuend_polygon.difference(
+                        subtrahend_polygon)
 
-            for old_index, new_index in field_indices.iteritems():
-                old_value = minuend_feature.GetField(old_index)
-                new_feature.SetField(new_index, old_value)
+            subtrahend_layer.ResetReading()
 
-            difference_layer.CreateFeature(new_feature)
+        if minuend_polygon.area > 0:
+            difference_writer.add_feature(minuend_polygon,
+                source_feature=minuend_feature)
         else:
             fid = minuend_feature.GetFID()
             LOGGER.debug('Difference removed feature %s', fid)
+    difference_writer.close()
     ogr.DataSource.__swig_destroy__(minuend_vector)
     ogr.DataSource.__swig_destroy__(subtrahend_vector)
-    ogr.DataSource.__swig_destroy__(difference_vector)
 
-def calculate_lci(natural_parcels_uri, output_uri):
+def calculate_lci(natural_parcels_uri, output_uri, n_workers=None,
+        memory_limit=None):
+    """Calculate the Landscape Context Index (LCI) of every parcel in the
+    natural parcels vector.  The output vector has all of the fields of the
+    input vector, plus an 'LCI' field.
+
+    Parcels are read in spatial tiles (see utils.TiledVectorReader), each
+    with a halo of the parcels within LCI_DISTANCE of it, so only the
+    polygons of one tile need to be in memory at once.
+
+        natural_parcels_uri - a URI to an OGR vector of natural parcels.
+        output_uri - a URI to where the output vector should be written.
+        n_workers=None - the number of worker processes to use.  If None or
+            less than 2, the LCI is calculated in this process.  Otherwise,
+            the tiles are processed in a multiprocessing pool.  Output
+            features are always written in the order of the input features,
+            and the LCI values are the same regardless of the number of
+            workers.
+        memory_limit=None - the approximate number of bytes the parcel
+            polygons in memory may use.  Defaults to
+            utils.DEFAULT_TILE_MEMORY.
+
+    Returns nothing."""
     utils.assert_files_exist([natural_parcels_uri])
+
+    opal_geometry.enable_speedups()
+
+    LOGGER.debug('Indexing parcels in %s', natural_parcels_uri)
+    parcels_reader = utils.TiledVectorReader(natural_parcels_uri,
+        memory_limit)
+    if n_workers is not None and n_workers > 1:
+        lci_values = _parallel_lci(parcels_reader, n_workers)
+    else:
+        lci_values = {}
+        last_time = time.time()
+        for core, context in parcels_reader.iter_tiles(halo=LCI_DISTANCE):
+            lci_values.update(_tile_lci([fid for (fid, _, _) in core],
+                [(fid, polygon) for (fid, polygon, _) in context]))
+
+            current_time = time.time()
+            if (current_time - last_time) > 5.:
+                last_time = current_time
+                percent_complete = round((float(len(lci_values)) /
+                                          len(parcels_reader)) * 100, 2)
+                LOGGER.info('Calculating LCI %s%% complete',
+                    percent_complete)
+    parcels_reader.close()
+
     LOGGER.debug('Opening the natural parcels vector %s', natural_parcels_uri)
     parcels_vector = ogr.Open(natural_parcels_uri)
     parcels_layer = parcels_vector.GetLayer()
     parcels_defn = parcels_layer.GetLayerDefn()
     parcels_srs = parcels_layer.GetSpatialRef()
 
-    if os.path.exists(output_uri):
-        rm_shapefile(output_uri)
-
     LOGGER.debug('Creating LCI vector at %s', output_uri)
-    output_driver = ogr.GetDriverByName('ESRI Shapefile')
-    output_vector = output_driver.CreateDataSource(output_uri)
-    # Cast to str here because the ESRI shapefile expects it.
-    layer_name = str(os.path.basename(os.path.splitext(output_uri)[0]))
-    output_layer = output_vector.CreateLayer(layer_name,
-        srs=parcels_srs)
+    output_writer = utils.VectorWriter(output_uri, parcels_srs)
 
     LOGGER.debug('Creating new field LCI')
-    lci_field_defn = ogr.FieldDefn('LCI', ogr.OFTReal)
-    output_layer.CreateField(lci_field_defn)
-    output_layer_defn = output_layer.GetLayerDefn()
-    lci_index = output_layer_defn.GetFieldIndex('LCI')
+    lci_index = output_writer.create_field(ogr.FieldDefn('LCI', ogr.OFTReal))
     LOGGER.debug('LCI field index: %s', lci_index)
 
     # create all the same fields in the output vector
-    field_indices = {}
-    for field_index in xrange(parcels_defn.GetFieldCount()):
-        # get the old field definition, create a new field in the new layer
-        old_field_defn = parcels_defn.GetFieldDefn(field_index)
-        output_layer.CreateField(old_field_defn)
-        field_name = old_field_defn.GetName()
-        output_layer_defn = output_layer.GetLayerDefn()
-        output_field_index = output_layer_defn.GetFieldIndex(field_name)
-        field_indices[field_index] = output_field_index
-        LOGGER.debug('Old field: %s|%s, new field: %s type:%s', field_name,
-            field_index, output_field_index, old_field_defn.GetType())
-
-    LOGGER.debug('Field map: %s', field_indices)
-
-    if shapely.speedups.available:
-        LOGGER.debug('Enabling shapely speedups')
-        shapely.speedups.enable()
-
-    LOGGER.debug('Preprocessing all parcels')
-    parcel_dict = {}
-    spat_index = rtree.index.Index()
-    for parcel_index in xrange(parcels_layer.GetFeatureCount()):
-        parcel_feature = parcels_layer.GetFeature(parcel_index)
-        parcel_polygon = offsets.build_shapely_polygon(parcel_feature)
-        spat_index.insert(parcel_index, parcel_polygon.bounds)
-        parcel_dict[parcel_index] = parcel_polygon
-
-    LOGGER.debug('Locating nearby parcels')
-    lci_dict = {}
-    index = 0
-    num_parcels = len(parcel_dict)
-    for parcel_index, parcel_polygon in parcel_dict.iteritems():
-        minx, miny, maxx, maxy = parcel_polygon.bounds
-        minx -= 500
-        miny -= 500
-        maxx += 500
-        maxy += 500
-
-        nearby_indices = spat_index.intersection((minx, miny, maxx, maxy))
-        nearby_polygons = [parcel_dict[n_index] for n_index in nearby_indices]
-
-        num_nearby_polygons = len(nearby_polygons)
-        LOGGER.debug('Parcel %s of %s, %s nearby', parcel_index, num_parcels,
-            num_nearby_polygons)
-        if num_nearby_polygons > 0:
-            lci = calculate_parcel_lci(parcel_polygon, nearby_polygons)
-            lci_dict[index] = lci
-        index += 1
-
-        # create the feature in the output vector.
-        old_feature = parcels_layer.GetFeature(parcel_index)
-        new_feature = ogr.Feature(output_layer_defn)
-        new_geometry = ogr.CreateGeometryFromWkb(parcel_polygon.wkb)
-        new_feature.SetGeometry(new_geometry)
-        new_feature.SetField('LCI', lci)
-
-        for old_index, new_index in field_indices.iteritems():
-            old_value = old_feature.GetField(old_index)
-            new_feature.SetField(new_index, old_value)
-
-        output_layer.CreateFeature(new_feature)
-        new_feature = None
-        old_feature = None
+    output_writer.copy_fields(parcels_defn)
+
+    # Features are written in the order of the input features.
+    LOGGER.debug('Writing LCI for %s parcels', len(lci_values))
+    for old_feature in parcels_layer:
+        output_writer.add_feature(offsets.build_shapely_polygon(old_feature),
+            {lci_index: lci_values[old_feature.GetFID()]},
+            source_feature=old_feature)
+
     LOGGER.info('Cleaning up from LCI calculations')
     parcels_vector = None
-    output_layer.SyncToDisk()
-    output_layer = None
-    output_vector = None
-    output_driver = None
-    spat_index = None
+    output_writer.close()
     LOGGER.info('Finished calculating LCI')
 
+def _nearby_parcels_lci(parcel_position, parcel_polygons, spatial_index):
+    """Calculate the LCI of a single parcel using the parcels around it.
+
+        parcel_position - the index of the parcel in parcel_polygons.
+        parcel_polygons - a list of shapely polygons.
+        spatial_index - an rtree index of the bounding boxes of
+            parcel_polygons, where each id is a position in parcel_polygons.
+
+    Returns the float LCI of the parcel."""
+    parcel_polygon = parcel_polygons[parcel_position]
+    minx, miny, maxx, maxy = parcel_polygon.bounds
+    minx -= LCI_DISTANCE
+    miny -= LCI_DISTANCE
+    maxx += LCI_DISTANCE
+    maxy += LCI_DISTANCE
+
+    # The parcel itself only touches its own buffer ring, so it can be left
+    # out of the neighbors.  Neighbors are sorted so that the union is built
+    # in the same order no matter how the index was built.
+    nearby_polygons = [parcel_polygons[n_index] for n_index in
+        sorted(spatial_index.intersection((minx, miny, maxx, maxy)))
+        if n_index != parcel_position]
+    return calculate_parcel_lci(parcel_polygon, nearby_polygons)
+
+def _tile_lci(tile_fids, context):
+    """Calculate the LCI for the parcels of a single tile.
+
+        tile_fids - a list of the FIDs of the parcels to calculate the LCI
+            for.
+        context - a list of (FID, shapely polygon) tuples, sorted by FID, of
+            the tile's parcels and all of their neighbors.
+
+    Returns a dict mapping the FIDs in tile_fids to their LCI."""
+    local_polygons = [polygon for (_, polygon) in context]
+    local_positions = dict((fid, local_position)
+        for (local_position, (fid, _)) in enumerate(context))
+    local_index = build_geometry_index(local_polygons)
+
+    return dict((fid, _nearby_parcels_lci(local_positions[fid],
+        local_polygons, local_index)) for fid in tile_fids)
+
+def _parallel_lci(parcels_reader, n_workers):
+    """Calculate the LCI of all parcels in a multiprocessing pool.
+
+    Each tile of parcels is sent to a worker along with a halo of all
+    parcels within LCI_DISTANCE of the tile's parcels, so that every worker
+    has all of the neighbors it needs.  Only a couple of tiles per worker are
+    read at a time, and the tiles are made smaller so that they fit in the
+    reader's memory limit together and so that there is at least one tile
+    per worker.
+
+        parcels_reader - a utils.TiledVectorReader of the parcels.
+        n_workers - the number of worker processes to use.
+
+    Returns a dict mapping parcel FIDs to their float LCI."""
+    lci_values = {}
+    num_parcels = len(parcels_reader)
+    if num_parcels == 0:
+        return lci_values
+
+    # Two tiles per worker are in memory at once, so each tile gets a share
+    # of the memory limit.  Tiles are also made small enough that every
+    # worker gets at least one, but no smaller, since each tile also reads
+    # (and sends to a worker) the halo around it.
+    tiles_in_flight = n_workers * 2
+    parcels_reader.memory_limit = min(
+        float(parcels_reader.memory_limit) / tiles_in_flight,
+        parcels_reader.memory() / float(n_workers))
+
+    tile_jobs = ((
+        [fid for (fid, _, _) in core],
+        [(fid, polygon.wkb) for (fid, polygon, _) in context])
+        for (core, context) in parcels_reader.iter_tiles(halo=LCI_DISTANCE))
+
+    LOGGER.info('Calculating LCI for %s parcels with %s workers',
+        num_parcels, n_workers)
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        last_time = time.time()
+        while True:
+            tile_batch = list(itertools.islice(tile_jobs, tiles_in_flight))
+            if len(tile_batch) == 0:
+                break
+
+            for tile_results in pool.imap_unordered(_lci_tile_worker,
+                    tile_batch):
+                lci_values.update(tile_results)
+
+            current_time = time.time()
+            if (current_time - last_time) > 5.:
+                last_time = current_time
+                percent_complete = round((float(len(lci_values)) /
+                                          num_parcels) * 100, 2)
+                LOGGER.info('Calculating LCI %s%% complete',
+                    percent_complete)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    LOGGER.info('Calculating LCI %s%% complete', 100)
+    return lci_values
+
+def _lci_tile_worker(tile_job):
+    """Calculate the LCI for the parcels in a single tile.  This is run in a
+    worker process by _parallel_lci().
+
+        tile_job - a tuple of (tile_fids, context_wkb), where tile_fids is
+            a list of parcel FIDs to calculate the LCI for and context_wkb
+            is a list of (FID, polygon WKB) tuples, sorted by FID, for the
+            tile's parcels and all of their neighbors.
+
+    Returns a dict mapping the FIDs in tile_fids to their LCI."""
+    tile_fids, context_wkb = tile_job
+    return _tile_lci(tile_fids, [(fid, shapely.wkb.loads(wkb))
+        for (fid, wkb) in context_wkb])
 
 def calculate_parcel_lci(parcel, nearby_polygons):
     """Calculate the landscape context index of a parcel given polygons that
     are in the neighborhood of the input parcel.  A polygon will be included
     in the LCI calculations if it's within 500m of the parcel.
 
+    The neighboring polygons that touch the parcel's 500m buffer ring are
+    unioned together once and removed from the ring in a single difference
+    operation, so the LCI is the fraction of the ring covered by neighbors.
+
         parcel - a shapely polygon.
         nearby_polygons - a list of shapely polygons to consider.
 
     Returns a float value of the Landscape Context Index (LCI)"""
-    buffer_geom = parcel.buffer(500).difference(parcel)
+    buffer_geom = parcel.buffer(LCI_DISTANCE).difference(parcel)
     buffer_orig_area = buffer_geom.area
 
+    prep_buffer = shapely.prepared.prep(buffer_geom)
+    neighbors = [polygon for polygon in nearby_polygons
+        if prep_buffer.intersects(polygon)]
+
     try:
-        for polygon in nearby_polygons:
-            buffer_geom = buffer_geom.difference(polygon)
-        buffer_difference_area = buffer_geom.area
+        if len(neighbors) > 0:
+            neighbors_union = opal_geometry.union_all(neighbors)
+            buffer_difference_area = buffer_geom.difference(
+                neighbors_union).area
+        else:
+            buffer_difference_area = buffer_orig_area
     except shapely.geos.TopologicalError as error:
         # happens when there's nothing left to take away.
         LOGGER.warn('"%s"', error)
@@ -988,13 +1100,16 @@ def filter_by_raster(raster_uri, sample_vector_uri, out_vector_uri, clip=False):
     locate_intersecting_polygons(sample_vector_uri,
         bounding_box_uri, out_vector_uri, clip)
 
-def split_impacts(impacts_vector_uri, zones_vector_uri, workspace, fieldname='fid'):
+def split_impacts(impacts_vector_uri, zones_vector_uri, workspace,
+        fieldname='fid', vector_format='ESRI Shapefile'):
     """Split the impacts vector by the zones provided, saving the output
     geometries to the workspace.
 
     impacts_vector_uri = an OGR vector to be split
     zones_vector_uri = an OGR vector
     workspace = the folder to where the output vectors should be saved.
+    vector_format = the OGR driver name of the format of the output vectors.
+        One of the keys of utils.VECTOR_FORMATS.
 
     Returns a list of dictionaries, one dictionary per new impact vector.  Each
     dictionary contains information about the impact vector."""
@@ -1006,22 +1121,17 @@ def split_impacts(impacts_vector_uri, zones_vector_uri, workspace, fieldname='fi
 
     impacts_vector = ogr.Open(impacts_vector_uri)
     impacts_layer = impacts_vector.GetLayer()
-    impacts = dict((f.GetFID(), offsets.build_shapely_polygon(f)) for f in
-        impacts_layer)
-
-    # get the fields that should be created in the output impact vector.
-    field_definitions = impacts_layer.schema
-
-    # build up an index of impact polygons that we can query later on.
-    LOGGER.debug('Building spatial index of impacts polygons')
-    impacts_index = rtree.index.Index()
-    for impact_fid, impact_polygon in impacts.iteritems():
-        impacts_index.insert(impact_fid, impact_polygon.bounds)
 
     zones_vector = ogr.Open(zones_vector_uri)
     zones_layer = zones_vector.GetLayer()
     zones_layer_srs = zones_layer.GetSpatialRef()
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
+
+    # Only read the zones near the impacts.
+    if impacts_layer.GetFeatureCount() > 0:
+        impacts_minx, impacts_maxx, impacts_miny, impacts_maxy = (
+            impacts_layer.GetExtent())
+        zones_layer.SetSpatialFilterRect(impacts_minx, impacts_miny,
+            impacts_maxx, impacts_maxy)
 
     # Keep track of per-hydrozone data so we can return this later on.
     output_data = []
@@ -1029,18 +1139,24 @@ def split_impacts(impacts_vector_uri, zones_vector_uri, workspace, fieldname='fi
     LOGGER.debug('Checking for intersections')
     for zone in zones_layer:
         zone_polygon = offsets.build_shapely_polygon(zone)
-        impacts_in_zone = impacts_index.intersection(zone_polygon.bounds)
-
-        # impacts_in_zone is a generator, so we can't just check the length of
-        # it to see if there are any intersecting parcels.
-        intersecting_impacts = []
-        for impact_index in impacts_in_zone:
-            impact_polygon = impacts[impact_index]
-            intersection = impact_polygon.intersection(zone_polygon)
-            if intersection.area == 0.0:
-                continue
-            else:
-                intersecting_impacts.append((impact_index, intersection))
+
+        # Only the impacts near this zone are read, so the impacts never all
+        # need to be in memory at once.
+        impacts_layer.SetSpatialFilterRect(*zone_polygon.bounds)
+        impact_fids = []
+        impact_polygons = []
+        for impact_feature in impacts_layer:
+            impact_fids.append(impact_feature.GetFID())
+            impact_polygons.append(offsets.build_shapely_polygon(
+                impact_feature))
+        impacts_layer.SetSpatialFilter(None)
+
+        intersections = opal_geometry.intersection(
+            opal_geometry.as_array(impact_polygons), zone_polygon)
+        intersecting_impacts = [(impact_fid, intersection) for
+            (impact_fid, intersection, intersection_area) in zip(impact_fids,
+            intersections, opal_geometry.area(intersections))
+            if intersection_area != 0.0]
 
         if len(intersecting_impacts) > 0:
             # hydrozone name might not be ASCII.
@@ -1060,37 +1176,28 @@ def split_impacts(impacts_vector_uri, zones_vector_uri, workspace, fieldname='fi
                 # should work as expected.
                 workspace = workspace.decode('utf-8')
 
-            hzone_impacts_uri = os.path.join(workspace, u'impacts_%s.shp' %
-                decoded_zone_name)
+            hzone_impacts_uri = os.path.join(workspace, u'impacts_%s%s' %
+                (decoded_zone_name, utils.VECTOR_FORMATS[vector_format]))
             layer_name = os.path.basename(os.path.splitext(hzone_impacts_uri)[0])
             layer_name = layer_name.encode('utf-8')
 
             LOGGER.debug('Saving %s parcels to %s', len(intersecting_impacts),
                 hzone_impacts_uri)
 
-            if os.path.exists(hzone_impacts_uri):
-                rm_shapefile(hzone_impacts_uri)
-
-            out_vector = out_driver.CreateDataSource(hzone_impacts_uri)
-            out_layer = out_vector.CreateLayer(layer_name, srs=zones_layer_srs)
-
-            for field_defn in field_definitions:
-                out_layer.CreateField(field_defn)
+            out_writer = utils.VectorWriter(hzone_impacts_uri,
+                zones_layer_srs, layer_name=layer_name)
+            out_writer.copy_fields(impacts_layer.GetLayerDefn())
 
             for impact_index, intersection_polygon in intersecting_impacts:
-                new_geometry = ogr.CreateGeometryFromWkb(intersection_polygon.wkb)
-                new_feature = ogr.Feature(impacts_layer.GetLayerDefn())
-                new_feature.SetGeometry(new_geometry)
+                out_writer.add_feature(intersection_polygon,
+                    source_feature=impacts_layer.GetFeature(impact_index))
 
-                impact_ogr_feature = impacts_layer.GetFeature(impact_index)
-                for field_name, field_value in impact_ogr_feature.items().iteritems():
-                    new_feature.SetField(field_name, field_value)
-
-                out_layer.CreateFeature(new_feature)
+            output_fields = out_writer.field_names()
+            out_writer.close()
 
             output_data.append({
                 'name': hydrozone_name,
-                'fields': map(lambda f: f.GetName(), out_layer.schema),
+                'fields': output_fields,
                 'layer_name': layer_name,
                 'zone_fid': zone.GetFID(),
                 'uri': hzone_impacts_uri,
@@ -1140,21 +1247,12 @@ def union_by_attribute(in_vector_uri, attr_name, out_vector_uri):
             attributes[attribute_value] = [feature_id]
 
     LOGGER.debug('Found %s attribute(s) to aggregate by.', len(attributes))
-    out_driver = ogr.GetDriverByName('ESRI Shapefile')
 
     LOGGER.debug('Creating out vector at %s', out_vector_uri)
-    if os.path.exists(out_vector_uri):
-        rm_shapefile(out_vector_uri)
-
-    out_vector = out_driver.CreateDataSource(out_vector_uri)
-    layer_name = str(os.path.basename(os.path.splitext(out_vector_uri)[0]))
-    out_layer = out_vector.CreateLayer(layer_name, srs=in_srs)
-    #TODO: create a feature for the attribute
+    out_writer = utils.VectorWriter(out_vector_uri, in_srs)
 
     # create the target attribute.
-    field_defn = ogr.FieldDefn(attr_name, in_fields[attr_name])
-    out_layer.CreateField(field_defn)
-    out_layer_defn = out_layer.GetLayerDefn()
+    out_writer.create_field(ogr.FieldDefn(attr_name, in_fields[attr_name]))
 
     for name, feature_list in attributes.iteritems():
         LOGGER.debug('%s:%s has %s features: %s', attr_name, name,
@@ -1164,20 +1262,13 @@ def union_by_attribute(in_vector_uri, attr_name, out_vector_uri):
             feature = in_layer.GetFeature(feature_id)
             polygon_list.append(offsets.build_shapely_polygon(feature))
 
-        union = shapely.ops.cascaded_union(polygon_list)
-
-        new_feature = ogr.Feature(out_layer_defn)
-        new_geometry = ogr.CreateGeometryFromWkb(union.wkb)
-        new_feature.SetGeometry(new_geometry)
-        new_feature.SetField(attr_name, name)
-        out_layer.CreateFeature(new_feature)
+        union = opal_geometry.union_all(polygon_list)
+        out_writer.add_feature(union, {attr_name: name})
 
+    out_writer.close()
     ogr.DataSource.__swig_destroy__(in_vector)
-    ogr.DataSource.__swig_destroy__(out_vector)
     in_layer = None
-    out_layer = None
     in_vector = None
-    out_vector = None
 
     LOGGER.debug('Finished taking union by attribute')
     return attributes
@@ -3,8 +3,6 @@ import codecs
 import csv
 import json
 import logging
-import os
-import tempfile
 from types import FloatType
 from types import IntType
 from types import StringType
@@ -15,9 +13,9 @@ import shapely.geos
 import shapely.validation
 
 import adept_core
+import analysis
 import natcap.opal.i18n
 import offsets
-import preprocessing
 import utils
 
 LOGGER = logging.getLogger('natcap.opal.reporting')
@@ -50,7 +48,7 @@ def _recode(string):
     return string
 
 def get_impact_data(municipalities_vector, impacts_vector, name_col, pop_col,
-        service_mitrat, out_json_file=None):
+        service_mitrat, out_json_file=None, impact_overlaps=None):
     """Calculate per-impact information as it relates to municipalities.
 
         municipalities_vector - a URI to an OGR vector
@@ -62,16 +60,31 @@ def get_impact_data(municipalities_vector, impacts_vector, name_col, pop_col,
         service_mitrat - a python list of strings containing services to consider.
         out_json_file=None - a URI to where an output json file with this data
             should be written.
+        impact_overlaps=None - the areas of the intersections of the impact
+            sites with the municipalities, as returned by
+            analysis.overlap_areas(impacts_vector, municipalities_vector).
+            If None, they are calculated here.
 """
 
     utils.assert_files_exist([municipalities_vector, impacts_vector])
 
+    if impact_overlaps is None:
+        LOGGER.debug('Calculating overlap of impacts and municipalities')
+        impact_overlaps = analysis.overlap_areas(impacts_vector,
+            municipalities_vector)
+
+    # Group the overlapping impacts by municipality.
+    muni_overlaps = {}
+    for impact_fid, muni_areas in impact_overlaps.iteritems():
+        for muni_fid, intersection_area in muni_areas.iteritems():
+            muni_overlaps.setdefault(muni_fid, []).append(
+                (impact_fid, intersection_area))
+
     LOGGER.debug('Opening municipalities vector %s', municipalities_vector)
     muni_vector = ogr.Open(municipalities_vector)
     muni_layer = muni_vector.GetLayer()
 
     LOGGER.debug('Opening impacts vector: %s', impacts_vector)
-    impact_index, impact_dict = preprocessing.build_spatial_index(impacts_vector)
     impacts_vector = ogr.Open(impacts_vector)
     impacts_layer = impacts_vector.GetLayer()
 
@@ -81,8 +94,10 @@ def get_impact_data(municipalities_vector, impacts_vector, name_col, pop_col,
     # preprocess impacts so we don't have to retrieve information repeatedly
     # later on.
     impact_features = {}
+    impact_areas = {}
     for impact_feature in impacts_layer:
         impact_fid = impact_feature.GetFID()
+        impact_areas[impact_fid] = impact_feature.GetGeometryRef().Area()
         service_dict = {}
 
         for service_name in services:
@@ -99,13 +114,12 @@ def get_impact_data(municipalities_vector, impacts_vector, name_col, pop_col,
 
     for muni_feature in muni_layer:
         muni_fid = muni_feature.GetFID()
-        muni_geom = muni_feature.GetGeometryRef()
         LOGGER.debug('Processing municipality %s', muni_fid)
         muni_name = muni_feature.GetField(name_col)
         muni_population = muni_feature.GetField(pop_col)
 
         try:
-            muni_polygon = offsets.build_shapely_polygon(muni_feature)
+            offsets.build_shapely_polygon(muni_feature)
         except shapely.geos.ReadingError:
             LOGGER.debug('Muni %s (%s) has invalid geometry: "%s". Skipping',
                 muni_fid, muni_name, shapely.validation.explain_validity())
@@ -125,40 +139,31 @@ def get_impact_data(municipalities_vector, impacts_vector, name_col, pop_col,
 
         num_impacts = 0
         skipped_impacts = []
-        for impact_fid in impact_index.intersection(muni_polygon.bounds):
+        for impact_fid, intersection_area in sorted(
+                muni_overlaps.get(muni_fid, [])):
             if sum(impact_features[impact_fid].values()) == 0:
                 skipped_impacts.append(impact_fid)
                 continue
 
-            impact_feature = impacts_layer.GetFeature(impact_fid)
-            impact_geom = impact_feature.GetGeometryRef()
-
-            # get the intersection geometry and area.
-            # if the area is 0, we know that there's no intersection.
-            intersection = impact_geom.Intersection(muni_geom)
-            intersection_area = intersection.Area()
+            num_impacts += 1
+            # Find the proportion of the impact site that is in this
+            # municipality.
+            prop_area = intersection_area / impact_areas[impact_fid]
 
-            if intersection_area > 0:
-                num_impacts += 1
-                # Find the proportion of the impact site that is in this
-                # municipality.
-                prop_area = intersection_area / impact_geom.Area()
+            impact_data = impact_features[impact_fid]
 
-                impact_data = impact_features[impact_fid]
-
-                for service in services:
-                    if service == 'nutrient':
-                        label = 'Nitrogen'
-                    else:
-                        label = service.capitalize()
-                    impact_amt = impact_data[service] * prop_area
-                    mit_ratio = service_mitrat[service]
-                    impacts[template % label] += impact_amt * mit_ratio
+            for service in services:
+                if service == 'nutrient':
+                    label = 'Nitrogen'
+                else:
+                    label = service.capitalize()
+                impact_amt = impact_data[service] * prop_area
+                mit_ratio = service_mitrat[service]
+                impacts[template % label] += impact_amt * mit_ratio
 
         if len(skipped_impacts) > 0:
             LOGGER.debug('%s impact sites had not impacts and were skipped: %s',
                 len(skipped_impacts), skipped_impacts)
-        impacts_layer.ResetReading()
 
         # If at least one of the service impacts is not 0.0 (the default), then
         # we want to initialize the impacts.
@@ -166,6 +171,8 @@ def get_impact_data(municipalities_vector, impacts_vector, name_col, pop_col,
             muni_data['impacts'] = impacts
         per_muni_data[muni_name] = muni_data
     muni_layer.ResetReading()
+    impacts_layer = None
+    impacts_vector = None
 
     LOGGER.debug('Per-municipality impacts: %s', json.dumps(per_muni_data,
         sort_keys=True, indent=4))
@@ -461,7 +468,8 @@ def build_parcel_table(per_offset_data, total_impacts, out_csv,
     }
     return reporting_config
 
-def impacted_parcels_table(impact_sites, natural_parcels, csv_uri):
+def impacted_parcels_table(impact_sites, natural_parcels, csv_uri,
+        impacted_areas=None):
     """Determine which natural parcels have been impacted and build a
     reporting table based on the results.
 
@@ -471,27 +479,28 @@ def impacted_parcels_table(impact_sites, natural_parcels, csv_uri):
             Richness columns.  If threat and richness are provided, they will
             be included in the resulting table.
         csv_uri - a URI to an output CSV.
+        impacted_areas=None - the areas of the intersections of the natural
+            parcels with the impact sites, as returned by
+            analysis.overlap_areas(natural_parcels, impact_sites).  If None,
+            they are calculated here.
 
-    Returns a reporting args dictionary with appropriate data."""
+    Returns a reporting args dictionary with appropriate data.  The patch
+    code of each row is the FID of the parcel in natural_parcels."""
 
-    # create a temp folder
     # build column names
-    # locate intersecting natural polygons, saving them to the temp dir.
-    # for natural polygon in intersecting polygons,
+    # for each natural parcel overlapping the impacts,
     #    build up a row with relevant data from the current natural polygon
-    # remove the temp folder.
     # Write the row/column data to a CSV
     # return an appropriate dictionary for reporting.
 
-    utils.assert_files_exist([impact_sites])
+    utils.assert_files_exist([impact_sites, natural_parcels])
 
-    temp_dir = tempfile.mkdtemp()
+    if impacted_areas is None:
+        LOGGER.debug('Calculating overlap of natural parcels and impacts')
+        impacted_areas = analysis.overlap_areas(natural_parcels,
+            impact_sites)
 
-    impacted_natural_parcels = os.path.join(temp_dir, 'impact_parcels.shp')
-    preprocessing.locate_intersecting_polygons(natural_parcels, impact_sites,
-        impacted_natural_parcels)
-
-    parcels_vector = ogr.Open(impacted_natural_parcels)
+    parcels_vector = ogr.Open(natural_parcels)
     parcels_layer = parcels_vector.GetLayer()
 
     layer_fields = map(lambda f: f.GetName(), parcels_layer.schema)
@@ -515,14 +524,10 @@ def impacted_parcels_table(impact_sites, natural_parcels, csv_uri):
         field_functions['Threat score'] = lambda p: round(p.GetField('Threat'),
             2)
 
-    LOGGER.debug('Buliding up shapely impact geometries')
-    # build up a list of prepared shapely geometries for fast intersections.
-    impacts_vector = ogr.Open(impact_sites)
-    impacts_layer = impacts_vector.GetLayer()
-    shapely_impacts = [offsets.build_shapely_polygon(f) for f in impacts_layer]
-
     rows = []
-    for natural_parcel in parcels_layer:
+    for parcel_fid in sorted(impacted_areas):
+        natural_parcel = parcels_layer.GetFeature(parcel_fid)
+
         # get the columns we know exist, based on our earlier tests
         row_data = {}
         for label, value_func in field_functions.iteritems():
@@ -531,21 +536,16 @@ def impacted_parcels_table(impact_sites, natural_parcels, csv_uri):
 
         # now, add in the impacted area.  This is the sum of (area of the
         # intersection of each impact geometry with the natural parcel).
-        offset_polygon = offsets.build_shapely_polygon(natural_parcel)
-        prep_offset_polygon = shapely.prepared.prep(offset_polygon)
-        intersection_area = 0.0
-        for impact_polygon in shapely_impacts:
-            if prep_offset_polygon.intersects(impact_polygon):
-                intersection_area += offset_polygon.intersection(impact_polygon).area
-
         # convert from m^2 to ha.
-        intersection_area /= 10000.0
+        intersection_area = sum(impacted_areas[parcel_fid].values()) / 10000.0
 
         row_data[_('Patch area impacted (ha)')] = sigfig(round(intersection_area, 2), 3)
         row_data[_('Required offset area (ha)')] = sigfig(round(intersection_area *
             natural_parcel.GetField('mit_ratio'), 2), 3)
 
         rows.append(row_data)
+    parcels_layer = None
+    parcels_vector = None
 
     # order the fieldnames
     fieldnames = [
@@ -1,5 +1,6 @@
 import os
 import json
+import csv
 import hashlib
 import logging
 from types import UnicodeType
@@ -36,18 +37,21 @@ MODELS = {
         'landcover_key': 'lulc_cur_uri',
         'target_raster': os.path.join('output', 'tot_C_cur.tif'),
         'watersheds_key': None,
+        'routed': False,
     },
     'sediment': {
         'module': sdr,
         'landcover_key': 'lulc_uri',
         'target_raster': os.path.join('output', 'sed_export.tif'),
         'watersheds_key': 'watersheds_uri',
+        'routed': True,
     },
     'nutrient': {
         'module': nutrient,
         'landcover_key': 'lulc_uri',
         'target_raster': os.path.join('output', 'n_export.tif'),
         'watersheds_key': 'watersheds_uri',
+        'routed': True,
     }
 }
 
@@ -75,7 +79,13 @@ def execute(args):
             landcover_code (required)
             future_type (required) - either 'protection' or 'restoration'
             model_name (required) - either 'carbon' or 'sediment'
-            do_parallelism (optional) - Boolean.  Assumed to be False.
+            do_parallelism (optional) - Boolean.  Assumed to be False.  If
+                True and n_workers is not provided, independent static map
+                tasks are run in as many processes as there are CPUs.
+            n_workers (optional) - The maximum number of processes to run
+                static map tasks (model runs, subtractions, simulations) in
+                at once.  The quality simulations of the scenarios share
+                these processes.  Defaults to 1.
             fut_landuse_uri (optional) - URI.  If not present, a future
                 landcover scenario will not be calculated.
 
@@ -95,6 +105,15 @@ def execute(args):
             num_simulations - an int indicating the number of impact sites
                 that should be simulated per watershed.  If this key is not
                 provided, static map quality estimates will be skipped.
+            incremental_simulations (optional) - Boolean.  Whether to
+                estimate each simulated impact without running the model on
+                the whole watershed.  Assumed to be False.
+            window_buffer (optional) - the distance to buffer the windows of
+                incremental simulations by, for routed models.  Defaults to
+                2000.
+            validation_interval (optional) - how often an incremental
+                simulation is also run on the whole watershed to validate it.
+                Defaults to 10.
             """
 
     for key in ['workspace_dir', 'landuse_uri', 'paved_landcover_code',
@@ -172,27 +191,19 @@ def execute(args):
             sort_keys=True,
             indent=4))
 
-    # now, run the sediment model on the input landcover
-    LOGGER.info('Running the model on the original landscape')
-    original_workspace = os.path.join(args['workspace_dir'],
-                                      '%s_base' % args['model_name'])
-    if not os.path.exists(original_workspace):
-        os.makedirs(original_workspace)
-        LOGGER.debug('Making workspace for base scenario: %s',
-                     original_workspace)
-
-    LOGGER.debug('Original workspace: %s', original_workspace)
-    execute_model(args['model_name'], args['landuse_uri'], original_workspace,
-                  model_args)
-    base_raster = os.path.join(original_workspace,
-                               MODELS[args['model_name']]['target_raster'])
-
     try:
-        do_parallelism = args['do_parallelism']
-        LOGGER.debug('Process-based parallelism enabled')
+        n_workers = int(args['n_workers'])
     except KeyError:
-        LOGGER.debug('Process-based parallelism disabled')
-        do_parallelism = False
+        try:
+            do_parallelism = args['do_parallelism']
+        except KeyError:
+            do_parallelism = False
+
+        if do_parallelism:
+            n_workers = multiprocessing.cpu_count()
+        else:
+            n_workers = 1
+    LOGGER.debug('Running static map tasks with %s workers', n_workers)
 
     try:
         num_simulations = int(args['num_simulations'])
@@ -202,51 +213,52 @@ def execute(args):
         num_simulations = None
         LOGGER.debug('Skipping impact simulations')
 
-    processes = []
-    for impact_type in ['paved', 'bare']:
-        LOGGER.debug('Starting calculations for impact %s', impact_type)
-        impact_code = int(args['%s_landcover_code' % impact_type])
+    try:
+        incremental = bool(args['incremental_simulations'])
+    except KeyError:
+        incremental = False
 
-        impact_workspace = os.path.join(args['workspace_dir'], impact_type)
-        static_map_uri = os.path.join(
-            args['workspace_dir'], '%s_%s_static_map.tif' %
-            (args['model_name'], impact_type))
+    try:
+        window_buffer = float(args['window_buffer'])
+    except KeyError:
+        window_buffer = 2000
+
+    try:
+        validation_interval = int(args['validation_interval'])
+    except KeyError:
+        validation_interval = 10
 
-        # Carbon is the only known ES that has inverted values.
-        invert = True if args['model_name'] == 'carbon' else False
+    # Build the graph of static map tasks.  Tasks whose outputs are already
+    # newer than their inputs and were built with the same arguments (from a
+    # previous run in this workspace) are skipped.
+    graph = utils.TaskGraph(n_workers)
+    model_name = args['model_name']
+    target_raster = MODELS[model_name]['target_raster']
 
-        if do_parallelism:
-            process = multiprocessing.Process(
-                target=build_static_map,
-                args=(
-                    args['model_name'],
-                    args['landuse_uri'],
-                    impact_code,
-                    static_map_uri,
-                    base_raster,
-                    model_args,
-                    impact_workspace),
-                kwargs={
-                    'num_simulations': num_simulations,
-                    'invert': invert})
-            processes.append(process)
-            process.start()
-        else:
-            build_static_map(
-                args['model_name'],
-                args['landuse_uri'],
-                impact_code,
-                static_map_uri,
-                base_raster,
-                model_args,
-                impact_workspace,
-                num_simulations=num_simulations,
-                invert=invert)
-
-    # Build the static protection map if the user has provided a future
-    # landcover scenario.
-    LOGGER.info('Found a future landcover.  Building (%s) map.',
-                args['future_type'])
+    # the model on the original landscape
+    original_workspace = os.path.join(args['workspace_dir'],
+                                      '%s_base' % model_name)
+    if not os.path.exists(original_workspace):
+        os.makedirs(original_workspace)
+        LOGGER.debug('Making workspace for base scenario: %s',
+                     original_workspace)
+    LOGGER.debug('Original workspace: %s', original_workspace)
+    base_raster = os.path.join(original_workspace, target_raster)
+    graph.add_task('base_run', execute_model,
+        args=(model_name, args['landuse_uri'], original_workspace,
+              model_args),
+        target_files=[base_raster], source_files=[args['landuse_uri']])
+
+    # Carbon is the only known ES that has inverted values.
+    scenarios = []
+    for impact_type in ['paved', 'bare']:
+        scenarios.append({
+            'name': impact_type,
+            'landcover_code': int(args['%s_landcover_code' % impact_type]),
+            'invert': True if model_name == 'carbon' else False,
+        })
+
+    # Build the static protection map from the future landcover scenario.
     if 'fut_landuse_uri' not in args:
         LOGGER.debug('No custom future lulc found.  Clipping default.')
         # if the user has not provided a custom lulc, we should clip the
@@ -255,10 +267,16 @@ def execute(args):
         future_landuse_uri = os.path.join(
             args['workspace_dir'],
             'future_landuse.tif')
-        _clip_dem(common_data['future_landcover'], args['landuse_uri'],
-                  future_landuse_uri)
+        graph.add_task('future_landuse', _clip_dem,
+            args=(common_data['future_landcover'], args['landuse_uri'],
+                  future_landuse_uri),
+            target_files=[future_landuse_uri],
+            source_files=[common_data['future_landcover'],
+                          args['landuse_uri']])
+        future_dependencies = ['future_landuse']
     else:
         future_landuse_uri = args['fut_landuse_uri']
+        future_dependencies = []
     LOGGER.debug('Future landcover %s', future_landuse_uri)
 
     # determine whether the future, converted landcover should be inverted,
@@ -273,47 +291,102 @@ def execute(args):
 
     # if we're building carbon static maps, the invert flag is opposite of what
     # other models would do, for all cases.
-    if args['model_name'] == 'carbon':
+    if model_name == 'carbon':
         invert = not invert
 
-    future_map_uri = os.path.join(
-        args['workspace_dir'], '%s_%s_static_map.tif' %
-        (args['model_name'], future_tif_name))
-    future_workspace = os.path.join(args['workspace_dir'], future_tif_name)
-    build_static_map(args['model_name'], args['landuse_uri'], future_landuse_uri,
-                     future_map_uri, base_raster, model_args, future_workspace,
-                     convert_landcover=False,  # just use the future landcover
-                     num_simulations=num_simulations, invert=invert)
-    LOGGER.info('Completed the future (%s) static map.', args['future_type'])
-
-    # If we aren't doing parallelism, then this list has no elements in it.
-    for process in processes:
-        process.join()
-
-    # If we just ran the nutrient model, we need to copy the appropriate
-    # percent-to-stream rasters to the root static maps directory.
-    # Do this copy by recompressing the GeoTiff using DEFLATE instead of LZW.
-    # See issue 2910 (code.google.com/p/invest-natcap/issues/detail?id=2910)
-
-    if args['model_name'] in ['nutrient']:
-        fmt_string = os.path.join(args['workspace_dir'], '%s',
-            '%s_converted' % args['model_name'], 'intermediate')
-        pts_name = 'n_percent_to_stream.tif'
-        fmt_string = os.path.join(fmt_string, pts_name)
-
-        percent_to_streams = [
-            (fmt_string % 'paved', '%s_paved_pts.tif' % args['model_name']),
-            (fmt_string % 'bare', '%s_bare_pts.tif' % args['model_name']),
-            (fmt_string % future_tif_name, '%s_%s_pts.tif' %
-                (args['model_name'], future_tif_name)),
-        ]
-        for source_uri, dest_uri in percent_to_streams:
-            dest_uri = os.path.join(args['workspace_dir'], dest_uri)
-            LOGGER.debug('Copying %s to %s', source_uri, dest_uri)
-            preprocessing.recompress_gtiff(source_uri, dest_uri, 'DEFLATE')
-
-    LOGGER.debug('Completed creating the %s static maps', args['model_name'])
-
+    scenarios.append({
+        'name': future_tif_name,
+        'landcover_uri': future_landuse_uri,
+        'dependencies': future_dependencies,
+        'invert': invert,
+    })
+
+    # The simulations of the scenarios may run at the same time, so they
+    # share the workers.  Each simulation task counts its pool towards the
+    # graph's limit.
+    simulation_workers = max(1, n_workers // len(scenarios))
+
+    for scenario in scenarios:
+        name = scenario['name']
+        impact_workspace = os.path.join(args['workspace_dir'], name)
+        if not os.path.exists(impact_workspace):
+            os.makedirs(impact_workspace)
+        static_map_uri = os.path.join(
+            args['workspace_dir'], '%s_%s_static_map.tif' %
+            (model_name, name))
+
+        # convert the LULC to the correct landcover code.  The future
+        # scenario is not converted, as in build_static_map() with
+        # convert_landcover=False.
+        if 'landcover_code' in scenario:
+            converted_lulc = os.path.join(impact_workspace,
+                                          'converted_lulc.tif')
+            graph.add_task('convert_%s' % name, convert_lulc,
+                args=(args['landuse_uri'], scenario['landcover_code'],
+                      converted_lulc),
+                target_files=[converted_lulc],
+                source_files=[args['landuse_uri']])
+            convert_dependencies = ['convert_%s' % name]
+            landcover_code = scenario['landcover_code']
+            landcover_label = str(landcover_code)
+        else:
+            converted_lulc = args['landuse_uri']
+            convert_dependencies = scenario['dependencies']
+            landcover_code = scenario['landcover_uri']
+            landcover_label = 'transformed'
+
+        converted_workspace = os.path.join(impact_workspace,
+                                           '%s_converted' % model_name)
+        converted_es_map = os.path.join(converted_workspace, target_raster)
+        graph.add_task('model_%s' % name, execute_model,
+            args=(model_name, converted_lulc, converted_workspace,
+                  model_args),
+            dependencies=convert_dependencies,
+            target_files=[converted_es_map], source_files=[converted_lulc])
+
+        # subtract the two rasters.  See build_static_map() for why the
+        # order is reversed when inverting.
+        if scenario['invert'] is True:
+            rasters = (converted_es_map, base_raster)
+        else:
+            rasters = (base_raster, converted_es_map)
+        graph.add_task('subtract_%s' % name, subtract_rasters,
+            args=rasters + (static_map_uri,),
+            dependencies=['base_run', 'model_%s' % name],
+            target_files=[static_map_uri])
+
+        if num_simulations is not None:
+            simulation_workspace = os.path.join(
+                impact_workspace, 'simulations_%s' % landcover_label)
+            graph.add_task('simulate_%s' % name, simulate_static_map,
+                args=(model_name, args['landuse_uri'], landcover_code,
+                      static_map_uri, base_raster, model_args,
+                      simulation_workspace, num_simulations,
+                      scenario['invert'], simulation_workers, incremental,
+                      window_buffer, validation_interval),
+                dependencies=['subtract_%s' % name],
+                target_files=[os.path.join(simulation_workspace,
+                                           'simulations.png')],
+                processes=simulation_workers)
+
+        # If we're running the nutrient model, we need to copy the
+        # appropriate percent-to-stream rasters to the root static maps
+        # directory.  Do this copy by recompressing the GeoTiff using DEFLATE
+        # instead of LZW.  See issue 2910
+        # (code.google.com/p/invest-natcap/issues/detail?id=2910)
+        if model_name in ['nutrient']:
+            source_uri = os.path.join(converted_workspace, 'intermediate',
+                                      'n_percent_to_stream.tif')
+            dest_uri = os.path.join(args['workspace_dir'], '%s_%s_pts.tif' %
+                                    (model_name, name))
+            graph.add_task('recompress_%s' % name,
+                preprocessing.recompress_gtiff,
+                args=(source_uri, dest_uri, 'DEFLATE'),
+                dependencies=['model_%s' % name],
+                target_files=[dest_uri], source_files=[source_uri])
+
+    graph.run()
+    LOGGER.debug('Completed creating the %s static maps', model_name)
 
 def raster_math(args):
     """Perform all of the raster math to create static maps from the input
@@ -391,8 +464,8 @@ def _clip_dem(dem_uri, lulc_uri, out_dem_uri):
         vectorize_op=False)
 
 def convert_lulc(lulc_uri, new_code, out_uri):
-    """Use vectorize_datasets to convert a land cover raster to a new landcover
-    code and save it to an output dataset.
+    """Convert a land cover raster to a new landcover code and save it to an
+    output dataset.
 
         lulc_uri - a uri to a GDAL landcover raster on disk.
         new_code - an integer landcover code
@@ -408,12 +481,12 @@ def convert_lulc(lulc_uri, new_code, out_uri):
     def _convert(pixels):
         return numpy.where(pixels != nodata, new_code, nodata)
 
-    pixel_size = pygeoprocessing.get_cell_size_from_uri(lulc_uri)
     datatype = pygeoprocessing.get_datatype_from_uri(lulc_uri)
-    pygeoprocessing.vectorize_datasets([lulc_uri], _convert,
-        dataset_out_uri=out_uri, datatype_out=datatype,
-        nodata_out=nodata, pixel_size_out=pixel_size,
-        bounding_box_mode='intersection', vectorize_op=False)
+    pipeline = utils.RasterPipeline('intersection')
+    pipeline.add_raster('lulc', lulc_uri)
+    pipeline.add_operation('converted', _convert, ['lulc'], nodata, datatype,
+                           out_uri=out_uri)
+    pipeline.run()
 
 def unzip_static_zipfile(zipfile_uri):
     """Unzip the given file to the static maps folder."""
@@ -483,7 +556,11 @@ def build_static_map(
         workspace=None,
         convert_landcover=True,
         num_simulations=None,
-        invert=False):
+        invert=False,
+        n_workers=1,
+        incremental=False,
+        window_buffer=2000,
+        validation_interval=10):
     """Build the static map for the target ecosystem service.  Currently assumes
     we're doing sediment only.
 
@@ -505,6 +582,17 @@ def build_static_map(
             `converted`, where `converted` is the converted or input landcover.
             When invert==True, the static map produced will be the differece
             of `converted` - `base_run`.
+        n_workers=1 - the number of worker processes to run simulations in.
+        incremental=False - whether to estimate each simulated impact without
+            running the model on the whole watershed.  See
+            test_static_map_quality().
+        window_buffer=2000 - for routed models, the distance to buffer each
+            incremental impact site's bounding box by.
+        validation_interval=10 - how often an incremental simulation is also
+            run on the whole watershed to validate it.
+
+    When profiling is enabled (see utils.enable_profiling()), each step is
+    recorded as a span tagged with the model name.
     """
     assert invert in [True, False], '%s found instead' % type(invert)
     assert model_name in MODELS.keys()
@@ -523,7 +611,10 @@ def build_static_map(
     if convert_landcover:
         converted_lulc = os.path.join(workspace, 'converted_lulc.tif')
         LOGGER.info('Creating converted landcover raster: %s', converted_lulc)
-        convert_lulc(landcover_uri, landcover_code, converted_lulc)
+        with utils.span('convert_lulc', model=model_name) as stage:
+            convert_lulc(landcover_uri, landcover_code, converted_lulc)
+            if stage.enabled:
+                stage.count(pixels=utils.pixel_count(converted_lulc))
         landcover_label = str(landcover_code)
     else:
         converted_lulc = landcover_uri
@@ -534,7 +625,10 @@ def build_static_map(
     target_raster = MODELS[model_name]['target_raster']
     converted_workspace = os.path.join(workspace, '%s_converted' % model_name)
     LOGGER.debug('Converted workspace: %s', converted_workspace)
-    execute_model(model_name, converted_lulc, converted_workspace, config)
+    with utils.span('execute_model', model=model_name) as stage:
+        execute_model(model_name, converted_lulc, converted_workspace, config)
+        if stage.enabled:
+            stage.count(pixels=utils.pixel_count(converted_lulc))
     converted_es_map = os.path.join(converted_workspace, target_raster)
 
     # subtract the two rasters.
@@ -544,10 +638,13 @@ def build_static_map(
     # which is 'bad'.  For sediment and nutrient, we want to invert the result.
     # This is done by just reversing the order of the subtraction.
     LOGGER.info('Subtracting the two rasters.  Invert=%s', invert)
-    if invert is True:
-        subtract_rasters(converted_es_map, base_run, static_map_uri)
-    else:
-        subtract_rasters(base_run, converted_es_map, static_map_uri)
+    with utils.span('subtract_rasters', model=model_name) as stage:
+        if invert is True:
+            subtract_rasters(converted_es_map, base_run, static_map_uri)
+        else:
+            subtract_rasters(base_run, converted_es_map, static_map_uri)
+        if stage.enabled:
+            stage.count(pixels=utils.pixel_count(static_map_uri))
 
     if num_simulations is not None:
         if workspace is None:
@@ -555,50 +652,92 @@ def build_static_map(
             # folder in CWD for the quality workspace.
             workspace = os.getcwd()
 
-        if config is None:
-            # in case the user has not provided the config dictionary
-            config = get_static_data_json(model_name)
-
-        watersheds = config[MODELS[model_name]['watersheds_key']]
-
         simulation_workspace = os.path.join(workspace, 'simulations_%s' %
                                             landcover_label)
-        test_static_map_quality(
-            base_run,
-            static_map_uri,
-            landcover_uri,
-            landcover_code,
-            watersheds,
-            model_name,
-            simulation_workspace,
-            config,
-            num_simulations,
-            invert=invert)
-
-        simulations_csv = os.path.join(simulation_workspace,
-                                       'impact_site_simulation.csv')
-        out_png = os.path.join(simulation_workspace, 'simulations.png')
-        graph_it(simulations_csv, out_png)
+        with utils.span('simulate_static_map', model=model_name) as stage:
+            simulate_static_map(model_name, landcover_uri, landcover_code,
+                                static_map_uri, base_run, config,
+                                simulation_workspace, num_simulations, invert,
+                                n_workers, incremental, window_buffer,
+                                validation_interval)
+            stage.count(simulations=num_simulations)
     LOGGER.info('Finished')
 
 
+def simulate_static_map(model_name, landcover_uri, landcover_code,
+                        static_map_uri, base_run, config,
+                        simulation_workspace, num_simulations, invert,
+                        n_workers=1, incremental=False, window_buffer=2000,
+                        validation_interval=10):
+    """Run the impact site simulations for a static map and graph the
+    results.  See test_static_map_quality() for details.
+
+        model_name - a string.  Must be a key in MODELS.
+        landcover_uri - a URI to the landcover the static map was built from.
+        landcover_code - the landcover code (or future landcover URI) the
+            static map converts to.
+        static_map_uri - a URI to the static map to test.
+        base_run - a URI to the output map from a base run of the target
+            model.
+        config - a python dictionary with arguments for the target model, or
+            None to use the internal defaults.
+        simulation_workspace - a URI to the folder for the simulations.
+        num_simulations - the number of simulations to run per watershed.
+        invert - whether the static map subtraction was inverted.
+        n_workers=1 - the number of worker processes to run simulations in.
+        incremental=False - whether to estimate each impact without running
+            the model on the whole watershed.
+        window_buffer=2000 - for routed models, the distance to buffer each
+            incremental impact site's bounding box by.
+        validation_interval=10 - how often an incremental simulation is
+            also run on the whole watershed.
+
+    Returns nothing."""
+
+    if config is None:
+        # in case the user has not provided the config dictionary
+        config = get_static_data_json(model_name)
+
+    watersheds = config[MODELS[model_name]['watersheds_key']]
+
+    test_static_map_quality(
+        base_run,
+        static_map_uri,
+        landcover_uri,
+        landcover_code,
+        watersheds,
+        model_name,
+        simulation_workspace,
+        config,
+        num_simulations,
+        invert=invert,
+        n_workers=n_workers,
+        incremental=incremental,
+        window_buffer=window_buffer,
+        validation_interval=validation_interval)
+
+    simulations_csv = os.path.join(simulation_workspace,
+                                   'impact_site_simulation.csv')
+    out_png = os.path.join(simulation_workspace, 'simulations.png')
+    graph_it(simulations_csv, out_png)
+
+
 def subtract_rasters(raster_a, raster_b, out_uri):
     utils.assert_files_exist([raster_a, raster_b])
     LOGGER.debug('Subtracting rasters %s and %s', raster_a, raster_b)
     LOGGER.debug('Saving difference to %s', out_uri)
-    pixel_size = pygeoprocessing.get_cell_size_from_uri(raster_a)
     nodata = pygeoprocessing.get_nodata_from_uri(raster_b)
     datatype = pygeoprocessing.get_datatype_from_uri(raster_b)
-    LOGGER.debug('Output pixel size: %s', pixel_size)
     LOGGER.debug('Output nodata value: %s', nodata)
     LOGGER.debug('Output datatype: %s', datatype)
 
-    pygeoprocessing.vectorize_datasets([raster_a, raster_b],
+    pipeline = utils.RasterPipeline('intersection')
+    pipeline.add_raster('a', raster_a)
+    pipeline.add_raster('b', raster_b)
+    pipeline.add_operation('difference',
         lambda c, o: numpy.where(c != nodata, numpy.subtract(c, o), nodata),
-        dataset_out_uri = out_uri,
-        datatype_out=datatype, nodata_out=nodata,
-        pixel_size_out=pixel_size, bounding_box_mode='intersection',
-        vectorize_op=False)
+        ['a', 'b'], nodata, datatype, out_uri=out_uri)
+    pipeline.run()
 
 
 def get_static_data_json(model_name):
@@ -708,10 +847,11 @@ def clip_raster_to_watershed(in_raster, ws_vector, out_uri, clip_raster=None):
     """
     datatype = pygeoprocessing.get_datatype_from_uri(in_raster)
     nodata = pygeoprocessing.get_nodata_from_uri(in_raster)
-    pixel_size = pygeoprocessing.get_cell_size_from_uri(in_raster)
 
+    pipeline = utils.RasterPipeline('intersection', aoi_uri=ws_vector)
+    pipeline.add_raster('in', in_raster)
     if clip_raster is not None:
-        rasters = [in_raster, clip_raster]
+        pipeline.add_raster('clip', clip_raster)
         clip_nodata = pygeoprocessing.get_nodata_from_uri(clip_raster)
 
         def operation(in_values, clip_values):
@@ -719,24 +859,18 @@ def clip_raster_to_watershed(in_raster, ws_vector, out_uri, clip_raster=None):
                 clip_values == clip_nodata,
                 clip_nodata,
                 in_values)
+        inputs = ['in', 'clip']
     else:
-        rasters = [in_raster]
         operation = lambda x: x
+        inputs = ['in']
 
-    pygeoprocessing.vectorize_datasets(
-        rasters,
-        operation,
-        out_uri,
-        datatype,
-        nodata,
-        pixel_size,
-        'intersection',
-        dataset_to_align_index=0,
-        aoi_uri=ws_vector,
-        vectorize_op=False)
+    pipeline.add_operation('clipped', operation, inputs, nodata, datatype,
+                           out_uri=out_uri)
+    pipeline.run()
 
 
-def make_random_impact_vector(new_vector, base_vector, side_length):
+def make_random_impact_vector(new_vector, base_vector, side_length,
+        rng=None):
     """Create a new vector with a single, squarish polygon.  This polygon will
     be created within the spatial envelope of the first polygon in base_vector.
     The new squarish polygon will have a side length of side_length.
@@ -747,8 +881,13 @@ def make_random_impact_vector(new_vector, base_vector, side_length):
             information).
         side_length - a python int or float describing the side length of the
             new polygon to be created.
+        rng=None - a random.Random instance to draw the polygon's location
+            from.  If None, the random module's shared state is used.
 
         Returns nothing."""
+    if rng is None:
+        rng = random
+
     base_datasource = ogr.Open(base_vector)
     base_layer = base_datasource.GetLayer()
     base_feature = base_layer.GetFeature(0)
@@ -773,12 +912,12 @@ def make_random_impact_vector(new_vector, base_vector, side_length):
         bbox_width = feature_extent[1]-feature_extent[0]
         bbox_height = feature_extent[3]-feature_extent[2]
 
-        rand_width_percent = random.random()
+        rand_width_percent = rng.random()
         xmin = feature_extent[0] + bbox_width * rand_width_percent
         xmax = xmin + side_length
 
         # Make it squarish
-        rand_height_percent = random.random()
+        rand_height_percent = rng.random()
         ymin = feature_extent[2] + bbox_height * rand_height_percent
         ymax = ymin + side_length
 
@@ -821,6 +960,586 @@ def get_watershed_id(watershed_uri):
     return watershed_id
 
 
+def _divide_estimates(numerator, denominator):
+    """Divide one estimate by another.  An impact that doesn't change the
+    watershed's export (such as one outside of the watershed, or one on
+    pixels that already have the impacted landcover) has an InVEST estimate
+    of 0, so division by zero gives inf or nan like numpy float division
+    instead of raising an exception.
+
+        numerator - a number.
+        denominator - a number.
+
+    Returns a python float.  If denominator is 0, this is nan if numerator is
+    also 0, or inf with the sign of numerator otherwise."""
+    numerator = float(numerator)
+    denominator = float(denominator)
+    if denominator == 0:
+        if numerator == 0:
+            return float('nan')
+        return float('inf') if numerator > 0 else float('-inf')
+    return numerator / denominator
+
+
+def _job_seed(seed, watershed_id, run_number):
+    """Derive the random seed for a single impact simulation.  The seed
+    depends only on the base seed and the job, so a simulation draws the same
+    impact site regardless of which worker runs it or in what order.
+
+        seed - the base seed for the quality test.
+        watershed_id - the ws_id of the simulation's watershed.
+        run_number - the integer impact ID within the watershed.
+
+    Returns an int."""
+    job_key = '%s:%s:%s' % (seed, watershed_id, run_number)
+    return int(hashlib.md5(job_key).hexdigest()[:8], 16)
+
+
+def _completed_simulations(logfile_uri):
+    """Find the simulations already recorded in the simulation CSV.
+
+        logfile_uri - a URI to the impact site simulation CSV.  It does not
+            need to exist.
+
+    Returns a set of (ws_id, impact ID) string tuples."""
+    completed = set()
+    if not os.path.exists(logfile_uri):
+        return completed
+
+    with open(logfile_uri) as logfile:
+        lines = logfile.readlines()
+
+    # A last line without a newline was cut off when a run was killed, even
+    # if it has all of its fields (the last value may be truncated).
+    if len(lines) > 0 and not lines[-1].endswith('\n'):
+        lines = lines[:-1]
+
+    for row in csv.DictReader(lines):
+        if None in row.values():
+            continue
+        completed.add((row['ws_id'], row['Impact ID']))
+    return completed
+
+
+def _prepare_quality_watershed(job):
+    """Clip the inputs to a single watershed and run the target model on the
+    watershed's base landcover.
+
+        job - a python dictionary with the keys 'watershed_uri',
+            'watershed_workspace', 'landuse_uri', 'base_run',
+            'base_static_map', 'model_name', 'config', 'impact_lucode' and
+            'incremental'.
+
+    Returns a python dictionary with the keys 'watershed_lulc',
+    'ws_base_export_uri', 'ws_base_static_map', 'config' and
+    'landcover_values'.  landcover_values is the dictionary from
+    _landcover_values() for the impacted landcover codes when the
+    simulations are incremental and the model isn't routed, or None
+    otherwise."""
+
+    watershed_uri = job['watershed_uri']
+    watershed_workspace = job['watershed_workspace']
+    landuse_uri = job['landuse_uri']
+    base_run = job['base_run']
+    model_name = job['model_name']
+    config = job['config'].copy()
+    if not os.path.exists(watershed_workspace):
+        os.makedirs(watershed_workspace)
+
+    # keep this watershed's tempfiles in its own workspace.
+    tempfile.tempdir = os.path.join(watershed_workspace, 'tmp')
+    pygeoprocessing.create_directories([tempfile.tempdir])
+
+    watershed_id = get_watershed_id(watershed_uri)
+
+    lulc_nodata = pygeoprocessing.get_nodata_from_uri(landuse_uri)
+    lulc_pixel_size = pygeoprocessing.get_cell_size_from_uri(landuse_uri)
+    watershed_lulc = os.path.join(watershed_workspace,
+        'watershed_lulc.tif')
+    lulc_datatype = pygeoprocessing.get_datatype_from_uri(landuse_uri)
+    pygeoprocessing.vectorize_datasets([landuse_uri], lambda x: x,
+        watershed_lulc, lulc_datatype, lulc_nodata, lulc_pixel_size,
+        'intersection', dataset_to_align_index=0, aoi_uri=watershed_uri,
+        vectorize_op=False)
+
+    ws_base_export_uri = os.path.join(watershed_workspace,
+        'watershed_' + os.path.basename(base_run))
+    base_nodata = pygeoprocessing.get_nodata_from_uri(base_run)
+    base_pixel_size = pygeoprocessing.get_cell_size_from_uri(base_run)
+    base_export_datatype = pygeoprocessing.get_datatype_from_uri(base_run)
+    pygeoprocessing.vectorize_datasets([base_run], lambda x: x,
+        ws_base_export_uri, base_export_datatype, base_nodata, base_pixel_size,
+        'intersection', dataset_to_align_index=0, aoi_uri=watershed_uri,
+        vectorize_op=False)
+    base_ws_export = pygeoprocessing.aggregate_raster_values_uri(
+        ws_base_export_uri, watershed_uri, 'ws_id',
+        'sum').total[watershed_id]
+
+    # if the model uses watersheds, we only want to run the model using
+    # the one current watershed.
+    watersheds_key = MODELS[model_name]['watersheds_key']
+    if watersheds_key is not None:
+        config[watersheds_key] = watershed_uri
+
+    watershed_lulc = os.path.join(watershed_workspace,
+                                  'watershed_lulc.tif')
+    clip_raster_to_watershed(landuse_uri, watershed_uri, watershed_lulc)
+    watershed_base_workspace = os.path.join(watershed_workspace, 'base')
+    execute_model(model_name, watershed_lulc, watershed_base_workspace, config)
+
+    ws_base_export_uri = os.path.join(watershed_base_workspace,
+                                      MODELS[model_name]['target_raster'])
+    ws_base_static_map = os.path.join(
+        watershed_workspace, 'watershed_' + os.path.basename(
+            job['base_static_map']))
+    clip_raster_to_watershed(job['base_static_map'], watershed_uri,
+                             ws_base_static_map)
+
+    # The incremental simulations of a model that isn't routed look up the
+    # value of each impacted pixel by its new landcover code.
+    landcover_values = None
+    if job['incremental'] and not MODELS[model_name]['routed']:
+        landcover_values = _landcover_values(
+            model_name, _impact_codes(job['impact_lucode'], watershed_uri),
+            watershed_lulc, os.path.join(watershed_workspace, 'legend'),
+            config)
+
+    return {
+        'watershed_lulc': watershed_lulc,
+        'ws_base_export_uri': ws_base_export_uri,
+        'ws_base_static_map': ws_base_static_map,
+        'config': config,
+        'landcover_values': landcover_values,
+    }
+
+
+def _impact_codes(impact_lucode, watershed_uri):
+    """Find the landcover codes that an impact site may be converted to.
+
+        impact_lucode - the landcover code to convert to, or a URI to a
+            landcover raster whose values are converted to (see
+            convert_impact()).
+        watershed_uri - a URI to a vector of the watershed the impacts are
+            in.
+
+    Returns a sorted list of landcover codes."""
+    try:
+        return [int(impact_lucode)]
+    except ValueError:
+        pass
+
+    codes = set()
+    def _collect_codes(values):
+        codes.update(numpy.unique(values).tolist())
+        return values
+
+    impact_nodata = pygeoprocessing.get_nodata_from_uri(impact_lucode)
+    pipeline = utils.RasterPipeline('intersection', aoi_uri=watershed_uri)
+    pipeline.add_raster('impact', impact_lucode)
+    pipeline.add_operation('codes', _collect_codes, ['impact'],
+                           impact_nodata)
+    pipeline.run()
+    codes.discard(impact_nodata)
+    return sorted(codes)
+
+
+def _landcover_values(model_name, landcover_codes, reference_lulc, workspace,
+                      config):
+    """Find the value a model gives a single pixel of each landcover code,
+    for a model whose pixel values only depend on the pixel's own landcover
+    (one that isn't routed).  The model is run once on a raster with one
+    pixel per landcover code.
+
+        model_name - a string.  Must be a key in MODELS.
+        landcover_codes - a list of landcover codes.
+        reference_lulc - a URI to a landcover raster whose projection, pixel
+            size, datatype and nodata value should be used.
+        workspace - a URI to the folder the model should be run in.
+        config - a python dictionary with arguments for the target model.
+
+    Returns a python dictionary mapping each landcover code to the pixel
+    value, or to None if the model gives that landcover code nodata."""
+
+    if not os.path.exists(workspace):
+        os.makedirs(workspace)
+
+    reference_raster = gdal.Open(reference_lulc)
+    reference_band = reference_raster.GetRasterBand(1)
+    legend_uri = os.path.join(workspace, 'legend_lulc.tif')
+    driver = gdal.GetDriverByName('GTiff')
+    legend_raster = driver.Create(legend_uri, len(landcover_codes), 1, 1,
+                                  reference_band.DataType)
+    legend_raster.SetProjection(reference_raster.GetProjection())
+    legend_raster.SetGeoTransform(reference_raster.GetGeoTransform())
+    legend_band = legend_raster.GetRasterBand(1)
+    lulc_nodata = reference_band.GetNoDataValue()
+    if lulc_nodata is not None:
+        legend_band.SetNoDataValue(lulc_nodata)
+    legend_band.WriteArray(numpy.array([landcover_codes],
+                                       dtype=numpy.float64))
+    legend_band = None
+    legend_raster = None
+    reference_band = None
+    reference_raster = None
+
+    execute_model(model_name, legend_uri, workspace, config)
+
+    values_uri = os.path.join(workspace, MODELS[model_name]['target_raster'])
+    values_nodata = pygeoprocessing.get_nodata_from_uri(values_uri)
+    values_raster = gdal.Open(values_uri)
+    values = values_raster.GetRasterBand(1).ReadAsArray()[0]
+    values_raster = None
+
+    landcover_values = {}
+    for landcover_code, value in zip(landcover_codes, values.tolist()):
+        if value == values_nodata:
+            value = None
+        landcover_values[landcover_code] = value
+    LOGGER.debug('Pixel values of the impacted landcover codes: %s',
+                 landcover_values)
+    return landcover_values
+
+
+def _simulate_impact(job):
+    """Run a single random impact simulation in its own workspace.
+
+        job - a python dictionary with the keys 'watershed_id',
+            'watershed_uri', 'run_number', 'seed', 'impact_workspace',
+            'impact_lucode', 'model_name', 'invert', 'incremental',
+            'window_buffer', 'validate' and the keys returned by
+            _prepare_quality_watershed().
+
+    When job['incremental'] is True, a model that isn't routed is not run at
+    all (see _local_estimates()), and a routed model is only run on a window
+    around the impact site (see _windowed_estimates()).
+
+    Returns a tuple of (row, validation_row).  row is a list of the values to
+    write to the simulation CSV.  validation_row is a list of the values to
+    write to the incremental validation CSV, or None if the simulation was
+    not validated against a full run."""
+
+    rng = random.Random(job['seed'])
+    impact_site_length = rng.uniform(500, 3000)
+    impact_workspace = job['impact_workspace']
+    run_number = job['run_number']
+    watershed_uri = job['watershed_uri']
+
+    if os.path.exists(impact_workspace):
+        shutil.rmtree(impact_workspace)
+    os.makedirs(impact_workspace)
+
+    # keep this simulation's tempfiles in its own workspace.
+    tempfile.tempdir = os.path.join(impact_workspace, 'tmp')
+    pygeoprocessing.create_directories([tempfile.tempdir])
+
+    # make a random impact vector somewhere in the current watershed.
+    impact_site = os.path.join(impact_workspace, 'impact_%s.shp' % run_number)
+    make_random_impact_vector(impact_site, watershed_uri,
+                              impact_site_length, rng=rng)
+
+    # convert the area under the impact to the correct landcover
+    # code(s), run the target model and analyze the outputs.
+    converted_landcover = os.path.join(impact_workspace,
+                                       'converted_lulc.tif')
+    # If the landcover is a string, we convert to the area under the
+    # impact.  If the landcover is a number, that's the conversion
+    # type.
+    convert_impact(impact_site, job['watershed_lulc'], job['impact_lucode'],
+                   converted_landcover, impact_workspace)
+
+    validation_row = None
+    if job['incremental']:
+        if MODELS[job['model_name']]['routed']:
+            estimates = _windowed_estimates(job, impact_site,
+                                            converted_landcover,
+                                            impact_workspace)
+        else:
+            estimates = _local_estimates(job, impact_site,
+                                         converted_landcover,
+                                         impact_workspace)
+        if job['validate']:
+            full_workspace = os.path.join(impact_workspace, 'full_run')
+            full_estimates = _full_estimates(job, impact_site,
+                                             converted_landcover,
+                                             full_workspace)
+            # an impact that doesn't change the watershed's export has a
+            # full estimate of 0.
+            relative_error = _divide_estimates(
+                estimates['invest_est'] - full_estimates['invest_est'],
+                full_estimates['invest_est'])
+            LOGGER.info('Windowed estimate for ws %s impact %s is %s, full '
+                        'estimate is %s', job['watershed_id'], run_number,
+                        estimates['invest_est'], full_estimates['invest_est'])
+            validation_row = [
+                job['watershed_id'],
+                run_number,
+                estimates['invest_est'],
+                full_estimates['invest_est'],
+                relative_error,
+            ]
+    else:
+        estimates = _full_estimates(job, impact_site, converted_landcover,
+                                    impact_workspace)
+
+    # ability to sort based on area of impact site.
+    # also record which watershed this run is in, impact site ID as well
+    impact_site_area = get_polygon_area(impact_site)
+    row = [
+        job['watershed_id'],
+        run_number,
+        impact_site_area,
+        estimates['static_est'],
+        estimates['invest_est'],
+        estimates['export_ratio'],
+    ]
+    return row, validation_row
+
+
+def _full_estimates(job, impact_site, converted_landcover, workspace):
+    """Run the target model on the whole converted watershed landcover and
+    compare it with the watershed's base run.
+
+        job - a simulation job.  See _simulate_impact().
+        impact_site - a URI to the impact site vector.
+        converted_landcover - a URI to the watershed landcover with the impact
+            site converted.
+        workspace - a URI to the folder the model should be run in.
+
+    Returns the estimates dictionary from aggregate_test_results()."""
+
+    execute_model(job['model_name'], converted_landcover, workspace,
+                  job['config'])
+    return aggregate_test_results(
+        workspace,
+        job['model_name'],
+        job['watershed_uri'],
+        impact_site,
+        job['ws_base_static_map'],
+        job['ws_base_export_uri'],
+        invert=job['invert'])
+
+
+def _local_estimates(job, impact_site, converted_landcover, workspace):
+    """Estimate the change in the target service of a model that isn't
+    routed (carbon) without running the model.  A pixel's value only depends
+    on its own landcover, so the impacted export is the watershed's base run
+    with the pixels under the impact mask replaced by the value of their new
+    landcover code (from job['landcover_values']).  This is exact.
+
+        job - a simulation job.  See _simulate_impact().
+        impact_site - a URI to the impact site vector.
+        converted_landcover - a URI to the watershed landcover with the impact
+            site converted.
+        workspace - a URI to the impact's workspace.  It must contain the
+            impact_mask.tif written by convert_impact().  The impacted
+            export is written here where the model would have written it.
+
+    Returns the estimates dictionary from aggregate_test_results()."""
+
+    model_name = job['model_name']
+    base_export = job['ws_base_export_uri']
+    export_nodata = pygeoprocessing.get_nodata_from_uri(base_export)
+
+    # codes the model gives nodata are left out of the lookup, so their
+    # pixels become nodata as they would in a model run.
+    known_values = sorted((code, value) for (code, value)
+                          in job['landcover_values'].iteritems()
+                          if value is not None)
+    codes = numpy.array([code for (code, _) in known_values])
+    code_values = numpy.array([value for (_, value) in known_values])
+
+    def _impacted_export(mask_values, lulc_values, export_values):
+        impacted = mask_values == 1
+        if len(codes) == 0:
+            return numpy.where(impacted, export_nodata, export_values)
+        positions = numpy.searchsorted(codes, lulc_values).clip(
+            0, len(codes) - 1)
+        known = codes[positions] == lulc_values
+        return numpy.where(impacted, numpy.where(
+            known, code_values[positions], export_nodata), export_values)
+
+    export_uri = os.path.join(workspace, MODELS[model_name]['target_raster'])
+    if not os.path.exists(os.path.dirname(export_uri)):
+        os.makedirs(os.path.dirname(export_uri))
+    pipeline = utils.RasterPipeline('union')
+    pipeline.add_raster('mask', os.path.join(workspace, 'impact_mask.tif'))
+    pipeline.add_raster('lulc', converted_landcover)
+    pipeline.add_raster('base_export', base_export)
+    pipeline.add_operation('impacted_export', _impacted_export,
+                           ['mask', 'lulc', 'base_export'], export_nodata,
+                           out_uri=export_uri)
+    pipeline.run()
+
+    return aggregate_test_results(
+        workspace,
+        model_name,
+        job['watershed_uri'],
+        impact_site,
+        job['ws_base_static_map'],
+        base_export,
+        invert=job['invert'])
+
+
+def _windowed_estimates(job, impact_site, converted_landcover, workspace):
+    """Estimate the change in the target service of a routed model by
+    running the model on a window around the impact site rather than on the
+    whole watershed.
+
+    The window is the impact site's bounding box buffered by
+    job['window_buffer'] and clipped to the watershed, which covers the
+    upslope and downslope pixels whose export is most affected by the impact.
+    Routing near the edges of the window differs from routing in the full
+    watershed, so the model is also run on the window's base landcover and
+    the two window runs are compared.  This is an approximation; see the
+    'validate' option of test_static_map_quality().
+
+        job - a simulation job.  See _simulate_impact().
+        impact_site - a URI to the impact site vector.
+        converted_landcover - a URI to the watershed landcover with the impact
+            site converted.
+        workspace - a URI to the folder the model should be run in.
+
+    Returns the estimates dictionary from aggregate_test_results()."""
+
+    model_name = job['model_name']
+    pixel_size = pygeoprocessing.get_cell_size_from_uri(converted_landcover)
+    buffer_distance = max(job['window_buffer'], pixel_size)
+
+    window_uri = os.path.join(workspace, 'impact_window.shp')
+    make_impact_window(impact_site, job['watershed_uri'], buffer_distance,
+                       window_uri)
+
+    # if the model uses watersheds, the window is the only watershed.
+    config = job['config'].copy()
+    watersheds_key = MODELS[model_name]['watersheds_key']
+    if watersheds_key is not None:
+        config[watersheds_key] = window_uri
+
+    window_lulc = os.path.join(workspace, 'window_converted_lulc.tif')
+    clip_raster_to_watershed(converted_landcover, window_uri, window_lulc)
+    execute_model(model_name, window_lulc, workspace, config)
+
+    window_base_lulc = os.path.join(workspace, 'window_base_lulc.tif')
+    clip_raster_to_watershed(job['watershed_lulc'], window_uri,
+                             window_base_lulc)
+    window_base_workspace = os.path.join(workspace, 'window_base')
+    execute_model(model_name, window_base_lulc, window_base_workspace,
+                  config)
+    base_export = os.path.join(window_base_workspace,
+                               MODELS[model_name]['target_raster'])
+
+    return aggregate_test_results(
+        workspace,
+        model_name,
+        window_uri,
+        impact_site,
+        job['ws_base_static_map'],
+        base_export,
+        invert=job['invert'])
+
+
+def make_impact_window(impact_site, watershed_uri, buffer_distance, out_uri):
+    """Create a vector with a single polygon covering the bounding box of the
+    first polygon in impact_site, buffered by buffer_distance and clipped to
+    the first polygon in watershed_uri.  The window has the watershed's ws_id
+    so that it can be used in place of the watershed.
+
+        impact_site - a URI to an OGR vector of the impact site.
+        watershed_uri - a URI to an OGR vector with a single watershed
+            polygon, with an integer ws_id field.
+        buffer_distance - a python int or float.  The distance to buffer the
+            impact site's bounding box by, in the units of the vectors.
+        out_uri - a URI to where the new ESRI Shapefile should be created.
+
+    Returns nothing."""
+
+    impact_vector = ogr.Open(impact_site)
+    impact_layer = impact_vector.GetLayer()
+    impact_feature = impact_layer.GetNextFeature()
+    # envelope = [xmin, xmax, ymin, ymax]
+    xmin, xmax, ymin, ymax = impact_feature.GetGeometryRef().GetEnvelope()
+    xmin -= buffer_distance
+    ymin -= buffer_distance
+    xmax += buffer_distance
+    ymax += buffer_distance
+
+    poly_ring = ogr.Geometry(type=ogr.wkbLinearRing)
+    poly_ring.AddPoint(xmin, ymin)
+    poly_ring.AddPoint(xmin, ymax)
+    poly_ring.AddPoint(xmax, ymax)
+    poly_ring.AddPoint(xmax, ymin)
+    poly_ring.AddPoint(xmin, ymin)
+    window = ogr.Geometry(ogr.wkbPolygon)
+    window.AddGeometry(poly_ring)
+
+    watershed_vector = ogr.Open(watershed_uri)
+    watershed_layer = watershed_vector.GetLayer()
+    watershed = watershed_layer.GetNextFeature()
+    window = window.Intersection(watershed.GetGeometryRef())
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    datasource = driver.CreateDataSource(out_uri)
+    layer_name = str(os.path.splitext(os.path.basename(out_uri))[0])
+    layer = datasource.CreateLayer(layer_name,
+                                   watershed_layer.GetSpatialRef(),
+                                   ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('ws_id', ogr.OFTInteger))
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(window)
+    feature.SetField('ws_id', watershed.GetField('ws_id'))
+    layer.CreateFeature(feature)
+
+    feature = None
+    layer = None
+    datasource = None
+    impact_layer = None
+    impact_vector = None
+    watershed_layer = None
+    watershed_vector = None
+
+
+def _map_jobs(function, jobs, n_workers):
+    """Call function on each job, in a process pool if n_workers > 1.
+
+        function - a module-level function taking a single job argument.
+        jobs - a list of jobs.
+        n_workers - the number of worker processes to use.
+
+    Returns a generator of (job, result) tuples in the order the jobs
+    finish."""
+
+    n_workers = min(n_workers, len(jobs))
+    if n_workers <= 1:
+        for job in jobs:
+            yield job, function(job)
+        return
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        # imap_unordered() re-raises the first exception raised in a worker.
+        for job, result in pool.imap_unordered(_call_job,
+                [(function, job) for job in jobs]):
+            yield job, result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _call_job(function_and_job):
+    """Call function on job in a worker process, keeping the job with its
+    result so that results can be matched up out of order.
+
+        function_and_job - a tuple of (function, job).
+
+    Returns a tuple of (job, result)."""
+    function, job = function_and_job
+    return job, function(job)
+
+
 def test_static_map_quality(
         base_run,
         base_static_map,
@@ -834,9 +1553,20 @@ def test_static_map_quality(
         clean_workspaces=False,
         start_ws=0,
         start_impact=0,
-        invert=None):
+        invert=None,
+        n_workers=1,
+        seed=None,
+        incremental=False,
+        window_buffer=2000,
+        validation_interval=10):
     """Test the quality of the provided static map.
 
+    Simulations are run as independent (watershed, impact) jobs, each in its
+    own workspace.  Rows are appended to impact_site_simulation.csv by this
+    process as the jobs finish, and any simulation already recorded in that
+    CSV is skipped, so an interrupted test resumes where it left off when
+    called again with the same workspace.
+
     Args:
         base_run (filepath): The base run of the target model on the base lulc.
         base_static_map (filepath): The static map generated from the difference
@@ -860,11 +1590,31 @@ def test_static_map_quality(
         clean_workspace=False (boolean, optional): Whether to remove the
             workspace before starting to test the inputs.
         start_ws=0 (int, optional): The watershed index to start on.  If 0, all
-            watersheds will be tested.  Useful for resuming testing after
-            failure (such as when running out of disk space).
-        start_impact=0 (int, optional): The integer impact ID to start on.
-            This must be less than `num_interations`.
+            watersheds will be tested.  Completed simulations are skipped
+            automatically, so this is no longer needed for resuming.
+        start_impact=0 (int, optional): The integer impact ID to start on
+            within the `start_ws` watershed.  This must be less than
+            `num_interations`.
         invert=None (boolean): Whether to invert the static map calculation.
+        n_workers=1 (int, optional): The number of worker processes to run
+            simulations in.
+        seed=None (int, optional): The base seed for the random impact sites.
+            Each simulation's random state is derived from this seed, its
+            ws_id and its impact ID.  If None, a base seed is chosen at random
+            and logged.
+        incremental=False (boolean, optional): Whether to estimate each
+            impact without running the target model on the whole watershed.
+            Models that aren't routed aren't run at all (see
+            `_local_estimates()`), and routed models are run on a window
+            around each impact site (see `_windowed_estimates()`).
+        window_buffer=2000 (int or float, optional): For routed models, the
+            distance to buffer each impact site's bounding box by to build its
+            window, in the units of the watersheds vector.
+        validation_interval=10 (int, optional): When `incremental` is True,
+            every `validation_interval`th impact in each watershed is also run
+            on the whole watershed, and the windowed and full estimates are
+            written to incremental_validation.csv.  If 0 or None, no
+            simulations are validated.
 
     Returns:
         Nothing.
@@ -881,28 +1631,37 @@ def test_static_map_quality(
     # make all the folders we know about at the moment
     pygeoprocessing.create_directories([workspace, temp_dir])
 
-    # Open a logfile so we can incrementally write model data we care about
-    logfile_uri = os.path.join(workspace, 'impact_site_simulation.csv')
-    logfile = open(logfile_uri, 'a')
-    labels = ['ws_id', 'Impact ID', 'Impact Area', 'Static Estimate',
-              'InVEST Estimate', 'Estimate Ratio']
-    logfile.write("%s\n" % ','.join(labels))
-    logfile.close()
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    LOGGER.info('Simulating impacts with base seed %s', seed)
 
-    lulc_nodata = pygeoprocessing.get_nodata_from_uri(landuse_uri)
-    lulc_pixel_size = pygeoprocessing.get_cell_size_from_uri(landuse_uri)
+    # Only write the header if we're starting a new logfile.  Otherwise,
+    # skip the simulations that have already been recorded.
+    logfile_uri = os.path.join(workspace, 'impact_site_simulation.csv')
+    completed = _completed_simulations(logfile_uri)
+    if os.path.exists(logfile_uri):
+        # remove a partially-written last line.  Its simulation is run again.
+        logfile = open(logfile_uri, 'rb+')
+        contents = logfile.read()
+        if not contents.endswith('\n'):
+            logfile.truncate(contents.rfind('\n') + 1)
+        logfile.close()
+
+    if not os.path.exists(logfile_uri) or os.path.getsize(logfile_uri) == 0:
+        labels = ['ws_id', 'Impact ID', 'Impact Area', 'Static Estimate',
+                  'InVEST Estimate', 'Estimate Ratio']
+        logfile = open(logfile_uri, 'w')
+        logfile.write("%s\n" % ','.join(labels))
+        logfile.close()
+    else:
+        LOGGER.info('Resuming: %s simulations already recorded in %s',
+                    len(completed), logfile_uri)
 
     # limit the watersheds to just those that intersect the input lulc.
     current_watersheds = os.path.join(temp_dir, 'current_watersheds.shp')
     preprocessing.filter_by_raster(landuse_uri, watersheds_uri,
         current_watersheds, clip=True)
 
-    # get the sediment export from the base raster, passed in from the user.
-    # calculate for each watershed, so I can access these later.
-    #base_export = pygeoprocessing.aggregate_raster_values_uri(
-    #    base_run, current_watersheds, 'ws_id', 'sum').total
-    #LOGGER.debug('All watershed ids: %s', base_export.keys())
-
     # split the watersheds so I can use each watershed as an AOI for the
     # correct model later on.
     watersheds_dir = os.path.join(workspace, 'watershed_vectors')
@@ -911,6 +1670,10 @@ def test_static_map_quality(
         watersheds_dir,
         ['ws_id'])
 
+    # Work out which simulations still need to run, and only prepare the
+    # watersheds that have some left.
+    watershed_jobs = []
+    pending_runs = {}
     for ws_index, watershed_uri in enumerate(split_watersheds):
         if ws_index < start_ws:
             LOGGER.debug(
@@ -918,112 +1681,81 @@ def test_static_map_quality(
                 ws_index, start_ws)
             continue
 
-        watershed_workspace = os.path.join(
-            workspace, 'watershed_%s' % ws_index)
-        if not os.path.exists(watershed_workspace):
-            os.makedirs(watershed_workspace)
-
-        # get this watershed's ws_id
-        watershed_vector = ogr.Open(watershed_uri)
-        watershed_layer = watershed_vector.GetLayer()
-        watershed = watershed_layer.GetFeature(0)
-        watershed_id = watershed.GetField('ws_id')
-        LOGGER.debug('This watershed\'s ws_id: %s', watershed_id)
-
-        watershed_lulc = os.path.join(watershed_workspace,
-            'watershed_lulc.tif')
-        lulc_datatype = pygeoprocessing.get_datatype_from_uri(landuse_uri)
-        pygeoprocessing.vectorize_datasets([landuse_uri], lambda x: x,
-            watershed_lulc, lulc_datatype, lulc_nodata, lulc_pixel_size,
-            'intersection', dataset_to_align_index=0, aoi_uri=watershed_uri,
-            vectorize_op=False)
-
-        ws_base_export_uri = os.path.join(watershed_workspace,
-            'watershed_' + os.path.basename(base_run))
-        base_nodata = pygeoprocessing.get_nodata_from_uri(base_run)
-        base_pixel_size = pygeoprocessing.get_cell_size_from_uri(base_run)
-        base_export_datatype = pygeoprocessing.get_datatype_from_uri(base_run)
-        pygeoprocessing.vectorize_datasets([base_run], lambda x: x,
-            ws_base_export_uri, base_export_datatype, base_nodata, base_pixel_size,
-            'intersection', dataset_to_align_index=0, aoi_uri=watershed_uri,
-            vectorize_op=False)
-        base_ws_export = pygeoprocessing.aggregate_raster_values_uri(
-            ws_base_export_uri, watershed_uri, 'ws_id',
-            'sum').total[watershed_id]
-
-        # if the model uses watersheds, we only want to run the model using
-        # the one current watershed.
-        watersheds_key = MODELS[model_name]['watersheds_key']
-        if watersheds_key is not None:
-            config[watersheds_key] = watershed_uri
-
-        watershed_lulc = os.path.join(watershed_workspace,
-                                      'watershed_lulc.tif')
-        clip_raster_to_watershed(landuse_uri, watershed_uri, watershed_lulc)
-        watershed_base_workspace = os.path.join(watershed_workspace, 'base')
-        execute_model(model_name, watershed_lulc, watershed_base_workspace, config)
-
-        ws_base_export_uri = os.path.join(watershed_base_workspace,
-                                          MODELS[model_name]['target_raster'])
-        ws_base_static_map = os.path.join(
-            watershed_workspace, 'watershed_' + os.path.basename(base_static_map))
-        clip_raster_to_watershed(base_static_map, watershed_uri, ws_base_static_map)
-
-        # If we're not in the starting watershed, then reset the starting index
-        # of the impact site.
-        start_impact = 0 if ws_index != start_impact else start_impact
-
-        for run_number in range(start_impact, num_iterations):
-            impact_site_length = random.uniform(500, 3000)
-            impact_workspace = os.path.join(watershed_workspace,
-                                            'random_impact_%s' % run_number)
-
-            if os.path.exists(impact_workspace):
-                shutil.rmtree(impact_workspace)
-            os.makedirs(impact_workspace)
+        first_impact = start_impact if ws_index == start_ws else 0
+        watershed_id = get_watershed_id(watershed_uri)
+        run_numbers = [run_number for run_number
+                       in range(first_impact, num_iterations)
+                       if (str(watershed_id), str(run_number))
+                       not in completed]
+        if len(run_numbers) == 0:
+            LOGGER.debug('All simulations in watershed %s are recorded',
+                         watershed_id)
+            continue
 
-            # make a random impact vector somewhere in the current watershed.
-            impact_site = os.path.join(
-                impact_workspace,
-                'impact_%s.shp' %
-                run_number)
-            make_random_impact_vector(impact_site, watershed_uri,
-                                      impact_site_length)
-
-            # convert the area under the impact to the correct landcover
-            # code(s), run the target model and analyze the outputs.
-            converted_landcover = os.path.join(impact_workspace,
-                                               'converted_lulc.tif')
-            # If the landcover is a string, we convert to the area under the
-            # impact.  If the landcover is a number, that's the conversion
-            # type.
-            convert_impact(impact_site, watershed_lulc, impact_lucode,
-                           converted_landcover, impact_workspace)
-            execute_model(model_name, converted_landcover, impact_workspace,
-                          config)
-            estimates = aggregate_test_results(
-                impact_workspace,
-                model_name,
-                watershed_uri,
-                impact_site,
-                ws_base_static_map,
-                ws_base_export_uri,
-                invert=invert)
-
-            # ability to sort based on area of impact site.
-            # also record which watershed this run is in, impact site ID as well
-            impact_site_area = get_polygon_area(impact_site)
-            values_to_write = [
-                watershed_id,
-                run_number,
-                impact_site_area,
-                estimates['static_est'],
-                estimates['invest_est'],
-                estimates['export_ratio'],
-            ]
-            logfile = open(logfile_uri, 'a')
-            logfile.write("%s\n" % ','.join(map(str, values_to_write)))
-            logfile.close()
+        pending_runs[ws_index] = (watershed_id, run_numbers)
+        watershed_jobs.append({
+            'ws_index': ws_index,
+            'watershed_uri': watershed_uri,
+            'watershed_workspace': os.path.join(
+                workspace, 'watershed_%s' % ws_index),
+            'landuse_uri': landuse_uri,
+            'base_run': base_run,
+            'base_static_map': base_static_map,
+            'model_name': model_name,
+            'config': config,
+            'impact_lucode': impact_lucode,
+            'incremental': incremental,
+        })
+
+    impact_jobs = []
+    for watershed_job, watershed_data in _map_jobs(
+            _prepare_quality_watershed, watershed_jobs, n_workers):
+        ws_index = watershed_job['ws_index']
+        watershed_id, run_numbers = pending_runs[ws_index]
+        for run_number in run_numbers:
+            impact_job = watershed_data.copy()
+            impact_job.update({
+                'watershed_id': watershed_id,
+                'watershed_uri': watershed_job['watershed_uri'],
+                'run_number': run_number,
+                'seed': _job_seed(seed, watershed_id, run_number),
+                'impact_workspace': os.path.join(
+                    watershed_job['watershed_workspace'],
+                    'random_impact_%s' % run_number),
+                'impact_lucode': impact_lucode,
+                'model_name': model_name,
+                'invert': invert,
+                'incremental': incremental,
+                'window_buffer': window_buffer,
+                'validate': bool(incremental and validation_interval and
+                                 run_number % validation_interval == 0),
+            })
+            impact_jobs.append(impact_job)
+
+    # Rows are only ever written here, in the parent process, so there's a
+    # single writer no matter how many workers there are.
+    LOGGER.info('Running %s impact simulations with %s workers',
+                len(impact_jobs), n_workers)
+    validation_uri = os.path.join(workspace, 'incremental_validation.csv')
+    for _, (values_to_write, validation_row) in _map_jobs(
+            _simulate_impact, impact_jobs, n_workers):
+        logfile = open(logfile_uri, 'a')
+        logfile.write("%s\n" % ','.join(map(str, values_to_write)))
+        logfile.close()
+
+        if validation_row is not None:
+            if not os.path.exists(validation_uri):
+                labels = ['ws_id', 'Impact ID', 'Windowed Estimate',
+                          'InVEST Estimate', 'Relative Error']
+                validation_file = open(validation_uri, 'w')
+                validation_file.write("%s\n" % ','.join(labels))
+            else:
+                validation_file = open(validation_uri, 'a')
+            validation_file.write("%s\n" % ','.join(
+                map(str, validation_row)))
+            validation_file.close()
+
+    tempfile.tempdir = old_tempdir
 
 def compute_impact_stats(impact_dir, model_name, watershed_vector,
                          base_ws_export, base_static_map):
@@ -1084,7 +1816,7 @@ def compute_impact_stats(impact_dir, model_name, watershed_vector,
     invest_estimate = impact_ws_export - base_ws_export
     #invest_estimate = base_ws_export - impact_ws_export
 
-    export_ratio = static_estimate / invest_estimate
+    export_ratio = _divide_estimates(static_estimate, invest_estimate)
 
     return {
         'impact_dir': impact_dir,
@@ -1345,43 +2077,43 @@ def aggregate_test_results(impact_workspace, model_name, watershed_uri,
     export = os.path.join(impact_workspace,
                           MODELS[model_name]['target_raster'])
 
-    def _mask_out_pixels(in_raster, comp_raster, out_raster):
-        comp_nodata = pygeoprocessing.get_nodata_from_uri(comp_raster)
-        pixel_size = pygeoprocessing.get_cell_size_from_uri(comp_raster)
-
-        def _pixel_mask(_in_values, _out_values):
-            return numpy.where(_in_values == comp_nodata,
-                comp_nodata, _out_values)
-
-        pygeoprocessing.vectorize_datasets([comp_raster, in_raster],
-            _pixel_mask, out_raster, gdal.GDT_Float32, comp_nodata,
-            pixel_size, 'union', dataset_to_align_index=0,
-            vectorize_op=False)
-
-    # mutually mask out the impacted/base export rasters.
-    masked_impact_export = os.path.join(impact_workspace,
-                                        'masked_impacted_export.tif')
-    masked_base_export = os.path.join(impact_workspace,
-                                      'masked_base_export.tif')
-    _mask_out_pixels(export, base_export, masked_impact_export)
-    _mask_out_pixels(base_export, export, masked_base_export)
+    # Mutually mask out the impacted/base export rasters, aggregate them over
+    # the target watershed and get the static map's estimate under the
+    # impacted area, all in a single pass over the rasters.
+    export_nodata = pygeoprocessing.get_nodata_from_uri(export)
+    base_nodata = pygeoprocessing.get_nodata_from_uri(base_export)
+    pipeline = utils.RasterPipeline('union')
+    pipeline.add_raster('export', export)
+    pipeline.add_raster('base_export', base_export)
+    pipeline.add_raster('static_map', base_static_map)
+    pipeline.add_operation('masked_impact_export',
+        lambda base_values, export_values: numpy.where(
+            base_values == base_nodata, base_nodata, export_values),
+        ['base_export', 'export'], base_nodata)
+    pipeline.add_operation('masked_base_export',
+        lambda export_values, base_values: numpy.where(
+            export_values == export_nodata, export_nodata, base_values),
+        ['export', 'base_export'], export_nodata)
+    pipeline.add_zonal_sum('impact_ws_export', 'masked_impact_export',
+                           watershed_uri, 'ws_id')
+    pipeline.add_zonal_sum('base_ws_export', 'masked_base_export',
+                           watershed_uri, 'ws_id')
+    pipeline.add_zonal_sum('static_estimate', 'static_map', impact_site, 'id')
+    sums = pipeline.run()
 
     # Aggregate the sediment export from this impact simulation over
     # the target watershed
-    impact_ws_export = pygeoprocessing.aggregate_raster_values_uri(
-        masked_impact_export, watershed_uri, 'ws_id').total.values()[0]
+    impact_ws_export = sums['impact_ws_export'].values()[0]
 
     # Get the sediment export from the static map under the impacted area.
     # only 1 feature in the impactd area, so we access that number with
     # index 1.
-    static_estimate = pygeoprocessing.aggregate_raster_values_uri(
-        base_static_map, impact_site, 'id').total[1]
+    static_estimate = sums['static_estimate'][1]
 
     # Get the watershed's base export from the masked version of the
     # watershed's export raster.
     watershed_id = get_watershed_id(watershed_uri)
-    base_ws_export = pygeoprocessing.aggregate_raster_values_uri(
-        masked_base_export, watershed_uri, 'ws_id').total[watershed_id]
+    base_ws_export = sums['base_ws_export'][watershed_id]
 
     LOGGER.warning('NOT adjusting by %%-to-stream. model=%s', model_name)
     # This conditional makes the outputs all
@@ -1393,7 +2125,7 @@ def aggregate_test_results(impact_workspace, model_name, watershed_uri,
         invest_estimate = base_ws_export - impact_ws_export
 
 
-    export_ratio = static_estimate / invest_estimate
+    export_ratio = _divide_estimates(static_estimate, invest_estimate)
 
     return {
         'static_est': static_estimate,
@@ -1415,8 +2147,9 @@ def clip_static_map(map_uri, aoi_uri, out_uri):
     Returns nothing."""
 
     nodata = pygeoprocessing.get_nodata_from_uri(map_uri)
-    pixel_size = pygeoprocessing.get_cell_size_from_uri(map_uri)
 
-    pygeoprocessing.vectorize_datasets([map_uri], lambda x: x, out_uri,
-        gdal.GDT_Float32, nodata, pixel_size, 'intersection', aoi_uri=aoi_uri,
-        vectorize_op=False)
+    pipeline = utils.RasterPipeline('intersection', aoi_uri=aoi_uri)
+    pipeline.add_raster('map', map_uri)
+    pipeline.add_operation('clipped', lambda x: x, ['map'], nodata,
+                           gdal.GDT_Float32, out_uri=out_uri)
+    pipeline.run()
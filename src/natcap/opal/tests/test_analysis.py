@@ -0,0 +1,197 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy
+from shapely.geometry import Polygon
+from osgeo import ogr
+
+import natcap.opal.tests
+from natcap.opal.tests.test_smoke import square
+from natcap.opal import analysis
+
+
+class AnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_aggregate_stats_multi(self):
+        # Build two 10x10 rasters with 30m pixels and a vector with two
+        # polygons that each cover a 2x2 block of pixels.
+        pixel_size = 30
+        geotransform = natcap.opal.tests.COLOMBIA_GEOTRANSFORM(pixel_size,
+            -pixel_size)
+        origin_x, origin_y = geotransform[0], geotransform[3]
+
+        values = numpy.arange(100, dtype=numpy.float32).reshape((10, 10))
+        values[0][0] = -1  # nodata pixel under the first polygon.
+        values_uri = natcap.opal.tests.raster(values,
+            natcap.opal.tests.COLOMBIA_SRS, geotransform, -1,
+            filename=os.path.join(self.workspace, 'values.tif'))
+
+        pts = numpy.ones((10, 10), dtype=numpy.float32) * 0.5
+        pts[5][5] = 0.75
+        pts_uri = natcap.opal.tests.raster(pts,
+            natcap.opal.tests.COLOMBIA_SRS, geotransform, -1,
+            filename=os.path.join(self.workspace, 'pts.tif'))
+
+        def pixel_square(col, row, size):
+            minx = origin_x + col * pixel_size
+            maxy = origin_y - row * pixel_size
+            maxx = minx + size * pixel_size
+            miny = maxy - size * pixel_size
+            return Polygon([(minx, miny), (maxx, miny), (maxx, maxy),
+                (minx, maxy), (minx, miny)])
+
+        vector_uri = natcap.opal.tests.vector(
+            [pixel_square(0, 0, 2), pixel_square(5, 5, 2)],
+            natcap.opal.tests.COLOMBIA_SRS, {'FID': int},
+            [{'FID': 0}, {'FID': 1}], format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'polygons.shp'))
+
+        stats = analysis.aggregate_stats_multi(vector_uri, 'FID', [
+            ('sediment', values_uri, None),
+            ('nutrient', values_uri, pts_uri),
+        ])
+
+        expected_sums = {0: 1. + 10 + 11, 1: 55. + 56 + 65 + 66}
+        self.assertEqual(stats['sediment'], expected_sums)
+        self.assertEqual(stats['nutrient'], {
+            0: expected_sums[0] * 0.5, 1: expected_sums[1] * 0.75})
+
+        # Verify the fields were written to the vector.
+        vector = ogr.Open(vector_uri)
+        layer = vector.GetLayer()
+        for feature in layer:
+            fid_value = feature.GetField('FID')
+            self.assertEqual(feature.GetField('sediment'),
+                expected_sums[fid_value])
+            self.assertEqual(feature.GetField('nutrient'),
+                stats['nutrient'][fid_value])
+        layer = None
+        vector = None
+
+    def test_aggregate_stats_multi_overlapping(self):
+        # Two polygons that overlap by a 1x1 block of pixels, and a third
+        # that only shares an edge with the second.
+        pixel_size = 30
+        geotransform = natcap.opal.tests.COLOMBIA_GEOTRANSFORM(pixel_size,
+            -pixel_size)
+        origin_x, origin_y = geotransform[0], geotransform[3]
+
+        values = numpy.arange(100, dtype=numpy.float32).reshape((10, 10))
+        values_uri = natcap.opal.tests.raster(values,
+            natcap.opal.tests.COLOMBIA_SRS, geotransform, -1,
+            filename=os.path.join(self.workspace, 'values.tif'))
+
+        def pixel_square(col, row, size):
+            minx = origin_x + col * pixel_size
+            maxy = origin_y - row * pixel_size
+            maxx = minx + size * pixel_size
+            miny = maxy - size * pixel_size
+            return Polygon([(minx, miny), (maxx, miny), (maxx, maxy),
+                (minx, maxy), (minx, miny)])
+
+        vector_uri = natcap.opal.tests.vector(
+            [pixel_square(0, 0, 2), pixel_square(1, 1, 2),
+             pixel_square(3, 1, 2)],
+            natcap.opal.tests.COLOMBIA_SRS, {'FID': int},
+            [{'FID': 0}, {'FID': 1}, {'FID': 2}], format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'polygons.shp'))
+
+        stats = analysis.aggregate_stats_multi(vector_uri, 'FID', [
+            ('sediment', values_uri, None),
+        ])
+
+        # pixel 11 is under both of the first two polygons.
+        self.assertEqual(stats['sediment'], {
+            0: 0. + 1 + 10 + 11,
+            1: 11. + 12 + 21 + 22,
+            2: 13. + 14 + 23 + 24,
+        })
+
+    def test_percent_overlap(self):
+        # two servicesheds side by side, with one offset site straddling
+        # both and another entirely within the second.
+        servicesheds_uri = natcap.opal.tests.vector(
+            [square((5, 5), 10), square((15, 5), 10)],
+            natcap.opal.tests.COLOMBIA_SRS, {'pop_center': str},
+            [{'pop_center': 'a'}, {'pop_center': 'b'}],
+            format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'servicesheds.shp'))
+        offsets_uri = natcap.opal.tests.vector(
+            [square((10, 5), 2), square((15, 5), 2)],
+            natcap.opal.tests.COLOMBIA_SRS,
+            {'ecosystem': str, 'nutrient': float},
+            [{'ecosystem': 'x', 'nutrient': 1.5},
+             {'ecosystem': 'y', 'nutrient': 2.5}],
+            format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'offsets.shp'))
+
+        overlap, sshed_names, overlap_matrix = analysis.percent_overlap(
+            offsets_uri, servicesheds_uri,
+            os.path.join(self.workspace, 'temp.shp'), 'pop_center',
+            sparse=True)
+
+        self.assertEqual(overlap, {
+            0: {'Area': 4.0, 'Ecosystem': 'x', 'Nitrogen': 1.5,
+                'municipalities': {'a': 0.5, 'b': 0.5}},
+            1: {'Area': 4.0, 'Ecosystem': 'y', 'Nitrogen': 2.5,
+                'municipalities': {'b': 1.0}},
+        })
+        self.assertEqual(sshed_names, ['a', 'b'])
+        self.assertEqual(overlap_matrix.toarray().tolist(),
+            [[0.5, 0.5], [0.0, 1.0]])
+
+    def test_calculate_biodiversity_impact(self):
+        # Two overlapping impact sites straddle two parcels of the same
+        # ecosystem.  The overlap must only be counted once.
+        impacts_uri = natcap.opal.tests.vector(
+            [square((10, 5), 4), square((11, 5), 4)],
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'impacts.shp'))
+        parcels_uri = natcap.opal.tests.vector(
+            [square((5, 5), 10), square((15, 5), 10), square((45, 5), 10)],
+            natcap.opal.tests.COLOMBIA_SRS,
+            {'ecosystem': str, 'mit_ratio': float, 'LCI': float},
+            [{'ecosystem': 'x', 'mit_ratio': 2.0, 'LCI': 0.5},
+             {'ecosystem': 'x', 'mit_ratio': 1.0, 'LCI': 0.7},
+             {'ecosystem': 'y', 'mit_ratio': 1.0, 'LCI': 0.1}],
+            format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'parcels.shp'))
+
+        impacts = analysis.calculate_biodiversity_impact(impacts_uri,
+            parcels_uri)
+
+        self.assertEqual(impacts.keys(), ['x'])
+        expected = {
+            'impacted_area': 0.002,
+            'mitigation_area': 0.0028,
+            'mitigation_ratio': 1.4,
+            'min_impacted_parcel_area': 0.01,
+            'min_lci': 0.7,
+        }
+        for key, value in expected.iteritems():
+            self.assertAlmostEqual(impacts['x'][key], value)
+        self.assertEqual(impacts['x']['patches_impacted'], 2)
+        self.assertEqual(impacts['x']['max_threat'], None)
+        self.assertEqual(impacts['x']['min_richness'], None)
+
+    def test_overlap_areas(self):
+        # The first polygon overlaps the two on the right, and only touches
+        # the one below it.
+        vector_a_uri = natcap.opal.tests.vector(
+            [square((10, 5), 4), square((40, 5), 2)],
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'a.shp'))
+        vector_b_uri = natcap.opal.tests.vector(
+            [square((5, 5), 10), square((15, 5), 10), square((10, -2), 10)],
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile',
+            filename=os.path.join(self.workspace, 'b.shp'))
+
+        self.assertEqual(analysis.overlap_areas(vector_a_uri, vector_b_uri),
+            {0: {0: 8.0, 1: 8.0}})
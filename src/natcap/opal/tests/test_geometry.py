@@ -0,0 +1,40 @@
+import unittest
+
+import numpy
+from shapely.geometry import MultiPolygon
+from shapely.geometry import Point
+
+from natcap.opal.tests.test_smoke import square
+from natcap.opal import geometry
+
+
+class GeometryTest(unittest.TestCase):
+    def test_as_array(self):
+        # multi-part geometries must not be unpacked into the array.
+        multipolygon = MultiPolygon([square((0, 0), 1), square((5, 5), 1)])
+        array = geometry.as_array([multipolygon, Point(1, 1)])
+        self.assertEqual(array.shape, (2,))
+        self.assertEqual(array[0], multipolygon)
+        self.assertEqual(geometry.as_array(multipolygon).shape, ())
+
+    def test_elementwise(self):
+        polygons = geometry.as_array([square((0, 0), 2), square((10, 0), 2)])
+        self.assertEqual(geometry.area(polygons).tolist(), [4.0, 4.0])
+        self.assertEqual(geometry.intersects(polygons,
+            square((1, 0), 2)).tolist(), [True, False])
+        self.assertEqual(geometry.area(geometry.intersection(polygons,
+            square((1, 0), 2))).tolist(), [2.0, 0.0])
+        self.assertEqual(geometry.area(geometry.difference(polygons,
+            square((1, 0), 2))).tolist(), [2.0, 4.0])
+        self.assertEqual(geometry.distance(polygons, Point(0, 0)).tolist(),
+            [0.0, 9.0])
+        self.assertEqual(geometry.bounds(geometry.buffer(polygons, 1)).tolist(),
+            [[-2, -2, 2, 2], [8, -2, 12, 2]])
+
+    def test_intersecting_pairs(self):
+        polygons_a = [square((0, 0), 2), square((10, 0), 2), square((5, 0), 8)]
+        polygons_b = [square((1, 0), 2), square((20, 0), 2), square((10, 0), 1)]
+        indices_a, indices_b = geometry.intersecting_pairs(polygons_a,
+            polygons_b)
+        self.assertEqual(zip(indices_a, indices_b),
+            [(0, 0), (1, 2), (2, 0)])
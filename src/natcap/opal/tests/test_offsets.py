@@ -1,7 +1,11 @@
 import unittest
 import os
+import random
 import shutil
+import time
 
+import numpy
+import scipy.sparse
 from shapely.geometry import Polygon
 
 from natcap.opal.tests import vector, COLOMBIA_SRS
@@ -200,6 +204,133 @@ class OffsetTest(unittest.TestCase):
             bio_requirements, es_requirements, global_reqs)
         self.assertEqual(expected_parcels, selected_parcels)
 
+    def test_select_set_optimal(self):
+        parcels_dict = {
+            1: {'area': 400, 'carbon': 3500, 'sediment': 290, 'ecosystem': 'a'},
+            2: {'area': 123, 'carbon': 382, 'sediment': 1348, 'ecosystem': 'a'},
+            3: {'area': 8392, 'carbon': 1910, 'sediment': 18234, 'ecosystem': 'b'},
+            4: {'area': 149, 'carbon': 192, 'sediment': 1019, 'ecosystem': 'b'},
+        }
+
+        bio_requirements = {
+            'a': {
+                'mitigation_area': 200,
+            },
+            'b': {
+                'mitigation_area': 100,
+            }
+        }
+
+        es_requirements = {
+            1: {
+                'sediment': 2500,
+                'parcels': [1, 2, 3],
+            }
+        }
+
+        global_reqs = {
+            'carbon': 4000,
+            'sediment': 500,
+        }
+
+        # The greedy selection is [1, 3] for biodiversity and [1, 2, 3, 4]
+        # for all three requirements.
+        self.assertEqual(offsets.select_set_optimal(parcels_dict,
+            bio_requirements), [1, 4])
+        self.assertEqual(offsets.select_set_optimal(parcels_dict,
+            bio_requirements, es_requirements, global_reqs), [1, 3])
+        self.assertEqual(offsets.select_set_optimal(parcels_dict,
+            bio_requirements, objective='count'), [1, 3])
+
+    def test_select_set_optimal_time_budget(self):
+        # A problem far too large to solve to optimality in the budget.
+        generator = random.Random(0)
+        ecosystems = ['ecosystem_%s' % index for index in xrange(20)]
+        parcels_dict = {}
+        for parcel_id in xrange(3000):
+            parcels_dict[parcel_id] = {
+                'area': generator.uniform(1, 100),
+                'ecosystem': generator.choice(ecosystems),
+                'sediment': generator.uniform(0, 10),
+                'carbon': generator.uniform(0, 20),
+            }
+        bio_requirements = dict((ecosystem,
+            {'mitigation_area': generator.uniform(100, 2000)})
+            for ecosystem in ecosystems)
+        es_requirements = dict((sshed_id, {
+            'sediment': generator.uniform(10, 200),
+            'parcels': generator.sample(parcels_dict.keys(), 300),
+        }) for sshed_id in xrange(30))
+        global_reqs = {'carbon': 1000}
+
+        greedy_parcels = offsets.select_set_multifactor(parcels_dict,
+            bio_requirements, es_requirements, global_reqs)
+
+        # With no time at all, the greedy selection is returned.
+        self.assertEqual(offsets.select_set_optimal(parcels_dict,
+            bio_requirements, es_requirements, global_reqs, time_budget=0),
+            greedy_parcels)
+
+        # Running out of time returns a selection at least as good as the
+        # greedy one.
+        selected_parcels = offsets.select_set_optimal(parcels_dict,
+            bio_requirements, es_requirements, global_reqs, time_budget=0.5)
+        self.assertLessEqual(
+            sum(parcels_dict[parcel]['area'] for parcel in selected_parcels),
+            sum(parcels_dict[parcel]['area'] for parcel in greedy_parcels))
+
+    def test_solve_covering_lp(self):
+        # Cover the edges of a triangle with its vertices: the relaxation
+        # takes half of every vertex, for a cost of 1.5.
+        coverage = scipy.sparse.csr_matrix(numpy.array([
+            [1., 1., 0.],
+            [0., 1., 1.],
+            [1., 0., 1.]]))
+        cost, solution = offsets._solve_covering_lp(coverage,
+            numpy.ones(3), numpy.ones(3), time.time() + 60)
+        self.assertLessEqual(cost, 1.5 + 1e-12)
+        self.assertAlmostEqual(cost, 1.5, places=6)
+        self.assertTrue(numpy.allclose(solution, 0.5, atol=1e-6))
+
+        # minimize x0 + x1 subject to 2 x0 + x1 >= 3: without the upper
+        # bounds the optimum would be x0 = 1.5, for a cost of 1.5.
+        cost, solution = offsets._solve_covering_lp(
+            scipy.sparse.csr_matrix(numpy.array([[2., 1.]])), numpy.ones(2),
+            numpy.array([3.]), time.time() + 60)
+        self.assertLessEqual(cost, 2.0 + 1e-12)
+        self.assertAlmostEqual(cost, 2.0, places=6)
+        self.assertTrue(numpy.allclose(solution, [1, 1], atol=1e-6))
+
+        # Nothing is solved once the deadline has passed.
+        self.assertEqual(offsets._solve_covering_lp(coverage, numpy.ones(3),
+            numpy.ones(3), time.time()), (None, None))
+
+    def test_parcel_table(self):
+        per_offset_data = {
+            1: {'Area': 20000.0, 'Carbon': 3.0, 'Sediment': None,
+                'Ecosystem': 'a', 'municipalities': {'x': 0.5, 'y': 0.25}},
+            2: {'Area': 10000.0, 'Nitrogen': 2.0, 'Ecosystem': 'b',
+                'municipalities': {}},
+        }
+        expected_parcels = {
+            1: {'area': 2.0, 'carbon': 3.0, 'sediment': None,
+                'ecosystem': 'a', 'overlap': {'x': 0.5, 'y': 0.25}},
+            2: {'area': 1.0, 'nutrient': 2.0, 'ecosystem': 'b',
+                'overlap': {}},
+        }
+        table = offsets.ParcelTable.from_per_offset_data(per_offset_data)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.to_dict(), expected_parcels)
+        self.assertEqual(offsets.translate_parcel_data(per_offset_data),
+            expected_parcels)
+        self.assertEqual(table.values('sediment').tolist(), [0.0, 0.0])
+        self.assertEqual(table.ecosystem_rows('b').tolist(), [1])
+        self.assertEqual(table.sshed_overlap.shape, (2, 2))
+
+        # Selection accepts a ParcelTable as well as a dict.
+        self.assertEqual(offsets.select_set_multifactor(table,
+            {'a': {'mitigation_area': 1.5}}), [1])
+
     def test_select_set(self):
         parcels_dict = {
             1: {'area': 400, 'carbon': 3500, 'sediment': 290},
@@ -233,6 +364,71 @@ class OffsetTest(unittest.TestCase):
 
         self.assertEqual(offsets.select_set(parcels, requirements), [2, 3, 4])
 
+    def test_select_set_ties(self):
+        # Parcels with equal values are taken in order of parcel ID, whatever
+        # order the parcels are given in.
+        parcels = {
+            9: {'area': 10, 'ecosystem': 'a'},
+            1: {'area': 10, 'ecosystem': 'a'},
+            17: {'area': 10, 'ecosystem': 'a'},
+            4: {'area': 5, 'ecosystem': 'a'},
+        }
+        self.assertEqual(offsets.select_set(parcels, [('area', 15)]), [1, 9])
+        self.assertEqual(offsets.select_set_multifactor(parcels,
+            {'a': {'mitigation_area': 15}}), [1, 9])
+        self.assertEqual(offsets.select_set_multifactor(parcels,
+            es_global_req={'area': 15}), [1, 9])
+
+    def test_intersection_oracle(self):
+        aoi = vector([test_smoke.square((20, 20), 10)], COLOMBIA_SRS,
+            format='ESRI Shapefile')
+        city = vector([test_smoke.square((60, 20), 10),
+            test_smoke.square((100, 20), 10)], COLOMBIA_SRS,
+            format='ESRI Shapefile')
+        parcels = [
+            test_smoke.square((24, 20), 2),  # within the AOI
+            test_smoke.square((80, 20), 2),  # intersects neither
+            test_smoke.square((106, 20), 2),  # touches the second city
+        ]
+
+        oracle = offsets.IntersectionOracle({'City': city, 'AOI': aoi})
+        self.assertEqual(oracle.names, ['AOI', 'City'])
+        self.assertEqual(oracle.query(parcels).tolist(), [
+            [True, False],
+            [False, False],
+            [False, True],
+        ])
+        for parcel in parcels:
+            for name, uri in [('AOI', aoi), ('City', city)]:
+                self.assertEqual(oracle.intersects(parcel, name),
+                    offsets.poly_intersects_vector(parcel, uri))
+
+    def test_distance_engine(self):
+        impacts = [
+            test_smoke.square((0, 0), 10),
+            test_smoke.square((100, 0), 10),
+        ]
+        parcels = [
+            test_smoke.square((20, 0), 10),
+            test_smoke.square((70, 0), 2),
+        ]
+
+        centroid_engine = offsets.DistanceEngine(impacts,
+            offsets.DISTANCE_CENTROID)
+        self.assertEqual(centroid_engine.nearest_distances(parcels).tolist(),
+            [20.0, 30.0])
+        self.assertEqual(centroid_engine.all_distances(parcels[0]).tolist(),
+            [20.0, 80.0])
+
+        edge_engine = offsets.DistanceEngine(impacts, offsets.DISTANCE_EDGE)
+        self.assertEqual(edge_engine.nearest_distances(parcels).tolist(),
+            [10.0, 24.0])
+        self.assertEqual(edge_engine.all_distances(parcels[0]).tolist(),
+            [10.0, 70.0])
+
+        self.assertRaises(ValueError, offsets.DistanceEngine, impacts,
+            'bad metric')
+
     def test_locate_biodiversity_offsets(self):
         eco_a = test_smoke.square((20, 20), 10)
         eco_b = test_smoke.square((60, 20), 10)
@@ -396,6 +592,60 @@ class OffsetTest(unittest.TestCase):
         self.assertEqual(offset_tuple, ([0, 2], {}))
 
 
+    def test_select_offsets_threat_richness(self):
+        ecosystems_polygons = [test_smoke.square((x, 20), 10)
+                               for x in [20, 60, 100, 140]]
+        ecosystems_fields = {
+            'ecosystem': str,
+            'LCI': float,
+            'carbon': float,
+            'Threat': float,
+            'Richness': float,
+        }
+        # Fields left out of a feature are unset, so GetField returns None.
+        ecosystems_attributes = [
+            {'ecosystem': 'eco_a', 'LCI': 0.1, 'carbon': 1.0,
+                'Threat': 0.2, 'Richness': 0.5},
+            # No threat value: meets the threat requirement.
+            {'ecosystem': 'eco_a', 'LCI': 0.1, 'carbon': 1.0,
+                'Richness': 0.5},
+            # Too threatened.
+            {'ecosystem': 'eco_a', 'LCI': 0.1, 'carbon': 1.0,
+                'Threat': 0.9, 'Richness': 0.5},
+            # No richness value: does not meet the richness requirement.
+            {'ecosystem': 'eco_a', 'LCI': 0.1, 'carbon': 1.0,
+                'Threat': 0.2},
+        ]
+        ecosystems_vector = vector(ecosystems_polygons, COLOMBIA_SRS,
+            ecosystems_fields, ecosystems_attributes, format='ESRI Shapefile')
+        biodiversity_impacts = {
+                'eco_a': {
+                    'min_impacted_parcel_area': 50,
+                    'min_lci': 0.1,
+                    'max_threat': 0.5,
+                    'min_richness': 0.4,
+                    'mitigation_area': 125.0,
+                }
+            }
+
+        impact_parcels_vector = vector([test_smoke.square((40, 50), 10)],
+            COLOMBIA_SRS, {'carbon': float}, [{'carbon': 1.0}],
+            format='ESRI Shapefile')
+
+        output_workspace = os.path.join(os.getcwd(), 'test_select_offsets')
+        output_vector = os.path.join(output_workspace, 'output_vector.shp')
+        output_json = os.path.join(output_workspace, 'output_json.json')
+
+        if os.path.exists(output_workspace):
+            shutil.rmtree(output_workspace)
+        os.makedirs(output_workspace)
+
+        offset_tuple = offsets._select_offsets(ecosystems_vector,
+            impact_parcels_vector, biodiversity_impacts, output_vector,
+            output_json, services=['carbon'])
+
+        self.assertEqual(sorted(offset_tuple[0]), [0, 1])
+
     def test_select_offsets_no_impacts(self):
         ecosystems_polygons = map(lambda x: test_smoke.square((x, 20), 10), [20, 60,
             100, 140])
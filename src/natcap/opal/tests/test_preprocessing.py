@@ -4,6 +4,7 @@ import shutil
 import os
 import glob
 
+import numpy
 import shapely.wkt
 import shapely.ops
 from shapely.geometry import Polygon, MultiPolygon, LineString, MultiLineString
@@ -208,6 +209,47 @@ class PreprocessingTest(unittest.TestCase):
 
         shutil.rmtree(temp_dir)
 
+    def test_prepare_impact_sites_geopackage(self):
+        # Impact sites split into GeoPackages should have the same geometries
+        # and fields as when split into shapefiles.
+        impact_a = Polygon([(5, 3), (10, 3), (10, 5), (5, 5), (5, 3)])
+        impacts_vector = natcap.opal.tests.vector([impact_a],
+            natcap.opal.tests.COLOMBIA_SRS, {'category': str},
+            [{'category': 'road'}], format='ESRI Shapefile')
+
+        subzone_a = Polygon([(1, 1), (8, 1), (8, 7), (1, 7), (1, 1)])
+        subzone_b = Polygon([(8, 1), (14, 1), (14, 8), (8, 8), (8, 1)])
+        subzones_vector = natcap.opal.tests.vector([subzone_a, subzone_b],
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile',
+            fields={'zone': str}, features=[{'zone': 'A'}, {'zone': 'B'}])
+
+        temp_dir = tempfile.mkdtemp()
+        impact_data = preprocessing.prepare_impact_sites(impacts_vector,
+            subzones_vector, temp_dir, vector_format='GPKG')
+        self.assertEqual(sorted(d['name'] for d in impact_data), ['A', 'B'])
+
+        geom_a = Polygon([(5, 3), (8, 3), (8, 5), (5, 5), (5, 3)])
+        geom_b = Polygon([(8, 3), (10, 3), (10, 5), (8, 5), (8, 3)])
+        for zone, impact_geom in [('A', geom_a), ('B', geom_b)]:
+            impact_filename = os.path.join(temp_dir, 'impacts_%s.gpkg' % zone)
+            self.assertEqual(glob.glob(os.path.join(temp_dir,
+                'impacts_%s.*' % zone)), [impact_filename])
+
+            impact_vector = ogr.Open(impact_filename)
+            impact_layer = impact_vector.GetLayer()
+            self.assertEqual(impact_layer.GetFeatureCount(), 1)
+
+            # GeoPackage feature IDs start at 1, so don't assume FID 0.
+            feature = impact_layer.GetNextFeature()
+            self.assertEqual(feature.GetField('category'), 'road')
+            shapely_feature = utils.build_shapely_polygon(feature)
+            self.assertEqual(impact_geom.symmetric_difference(
+                shapely_feature).area, 0.0)
+            impact_layer = None
+            impact_vector = None
+
+        shutil.rmtree(temp_dir)
+
     def test_union_by_attribute(self):
         # build a sample vector
         polygon_a = Polygon([(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)])
@@ -273,3 +315,204 @@ class PreprocessingTest(unittest.TestCase):
         # to compare OGR layer operations against per-polygon operations.
 
 
+    def test_locate_intersecting_polygons_indexed(self):
+        # The indexed and unindexed modes should produce the same vectors.
+        source_polygons = [Polygon([(x, y), (x + 2, y), (x + 2, y + 2),
+            (x, y + 2), (x, y)]) for x in range(0, 20, 2)
+            for y in range(0, 20, 2)]
+        source_uri = natcap.opal.tests.vector(source_polygons,
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile')
+
+        comparison_polygons = [
+            Polygon([(1, 1), (7, 1), (7, 3), (1, 3), (1, 1)]),
+            Polygon([(4.5, 4.5), (5.5, 4.5), (5.5, 5.5), (4.5, 5.5),
+                (4.5, 4.5)]),
+            Polygon([(12, 12), (16, 12), (16, 16), (12, 12)]),
+        ]
+        comparison_uri = natcap.opal.tests.vector(comparison_polygons,
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile')
+
+        out_dir = tempfile.mkdtemp()
+        for clip in [False, True]:
+            found_geometries = []
+            for spatial_index in [False, True]:
+                out_uri = os.path.join(out_dir, 'out_%s_%s.shp' % (clip,
+                    spatial_index))
+                preprocessing.locate_intersecting_polygons(source_uri,
+                    comparison_uri, out_uri, clip=clip,
+                    spatial_index=spatial_index)
+
+                out_vector = ogr.Open(out_uri)
+                out_layer = out_vector.GetLayer()
+                found_geometries.append([
+                    utils.build_shapely_polygon(feature)
+                    for feature in out_layer])
+                out_layer = None
+                out_vector = None
+
+            brute_force, indexed = found_geometries
+            self.assertTrue(len(brute_force) > 0)
+            self.assertEqual(len(brute_force), len(indexed))
+            for brute_geom, indexed_geom in zip(brute_force, indexed):
+                self.assertTrue(brute_geom.equals(indexed_geom))
+
+        shutil.rmtree(out_dir)
+
+    def test_subtract_vectors_indexed(self):
+        # The indexed subtraction should remove the same area as subtracting
+        # one subtrahend polygon at a time.
+        minuend_polygons = [
+            Polygon([(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]),
+            Polygon([(20, 0), (30, 0), (30, 10), (20, 10), (20, 0)]),
+            Polygon([(40, 0), (42, 0), (42, 2), (40, 2), (40, 0)]),
+        ]
+        minuend_uri = natcap.opal.tests.vector(minuend_polygons,
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile')
+
+        subtrahend_polygons = [
+            Polygon([(-5, -5), (5, -5), (5, 5), (-5, 5), (-5, -5)]),
+            Polygon([(3, 3), (8, 3), (8, 8), (3, 8), (3, 3)]),
+            Polygon([(39, -1), (43, -1), (43, 3), (39, 3), (39, -1)]),
+        ]
+        subtrahend_uri = natcap.opal.tests.vector(subtrahend_polygons,
+            natcap.opal.tests.COLOMBIA_SRS, format='ESRI Shapefile')
+
+        out_dir = tempfile.mkdtemp()
+        found_geometries = []
+        for spatial_index in [False, True]:
+            out_uri = os.path.join(out_dir, 'difference_%s.shp' %
+                spatial_index)
+            preprocessing.subtract_vectors(minuend_uri, subtrahend_uri,
+                out_uri, spatial_index=spatial_index)
+
+            out_vector = ogr.Open(out_uri)
+            out_layer = out_vector.GetLayer()
+            found_geometries.append([utils.build_shapely_polygon(feature)
+                for feature in out_layer])
+            out_layer = None
+            out_vector = None
+
+        brute_force, indexed = found_geometries
+        # the third minuend polygon is entirely removed.
+        self.assertEqual(len(brute_force), 2)
+        self.assertEqual(len(indexed), 2)
+        for brute_geom, indexed_geom in zip(brute_force, indexed):
+            self.assertAlmostEqual(brute_geom.symmetric_difference(
+                indexed_geom).area, 0.0)
+        self.assertAlmostEqual(indexed[0].area, 54.0)
+
+        shutil.rmtree(out_dir)
+
+    def test_calculate_parcel_lci(self):
+        # The LCI should match removing neighbors from the buffer ring one at
+        # a time, even when the neighbors overlap one another.
+        parcel = Polygon([(0, 0), (100, 0), (100, 100), (0, 100), (0, 0)])
+        nearby_polygons = [
+            Polygon([(100, 0), (400, 0), (400, 100), (100, 100), (100, 0)]),
+            Polygon([(300, -50), (700, -50), (700, 50), (300, 50),
+                (300, -50)]),
+            Polygon([(-300, 200), (0, 200), (0, 400), (-300, 400),
+                (-300, 200)]),
+            # too far away to be in the buffer ring.
+            Polygon([(2000, 2000), (2100, 2000), (2100, 2100), (2000, 2100),
+                (2000, 2000)]),
+        ]
+
+        buffer_geom = parcel.buffer(500).difference(parcel)
+        expected_geom = buffer_geom
+        for polygon in nearby_polygons:
+            expected_geom = expected_geom.difference(polygon)
+        expected_lci = 1 - (expected_geom.area / buffer_geom.area)
+
+        lci = preprocessing.calculate_parcel_lci(parcel, nearby_polygons)
+        self.assertAlmostEqual(lci, expected_lci)
+        self.assertTrue(0 < lci < 1)
+
+        # With no neighbors, none of the ring is covered.
+        self.assertEqual(preprocessing.calculate_parcel_lci(parcel, []), 0.)
+
+    def test_calculate_lci_n_workers(self):
+        # LCI values and feature order should not depend on the number of
+        # workers used.
+        polygons = []
+        for x in range(0, 3000, 250):
+            for y in range(0, 3000, 400):
+                polygons.append(Polygon([(x, y), (x + 200, y),
+                    (x + 200, y + 150), (x, y + 150), (x, y)]))
+        fields = {'parcel_id': int}
+        features = [{'parcel_id': i} for i in range(len(polygons))]
+        parcels_uri = natcap.opal.tests.vector(polygons,
+            natcap.opal.tests.COLOMBIA_SRS, fields, features,
+            format='ESRI Shapefile')
+
+        out_dir = tempfile.mkdtemp()
+        found_values = []
+        for n_workers in [None, 3]:
+            out_uri = os.path.join(out_dir, 'lci_%s.shp' % n_workers)
+            preprocessing.calculate_lci(parcels_uri, out_uri,
+                n_workers=n_workers)
+
+            out_vector = ogr.Open(out_uri)
+            out_layer = out_vector.GetLayer()
+            found_values.append([(feature.GetField('parcel_id'),
+                feature.GetField('LCI')) for feature in out_layer])
+            out_layer = None
+            out_vector = None
+
+        serial_values, parallel_values = found_values
+        self.assertEqual(len(serial_values), len(polygons))
+        self.assertEqual([p_id for (p_id, _) in serial_values],
+            range(len(polygons)))
+        self.assertEqual(serial_values, parallel_values)
+
+        shutil.rmtree(out_dir)
+
+    def test_calculate_lci_memory_limit(self):
+        # Reading the parcels in small tiles should give each parcel to
+        # exactly one tile and should not change the LCI values.
+        polygons = []
+        for x in range(0, 3000, 250):
+            for y in range(0, 3000, 400):
+                polygons.append(Polygon([(x, y), (x + 200, y),
+                    (x + 200, y + 150), (x, y + 150), (x, y)]))
+        fields = {'parcel_id': int}
+        features = [{'parcel_id': i} for i in range(len(polygons))]
+        parcels_uri = natcap.opal.tests.vector(polygons,
+            natcap.opal.tests.COLOMBIA_SRS, fields, features,
+            format='ESRI Shapefile')
+
+        reader = utils.TiledVectorReader(parcels_uri, memory_limit=1000)
+        tiled_fids = sorted(int(reader.fids[position])
+            for tile in reader.tiles() for position in tile)
+        self.assertEqual(tiled_fids, range(len(polygons)))
+        self.assertTrue(len(list(reader.tiles())) > 1)
+
+        # Each tile's context has its core features once, plus only the
+        # features near the tile.
+        for core, context in reader.iter_tiles(halo=100):
+            core_fids = [fid for (fid, _, _) in core]
+            context_fids = [fid for (fid, _, _) in context]
+            self.assertEqual(context_fids, sorted(set(context_fids)))
+            self.assertTrue(set(core_fids) <= set(context_fids))
+            near_fids = reader.fids[reader.near(
+                numpy.nonzero(numpy.in1d(reader.fids, core_fids))[0], 100)]
+            self.assertEqual(context_fids, sorted(near_fids.tolist()))
+        reader.close()
+
+        out_dir = tempfile.mkdtemp()
+        found_values = []
+        for memory_limit in [None, 1000]:
+            out_uri = os.path.join(out_dir, 'lci_%s.shp' % memory_limit)
+            preprocessing.calculate_lci(parcels_uri, out_uri,
+                memory_limit=memory_limit)
+
+            out_vector = ogr.Open(out_uri)
+            out_layer = out_vector.GetLayer()
+            found_values.append([(feature.GetField('parcel_id'),
+                feature.GetField('LCI')) for feature in out_layer])
+            out_layer = None
+            out_vector = None
+
+        self.assertEqual(found_values[0], found_values[1])
+
+        shutil.rmtree(out_dir)
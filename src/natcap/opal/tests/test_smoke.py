@@ -6,6 +6,7 @@ import shutil
 import inspect
 
 from shapely.geometry import Polygon
+from osgeo import ogr
 import invest_natcap.testing
 import numpy
 
@@ -57,6 +58,38 @@ def named_workspace(clean=True, index=1):
         shutil.rmtree(dir_name)
     return dir_name
 
+def hydrozone_outputs(workspace):
+    """Read the tables and vectors that adept_core.execute() wrote for each
+    hydrozone.  Paths in the tables are made relative to the workspace, so
+    the outputs of runs in different workspaces can be compared.
+
+    Returns a dict mapping the path of each output (relative to the results
+    folder) to its contents.  The contents of a JSON or CSV file are its
+    text, and the contents of a vector are a list of the WKT and field values
+    of each of its features."""
+    results_dir = os.path.join(workspace, 'results')
+    outputs = {}
+    for dirpath, _, filenames in os.walk(results_dir):
+        for filename in filenames:
+            uri = os.path.join(dirpath, filename)
+            extension = os.path.splitext(filename)[1]
+            if extension in ['.json', '.csv']:
+                contents = open(uri).read().replace(
+                    os.path.abspath(workspace), '<workspace>')
+            elif extension == '.shp':
+                vector = ogr.Open(uri)
+                contents = []
+                for feature in vector.GetLayer():
+                    geometry = feature.GetGeometryRef()
+                    if geometry is not None:
+                        geometry = geometry.ExportToWkt()
+                    contents.append((geometry, feature.items()))
+                vector = None
+            else:
+                continue
+            outputs[os.path.relpath(uri, results_dir)] = contents
+    return outputs
+
 class SmokeTest(invest_natcap.testing.GISTest):
     def setUp(self):
         natcap.opal.i18n.language.set('en')
@@ -298,6 +331,38 @@ class SmokeTest(invest_natcap.testing.GISTest):
         print natcap.opal.i18n.language.available_langs
         print natcap.opal.i18n.LOCALE_DIR
 
+    def test_hydrozone_workers(self):
+        # Split the search area into two hydrozones that are both impacted.
+        # Processing them in worker processes gives the same outputs as
+        # processing them one at a time.
+        subzones = subdivide(Polygon([(0, 0), (0, 40000), (20000, 40000),
+            (20000, 0), (0, 0)]), 5000)
+        zone_names = [{'zone': 'Hydrozone_A'} if subzone.centroid.x < 10000
+            else {'zone': 'Hydrozone_B'} for subzone in subzones]
+        self.args['search_areas_uri'] = vector(subzones, COLOMBIA_SRS,
+            {'zone': str}, zone_names, format='ESRI Shapefile')
+
+        adept_core.execute(dict(self.args))
+        serial_outputs = hydrozone_outputs(self.workspace)
+
+        parallel_workspace = tempfile.mkdtemp()
+        try:
+            self.args['workspace_dir'] = parallel_workspace
+            self.args['n_workers'] = 2
+            adept_core.execute(dict(self.args))
+            parallel_outputs = hydrozone_outputs(parallel_workspace)
+        finally:
+            shutil.rmtree(parallel_workspace)
+            self.args['workspace_dir'] = self.workspace
+
+        self.assertEqual(sorted(set(path.split(os.sep)[0]
+            for path in serial_outputs if os.sep in path)),
+            ['hydrozone_a', 'hydrozone_b'])
+        self.assertEqual(sorted(parallel_outputs), sorted(serial_outputs))
+        for path in serial_outputs:
+            self.assertEqual(parallel_outputs[path], serial_outputs[path],
+                path)
+
     def test_smoke_custom_es(self):
         self.args['custom_static_maps'] = self.custom_static_data
         self.assertRaises(KeyError, adept_core.execute, self.args)
@@ -1,14 +1,18 @@
 import unittest
 import tempfile
 import os
+import shutil
 
 from osgeo import gdal
 from osgeo import osr
+from osgeo import ogr
 import numpy
+from shapely.geometry import box
 from invest_natcap.testing import GISTest
 import pygeoprocessing
 
-from adept import static_maps
+import natcap.opal.tests
+from natcap.opal import static_maps
 
 def raster(numpy_matrix, nodata):
     out_uri = pygeoprocessing.temporary_filename()
@@ -33,6 +37,18 @@ def raster(numpy_matrix, nodata):
     new_raster = None
     return out_uri
 
+def srs_wkt():
+    # the spatial reference of the rasters made by raster().
+    srs = osr.SpatialReference()
+    srs.SetUTM(11, 1)
+    srs.SetWellKnownGeogCS('NAD27')
+    return srs.ExportToWkt()
+
+def pixel_box(row, col, n_rows=1, n_cols=1):
+    # a polygon covering pixels of the rasters made by raster().
+    return box(444720 + col * 30, 3751320 - (row + n_rows) * 30,
+        444720 + (col + n_cols) * 30, 3751320 - row * 30)
+
 def get_matrix(raster_uri):
     dataset = gdal.Open(raster_uri)
     band = dataset.GetRasterBand(1)
@@ -42,6 +58,34 @@ def get_matrix(raster_uri):
     dataset = None
     return matrix
 
+def pixel_model(model_name, landcover_uri, workspace_uri, config=None):
+    # A stand-in for the InVEST models, where each pixel's value is twice its
+    # landcover code.
+    target_uri = os.path.join(workspace_uri,
+        static_maps.MODELS[model_name]['target_raster'])
+    if not os.path.exists(os.path.dirname(target_uri)):
+        os.makedirs(os.path.dirname(target_uri))
+
+    lulc_raster = gdal.Open(landcover_uri)
+    lulc_band = lulc_raster.GetRasterBand(1)
+    lulc_values = lulc_band.ReadAsArray().astype(numpy.float32)
+    values = numpy.where(lulc_values == lulc_band.GetNoDataValue(), -1,
+        lulc_values * 2)
+
+    driver = gdal.GetDriverByName('GTiff')
+    target_raster = driver.Create(target_uri, lulc_raster.RasterXSize,
+        lulc_raster.RasterYSize, 1, gdal.GDT_Float32)
+    target_raster.SetProjection(lulc_raster.GetProjection())
+    target_raster.SetGeoTransform(lulc_raster.GetGeoTransform())
+    target_band = target_raster.GetRasterBand(1)
+    target_band.SetNoDataValue(-1)
+    target_band.WriteArray(values)
+
+    target_band = None
+    target_raster = None
+    lulc_band = None
+    lulc_raster = None
+
 class StaticMapsTest(GISTest):
     def setUp(self):
         self._temp_files = []
@@ -106,3 +150,312 @@ class StaticMapsTest(GISTest):
 
         workspace_folder = pygeoprocessing.temporary_folder()
         static_maps.execute_model('carbon', lulc_uri, workspace_folder)
+
+    def test_execute_future_landcover(self):
+        # As in build_static_map() with convert_landcover=False, the future
+        # scenario's model runs on the current landcover, and the future
+        # landcover is only used by its simulations.
+        lulc_uri = raster(numpy.matrix([
+            [5, 5, 5],
+            [4, 3, 1],
+            [6, 4, 1]]), -1)
+        future_uri = raster(numpy.matrix([
+            [5, 5, 5],
+            [5, 5, 5],
+            [6, 4, 1]]), -1)
+        workspace = tempfile.mkdtemp()
+
+        model_runs = []
+        def _record_model_run(model_name, landcover_uri, workspace_uri,
+                config=None):
+            model_runs.append((landcover_uri, workspace_uri))
+            target_uri = os.path.join(workspace_uri,
+                static_maps.MODELS[model_name]['target_raster'])
+            if not os.path.exists(os.path.dirname(target_uri)):
+                os.makedirs(os.path.dirname(target_uri))
+            shutil.copyfile(landcover_uri, target_uri)
+
+        execute_model = static_maps.execute_model
+        static_maps.execute_model = _record_model_run
+        try:
+            static_maps.execute({
+                'workspace_dir': workspace,
+                'landuse_uri': lulc_uri,
+                'paved_landcover_code': 7,
+                'bare_landcover_code': 8,
+                'model_name': 'carbon',
+                'future_type': 'protection',
+                'fut_landuse_uri': future_uri,
+            })
+        finally:
+            static_maps.execute_model = execute_model
+
+        future_workspace = os.path.join(workspace, 'protect')
+        self.assertEqual([landcover_uri for (landcover_uri, workspace_uri)
+            in model_runs if workspace_uri.startswith(future_workspace)],
+            [lulc_uri])
+        self.assertTrue(os.path.exists(os.path.join(workspace,
+            'carbon_protect_static_map.tif')))
+
+        shutil.rmtree(workspace)
+
+    def test_aggregate_test_results_unchanged_export(self):
+        # An impact that doesn't change the watershed's export has an InVEST
+        # estimate of 0, which must not raise ZeroDivisionError.
+        export_matrix = numpy.matrix([
+            [1, 2, 3],
+            [4, 5, 6],
+            [7, 8, 9]], dtype=numpy.float32)
+        base_export_uri = raster(export_matrix, -1)
+        static_map_uri = raster(numpy.ones((3, 3), dtype=numpy.float32), -1)
+        watershed_uri = natcap.opal.tests.vector([pixel_box(0, 0, 3, 3)],
+            srs_wkt(), {'ws_id': int}, [{'ws_id': 3}],
+            format='ESRI Shapefile')
+        impact_uri = natcap.opal.tests.vector([pixel_box(0, 0)], srs_wkt(),
+            {'id': int}, [{'id': 1}], format='ESRI Shapefile')
+
+        workspace = tempfile.mkdtemp()
+        export_uri = os.path.join(workspace,
+            static_maps.MODELS['carbon']['target_raster'])
+        os.makedirs(os.path.dirname(export_uri))
+        shutil.copyfile(base_export_uri, export_uri)
+
+        estimates = static_maps.aggregate_test_results(workspace, 'carbon',
+            watershed_uri, impact_uri, static_map_uri, base_export_uri,
+            invert=False)
+        self.assertEqual(estimates['invest_est'], 0)
+        self.assertEqual(estimates['static_est'], 1)
+        self.assertEqual(estimates['export_ratio'], float('inf'))
+        self.assertEqual(estimates['base_export'], 45)
+
+        self.assertTrue(numpy.isnan(static_maps._divide_estimates(0, 0)))
+        self.assertEqual(static_maps._divide_estimates(-2, 0), float('-inf'))
+        self.assertEqual(static_maps._divide_estimates(3, 2), 1.5)
+
+        shutil.rmtree(workspace)
+
+    def test_make_impact_window(self):
+        # The window is the impact's bounding box, buffered and clipped to
+        # the watershed, with the watershed's ws_id.
+        watershed_uri = natcap.opal.tests.vector([pixel_box(0, 0, 10, 10)],
+            srs_wkt(), {'ws_id': int}, [{'ws_id': 7}],
+            format='ESRI Shapefile')
+        impact_uri = natcap.opal.tests.vector([pixel_box(1, 1, 2, 2)],
+            srs_wkt(), {'id': int}, [{'id': 1}], format='ESRI Shapefile')
+        window_uri = os.path.join(tempfile.mkdtemp(), 'window.shp')
+
+        static_maps.make_impact_window(impact_uri, watershed_uri, 60,
+            window_uri)
+
+        window_vector = ogr.Open(window_uri)
+        window_layer = window_vector.GetLayer()
+        self.assertEqual(window_layer.GetFeatureCount(), 1)
+        window = window_layer.GetNextFeature()
+        self.assertEqual(window.GetField('ws_id'), 7)
+        self.assertEqual(window.GetGeometryRef().GetEnvelope(),
+            (444720, 444870, 3751200, 3751320))
+        self.assertAlmostEqual(window.GetGeometryRef().Area(), 150 * 120)
+
+        window = None
+        window_layer = None
+        window_vector = None
+        shutil.rmtree(os.path.dirname(window_uri))
+
+    def _simulate_incremental_impact(self, model_name):
+        # Prepare a watershed and simulate one incremental impact in it,
+        # validated against a full run.  Returns the simulation's row, its
+        # validation row and the landcover URIs the model was run on.
+        generator = numpy.random.RandomState(0)
+        lulc_uri = raster(generator.randint(1, 6, (200, 200)).astype(
+            numpy.float32), -1)
+        watershed_uri = natcap.opal.tests.vector(
+            [pixel_box(0, 0, 200, 200)], srs_wkt(), {'ws_id': int},
+            [{'ws_id': 1}], format='ESRI Shapefile')
+        workspace = tempfile.mkdtemp()
+        base_run = os.path.join(workspace, 'base_run.tif')
+        static_map_uri = raster(numpy.ones((200, 200), dtype=numpy.float32),
+            -1)
+
+        model_runs = []
+        def _record_model_run(model_name, landcover_uri, workspace_uri,
+                config=None):
+            model_runs.append(os.path.basename(landcover_uri))
+            pixel_model(model_name, landcover_uri, workspace_uri, config)
+
+        execute_model = static_maps.execute_model
+        old_tempdir = tempfile.tempdir
+        static_maps.execute_model = _record_model_run
+        try:
+            pixel_model(model_name, lulc_uri, os.path.join(workspace, 'base'))
+            shutil.copyfile(os.path.join(workspace, 'base',
+                static_maps.MODELS[model_name]['target_raster']), base_run)
+
+            job = static_maps._prepare_quality_watershed({
+                'watershed_uri': watershed_uri,
+                'watershed_workspace': os.path.join(workspace, 'watershed'),
+                'landuse_uri': lulc_uri,
+                'base_run': base_run,
+                'base_static_map': static_map_uri,
+                'model_name': model_name,
+                'config': {},
+                'impact_lucode': 9,
+                'incremental': True,
+            })
+            job.update({
+                'watershed_id': 1,
+                'watershed_uri': watershed_uri,
+                'run_number': 0,
+                'seed': 0,
+                'impact_workspace': os.path.join(workspace, 'impact'),
+                'impact_lucode': 9,
+                'model_name': model_name,
+                'invert': False,
+                'incremental': True,
+                'window_buffer': 300,
+                'validate': True,
+            })
+            row, validation_row = static_maps._simulate_impact(job)
+        finally:
+            static_maps.execute_model = execute_model
+            tempfile.tempdir = old_tempdir
+            shutil.rmtree(workspace)
+        return row, validation_row, model_runs
+
+    def test_simulate_impact_windowed(self):
+        # Routed models are run on a window around the impact.  This model
+        # isn't really routed, so the windowed estimate matches the full one.
+        row, validation_row, model_runs = self._simulate_incremental_impact(
+            'sediment')
+        self.assertTrue('window_converted_lulc.tif' in model_runs)
+        self.assertNotEqual(validation_row[3], 0)
+        self.assertEqual(row[4], validation_row[2])
+        self.assertAlmostEqual(validation_row[2] / validation_row[3], 1.0,
+            places=5)
+        self.assertLess(abs(validation_row[4]), 1e-5)
+
+    def test_simulate_impact_local(self):
+        # Carbon isn't routed, so the impact is estimated from the base run
+        # without running the model on the impacted landcover.
+        row, validation_row, model_runs = self._simulate_incremental_impact(
+            'carbon')
+        self.assertEqual(model_runs, ['watershed_lulc.tif',
+            'legend_lulc.tif', 'converted_lulc.tif'])
+        self.assertNotEqual(validation_row[3], 0)
+        self.assertEqual(row[4], validation_row[2])
+        self.assertAlmostEqual(validation_row[2] / validation_row[3], 1.0,
+            places=5)
+
+    def test_job_seed(self):
+        # A simulation's seed only depends on the base seed and the job.
+        self.assertEqual(static_maps._job_seed(5, 1, 2),
+            static_maps._job_seed(5, 1, 2))
+        seeds = set(static_maps._job_seed(5, ws_id, run_number)
+            for ws_id in range(3) for run_number in range(10))
+        self.assertEqual(len(seeds), 30)
+        self.assertNotEqual(static_maps._job_seed(5, 1, 2),
+            static_maps._job_seed(6, 1, 2))
+
+    def test_completed_simulations(self):
+        workspace = tempfile.mkdtemp()
+        logfile_uri = os.path.join(workspace, 'impact_site_simulation.csv')
+        self.assertEqual(static_maps._completed_simulations(logfile_uri),
+            set())
+
+        # The last row has all of its fields, but was cut off before its
+        # newline, so its last value may be truncated.
+        with open(logfile_uri, 'w') as logfile:
+            logfile.write('ws_id,Impact ID,Impact Area,Static Estimate,'
+                'InVEST Estimate,Estimate Ratio\n'
+                '1,0,100.0,5.0,4.0,1.25\n'
+                '1,1,100.0,5.0,4.0,1.25\n'
+                '1,2,100.0,5.0,4.0,1.2')
+        self.assertEqual(static_maps._completed_simulations(logfile_uri),
+            set([('1', '0'), ('1', '1')]))
+
+        shutil.rmtree(workspace)
+
+    def _test_quality(self, workspace, n_workers=1, seed=1):
+        # Run the static map quality test with the stand-in model on two
+        # watersheds.  Returns the workspaces the impacted landcovers were
+        # run in and the rows of the simulation CSV.
+        generator = numpy.random.RandomState(0)
+        lulc_uri = raster(generator.randint(1, 6, (300, 300)).astype(
+            numpy.float32), -1)
+        watersheds_uri = natcap.opal.tests.vector(
+            [pixel_box(0, 0, 150, 300), pixel_box(150, 0, 150, 300)],
+            srs_wkt(), {'ws_id': int}, [{'ws_id': 1}, {'ws_id': 2}],
+            format='ESRI Shapefile')
+        static_map_uri = raster(numpy.ones((300, 300), dtype=numpy.float32),
+            -1)
+        base_workspace = tempfile.mkdtemp()
+        pixel_model('carbon', lulc_uri, base_workspace)
+        base_run = os.path.join(base_workspace,
+            static_maps.MODELS['carbon']['target_raster'])
+
+        impact_runs = []
+        def _record_model_run(model_name, landcover_uri, workspace_uri,
+                config=None):
+            if os.path.basename(landcover_uri) == 'converted_lulc.tif':
+                impact_runs.append(os.path.basename(
+                    os.path.dirname(landcover_uri)))
+            pixel_model(model_name, landcover_uri, workspace_uri, config)
+
+        execute_model = static_maps.execute_model
+        old_tempdir = tempfile.tempdir
+        static_maps.execute_model = _record_model_run
+        try:
+            static_maps.test_static_map_quality(base_run, static_map_uri,
+                lulc_uri, 9, watersheds_uri, 'carbon', workspace, {},
+                num_iterations=3, invert=False, n_workers=n_workers,
+                seed=seed)
+        finally:
+            static_maps.execute_model = execute_model
+            tempfile.tempdir = old_tempdir
+            shutil.rmtree(base_workspace)
+
+        with open(os.path.join(workspace,
+                'impact_site_simulation.csv')) as logfile:
+            rows = logfile.read().splitlines()
+        return sorted(impact_runs), rows
+
+    def test_static_map_quality_resume(self):
+        workspace = tempfile.mkdtemp()
+        impact_runs, rows = self._test_quality(workspace)
+        self.assertEqual(len(impact_runs), 6)
+        self.assertEqual(len(rows), 7)
+
+        # Cut the last row off partway, as if the run had been killed while
+        # writing it.  Only that simulation is run again.
+        logfile_uri = os.path.join(workspace, 'impact_site_simulation.csv')
+        with open(logfile_uri, 'w') as logfile:
+            logfile.write('\n'.join(rows[:-1] + [rows[-1][:-2]]))
+        ws_id, run_number = rows[-1].split(',')[:2]
+        resumed_runs, resumed_rows = self._test_quality(workspace)
+        self.assertEqual(resumed_runs, ['random_impact_%s' % run_number])
+        self.assertEqual(resumed_rows, rows)
+
+        # Nothing is run again once every simulation is recorded.
+        self.assertEqual(self._test_quality(workspace), ([], rows))
+
+        shutil.rmtree(workspace)
+
+    def test_static_map_quality_workers(self):
+        # The simulations draw the same impacts and record the same rows
+        # with any number of workers.  Rows are written in the order the
+        # simulations finish.
+        serial_workspace = tempfile.mkdtemp()
+        parallel_workspace = tempfile.mkdtemp()
+        _, serial_rows = self._test_quality(serial_workspace, n_workers=1)
+        _, parallel_rows = self._test_quality(parallel_workspace,
+            n_workers=3)
+        self.assertEqual(serial_rows[0], parallel_rows[0])
+        self.assertEqual(sorted(serial_rows[1:]), sorted(parallel_rows[1:]))
+
+        # a different base seed draws different impacts.
+        other_workspace = tempfile.mkdtemp()
+        _, other_rows = self._test_quality(other_workspace, seed=2)
+        self.assertNotEqual(sorted(serial_rows[1:]), sorted(other_rows[1:]))
+
+        for workspace in [serial_workspace, parallel_workspace,
+                other_workspace]:
+            shutil.rmtree(workspace)
@@ -1,17 +1,356 @@
 import unittest
 import time
 import os
+import json
 import sys
+import shutil
+import tempfile
 
 import natcap.opal
+import natcap.opal.tests
 from natcap.opal import utils
 
+
+def _concatenate(out_uri, *in_uris):
+    # A task for the task graph tests.  Must be module-level so that it can
+    # be run in a separate process.
+    out_file = open(out_uri, 'w')
+    for in_uri in in_uris:
+        out_file.write(open(in_uri).read())
+    out_file.write(os.path.basename(out_uri))
+    out_file.close()
+
+def _log_events(log_uri):
+    # The events written by _record_events, in order.
+    return open(log_uri).read().split()
+
+def _record_events(log_uri, name, wait_for=None, seconds=0.0,
+        timeout=30.0):
+    # A task for the task graph tests that logs when it starts and ends.  If
+    # wait_for is the name of another task, this task doesn't end until that
+    # one has started, so the two only finish if they run at the same time.
+    # The timeout only ends a task that would otherwise wait forever.
+    log_file = open(log_uri, 'a')
+    log_file.write('start:%s\n' % name)
+    log_file.close()
+
+    time.sleep(seconds)
+    if wait_for is not None:
+        deadline = time.time() + timeout
+        while 'start:%s' % wait_for not in _log_events(log_uri):
+            if time.time() > deadline:
+                raise RuntimeError('%s never started' % wait_for)
+            time.sleep(0.01)
+
+    log_file = open(log_uri, 'a')
+    log_file.write('end:%s\n' % name)
+    log_file.close()
+
 class UtilsTest(unittest.TestCase):
     def test_sigfig(self):
         self.assertEqual(utils.sigfig(123456.1234, 3), 123000.0)
         self.assertEqual(utils.sigfig(1.12345, 3), 1.12)
         self.assertEqual(utils.sigfig(1234, 3), 1230)
 
+    def test_cache_roundtrip(self):
+        workspace = tempfile.mkdtemp()
+
+        def make_file(filename, contents):
+            uri = os.path.join(workspace, filename)
+            with open(uri, 'w') as new_file:
+                new_file.write(contents)
+            return uri
+
+        # a fake multi-file dataset.
+        vector_uri = make_file('parcels.shp', 'shp')
+        make_file('parcels.dbf', 'dbf')
+        digest = utils.get_digest({'parcels': vector_uri, 'option': 1})
+
+        # files that only share the base name are not part of the dataset.
+        make_file('parcels.shp.bak', 'backup')
+        make_file('parcels.tif', 'raster')
+        self.assertEqual(utils.get_digest({'parcels': vector_uri,
+            'option': 1}), digest)
+
+        # moving the dataset doesn't change the digest, but changing any file
+        # in the dataset does.
+        moved_uri = os.path.join(workspace, 'moved', 'parcels_moved.shp')
+        os.makedirs(os.path.dirname(moved_uri))
+        utils.copy_dataset(vector_uri, moved_uri)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(moved_uri))),
+            ['parcels_moved.dbf', 'parcels_moved.shp'])
+        self.assertEqual(utils.file_digest(moved_uri),
+            utils.file_digest(vector_uri))
+        time.sleep(0.01)
+        make_file('parcels.dbf', 'new dbf')
+        self.assertNotEqual(utils.get_digest({'parcels': vector_uri,
+            'option': 1}), digest)
+
+        cache_dir = os.path.join(workspace, 'cache')
+        self.assertEqual(utils.restore_cache(cache_dir, digest,
+            {'parcels': vector_uri}), None)
+
+        utils.store_cache(cache_dir, digest, {'parcels': vector_uri},
+            {1: [0.5, 'a']})
+        restored_uri = os.path.join(workspace, 'restored', 'out.shp')
+        os.makedirs(os.path.dirname(restored_uri))
+        data = utils.restore_cache(cache_dir, digest,
+            {'parcels': restored_uri})
+
+        self.assertEqual(data, {1: [0.5, 'a']})
+        self.assertEqual(open(restored_uri).read(), 'shp')
+        self.assertEqual(open(os.path.join(workspace, 'restored',
+            'out.dbf')).read(), 'new dbf')
+        self.assertFalse(os.path.exists(os.path.join(workspace, 'restored',
+            'out.shp.bak')))
+        self.assertFalse(os.path.exists(os.path.join(workspace, 'restored',
+            'out.tif')))
+
+        shutil.rmtree(workspace)
+
+    def test_vector_writer(self):
+        from osgeo import ogr
+        from osgeo import osr
+        from natcap.opal.tests.test_smoke import square
+
+        workspace = tempfile.mkdtemp()
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(natcap.opal.tests.COLOMBIA_SRS)
+
+        for extension in ['.shp', '.gpkg']:
+            out_uri = os.path.join(workspace, 'written' + extension)
+            writer = utils.VectorWriter(out_uri, srs, batch_size=2)
+            writer.create_fields(['FID', 'long_field_name'],
+                {'FID': ogr.OFTInteger})
+            writer.add_features([square((i, i), 1) for i in range(5)],
+                {'FID': range(5),
+                 'long_field_name': [i * 0.5 for i in range(5)]})
+            writer.close()
+
+            vector = ogr.Open(out_uri)
+            layer = vector.GetLayer()
+            self.assertEqual(layer.GetFeatureCount(), 5)
+            long_field_index = layer.GetLayerDefn().GetFieldIndex(
+                writer.field_names()[1])
+            for feature in layer:
+                fid_value = feature.GetField('FID')
+                self.assertEqual(feature.GetField(long_field_index),
+                    fid_value * 0.5)
+                self.assertAlmostEqual(
+                    feature.GetGeometryRef().GetArea(), 1.0)
+            layer = None
+            vector = None
+
+        shutil.rmtree(workspace)
+
+    def test_task_graph(self):
+        workspace = tempfile.mkdtemp()
+        path = lambda name: os.path.join(workspace, name)
+
+        for n_workers in [1, 3]:
+            for filename in os.listdir(workspace):
+                os.remove(path(filename))
+
+            graph = utils.TaskGraph(n_workers, poll_interval=0.01)
+            graph.add_task('a', _concatenate, args=(path('a'),),
+                target_files=[path('a')])
+            graph.add_task('b', _concatenate, args=(path('b'), path('a')),
+                dependencies=['a'], target_files=[path('b')])
+            graph.add_task('c', _concatenate, args=(path('c'), path('a')),
+                dependencies=['a'], target_files=[path('c')])
+            graph.add_task('d', _concatenate,
+                args=(path('d'), path('b'), path('c')),
+                dependencies=['b', 'c'], target_files=[path('d')])
+
+            self.assertEqual(sorted(graph.run()), ['a', 'b', 'c', 'd'])
+            self.assertEqual(open(path('d')).read(), 'abacd')
+
+            # Nothing is rerun when the outputs are up to date, and only the
+            # downstream tasks are rerun when an output changes.
+            self.assertEqual(graph.run(), [])
+            time.sleep(1.1)
+            os.utime(path('b'), None)
+            self.assertEqual(graph.run(), ['d'])
+
+        graph = utils.TaskGraph()
+        self.assertRaises(ValueError, graph.add_task, 'a', _concatenate,
+            dependencies=['missing'])
+
+        shutil.rmtree(workspace)
+
+    def test_task_graph_processes(self):
+        workspace = tempfile.mkdtemp()
+        log_uri = os.path.join(workspace, 'events.log')
+        open(log_uri, 'w').close()
+
+        # 'pool' keeps both workers busy, so nothing else may start or end
+        # while it runs.  It runs for a moment so that a task started beside
+        # it would be logged.  a and b each wait for the other to start, so
+        # they can only finish if they run at the same time.
+        graph = utils.TaskGraph(2, poll_interval=0.01)
+        graph.add_task('pool', _record_events,
+            args=(log_uri, 'pool', None, 0.5), processes=2)
+        graph.add_task('a', _record_events, args=(log_uri, 'a', 'b'))
+        graph.add_task('b', _record_events, args=(log_uri, 'b', 'a'))
+        self.assertEqual(sorted(graph.run()), ['a', 'b', 'pool'])
+
+        events = _log_events(log_uri)
+        self.assertEqual(sorted(events), ['end:a', 'end:b', 'end:pool',
+            'start:a', 'start:b', 'start:pool'])
+        self.assertLess(max(events.index('start:a'), events.index('start:b')),
+            min(events.index('end:a'), events.index('end:b')))
+        self.assertEqual(events.index('end:pool'),
+            events.index('start:pool') + 1)
+
+        shutil.rmtree(workspace)
+
+    def test_task_graph_changed_args(self):
+        workspace = tempfile.mkdtemp()
+        path = lambda name: os.path.join(workspace, name)
+
+        def _build_graph(b_args):
+            graph = utils.TaskGraph()
+            graph.add_task('a', _concatenate, args=(path('a'),),
+                target_files=[path('a')])
+            graph.add_task('b', _concatenate, args=b_args,
+                dependencies=['a'], target_files=[path('b')])
+            graph.add_task('c', _concatenate, args=(path('c'), path('b')),
+                dependencies=['b'], target_files=[path('c')])
+            return graph
+
+        self.assertEqual(_build_graph((path('b'), path('a'))).run(),
+            ['a', 'b', 'c'])
+        self.assertEqual(_build_graph((path('b'), path('a'))).run(), [])
+
+        # The outputs are newer than the inputs, but b's arguments changed,
+        # so b and the tasks that depend on it are rerun.
+        self.assertEqual(_build_graph((path('b'), path('a'), path('a'))).run(),
+            ['b', 'c'])
+        self.assertEqual(open(path('c')).read(), 'aabc')
+        self.assertEqual(_build_graph((path('b'), path('a'), path('a'))).run(),
+            [])
+
+        shutil.rmtree(workspace)
+
+    def test_raster_pipeline(self):
+        import numpy
+        from osgeo import gdal
+        from natcap.opal.tests.test_smoke import square
+
+        workspace = tempfile.mkdtemp()
+        srs = natcap.opal.tests.COLOMBIA_SRS
+        origin_x, origin_y = 444720, 3751320
+
+        # two aligned 4x4 rasters of 10m pixels, the second shifted one pixel
+        # right and one pixel down.
+        ones = numpy.ones((4, 4), dtype=numpy.float32)
+        raster_a = natcap.opal.tests.raster(ones, srs,
+            natcap.opal.tests.COLOMBIA_GEOTRANSFORM(10, -10),
+            -1, filename=os.path.join(workspace, 'a.tif'))
+        raster_b = natcap.opal.tests.raster(ones * 3, srs,
+            natcap.opal.tests.COLOMBIA_GEOTRANSFORM(10, -10,
+                (origin_x + 10, origin_y - 10)),
+            -1, filename=os.path.join(workspace, 'b.tif'))
+
+        # zones covering the top-left 2x2 and bottom-right 2x2 pixels of the
+        # 5x5 union of the two rasters.
+        zones_uri = natcap.opal.tests.vector(
+            [square((origin_x + 10, origin_y - 10), 20),
+             square((origin_x + 40, origin_y - 40), 20)],
+            srs, {'zone': int}, [{'zone': 1}, {'zone': 2}],
+            format='ESRI Shapefile',
+            filename=os.path.join(workspace, 'zones.shp'))
+
+        for mode, expected_shape in [('union', (5, 5)),
+                                     ('intersection', (3, 3))]:
+            out_uri = os.path.join(workspace, 'sum_%s.tif' % mode)
+            pipeline = utils.RasterPipeline(mode)
+            pipeline.add_raster('a', raster_a)
+            pipeline.add_raster('b', raster_b)
+            pipeline.add_operation('sum',
+                lambda a, b: numpy.where((a == -1) | (b == -1), -1, a + b),
+                ['a', 'b'], -1)
+            pipeline.add_operation('double', lambda x: numpy.where(
+                x == -1, -1, x * 2), ['sum'], -1, out_uri=out_uri)
+            pipeline.add_zonal_sum('a_totals', 'a', zones_uri, 'zone')
+            pipeline.add_zonal_sum('double_totals', 'double', zones_uri,
+                'zone')
+            sums = pipeline.run()
+
+            out_raster = gdal.Open(out_uri)
+            out_values = out_raster.GetRasterBand(1).ReadAsArray()
+            out_raster = None
+            self.assertEqual(out_values.shape, expected_shape)
+            self.assertEqual(out_values.max(), 8)
+
+            if mode == 'union':
+                # only the pixels that both rasters cover have a sum.
+                self.assertEqual((out_values == 8).sum(), 9)
+                self.assertEqual(sums['a_totals'], {1: 4.0, 2: 1.0})
+                self.assertEqual(sums['double_totals'], {1: 8.0, 2: 8.0})
+            else:
+                self.assertEqual(sums['a_totals'], {1: 1.0, 2: 1.0})
+                self.assertEqual(sums['double_totals'], {1: 8.0, 2: 8.0})
+
+        # Pixels outside of the AOI are nodata.
+        out_uri = os.path.join(workspace, 'clipped.tif')
+        aoi_uri = natcap.opal.tests.vector(
+            [square((origin_x + 10, origin_y - 10), 20)], srs,
+            format='ESRI Shapefile',
+            filename=os.path.join(workspace, 'aoi.shp'))
+        pipeline = utils.RasterPipeline('intersection', aoi_uri=aoi_uri)
+        pipeline.add_raster('a', raster_a)
+        pipeline.add_operation('clipped', lambda x: x, ['a'], -1,
+            out_uri=out_uri)
+        pipeline.run()
+        out_raster = gdal.Open(out_uri)
+        self.assertEqual(out_raster.GetRasterBand(1).ReadAsArray().tolist(),
+            [[1, 1], [1, 1]])
+        out_raster = None
+
+        shutil.rmtree(workspace)
+
+    def test_profiling_spans(self):
+        # When profiling is disabled, spans are shared no-ops.
+        self.assertEqual(utils.get_profiler(), None)
+        with utils.span('disabled') as stage:
+            self.assertFalse(stage.enabled)
+            stage.count(features=1)
+
+        profiler = utils.enable_profiling()
+        try:
+            with utils.span('outer', hydrozone='a') as stage:
+                stage.count(features=2)
+                with utils.span('inner') as inner_stage:
+                    inner_stage.count(pixels=3)
+                    inner_stage.count(pixels=4)
+            with utils.span('other'):
+                pass
+        finally:
+            self.assertEqual(utils.disable_profiling(), profiler)
+
+        self.assertEqual([s['name'] for s in profiler.spans],
+            ['inner', 'outer', 'other'])
+        inner, outer, other = profiler.spans
+        self.assertEqual(inner['parent'], 'outer')
+        self.assertEqual(inner['tags'], {'hydrozone': 'a'})
+        self.assertEqual(inner['counts'], {'pixels': 7})
+        self.assertEqual(outer['counts'], {'features': 2})
+        self.assertTrue(outer['wall_time'] >= inner['wall_time'])
+        self.assertEqual(other['tags'], {})
+
+        workspace = tempfile.mkdtemp()
+        json_uri = os.path.join(workspace, '_dev', 'profile.json')
+        trace_uri = os.path.join(workspace, '_dev', 'profile_trace.json')
+        profiler.write(json_uri, trace_uri, hydrozone='a')
+        profile = json.load(open(json_uri))
+        self.assertEqual([s['name'] for s in profile['spans']],
+            ['outer', 'inner'])
+        self.assertEqual(profile['stages']['inner']['calls'], 1)
+        trace = json.load(open(trace_uri))
+        self.assertEqual([e['ph'] for e in trace['traceEvents']], ['X', 'X'])
+        shutil.rmtree(workspace)
+
 
 class InitTest(unittest.TestCase):
     def test_local_dir_frozen(self):
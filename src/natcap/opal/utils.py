@@ -10,17 +10,30 @@ import platform
 import hashlib
 import locale
 import threading
+import multiprocessing
+import math
+import glob
+import shutil
+import tempfile
+import cPickle as pickle
+try:
+    import resource
+except ImportError:
+    # The resource module is only available on unix-like systems.
+    resource = None
 
 import natcap.opal
 import natcap.invest
 from natcap.invest.iui import executor as invest_executor
 import shapely
-import shapely.speedups
 import shapely.wkb
 import shapely.prepared
 import shapely.geometry
 import shapely.geos
 from osgeo import ogr
+from osgeo import gdal
+from osgeo import gdal_array
+import numpy
 
 LOGGER = logging.getLogger('natcap.opal.offsets')
 
@@ -43,7 +56,7 @@ class TimedLogFilter(logging.Filter):
         else:
             # Only log a message if more than <interval> seconds have passed
             # since the last record was logged.
-            if current_time - self._last_record_time >= 5.0:
+            if current_time - self._last_record_time >= self.interval:
                 self._last_record_time = current_time
                 return True
             return False
@@ -258,3 +271,1653 @@ def sigfig(number, digits=3):
     return input_type(float(output_num))
 
 
+
+def block_windows(x_size, y_size, block_size):
+    """Iterate over the blocks of a raster (or of a window of a raster).
+
+        x_size - the number of columns to cover.
+        y_size - the number of rows to cover.
+        block_size - a tuple of (block columns, block rows).
+
+    Yields tuples of (x offset, y offset, window columns, window rows) that
+    together cover every pixel exactly once."""
+
+    block_cols, block_rows = block_size
+    for y_offset in xrange(0, y_size, block_rows):
+        win_rows = min(block_rows, y_size - y_offset)
+        for x_offset in xrange(0, x_size, block_cols):
+            win_cols = min(block_cols, x_size - x_offset)
+            yield (x_offset, y_offset, win_cols, win_rows)
+
+def raster_window_for_extent(raster_uri, extent):
+    """Find the window of pixels in a raster that covers a bounding box.
+
+        raster_uri - a URI to a GDAL raster with a north-up geotransform.
+        extent - a tuple of (minx, maxx, miny, maxy), the order returned by
+            ogr.Layer.GetExtent().
+
+    Returns a tuple of (x offset, y offset, columns, rows), clamped to the
+    raster's size.  Returns None if the extent does not overlap the raster."""
+
+    raster = gdal.Open(raster_uri)
+    x_origin, pixel_width, _, y_origin, _, pixel_height = (
+        raster.GetGeoTransform())
+    n_cols = raster.RasterXSize
+    n_rows = raster.RasterYSize
+    raster = None
+
+    minx, maxx, miny, maxy = extent
+    col_min = max(0, int(math.floor((minx - x_origin) / pixel_width)))
+    col_max = min(n_cols, int(math.ceil((maxx - x_origin) / pixel_width)))
+    # pixel_height is negative for north-up rasters.
+    row_min = max(0, int(math.floor((maxy - y_origin) / pixel_height)))
+    row_max = min(n_rows, int(math.ceil((miny - y_origin) / pixel_height)))
+
+    if col_max <= col_min or row_max <= row_min:
+        return None
+    return (col_min, row_min, col_max - col_min, row_max - row_min)
+
+def rasterize_feature_ids(vector_uri, id_field, raster_uri, window, out_uri,
+        nodata=-1, fids=None):
+    """Burn the id_field value of each feature in a vector into a new int32
+    GeoTiff that is aligned with a window of an existing raster.  Where
+    features overlap, a pixel gets the value of the feature burned last, so
+    features that overlap should be burned into separate rasters with fids.
+
+        vector_uri - a URI to an OGR vector.
+        id_field - the name of an integer field in the vector.  If None, a
+            value of 1 is burned for every feature.
+        raster_uri - a URI to the GDAL raster whose grid should be used.
+        window - a tuple of (x offset, y offset, columns, rows) of the window
+            within raster_uri that the new raster should cover, as returned by
+            raster_window_for_extent().
+        out_uri - the URI where the new raster should be written.
+        nodata=-1 - the value of pixels that are not under any feature.
+        fids=None - a list of the feature IDs of the features to burn.  If
+            None, every feature is burned.
+
+    Returns nothing."""
+
+    raster = gdal.Open(raster_uri)
+    x_origin, pixel_width, row_rot, y_origin, col_rot, pixel_height = (
+        raster.GetGeoTransform())
+    projection = raster.GetProjection()
+    raster = None
+
+    x_offset, y_offset, n_cols, n_rows = window
+    driver = gdal.GetDriverByName('GTiff')
+    id_raster = driver.Create(out_uri, n_cols, n_rows, 1, gdal.GDT_Int32,
+        options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    id_raster.SetProjection(projection)
+    id_raster.SetGeoTransform([x_origin + x_offset * pixel_width, pixel_width,
+        row_rot, y_origin + y_offset * pixel_height, col_rot, pixel_height])
+    id_band = id_raster.GetRasterBand(1)
+    id_band.SetNoDataValue(nodata)
+    id_band.Fill(nodata)
+
+    vector = ogr.Open(vector_uri)
+    layer = vector.GetLayer()
+    burn_layer = layer
+    if fids is not None:
+        # copy the selected features to a layer in memory.
+        subset_vector = ogr.GetDriverByName('Memory').CreateDataSource(
+            'subset')
+        burn_layer = subset_vector.CreateLayer('subset',
+            layer.GetSpatialRef(), layer.GetGeomType())
+        if id_field is not None:
+            burn_layer.CreateField(ogr.FieldDefn(id_field, ogr.OFTInteger))
+        for fid in fids:
+            feature = layer.GetFeature(fid)
+            subset_feature = ogr.Feature(burn_layer.GetLayerDefn())
+            subset_feature.SetGeometry(feature.GetGeometryRef())
+            if id_field is not None:
+                subset_feature.SetField(id_field, feature.GetField(id_field))
+            burn_layer.CreateFeature(subset_feature)
+        feature = None
+        subset_feature = None
+
+    if id_field is None:
+        gdal.RasterizeLayer(id_raster, [1], burn_layer, burn_values=[1])
+    else:
+        gdal.RasterizeLayer(id_raster, [1], burn_layer,
+            options=['ATTRIBUTE=%s' % id_field])
+
+    burn_layer = None
+    subset_vector = None
+    layer = None
+    vector = None
+    id_band.FlushCache()
+    id_band = None
+    id_raster = None
+
+# MD5 digests of files, keyed by (absolute path, size, modification time) so
+# that a file is only hashed once per process unless it changes.
+_FILE_DIGESTS = {}
+
+# Extensions of the files that make up an ESRI Shapefile, including the
+# optional attribute, projection, encoding and spatial index files.
+_SHAPEFILE_EXTENSIONS = set(['.shp', '.shx', '.dbf', '.prj', '.cpg', '.qpj',
+    '.sbn', '.sbx', '.qix', '.fbn', '.fbx', '.ain', '.aih', '.atx', '.ixs',
+    '.mxs', '.shp.xml'])
+
+def _vector_files(uri):
+    """Get a sorted list of the files on disk that make up the dataset at uri.
+    For an ESRI Shapefile this includes the .shx, .dbf, .prj and other
+    sidecar files, but not unrelated files that share the base name (such as
+    a backup foo.shp.bak next to foo.shp).  Any other dataset is a single
+    file."""
+    base_uri, extension = os.path.splitext(uri)
+    if extension.lower() != '.shp':
+        return [uri]
+
+    dataset_files = []
+    for candidate in glob.glob(base_uri + '.*'):
+        suffix = candidate[len(base_uri):].lower()
+        if suffix in _SHAPEFILE_EXTENSIONS and os.path.isfile(candidate):
+            dataset_files.append(candidate)
+    return sorted(dataset_files)
+
+def file_digest(uri):
+    """Get an MD5 hex digest of the contents of a file.  If the file is part
+    of a multi-file dataset such as an ESRI Shapefile, all files in the
+    dataset are included in the digest.  Files are read in 1MB chunks.
+
+        uri - a URI to a file on disk.
+
+    Returns a python string hex digest."""
+
+    assert_files_exist([uri])
+    file_md5 = hashlib.md5()
+    for dataset_file in _vector_files(uri):
+        file_stat = os.stat(dataset_file)
+        memo_key = (os.path.abspath(dataset_file), file_stat.st_size,
+            file_stat.st_mtime)
+        try:
+            single_digest = _FILE_DIGESTS[memo_key]
+        except KeyError:
+            single_md5 = hashlib.md5()
+            with open(dataset_file, 'rb') as file_handler:
+                for chunk in iter(lambda: file_handler.read(2**20), ''):
+                    single_md5.update(chunk)
+            single_digest = single_md5.hexdigest()
+            _FILE_DIGESTS[memo_key] = single_digest
+
+        # Include the file extension so that renaming a sidecar file changes
+        # the digest.
+        file_md5.update(os.path.splitext(dataset_file)[1].lower())
+        file_md5.update(single_digest)
+    return file_md5.hexdigest()
+
+def get_digest(values):
+    """Get an MD5 hex digest of a JSON-compatible python object.  Like
+    natcap.opal.static_maps.get_json_md5(), any string that is a path to a
+    file on disk is replaced by the digest of the file's contents, so the
+    digest changes when an input file changes but not when it's moved.
+
+        values - a python object made of dicts, lists, tuples, strings,
+            numbers, booleans and None.
+
+    Returns a python string hex digest."""
+
+    def _replace_files(value):
+        if isinstance(value, dict):
+            return dict((key, _replace_files(item)) for (key, item) in
+                value.iteritems())
+        elif isinstance(value, (list, tuple)):
+            return [_replace_files(item) for item in value]
+        elif isinstance(value, basestring) and os.path.isfile(value):
+            return 'file:%s' % file_digest(value)
+        return value
+
+    canonical_json = json.dumps(_replace_files(values), sort_keys=True)
+    return hashlib.md5(canonical_json).hexdigest()
+
+def copy_dataset(src_uri, dest_uri):
+    """Copy all files of a dataset (e.g. all files of an ESRI Shapefile) to a
+    new location.  Existing files at the destination are overwritten.
+
+        src_uri - a URI to the dataset to copy.
+        dest_uri - the URI to copy the dataset to.  The extension should match
+            the extension of src_uri.
+
+    Returns nothing."""
+
+    src_base = os.path.splitext(src_uri)[0]
+    dest_base = os.path.splitext(dest_uri)[0]
+    for src_file in _vector_files(src_uri):
+        shutil.copyfile(src_file, dest_base + src_file[len(src_base):])
+
+def restore_cache(cache_dir, cache_key, files):
+    """Restore files and data that were saved by store_cache().
+
+        cache_dir - the folder where cached results are stored.
+        cache_key - a string key, usually from get_digest().
+        files - a dictionary mapping names to the URIs where the cached files
+            should be copied.  The names must match those used when the
+            results were stored.
+
+    Returns the python object of data stored with the files, or None if
+    there is no complete cache entry for cache_key."""
+
+    entry_dir = os.path.join(cache_dir, cache_key)
+    data_uri = os.path.join(entry_dir, 'data.pickle')
+    if not os.path.exists(data_uri):
+        return None
+
+    with open(data_uri, 'rb') as data_file:
+        cache_entry = pickle.load(data_file)
+
+    if set(cache_entry['files'].keys()) != set(files.keys()):
+        LOGGER.debug('Cache entry %s has different files, ignoring',
+            cache_key)
+        return None
+
+    LOGGER.debug('Restoring %s cached files from %s', len(files), entry_dir)
+    for name, dest_uri in files.iteritems():
+        copy_dataset(os.path.join(entry_dir, cache_entry['files'][name]),
+            dest_uri)
+    return cache_entry['data']
+
+def store_cache(cache_dir, cache_key, files, data):
+    """Save files and data so they can be restored with restore_cache().
+
+        cache_dir - the folder where cached results are stored.  It is
+            created if it doesn't exist.
+        cache_key - a string key, usually from get_digest().
+        files - a dictionary mapping names to URIs of files (or multi-file
+            datasets) to store.
+        data - a picklable python object to store with the files.
+
+    Returns nothing."""
+
+    entry_dir = os.path.join(cache_dir, cache_key)
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.makedirs(entry_dir)
+
+    cached_files = {}
+    for name, src_uri in files.iteritems():
+        cached_name = '%s%s' % (name, os.path.splitext(src_uri)[1])
+        copy_dataset(src_uri, os.path.join(entry_dir, cached_name))
+        cached_files[name] = cached_name
+
+    # The data file is written last, so an interrupted store will not be
+    # mistaken for a complete cache entry.
+    temp_data_uri = os.path.join(entry_dir, 'data.pickle.tmp')
+    with open(temp_data_uri, 'wb') as data_file:
+        pickle.dump({'files': cached_files, 'data': data}, data_file,
+            pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_data_uri, os.path.join(entry_dir, 'data.pickle'))
+    LOGGER.debug('Stored %s files in cache %s', len(files), entry_dir)
+
+# OGR drivers for vector outputs, by file extension.  Outputs with any other
+# extension are written as ESRI Shapefiles.
+VECTOR_DRIVERS = {
+    '.shp': 'ESRI Shapefile',
+    '.gpkg': 'GPKG',
+}
+
+# File extensions of the formats that may be used for workspace vectors.
+VECTOR_FORMATS = dict((driver_name, extension) for (extension, driver_name)
+    in VECTOR_DRIVERS.iteritems())
+
+# Layer creation options for vector outputs, by driver.  The GeoPackage FID
+# column is renamed so that it does not collide with the 'FID' attribute
+# fields used throughout OPAL (GeoPackage column names are case-insensitive).
+VECTOR_LAYER_OPTIONS = {
+    'GPKG': ['FID=ogc_fid'],
+}
+
+def vector_driver_name(uri):
+    """Get the name of the OGR driver used to write a vector to uri, based
+    on the file extension."""
+    extension = os.path.splitext(uri)[1].lower()
+    return VECTOR_DRIVERS.get(extension, 'ESRI Shapefile')
+
+def vector_field_name(uri, field_name):
+    """Get the name a new field should be created with in the vector at uri.
+    ESRI Shapefile field names are limited in length, so they are truncated
+    to 8 characters.  Other formats use the field name as is."""
+    if vector_driver_name(uri) == 'ESRI Shapefile':
+        return field_name[:8]
+    return field_name
+
+def set_spatial_filter(layer, geometries):
+    """Restrict the features read from an OGR layer to those whose bounding
+    boxes overlap the bounding box of all the geometries.  Drivers with a
+    spatial index (such as GeoPackage's built-in R-tree) use it to skip
+    features outside the bounding box without reading them.
+
+        layer - an ogr.Layer.
+        geometries - a list of shapely geometries.  If empty, no filter is
+            set.
+
+    Returns nothing."""
+    if len(geometries) == 0:
+        return
+
+    all_bounds = [geometry.bounds for geometry in geometries
+        if not geometry.is_empty]
+    if len(all_bounds) == 0:
+        return
+
+    layer.SetSpatialFilterRect(
+        min(b[0] for b in all_bounds), min(b[1] for b in all_bounds),
+        max(b[2] for b in all_bounds), max(b[3] for b in all_bounds))
+
+def remove_vector(uri):
+    """Delete a vector and all of its sidecar files from disk.
+
+        uri - a URI to an OGR vector.
+
+    Returns nothing."""
+    if vector_driver_name(uri) == 'ESRI Shapefile':
+        dataset_files = _vector_files(uri)
+    else:
+        dataset_files = [uri + suffix for suffix in
+            ['', '-wal', '-shm', '-journal']]
+
+    for filename in dataset_files:
+        if os.path.exists(filename):
+            LOGGER.debug('Removing %s', filename)
+            os.remove(filename)
+
+class VectorWriter(object):
+    """Writes features to a new single-layer OGR vector.
+
+    Features are written in transactions of batch_size features when the
+    driver supports them (such as GeoPackage).  Fields may be referred to by
+    the name they were created with, even if the driver truncates or
+    launders field names (as the ESRI Shapefile driver does).
+
+    Example:
+        writer = VectorWriter(out_uri, in_layer.GetSpatialRef())
+        writer.copy_fields(in_layer.GetLayerDefn())
+        for feature in in_layer:
+            writer.add_feature(feature.GetGeometryRef(),
+                source_feature=feature)
+        writer.close()
+    """
+
+    def __init__(self, out_uri, srs, layer_name=None, batch_size=10000):
+        """Create the vector, replacing any existing vector at out_uri.
+
+            out_uri - a URI to where the vector should be written.  The
+                driver is chosen by vector_driver_name().
+            srs - an osr.SpatialReference for the layer, or None.
+            layer_name=None - the name of the layer.  Defaults to the
+                basename of out_uri.
+            batch_size=10000 - the number of features to write per
+                transaction.
+        """
+        if os.path.exists(out_uri):
+            remove_vector(out_uri)
+
+        self.uri = out_uri
+        self.batch_size = batch_size
+        driver_name = vector_driver_name(out_uri)
+        LOGGER.debug('Creating a new %s vector at %s', driver_name, out_uri)
+        out_driver = ogr.GetDriverByName(driver_name)
+        self._vector = out_driver.CreateDataSource(out_uri)
+
+        if layer_name is None:
+            # Cast to str here because the ESRI shapefile expects it.
+            layer_name = str(os.path.basename(os.path.splitext(out_uri)[0]))
+        self._layer = self._vector.CreateLayer(layer_name, srs=srs,
+            options=VECTOR_LAYER_OPTIONS.get(driver_name, []))
+        self._use_transactions = self._layer.TestCapability(
+            ogr.OLCTransactions)
+        self._in_transaction = False
+        self._batch_count = 0
+
+        # map requested field names to output field indices.
+        self._field_indices = {}
+        # map source field indices to output field indices for copy_fields().
+        self._copied_fields = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def create_field(self, field_defn):
+        """Create a field in the output layer.
+
+            field_defn - an ogr.FieldDefn.
+
+        Returns the integer index of the new field."""
+        self._layer.CreateField(field_defn)
+        field_index = self._layer.GetLayerDefn().GetFieldCount() - 1
+        self._field_indices[field_defn.GetName()] = field_index
+        return field_index
+
+    def create_fields(self, field_names, field_types=None):
+        """Create a field for each field name.
+
+            field_names - a list of string field names.
+            field_types=None - a dict mapping field names to OGR field types.
+                Fields not in this dict are created as ogr.OFTReal.
+
+        Returns nothing."""
+        if field_types is None:
+            field_types = {}
+
+        for field_name in field_names:
+            self.create_field(ogr.FieldDefn(field_name,
+                field_types.get(field_name, ogr.OFTReal)))
+
+    def copy_fields(self, layer_defn, field_names=None):
+        """Create fields in the output layer like those of another layer.
+        Values of these fields are copied from a source feature passed to
+        add_feature().
+
+            layer_defn - an ogr.FeatureDefn of the source layer.
+            field_names=None - a list of the names of the fields to copy.  If
+                None, all fields are copied.
+
+        Returns nothing."""
+        if field_names is None:
+            field_names = [layer_defn.GetFieldDefn(index).GetName()
+                for index in xrange(layer_defn.GetFieldCount())]
+
+        for field_name in field_names:
+            source_index = layer_defn.GetFieldIndex(field_name)
+            self._copied_fields[source_index] = self.create_field(
+                layer_defn.GetFieldDefn(source_index))
+
+    def has_field(self, field_name):
+        """Check whether a field was created with the name field_name."""
+        return field_name in self._field_indices
+
+    def field_names(self):
+        """Get the names of the fields of the output layer, as stored by the
+        driver."""
+        return [field_defn.GetName() for field_defn in self._layer.schema]
+
+    def _begin_feature(self):
+        if self._use_transactions and not self._in_transaction:
+            self._layer.StartTransaction()
+            self._in_transaction = True
+
+    def _end_feature(self):
+        self._batch_count += 1
+        if self._in_transaction and self._batch_count >= self.batch_size:
+            self._layer.CommitTransaction()
+            self._in_transaction = False
+            self._batch_count = 0
+
+    def add_feature(self, geometry, values=None, source_feature=None):
+        """Write a feature to the output layer.
+
+            geometry - an ogr.Geometry, a shapely geometry or a WKB string.
+            values=None - a dict mapping field names (as created) or output
+                field indices to field values.  None values are left unset.
+            source_feature=None - an ogr.Feature whose values for the fields
+                created with copy_fields() are copied to the new feature.
+                Values in the values dict take precedence.
+
+        Returns the FID of the new feature."""
+        if hasattr(geometry, 'wkb'):
+            # a shapely geometry
+            geometry = ogr.CreateGeometryFromWkb(geometry.wkb)
+        elif isinstance(geometry, str):
+            geometry = ogr.CreateGeometryFromWkb(geometry)
+
+        self._begin_feature()
+        new_feature = ogr.Feature(self._layer.GetLayerDefn())
+        new_feature.SetGeometry(geometry)
+
+        if source_feature is not None:
+            for source_index, field_index in self._copied_fields.iteritems():
+                value = source_feature.GetField(source_index)
+                if value is not None:
+                    new_feature.SetField(field_index, value)
+
+        if values is not None:
+            for field_key, value in values.iteritems():
+                if value is None:
+                    continue
+                if not isinstance(field_key, int):
+                    field_key = self._field_indices[field_key]
+                new_feature.SetField(field_key, value)
+
+        self._layer.CreateFeature(new_feature)
+        self._end_feature()
+        return new_feature.GetFID()
+
+    def add_features(self, geometries, columns=None):
+        """Write many features to the output layer.
+
+            geometries - a sequence of geometries, as accepted by
+                add_feature().
+            columns=None - a dict mapping field names (as created) to
+                sequences of field values, one per geometry.
+
+        Returns a list of the FIDs of the new features."""
+        if columns is None:
+            columns = {}
+
+        # Look up the field indices once for all features.
+        column_indices = [(self._field_indices[field_name], values) for
+            (field_name, values) in columns.iteritems()]
+        fids = []
+        for feature_index, geometry in enumerate(geometries):
+            fids.append(self.add_feature(geometry, dict(
+                (field_index, values[feature_index]) for
+                (field_index, values) in column_indices)))
+        return fids
+
+    def close(self):
+        """Commit any pending features and close the vector.
+
+        Returns nothing."""
+        if self._vector is None:
+            return
+
+        if self._in_transaction:
+            self._layer.CommitTransaction()
+            self._in_transaction = False
+        self._layer.SyncToDisk()
+        self._layer = None
+        ogr.DataSource.__swig_destroy__(self._vector)
+        self._vector = None
+
+# The default approximate amount of memory (in bytes) that the polygons of a
+# single tile read by TiledVectorReader may use.
+DEFAULT_TILE_MEMORY = 512 * 2**20
+
+# An estimate of the memory used by a shapely polygon relative to the size of
+# its WKB.
+GEOMETRY_MEMORY_FACTOR = 4
+
+class TiledVectorReader(object):
+    """Reads the polygons of a large vector one spatial tile at a time, so
+    that only the polygons of one tile (plus an optional halo around it) are
+    in memory at once.
+
+    The feature IDs and bounding boxes of all features are read once when
+    the reader is created.  The extent of the vector is then split into
+    quadrants until the polygons whose bounding box centers fall in each
+    tile are estimated to fit in memory_limit bytes.  Polygons are then read
+    by FID, so reading a tile only touches the features of that tile.
+    Drivers that can't read features by FID (which excludes ESRI Shapefile
+    and GeoPackage) read each tile with an OGR spatial filter instead.
+
+    Example:
+        reader = TiledVectorReader(parcels_uri)
+        for core, context in reader.iter_tiles(halo=500):
+            # core is a list of (fid, polygon, values) tuples for the
+            # features of this tile.  Every feature is in the core of exactly
+            # one tile.  context has all features whose bounding boxes are
+            # within 500 units of the core features.
+            ...
+        reader.close()
+    """
+
+    def __init__(self, vector_uri, memory_limit=None):
+        """Index the features of the vector.
+
+            vector_uri - a URI to an OGR vector of polygons.
+            memory_limit=None - the approximate number of bytes that the
+                core polygons of a tile may use.  Defaults to
+                DEFAULT_TILE_MEMORY.
+        """
+        if memory_limit is None:
+            memory_limit = DEFAULT_TILE_MEMORY
+
+        self.uri = vector_uri
+        self.memory_limit = memory_limit
+        self._vector = ogr.Open(vector_uri)
+        self._layer = self._vector.GetLayer()
+        self._random_read = self._layer.TestCapability(ogr.OLCRandomRead)
+
+        fids = []
+        envelopes = []
+        sizes = []
+        for feature in self._layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            fids.append(feature.GetFID())
+            envelopes.append(geometry.GetEnvelope())
+            sizes.append(geometry.WkbSize())
+        self._layer.ResetReading()
+
+        self.fids = numpy.array(fids, dtype=numpy.int64)
+        # OGR envelopes are (minx, maxx, miny, maxy).  Store them as
+        # (minx, miny, maxx, maxy) like shapely bounds.
+        envelopes = numpy.array(envelopes, dtype=numpy.float64).reshape(
+            (-1, 4))
+        self.bounds = envelopes[:, [0, 2, 1, 3]]
+        self._memory = (numpy.array(sizes, dtype=numpy.float64) *
+            GEOMETRY_MEMORY_FACTOR)
+
+    def __len__(self):
+        return len(self.fids)
+
+    def memory(self):
+        """Get the approximate number of bytes all of the polygons would use
+        if they were read at once."""
+        return self._memory.sum()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def extent(self):
+        """Get the (minx, miny, maxx, maxy) extent of all the features."""
+        return (self.bounds[:, 0].min(), self.bounds[:, 1].min(),
+            self.bounds[:, 2].max(), self.bounds[:, 3].max())
+
+    def tiles(self):
+        """Split the features into spatial tiles by the center of their
+        bounding boxes.
+
+        Yields arrays of positions (in self.fids and self.bounds) of the
+        features of each tile.  Every feature is in exactly one tile."""
+        if len(self.fids) == 0:
+            return
+
+        centers_x = (self.bounds[:, 0] + self.bounds[:, 2]) / 2.
+        centers_y = (self.bounds[:, 1] + self.bounds[:, 3]) / 2.
+
+        # Tiles are split in half along both axes.  A tile whose features
+        # all have the same center can't be split any further.
+        pending = [numpy.arange(len(self.fids))]
+        while len(pending) > 0:
+            positions = pending.pop()
+            tile_x = centers_x[positions]
+            tile_y = centers_y[positions]
+            if (self._memory[positions].sum() <= self.memory_limit or
+                    len(positions) == 1 or (tile_x.min() == tile_x.max() and
+                    tile_y.min() == tile_y.max())):
+                yield positions
+                continue
+
+            mid_x = (tile_x.min() + tile_x.max()) / 2.
+            mid_y = (tile_y.min() + tile_y.max()) / 2.
+            east = tile_x > mid_x
+            north = tile_y > mid_y
+            for quadrant in [~east & ~north, east & ~north, ~east & north,
+                    east & north][::-1]:
+                if quadrant.any():
+                    pending.append(positions[quadrant])
+
+    def read(self, positions, field_names=None):
+        """Read the polygons of some of the features.
+
+            positions - an array of positions (in self.fids and self.bounds)
+                of the features to read.
+            field_names=None - a list of the names of fields whose values
+                should also be read.
+
+        Returns a list of (fid, polygon, values) tuples sorted by FID, where
+        values is a dict mapping each field name to its value."""
+        if len(positions) == 0:
+            return []
+        if field_names is None:
+            field_names = []
+
+        def _read_feature(feature):
+            return (feature.GetFID(), build_shapely_polygon(feature),
+                dict((field_name, feature.GetField(field_name))
+                    for field_name in field_names))
+
+        # Reading by FID in increasing order only decodes the wanted features
+        # and reads the file front to back.
+        wanted_fids = numpy.unique(self.fids[positions])
+        if self._random_read:
+            return [_read_feature(self._layer.GetFeature(int(fid)))
+                for fid in wanted_fids]
+
+        wanted_fids = set(wanted_fids.tolist())
+        tile_bounds = self.bounds[positions]
+        self._layer.SetSpatialFilterRect(tile_bounds[:, 0].min(),
+            tile_bounds[:, 1].min(), tile_bounds[:, 2].max(),
+            tile_bounds[:, 3].max())
+
+        features = []
+        for feature in self._layer:
+            if feature.GetFID() in wanted_fids:
+                features.append(_read_feature(feature))
+        self._layer.SetSpatialFilter(None)
+
+        return sorted(features, key=lambda feature: feature[0])
+
+    def intersecting(self, bounds):
+        """Locate the features whose bounding boxes intersect a box.
+
+            bounds - a (minx, miny, maxx, maxy) tuple.
+
+        Returns an array of positions (in self.fids and self.bounds), in
+        order of FID."""
+        minx, miny, maxx, maxy = bounds
+        return numpy.nonzero((self.bounds[:, 0] <= maxx) &
+            (self.bounds[:, 2] >= minx) & (self.bounds[:, 1] <= maxy) &
+            (self.bounds[:, 3] >= miny))[0]
+
+    def near(self, positions, distance):
+        """Locate the features whose bounding boxes are within distance of the
+        bounding box of some features.
+
+            positions - an array of positions of features.
+            distance - a number.
+
+        Returns an array of positions."""
+        return self.intersecting((
+            self.bounds[positions, 0].min() - distance,
+            self.bounds[positions, 1].min() - distance,
+            self.bounds[positions, 2].max() + distance,
+            self.bounds[positions, 3].max() + distance))
+
+    def iter_tiles(self, halo=None, field_names=None):
+        """Read the features one tile at a time.
+
+            halo=None - a distance.  If not None, the features whose bounding
+                boxes are within this distance of the tile are also read.
+            field_names=None - a list of field names whose values are read
+                for the core features of each tile.
+
+        Yields (core, context) tuples, where core is a list of
+        (fid, polygon, values) tuples of the tile's features as returned by
+        read(), and context is a list of (fid, polygon, values) tuples of
+        the features near the tile (including the core features), or None
+        if halo is None."""
+        for positions in self.tiles():
+            core = self.read(positions, field_names)
+            if halo is None:
+                context = None
+            else:
+                # The core polygons are already in memory, so only the ring
+                # of features around them is read.
+                halo_positions = numpy.setdiff1d(self.near(positions, halo),
+                    positions)
+                context = sorted(core + self.read(halo_positions),
+                    key=lambda feature: feature[0])
+            yield core, context
+
+    def close(self):
+        """Close the vector.
+
+        Returns nothing."""
+        if self._vector is None:
+            return
+        self._layer = None
+        ogr.DataSource.__swig_destroy__(self._vector)
+        self._vector = None
+
+
+class TaskFailed(Exception):
+    """Raised when a task in a TaskGraph fails."""
+    pass
+
+
+class TaskGraph(object):
+    """Runs tasks that depend on one another's outputs, running independent
+    tasks concurrently in up to n_workers processes.
+
+    Tasks must be added after the tasks they depend on, so the graph is always
+    acyclic.  A task is skipped if all of its target files exist and are
+    newer than its source files and the target files of its dependencies,
+    none of its dependencies were run, and it was last run with the same
+    function, arguments and files.  The last is checked with a digest that is
+    written next to the task's first target file (with a .digest extension)
+    when the task finishes.  Tasks without target files are always run.
+
+    Tasks are run in separate (non-daemonic) processes when n_workers > 1, so
+    they may start worker pools of their own.  A task that does should be
+    added with the size of its pool as its processes, so that the pool counts
+    towards the graph's n_workers.  Return values are discarded; tasks
+    communicate through the files they write.
+
+    Example:
+        graph = TaskGraph(n_workers=2)
+        graph.add_task('base', execute_model, args=(...),
+            target_files=[base_raster])
+        graph.add_task('diff', subtract_rasters, args=(base_raster, ...),
+            dependencies=['base'], target_files=[diff_raster])
+        graph.run()
+    """
+
+    def __init__(self, n_workers=1, poll_interval=0.5):
+        """Create an empty task graph.
+
+            n_workers=1 - the maximum number of processes that running
+                tasks may use at once.  If 1, tasks are run one at a time in
+                this process.
+            poll_interval=0.5 - the number of seconds to wait between checks
+                for finished tasks.
+        """
+        self.n_workers = max(1, int(n_workers))
+        self.poll_interval = poll_interval
+        self._tasks = {}
+        self._task_order = []
+
+    def add_task(self, name, function, args=(), kwargs=None, dependencies=(),
+            target_files=(), source_files=(), processes=1):
+        """Add a task to the graph.
+
+            name - a unique string name for the task.
+            function - the callable to run.  Must be picklable (a
+                module-level function) if n_workers > 1.
+            args=() - a tuple of positional arguments for function.
+            kwargs=None - a dictionary of keyword arguments for function.
+            dependencies=() - the names of tasks that must finish before this
+                one starts.
+            target_files=() - URIs to the files this task writes.
+            source_files=() - URIs to the files this task reads, other than
+                the target files of its dependencies.
+            processes=1 - the number of processes the task keeps busy, such
+                as the size of a worker pool that it starts.  A task with
+                more processes than n_workers only runs on its own.
+
+        Returns the name of the task."""
+        if name in self._tasks:
+            raise ValueError('Task %s has already been added' % name)
+        for dependency in dependencies:
+            if dependency not in self._tasks:
+                raise ValueError('Task %s depends on unknown task %s' % (
+                    name, dependency))
+
+        self._tasks[name] = {
+            'function': function,
+            'args': tuple(args),
+            'kwargs': {} if kwargs is None else kwargs,
+            'dependencies': list(dependencies),
+            'target_files': list(target_files),
+            'source_files': list(source_files),
+            'processes': max(1, int(processes)),
+        }
+        self._task_order.append(name)
+        return name
+
+    def task_digest(self, name):
+        """Get an MD5 hex digest of a task's function, arguments and files.
+        Paths are digested as strings; changes to the files' contents are
+        detected by their modification times.
+
+            name - the name of the task.
+
+        Returns a python string hex digest."""
+        task = self._tasks[name]
+        function = task['function']
+        description = {
+            'function': '%s.%s' % (getattr(function, '__module__', None),
+                getattr(function, '__name__', repr(function))),
+            'args': task['args'],
+            'kwargs': task['kwargs'],
+            'target_files': task['target_files'],
+            'source_files': task['source_files'],
+        }
+        # arguments that json can't represent are digested by their repr.
+        return hashlib.md5(json.dumps(description, sort_keys=True,
+            default=repr)).hexdigest()
+
+    def _digest_uri(self, name):
+        return self._tasks[name]['target_files'][0] + '.digest'
+
+    def _write_digest(self, name):
+        if len(self._tasks[name]['target_files']) == 0:
+            return
+        digest_file = open(self._digest_uri(name), 'w')
+        digest_file.write(self.task_digest(name))
+        digest_file.close()
+
+    def _remove_digest(self, name):
+        # so that a task that fails part way through is never up to date.
+        if len(self._tasks[name]['target_files']) == 0:
+            return
+        try:
+            os.remove(self._digest_uri(name))
+        except OSError:
+            pass
+
+    def is_up_to_date(self, name):
+        """Check whether a task's target files are newer than its inputs and
+        were written with the task's current function, arguments and files.
+
+            name - the name of the task.
+
+        Returns a boolean."""
+        task = self._tasks[name]
+        if len(task['target_files']) == 0:
+            return False
+
+        try:
+            stored_digest = open(self._digest_uri(name)).read().strip()
+        except IOError:
+            # the task has not finished with a digest before.
+            return False
+        if stored_digest != self.task_digest(name):
+            return False
+
+        try:
+            oldest_target = min(os.path.getmtime(uri)
+                for uri in task['target_files'])
+        except OSError:
+            # at least one of the targets doesn't exist.
+            return False
+
+        source_files = list(task['source_files'])
+        for dependency in task['dependencies']:
+            source_files.extend(self._tasks[dependency]['target_files'])
+
+        for uri in source_files:
+            if os.path.exists(uri) and os.path.getmtime(uri) > oldest_target:
+                return False
+        return True
+
+    def run(self):
+        """Run all of the tasks in the graph, waiting for them to finish.
+
+        If n_workers is 1, an exception raised by a task is re-raised here.
+        Otherwise, TaskFailed is raised when a task's process exits with a
+        nonzero exit code, and any other running tasks are terminated.
+
+        Returns a list of the names of the tasks that were run (rather than
+        skipped), in the order they finished."""
+        pending = list(self._task_order)
+        finished = set()
+        run_tasks = []
+        running = {}  # map task name to its process.
+
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                busy_processes = sum(self._tasks[running_name]['processes']
+                    for running_name in running)
+                if busy_processes >= self.n_workers:
+                    break
+
+                task = self._tasks[name]
+                if not all(dependency in finished
+                        for dependency in task['dependencies']):
+                    continue
+                if (len(running) > 0 and
+                        busy_processes + task['processes'] > self.n_workers):
+                    # wait for enough of the running tasks to finish.
+                    continue
+                pending.remove(name)
+
+                if (not any(dependency in run_tasks
+                        for dependency in task['dependencies']) and
+                        self.is_up_to_date(name)):
+                    LOGGER.info('Skipping task %s; its outputs are up to date',
+                        name)
+                    finished.add(name)
+                    continue
+
+                self._remove_digest(name)
+                if self.n_workers == 1:
+                    LOGGER.info('Running task %s', name)
+                    try:
+                        task['function'](*task['args'], **task['kwargs'])
+                    except:
+                        LOGGER.error('Task %s failed', name)
+                        raise
+                    self._write_digest(name)
+                    finished.add(name)
+                    run_tasks.append(name)
+                    continue
+
+                LOGGER.info('Starting task %s', name)
+                process = multiprocessing.Process(target=task['function'],
+                    args=task['args'], kwargs=task['kwargs'], name=name)
+                process.start()
+                running[name] = process
+
+            if len(running) == 0:
+                continue
+
+            time.sleep(self.poll_interval)
+            for name, process in running.items():
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[name]
+                if process.exitcode != 0:
+                    for other_process in running.values():
+                        other_process.terminate()
+                        other_process.join()
+                    raise TaskFailed('Task %s failed with exit code %s' % (
+                        name, process.exitcode))
+                LOGGER.info('Finished task %s', name)
+                self._write_digest(name)
+                finished.add(name)
+                run_tasks.append(name)
+
+        return run_tasks
+
+
+class RasterPipeline(object):
+    """Computes rasters and per-polygon sums from aligned rasters in a single
+    block-by-block sweep, without writing intermediate rasters to disk.
+
+    Every input raster must have the same pixel size, and its pixels must line
+    up with those of the other inputs, as is the case for rasters derived from
+    the same landcover.  Inputs don't need to have the same extent: the
+    pipeline's grid covers the union or intersection of their extents,
+    clipped to the AOI's extent if there is one.  Pixels outside of an input
+    are read as the input's nodata value (or 0 if it has none).
+
+    Operations are applied in the order they were added, and may use the
+    results of earlier operations as inputs.  If there's an AOI, pixels that
+    are not under an AOI polygon are set to each operation's nodata value.
+
+    Example:
+        pipeline = RasterPipeline('intersection', aoi_uri=watershed_uri)
+        pipeline.add_raster('base', base_uri)
+        pipeline.add_raster('converted', converted_uri)
+        pipeline.add_operation('difference', numpy.subtract,
+            ['base', 'converted'], nodata, out_uri=difference_uri)
+        pipeline.add_zonal_sum('total', 'difference', watershed_uri, 'ws_id')
+        totals = pipeline.run()['total']
+    """
+
+    BLOCK_SIZE = (256, 256)
+
+    def __init__(self, bounding_box_mode='intersection', aoi_uri=None):
+        """Create an empty pipeline.
+
+            bounding_box_mode='intersection' - either 'union' or
+                'intersection'.  How the extents of the input rasters are
+                combined to make the pipeline's grid.
+            aoi_uri=None - a URI to an OGR vector of polygons, or None.
+        """
+        if bounding_box_mode not in ['union', 'intersection']:
+            raise ValueError('Unknown bounding box mode: %s' %
+                bounding_box_mode)
+        self.bounding_box_mode = bounding_box_mode
+        self.aoi_uri = aoi_uri
+        self._steps = {}
+        self._rasters = []
+        self._operations = []
+        self._zonal_sums = []
+
+    def _check_name(self, name, inputs=()):
+        if name in self._steps:
+            raise ValueError('%s has already been added' % name)
+        for input_name in inputs:
+            if input_name not in self._steps or (
+                    'zonal_sum' in self._steps[input_name]):
+                raise ValueError('Unknown input %s' % input_name)
+
+    def add_raster(self, name, raster_uri):
+        """Add an input raster.
+
+            name - a unique string name for the raster.
+            raster_uri - a URI to a single-band GDAL raster.
+
+        Returns the name."""
+        self._check_name(name)
+        assert_files_exist([raster_uri])
+        raster = gdal.Open(raster_uri)
+        band = raster.GetRasterBand(1)
+        self._steps[name] = {
+            'uri': raster_uri,
+            'nodata': band.GetNoDataValue(),
+        }
+        band = None
+        raster = None
+        self._rasters.append(name)
+        return name
+
+    def add_operation(self, name, operation, inputs, nodata,
+            datatype=gdal.GDT_Float32, out_uri=None):
+        """Add an operation on blocks of pixels.
+
+            name - a unique string name for the operation's result.
+            operation - a function taking one numpy array per input and
+                returning an array (or a scalar) for the block.
+            inputs - a list of the names of the rasters and operations whose
+                blocks should be passed to operation.
+            nodata - the nodata value of the operation's result.
+            datatype=gdal.GDT_Float32 - the GDAL datatype of the output
+                raster, if there is one.
+            out_uri=None - a URI to where the result should be written as a
+                GeoTiff.  If None, the result is only available to later
+                operations and zonal sums.
+
+        Returns the name."""
+        self._check_name(name, inputs)
+        self._steps[name] = {
+            'operation': operation,
+            'inputs': list(inputs),
+            'nodata': nodata,
+            'datatype': datatype,
+            'out_uri': out_uri,
+        }
+        self._operations.append(name)
+        return name
+
+    def add_zonal_sum(self, name, input_name, vector_uri, id_field):
+        """Sum the valid pixels of a raster or operation under each polygon
+        of a vector.  A pixel is under a polygon if its center is.
+
+            name - a unique string name for the sums in the results of run().
+            input_name - the name of the raster or operation to sum.
+            vector_uri - a URI to an OGR vector of polygons.
+            id_field - the name of an integer field in the vector.
+
+        Returns the name."""
+        self._check_name(name, [input_name])
+        self._steps[name] = {'zonal_sum': True}
+        self._zonal_sums.append((name, input_name, vector_uri, id_field))
+        return name
+
+    def grid(self):
+        """Find the pipeline's grid.
+
+        Raises ValueError if the inputs are not aligned, or if their
+        extents (and the AOI's) don't overlap.
+
+        Returns a tuple of (reference raster URI, window), where window is
+        the (x offset, y offset, columns, rows) of the grid relative to the
+        reference raster, as used by rasterize_feature_ids().  The offsets may
+        be negative."""
+        if len(self._rasters) == 0:
+            raise ValueError('The pipeline has no input rasters')
+
+        reference_uri = self._steps[self._rasters[0]]['uri']
+        reference = gdal.Open(reference_uri)
+        x_origin, pixel_width, _, y_origin, _, pixel_height = (
+            reference.GetGeoTransform())
+        reference = None
+
+        bounds = []
+        for name in self._rasters:
+            step = self._steps[name]
+            raster = gdal.Open(step['uri'])
+            geotransform = raster.GetGeoTransform()
+            n_cols, n_rows = raster.RasterXSize, raster.RasterYSize
+            raster = None
+
+            col = (geotransform[0] - x_origin) / pixel_width
+            row = (geotransform[3] - y_origin) / pixel_height
+            aligned = (
+                abs(geotransform[1] - pixel_width) <=
+                    1e-9 * abs(pixel_width) and
+                abs(geotransform[5] - pixel_height) <=
+                    1e-9 * abs(pixel_height) and
+                geotransform[2] == 0 and geotransform[4] == 0 and
+                abs(col - round(col)) < 1e-6 and
+                abs(row - round(row)) < 1e-6)
+            if not aligned:
+                raise ValueError('%s is not aligned with %s' % (step['uri'],
+                    reference_uri))
+
+            step['offset'] = (int(round(col)), int(round(row)))
+            step['size'] = (n_cols, n_rows)
+            bounds.append((step['offset'][0], step['offset'][1],
+                step['offset'][0] + n_cols, step['offset'][1] + n_rows))
+
+        if self.bounding_box_mode == 'union':
+            col_min, row_min = [min(b[i] for b in bounds) for i in (0, 1)]
+            col_max, row_max = [max(b[i] for b in bounds) for i in (2, 3)]
+        else:
+            col_min, row_min = [max(b[i] for b in bounds) for i in (0, 1)]
+            col_max, row_max = [min(b[i] for b in bounds) for i in (2, 3)]
+
+        if self.aoi_uri is not None:
+            aoi_vector = ogr.Open(self.aoi_uri)
+            aoi_layer = aoi_vector.GetLayer()
+            if aoi_layer.GetFeatureCount() == 0:
+                raise ValueError('%s has no features' % self.aoi_uri)
+            minx, maxx, miny, maxy = aoi_layer.GetExtent()
+            aoi_layer = None
+            aoi_vector = None
+
+            col_min = max(col_min,
+                int(math.floor((minx - x_origin) / pixel_width)))
+            col_max = min(col_max,
+                int(math.ceil((maxx - x_origin) / pixel_width)))
+            # pixel_height is negative for north-up rasters.
+            row_min = max(row_min,
+                int(math.floor((maxy - y_origin) / pixel_height)))
+            row_max = min(row_max,
+                int(math.ceil((miny - y_origin) / pixel_height)))
+
+        if col_max <= col_min or row_max <= row_min:
+            raise ValueError('The pipeline\'s inputs do not overlap')
+        return reference_uri, (col_min, row_min, col_max - col_min,
+            row_max - row_min)
+
+    def _read_block(self, step, grid_col, grid_row, cols, rows):
+        """Read a block of an input raster at a position in the reference
+        raster's pixel coordinates, filling pixels outside of the raster
+        with its nodata value."""
+        col = grid_col - step['offset'][0]
+        row = grid_row - step['offset'][1]
+        n_cols, n_rows = step['size']
+        if col >= 0 and row >= 0 and col + cols <= n_cols and (
+                row + rows <= n_rows):
+            return step['band'].ReadAsArray(col, row, cols, rows)
+
+        block = numpy.empty((rows, cols), dtype=step['dtype'])
+        block.fill(step['nodata'] if step['nodata'] is not None else 0)
+        read_col, read_row = max(col, 0), max(row, 0)
+        read_cols = min(col + cols, n_cols) - read_col
+        read_rows = min(row + rows, n_rows) - read_row
+        if read_cols > 0 and read_rows > 0:
+            block[read_row - row:read_row - row + read_rows,
+                  read_col - col:read_col - col + read_cols] = (
+                step['band'].ReadAsArray(read_col, read_row, read_cols,
+                    read_rows))
+        return block
+
+    def run(self):
+        """Run the pipeline, writing each operation's output raster (if it
+        has one).
+
+        Returns a dictionary mapping the name of each zonal sum to a
+        dictionary mapping id_field values to the sum of the valid pixels
+        under the polygons with that id.  Every id in the vector is included,
+        with a sum of 0.0 if it covers no valid pixels."""
+        reference_uri, window = self.grid()
+        x_offset, y_offset, n_cols, n_rows = window
+
+        reference = gdal.Open(reference_uri)
+        x_origin, pixel_width, _, y_origin, _, pixel_height = (
+            reference.GetGeoTransform())
+        projection = reference.GetProjection()
+        reference = None
+        geotransform = [x_origin + x_offset * pixel_width, pixel_width, 0,
+            y_origin + y_offset * pixel_height, 0, pixel_height]
+
+        open_datasets = []
+        for name in self._rasters:
+            step = self._steps[name]
+            raster = gdal.Open(step['uri'])
+            step['band'] = raster.GetRasterBand(1)
+            step['dtype'] = gdal_array.GDALTypeCodeToNumericTypeCode(
+                step['band'].DataType)
+            open_datasets.append(raster)
+
+        driver = gdal.GetDriverByName('GTiff')
+        out_bands = {}
+        for name in self._operations:
+            step = self._steps[name]
+            if step['out_uri'] is None:
+                continue
+            out_raster = driver.Create(step['out_uri'], n_cols, n_rows, 1,
+                step['datatype'], options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+            out_raster.SetProjection(projection)
+            out_raster.SetGeoTransform(geotransform)
+            out_band = out_raster.GetRasterBand(1)
+            out_band.SetNoDataValue(step['nodata'])
+            out_bands[name] = out_band
+            open_datasets.append(out_raster)
+
+        aoi_band = None
+        zonal_sums = []
+        temp_dir = tempfile.mkdtemp()
+        try:
+            # rasterize the AOI and the zonal sum polygons onto the grid.
+            id_nodata = -1
+            if self.aoi_uri is not None:
+                aoi_uri = os.path.join(temp_dir, 'aoi.tif')
+                rasterize_feature_ids(self.aoi_uri, None, reference_uri,
+                    window, aoi_uri, id_nodata)
+                aoi_raster = gdal.Open(aoi_uri)
+                aoi_band = aoi_raster.GetRasterBand(1)
+                open_datasets.append(aoi_raster)
+
+            for index, (name, input_name, vector_uri, id_field) in (
+                    enumerate(self._zonal_sums)):
+                vector = ogr.Open(vector_uri)
+                layer = vector.GetLayer()
+                id_values = numpy.array(sorted(set(feature.GetField(id_field)
+                    for feature in layer)), dtype=numpy.int64)
+                layer = None
+                vector = None
+
+                ids_uri = os.path.join(temp_dir, 'ids_%s.tif' % index)
+                rasterize_feature_ids(vector_uri, id_field, reference_uri,
+                    window, ids_uri, id_nodata)
+                ids_raster = gdal.Open(ids_uri)
+                open_datasets.append(ids_raster)
+                zonal_sums.append((name, input_name, id_values,
+                    ids_raster.GetRasterBand(1), numpy.zeros(len(id_values))))
+
+            for (block_x, block_y, block_cols, block_rows) in block_windows(
+                    n_cols, n_rows, self.BLOCK_SIZE):
+                blocks = {}
+                for name in self._rasters:
+                    blocks[name] = self._read_block(self._steps[name],
+                        x_offset + block_x, y_offset + block_y, block_cols,
+                        block_rows)
+
+                if aoi_band is not None:
+                    in_aoi = aoi_band.ReadAsArray(block_x, block_y,
+                        block_cols, block_rows) != id_nodata
+
+                for name in self._operations:
+                    step = self._steps[name]
+                    result = numpy.asarray(step['operation'](
+                        *[blocks[input_name] for input_name
+                          in step['inputs']]))
+                    if aoi_band is not None:
+                        result = numpy.where(in_aoi, result, step['nodata'])
+                    elif result.shape != (block_rows, block_cols):
+                        result = numpy.broadcast_to(result,
+                            (block_rows, block_cols))
+                    blocks[name] = result
+
+                    if name in out_bands:
+                        out_bands[name].WriteArray(result, block_x, block_y)
+
+                for _, input_name, id_values, ids_band, totals in zonal_sums:
+                    ids_block = ids_band.ReadAsArray(block_x, block_y,
+                        block_cols, block_rows)
+                    under_polygons = ids_block != id_nodata
+                    if not under_polygons.any():
+                        continue
+
+                    values = blocks[input_name][under_polygons]
+                    positions = numpy.searchsorted(id_values,
+                        ids_block[under_polygons])
+                    nodata = self._steps[input_name]['nodata']
+                    if nodata is not None:
+                        valid_mask = values != nodata
+                        values = values[valid_mask]
+                        positions = positions[valid_mask]
+                    totals += numpy.bincount(positions, weights=values,
+                        minlength=len(id_values))
+
+            results = {}
+            for name, _, id_values, _, totals in zonal_sums:
+                results[name] = dict((int(id_value), float(total))
+                    for (id_value, total) in zip(id_values, totals))
+        finally:
+            for name in self._rasters:
+                self._steps[name].pop('band', None)
+            for out_band in out_bands.values():
+                out_band.FlushCache()
+            out_bands = None
+            zonal_sums = None
+            aoi_band = None
+            open_datasets = None
+            shutil.rmtree(temp_dir)
+
+        return results
+
+
+PROFILE_LOGGER = logging.getLogger('natcap.opal.profile')
+_PROFILER = None
+
+
+class SpanLogFilter(TimedLogFilter):
+    """A TimedLogFilter for the messages logged when a profiling span ends.
+    Top-level spans are always logged, but nested spans are only logged if at
+    least `interval` seconds have passed since the last one was, so that spans
+    inside of loops don't flood the logfile."""
+
+    def filter(self, record):
+        if getattr(record, 'span_depth', 0) == 0:
+            return True
+        return TimedLogFilter.filter(self, record)
+
+
+def _cpu_time():
+    """Return the user and system CPU seconds used by this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _peak_rss():
+    """Return the peak resident set size of this process in megabytes, or
+    None if it can't be determined on this platform."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        # ru_maxrss is in bytes on OS X, kilobytes everywhere else.
+        return round(peak_rss / 2.0**20, 1)
+    return round(peak_rss / 1024.0, 1)
+
+
+class _NullSpan(object):
+    """The span returned by span() when profiling is disabled.  It records
+    nothing."""
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def count(self, **counts):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """A timed section of a profiled run.  Create spans with span()."""
+    enabled = True
+
+    def __init__(self, profiler, name, tags):
+        self.profiler = profiler
+        self.name = name
+        self.tags = tags
+        self.counts = {}
+        self.start = None
+        self.start_cpu = None
+
+    def __enter__(self):
+        self.profiler._begin(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._end(self, failed=exc_info[0] is not None)
+        return False
+
+    def count(self, **counts):
+        """Add to the feature, pixel or other counts of this span."""
+        for key, value in counts.iteritems():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+class Profiler(object):
+    """Record the wall time, CPU time, peak memory use and counts of the
+    nested spans of a run.  Spans are tracked on a single stack, so only
+    spans opened from the main thread of a process are supported.
+
+    Most code should call span() instead of using a Profiler directly so that
+    it costs nothing when profiling is disabled.  See enable_profiling().
+
+        log_interval=1.0 - the minimum number of seconds between the log
+            messages of nested spans.  See SpanLogFilter.
+    """
+
+    def __init__(self, log_interval=1.0):
+        self.spans = []
+        self.log_filter = SpanLogFilter(log_interval)
+        self._stack = []
+
+    def span(self, name, **tags):
+        return Span(self, name, tags)
+
+    def _begin(self, span):
+        # spans inherit the tags (such as the hydrozone) of their parent.
+        if self._stack:
+            tags = dict(self._stack[-1].tags)
+            tags.update(span.tags)
+            span.tags = tags
+        self._stack.append(span)
+        span.start = time.time()
+        span.start_cpu = _cpu_time()
+
+    def _end(self, span, failed=False):
+        wall_time = time.time() - span.start
+        cpu_time = _cpu_time() - span.start_cpu
+        self._stack.pop()
+        record = {
+            'name': span.name,
+            'parent': self._stack[-1].name if self._stack else None,
+            'depth': len(self._stack),
+            'pid': os.getpid(),
+            'start': span.start,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'peak_rss': _peak_rss(),
+            'tags': span.tags,
+            'counts': span.counts,
+            'failed': failed,
+        }
+        self.spans.append(record)
+        PROFILE_LOGGER.debug('%s took %.2fs (%.2fs CPU, peak RSS %s MB) %s',
+            span.name, wall_time, cpu_time, record['peak_rss'], span.counts,
+            extra={'span_depth': record['depth']})
+
+    def select(self, **tags):
+        """Return the recorded spans whose tags match all of the given
+        tags, in the order they started."""
+        spans = [s for s in self.spans if all(s['tags'].get(key) == value
+            for (key, value) in tags.iteritems())]
+        return sorted(spans, key=lambda s: (s['start'], s['depth']))
+
+    def write(self, json_uri, trace_uri=None, **tags):
+        """Write the recorded spans to a JSON file.
+
+            json_uri - a URI to where the spans and per-stage totals should
+                be written.
+            trace_uri=None - if provided, the spans are also written to this
+                URI in the Chrome trace event format, which can be opened
+                with chrome://tracing.
+            **tags - if provided, only spans matching these tags are written.
+
+        Returns nothing."""
+
+        spans = self.select(**tags)
+        stages = {}
+        for span in spans:
+            try:
+                stage = stages[span['name']]
+            except KeyError:
+                stage = stages[span['name']] = {'calls': 0,
+                    'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss': None}
+            stage['calls'] += 1
+            stage['wall_time'] += span['wall_time']
+            stage['cpu_time'] += span['cpu_time']
+            stage['peak_rss'] = max(stage['peak_rss'], span['peak_rss'])
+
+        for uri in [json_uri, trace_uri]:
+            if uri is not None and not os.path.exists(os.path.dirname(
+                    os.path.abspath(uri))):
+                os.makedirs(os.path.dirname(os.path.abspath(uri)))
+
+        with open(json_uri, 'w') as json_file:
+            json.dump({'stages': stages, 'spans': spans}, json_file,
+                indent=4, sort_keys=True)
+
+        if trace_uri is not None:
+            origin = min([s['start'] for s in spans] or [0])
+            events = []
+            for span in spans:
+                event_args = dict(span['tags'])
+                event_args.update(span['counts'])
+                event_args['cpu_time'] = span['cpu_time']
+                event_args['peak_rss'] = span['peak_rss']
+                events.append({
+                    'name': span['name'],
+                    'cat': 'opal',
+                    'ph': 'X',
+                    'ts': (span['start'] - origin) * 1e6,
+                    'dur': span['wall_time'] * 1e6,
+                    'pid': span['pid'],
+                    'tid': span['pid'],
+                    'args': event_args,
+                })
+            with open(trace_uri, 'w') as trace_file:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                    trace_file)
+
+
+def enable_profiling(log_interval=1.0):
+    """Start recording profiling spans in this process, discarding any spans
+    recorded so far.
+
+        log_interval=1.0 - see Profiler.
+
+    Returns the new Profiler."""
+    global _PROFILER
+    disable_profiling()
+    _PROFILER = Profiler(log_interval)
+    PROFILE_LOGGER.addFilter(_PROFILER.log_filter)
+    return _PROFILER
+
+
+def disable_profiling():
+    """Stop recording profiling spans in this process.
+
+    Returns the Profiler that was recording, or None if profiling was not
+    enabled."""
+    global _PROFILER
+    profiler = _PROFILER
+    _PROFILER = None
+    if profiler is not None:
+        PROFILE_LOGGER.removeFilter(profiler.log_filter)
+    return profiler
+
+
+def get_profiler():
+    """Return the active Profiler, or None if profiling is disabled."""
+    return _PROFILER
+
+
+def span(name, **tags):
+    """Time a section of code when profiling is enabled.  When profiling is
+    disabled, a shared span that records nothing is returned, so spans are
+    nearly free to leave in place.
+
+        name - a string name for the section.  Spans with the same name are
+            totalled together in the profile.
+        **tags - values that identify the span, such as the hydrozone.
+            Nested spans inherit the tags of the spans they're in.
+
+    Counts are added to the span with its count() method.  Counts that are
+    expensive to compute should only be computed if the span is enabled:
+
+        with utils.span('aggregate', hydrozone=name) as stage:
+            ...
+            if stage.enabled:
+                stage.count(features=utils.feature_count(vector_uri))
+
+    Returns a context manager."""
+    if _PROFILER is None:
+        return _NULL_SPAN
+    return _PROFILER.span(name, **tags)
+
+
+def add_spans(spans):
+    """Add spans recorded in another process (such as a worker in a
+    multiprocessing.Pool) to the active Profiler.  Does nothing if profiling
+    is disabled.
+
+        spans - a list of spans, as in Profiler.spans.
+
+    Returns nothing."""
+    if _PROFILER is not None:
+        _PROFILER.spans.extend(spans)
+
+
+def feature_count(vector_uri):
+    """Return the number of features in the first layer of an OGR vector."""
+    vector = ogr.Open(vector_uri)
+    layer = vector.GetLayer()
+    count = layer.GetFeatureCount()
+    layer = None
+    vector = None
+    return count
+
+
+def pixel_count(raster_uri):
+    """Return the number of pixels in a GDAL raster."""
+    raster = gdal.Open(raster_uri)
+    count = raster.RasterXSize * raster.RasterYSize
+    raster = None
+    return count